@@ -0,0 +1,280 @@
+from datetime import date, datetime
+from typing import Optional, Union
+from agents.columnar import ColumnarResult, as_columnar
+from agents.downsampling import (
+    OTHER_LABEL, PointBudget, annotate, as_numbers, histogram_trace, point_budget, reduction, select_points, top_n)
+from agents.logger import setup_logger
+from bson import ObjectId
+import json
+import numpy as np
+import os
+
+logger = setup_logger(__name__)
+
+CHART_TYPES = ("bar", "line", "scatter", "pie", "histogram")
+
+# Field names that make a column the x axis of a line chart.
+_TIME_FIELDS = ("year", "month", "day", "date", "decade", "released", "lastupdated")
+
+# Words of the question that ask for a chart type, checked in order.
+_TYPE_KEYWORDS = (
+    ("pie", ("pie", "share", "proportion", "percentage")),
+    ("histogram", ("histogram", "distribution")),
+    ("scatter", ("scatter", "correlat", "versus", " vs ")),
+    ("line", ("line", "trend", "over time", "over the years", "per year", "by year")),
+    ("bar", ("bar", "column chart")),
+)
+
+# The layout of Plotly's 'plotly_dark' template that matters for these charts.
+_DARK_LAYOUT = {
+    "paper_bgcolor": "rgb(17,17,17)",
+    "plot_bgcolor": "rgb(17,17,17)",
+    "font": {"color": "#f2f5fa"},
+    "colorway": ["#636efa", "#EF553B", "#00cc96", "#ab63fa", "#FFA15A",
+                 "#19d3f3", "#FF6692", "#B6E880", "#FF97FF", "#FECB52"],
+}
+_DARK_AXIS = {"gridcolor": "#283442", "linecolor": "#506784", "zerolinecolor": "#283442"}
+
+
+def _column(table, field):
+    # JSON-ready values: missing values become None and list items are joined.
+    array = table.column(field)
+    absent = table.missing(field)
+    if table.is_list(field):
+        values = [None if value is None else ", ".join(str(item) for item in value) for value in array]
+    else:
+        values = array.tolist()
+    if absent.any():
+        for index in np.flatnonzero(absent):
+            values[index] = None
+    return values
+
+
+def _fields(table):
+    return [field for field in table.fields if field != "_id"]
+
+
+def _is_number(table, field):
+    return table.column(field).dtype.kind in "iuf" and not table.missing(field).all()
+
+
+def _is_time(table, field):
+    if field.split(".")[-1].lower() in _TIME_FIELDS:
+        return True
+    return table.column(field).dtype.kind == "M" and not table.missing(field).all()
+
+
+def _count_fields(pipeline):
+    # Output fields holding a per-group count: {"$sum": 1} accumulators and $count stages.
+    fields = set()
+    for stage in pipeline or []:
+        if not isinstance(stage, dict):
+            continue
+        for name, accumulator in (stage.get("$group") or {}).items():
+            if accumulator == {"$sum": 1} or accumulator == {"$count": {}}:
+                fields.add(name)
+        if isinstance(stage.get("$count"), str):
+            fields.add(stage["$count"])
+        if "$sortByCount" in stage:
+            fields.add("count")
+    return fields
+
+
+def _requested_type(question):
+    lowered = f" {question.lower()} "
+    for chart_type, keywords in _TYPE_KEYWORDS:
+        if any(keyword in lowered for keyword in keywords):
+            return chart_type
+    return None
+
+
+def infer_chart_spec(documents: Union[ColumnarResult, list], pipeline: Optional[list] = None,
+                     question: str = "") -> Optional[dict]:
+    """
+    Infers a chart from the shape of an aggregation result.
+
+    A label column with a numeric column becomes a bar chart (a pie chart when the
+    question asks for shares), a year or date column with a numeric column a line
+    chart, two numeric columns a scatter plot and a single numeric column a
+    histogram. Counts produced by the pipeline's `$group` stages are preferred as
+    values, and a chart type named in the question wins when the data fits it.
+
+    Args:
+        documents (ColumnarResult or list): The aggregation result.
+        pipeline (list, optional): The pipeline that produced it.
+        question (str): The user's question.
+
+    Returns:
+        dict: A chart specification for `build_chart`, or None when no template fits.
+    """
+    table = as_columnar(documents)
+    if not len(table):
+        return None
+    columns = _fields(table)
+    numeric = [field for field in columns if _is_number(table, field)]
+    times = [field for field in columns if _is_time(table, field)]
+    labels = [field for field in columns if field not in numeric and field not in times]
+    counts = _count_fields(pipeline)
+    values = sorted((field for field in numeric if field not in times),
+                    key=lambda field: field.split(".")[-1] not in counts)
+    requested = _requested_type(question)
+
+    if times and values:
+        spec = {"type": "line", "x": times[0], "y": values[0]}
+    elif labels and values:
+        spec = {"type": "bar", "x": labels[0], "y": values[0]}
+    elif len(values) >= 2:
+        spec = {"type": "scatter", "x": values[0], "y": values[1]}
+    elif len(values) == 1 and len(columns) == 1:
+        spec = {"type": "histogram", "x": values[0]}
+    else:
+        return None
+
+    if requested == "pie" and spec["type"] in ("bar", "line"):
+        spec["type"] = "pie"
+    elif requested in ("bar", "line", "scatter") and spec["type"] in ("bar", "line", "scatter"):
+        spec["type"] = requested
+    elif requested == "histogram" and values:
+        spec = {"type": "histogram", "x": values[0]}
+    spec["title"] = f"{spec['y']} by {spec['x']}" if spec.get("y") else f"Distribution of {spec['x']}"
+    return spec
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _sort_order(table, field):
+    array = table.column(field)
+    if array.dtype.kind in "iufM" and not table.is_list(field):
+        # NaN and NaT sort last.
+        return np.argsort(array, kind="stable")
+    values = _column(table, field)
+    return np.array(sorted(range(len(values)), key=lambda index: (values[index] is None, str(values[index]))),
+                    dtype=np.int64)
+
+
+def _trace(chart_type, rows, x, y, name):
+    if chart_type == "bar":
+        return {"type": "bar", "x": _column(rows, x), "y": _column(rows, y), "name": name}
+    if chart_type in ("line", "scatter"):
+        if chart_type == "line":
+            rows = rows.take(_sort_order(rows, x))
+        return {"type": "scatter", "x": _column(rows, x), "y": _column(rows, y), "name": name,
+                "mode": "lines+markers" if chart_type == "line" else "markers"}
+    if chart_type == "pie":
+        return {"type": "pie", "labels": _column(rows, x), "values": _column(rows, y), "name": name}
+    return {"type": "histogram", "x": _column(rows, x), "name": name}
+
+
+def _downsampled_trace(chart_type, rows, x, y, name, budget, share, index):
+    # Reduces the rows of a trace to the point budget before their values are
+    # converted for JSON. Returns the trace and its `reduction`, or None.
+    if budget is None:
+        return _trace(chart_type, rows, x, y, name), None
+    length = len(rows)
+    if chart_type == "histogram":
+        binned = histogram_trace(rows.column(x), share) if length > share else None
+        if binned is None:
+            return _trace(chart_type, rows, x, y, name), None
+        return {"type": "histogram", **binned, "name": name}, reduction(index, "histogram", length, len(binned["y"]))
+    if chart_type == "pie" or (chart_type == "bar" and not (_is_number(rows, x) or _is_time(rows, x))):
+        values = as_numbers(rows.column(y)) if length > budget.categories else None
+        if values is None:
+            return _trace(chart_type, rows, x, y, name), None
+        kept, other = top_n(values, budget.categories)
+        trace = _trace(chart_type, rows.take(kept), x, y, name)
+        label_key, value_key = ("labels", "values") if chart_type == "pie" else ("x", "y")
+        if other is not None:
+            trace[label_key].append(OTHER_LABEL)
+            trace[value_key].append(other)
+        return trace, reduction(index, "top_n", length, len(trace[value_key]))
+    method = "grid" if chart_type == "scatter" else "lttb"
+    kept = select_points(rows.column(x), rows.column(y), share, method) if length > share else None
+    if kept is None:
+        return _trace(chart_type, rows, x, y, name), None
+    return _trace(chart_type, rows.take(kept), x, y, name), reduction(index, method, length, len(kept))
+
+
+def build_chart(spec: Optional[dict], documents: Union[ColumnarResult, list],
+                budget: Optional[PointBudget] = None) -> Optional[str]:
+    """
+    Builds Plotly figure JSON from a chart specification, without Plotly and
+    without generating code.
+
+    With a `budget`, traces with more points are reduced before they are built,
+    with the methods of `agents.downsampling`: lines and bars along a numeric or
+    time axis by LTTB, scatter plots by grid sampling, histograms to their bins and
+    bars of labels and pie charts to their largest categories plus 'Other'. How
+    much was reduced is recorded under `layout.meta.downsampling`.
+
+    Args:
+        spec (dict): 'type' (one of `CHART_TYPES`), the 'x' and 'y' fields, and
+            optionally 'color' and 'title'.
+        documents (ColumnarResult or list): The rows to plot.
+        budget (PointBudget, optional): The most points to plot.
+
+    Returns:
+        str: The Plotly figure JSON, or None when the specification does not fit the
+            documents, in which case the caller falls back to another chart source.
+    """
+    if not spec or spec.get("type") not in CHART_TYPES:
+        return None
+    table = as_columnar(documents)
+    if not len(table):
+        return None
+    chart_type, x, y, color = spec["type"], spec.get("x"), spec.get("y"), spec.get("color")
+    fields = [field for field in (x, y, color) if field]
+    if not x or (chart_type != "histogram" and not y) \
+            or any(table.missing(field).all() for field in fields):
+        logger.info(f"Chart specification does not match the result: {spec}")
+        return None
+
+    groups = {}
+    if color:
+        for index, name in enumerate(_column(table, color)):
+            groups.setdefault(name, []).append(index)
+    series = [(None if name is None else str(name), table.take(rows))
+              for name, rows in groups.items()] if color else [(None, table)]
+    share = max(budget.points // len(series), 3) if budget else None
+    traces, reductions = [], []
+    for index, (name, rows) in enumerate(series):
+        trace, reduced = _downsampled_trace(chart_type, rows, x, y, name, budget, share, index)
+        traces.append(trace)
+        if reduced is not None:
+            reductions.append(reduced)
+    layout = {**_DARK_LAYOUT, "title": {"text": spec.get("title") or ""},
+              "showlegend": color is not None or chart_type == "pie"}
+    if chart_type != "pie":
+        layout["xaxis"] = {**_DARK_AXIS, "title": {"text": x}}
+        layout["yaxis"] = {**_DARK_AXIS, "title": {"text": y or "count"}}
+    figure = {"data": traces, "layout": layout}
+    annotate(figure, reductions)
+    return json.dumps(figure, default=_json_default)
+
+
+def chart_from_templates(documents: Union[ColumnarResult, list], pipeline: Optional[list] = None, question: str = "",
+                         spec: Optional[dict] = None) -> Optional[str]:
+    """
+    Builds a chart without an LLM call: from `spec` when it fits the documents,
+    otherwise from the chart `infer_chart_spec` picks.
+
+    Set CHART_TEMPLATES_ENABLED to 'false' to only use `spec`. Charts are reduced
+    to the `point_budget`.
+
+    Returns:
+        str: The Plotly figure JSON, or None when neither fits.
+    """
+    table = as_columnar(documents)
+    budget = point_budget()
+    chart = build_chart(spec, table, budget)
+    if chart is None and os.getenv("CHART_TEMPLATES_ENABLED", "true") == "true":
+        inferred = infer_chart_spec(table, pipeline, question)
+        if inferred is not None:
+            logger.info(f"Chart template: {inferred}")
+            chart = build_chart(inferred, table, budget)
+    return chart
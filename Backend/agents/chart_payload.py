@@ -0,0 +1,262 @@
+from collections import OrderedDict
+from numbers import Real
+from typing import Optional
+from agents.logger import setup_logger
+from agents.metrics import record_downsampling
+import base64
+import gzip
+import hashlib
+import json
+import numpy as np
+import os
+import threading
+
+try:
+    import brotli
+except ImportError:  # Optional; charts are then stored gzip compressed only.
+    brotli = None
+
+logger = setup_logger(__name__)
+
+CHART_FORMATS = ("string", "object", "reference")
+
+# Keys whose arrays Plotly does not read as data arrays, as in Plotly's own encoder.
+_SKIPPED_KEYS = frozenset({"geojson", "layer", "layers", "range"})
+
+# The NumPy types Plotly.js reads from a typed array specification, smallest first.
+_INTEGER_TYPES = (("i1", np.int8), ("u1", np.uint8), ("i2", np.int16), ("u2", np.uint16),
+                  ("i4", np.int32), ("u4", np.uint32))
+
+
+def _is_number(value):
+    return isinstance(value, Real) and not isinstance(value, bool)
+
+
+def _numeric_array(values):
+    # A float or integer array of a list of numbers, None read as NaN, or None when
+    # the list holds anything else. Nested lists of equal length give a 2D array.
+    first = next((value for value in values if value is not None), None)
+    if isinstance(first, list):
+        rows = [_numeric_array(row) for row in values if isinstance(row, list)]
+        if len(rows) != len(values) or any(row is None or row.ndim != 1 for row in rows) \
+                or len({len(row) for row in rows}) != 1:
+            return None
+        return np.stack([row.astype(np.float64) for row in rows]) \
+            if any(row.dtype.kind == "f" for row in rows) else np.stack(rows)
+    if not _is_number(first) or not all(value is None or _is_number(value) for value in values):
+        return None
+    if any(value is None for value in values):
+        return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    try:
+        array = np.array(values)
+    except OverflowError:
+        return None
+    return array if array.dtype.kind in "iuf" else None
+
+
+def typed_array(values: list) -> Optional[dict]:
+    """
+    Encodes a list of numbers as a Plotly.js typed array specification:
+    {'dtype': ..., 'bdata': base64 of the little-endian values[, 'shape': 'rows, columns']}.
+
+    Integers take the smallest integer type that holds them, floats 'f4' when that
+    loses nothing and 'f8' otherwise.
+
+    Returns:
+        dict: The specification, or None when the list holds anything but numbers
+            or integers beyond 32 bits.
+    """
+    array = _numeric_array(values)
+    if array is None or not array.size:
+        return None
+    if array.dtype.kind in "iu":
+        low, high = array.min(), array.max()
+        for dtype, numpy_type in _INTEGER_TYPES:
+            limits = np.iinfo(numpy_type)
+            if limits.min <= low and high <= limits.max:
+                break
+        else:
+            return None
+    else:
+        single = array.astype(np.float32)
+        dtype, numpy_type = ("f4", np.float32) \
+            if np.array_equal(single, array, equal_nan=True) else ("f8", np.float64)
+    data = np.ascontiguousarray(array, dtype=np.dtype(numpy_type).newbyteorder("<"))
+    spec = {"dtype": dtype, "bdata": base64.b64encode(data.tobytes()).decode("ascii")}
+    if array.ndim > 1:
+        spec["shape"] = ", ".join(str(size) for size in array.shape)
+    return spec
+
+
+def _compact(value, min_length):
+    if isinstance(value, dict):
+        return {key: item if key in _SKIPPED_KEYS else _compact(item, min_length)
+                for key, item in value.items()}
+    if not isinstance(value, list):
+        return value
+    if len(value) >= min_length:
+        spec = typed_array(value)
+        # Short decimals such as ratings are shorter as JSON text than as 'f8' bytes.
+        if spec is not None and len(spec["bdata"]) <= len(json.dumps(value, separators=(",", ":"))):
+            return spec
+    return [_compact(item, min_length) for item in value]
+
+
+def compact_figure(figure: dict, min_length: int = 16) -> dict:
+    """
+    Returns a copy of a Plotly figure whose numeric trace arrays of at least
+    `min_length` values are typed arrays (see `typed_array`) where that is not
+    larger than the JSON numbers. The layout is left as it is.
+    """
+    compacted = dict(figure)
+    if isinstance(figure.get("data"), list):
+        compacted["data"] = [_compact(trace, min_length) for trace in figure["data"]]
+    return compacted
+
+
+def _downsampling(figure):
+    # The `layout.meta.downsampling` record `agents.downsampling.annotate` leaves.
+    layout = figure.get("layout")
+    meta = layout.get("meta") if isinstance(layout, dict) else None
+    if not isinstance(meta, dict):
+        return {}
+    return meta.get("downsampling") or {}
+
+
+class ChartStore:
+    """
+    Keeps encoded charts by content hash so they can be served again with an ETag.
+
+    Each chart is stored as its JSON body and gzip compressed, and brotli
+    compressed when the `brotli` package is installed, once, when it is added. The
+    least recently used charts are dropped once the bodies exceed `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def put(self, body: bytes) -> str:
+        """Adds a chart body and returns its content hash."""
+        chart_id = hashlib.sha256(body).hexdigest()
+        with self._lock:
+            if chart_id in self._entries:
+                self._entries.move_to_end(chart_id)
+                return chart_id
+        encodings = {"identity": body, "gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            encodings["br"] = brotli.compress(body, quality=9)
+        size = sum(map(len, encodings.values()))
+        if size > self.max_bytes:
+            return chart_id
+        with self._lock:
+            if chart_id not in self._entries:
+                self._entries[chart_id] = encodings
+                self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= sum(map(len, evicted.values()))
+                self._stats["evictions"] += 1
+        return chart_id
+
+    def get(self, chart_id: str, accept_encoding: str = "") -> Optional[tuple]:
+        """
+        Returns the smallest stored body the client accepts and its content encoding
+        ('br', 'gzip' or 'identity'), or None for an unknown chart.
+        """
+        accepted = {part.split(";")[0].strip() for part in accept_encoding.lower().split(",")}
+        with self._lock:
+            encodings = self._entries.get(chart_id)
+            if encodings is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(chart_id)
+            self._stats["hits"] += 1
+        for encoding in ("br", "gzip"):
+            if encoding in encodings and encoding in accepted:
+                return encodings[encoding], encoding
+        return encodings["identity"], "identity"
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries), "bytes": self._bytes,
+                    "max_bytes": self.max_bytes, "brotli": brotli is not None}
+
+
+class ChartPayloads:
+    """
+    Turns the Plotly figure JSON the chart nodes produce into the chart fields of a
+    response, in one of `CHART_FORMATS`:
+
+    - 'string': the figure JSON as a string under 'chart', as before.
+    - 'object': the figure under 'figure', with numeric arrays as typed arrays
+      (see `compact_figure`), so it is not escaped into a string and parsed twice.
+    - 'reference': only the 'chart_id', for reading the figure from `GET /charts/{chart_id}`.
+
+    Every format carries the 'chart_id', the content hash of the compacted figure,
+    which is stored in `store` for `GET /charts/{chart_id}`.
+    """
+
+    def __init__(self, chart_format: str = "object", min_length: int = 16,
+                 store: Optional[ChartStore] = None):
+        if chart_format not in CHART_FORMATS:
+            raise ValueError(f"Unknown chart payload format: {chart_format}")
+        self.chart_format = chart_format
+        self.min_length = min_length
+        self.store = store or ChartStore()
+        self._lock = threading.Lock()
+        self._stats = {"charts": 0, "downsampled": 0, "string_bytes": 0, "compact_bytes": 0}
+
+    def encode(self, chart: Optional[str]) -> dict:
+        """
+        Returns the 'chart', 'figure' and 'chart_id' fields of a response for the
+        figure JSON of a chart node, or empty fields when there is no chart.
+        """
+        if not chart:
+            return {"chart": chart or '', "figure": None, "chart_id": None}
+        try:
+            figure = compact_figure(json.loads(chart), self.min_length)
+        except ValueError as e:
+            logger.error(f"Error compacting chart: {e}")
+            return {"chart": chart, "figure": None, "chart_id": None}
+        body = json.dumps(figure, separators=(",", ":"), default=str).encode("utf-8")
+        chart_id = self.store.put(body)
+        downsampled = _downsampling(figure)
+        for trace in downsampled.get("traces", []):
+            record_downsampling(trace["method"], trace["points"], trace["kept"])
+        with self._lock:
+            self._stats["charts"] += 1
+            self._stats["downsampled"] += bool(downsampled)
+            self._stats["string_bytes"] += len(json.dumps(chart))
+            self._stats["compact_bytes"] += len(body)
+        return {"chart": chart if self.chart_format == "string" else '',
+                "figure": figure if self.chart_format == "object" else None,
+                "chart_id": chart_id}
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {"format": self.chart_format, **self._stats}
+        stats["store"] = self.store.stats()
+        return stats
+
+
+def create_chart_payloads() -> ChartPayloads:
+    """
+    Builds the chart payload encoder from the environment.
+
+    Environment variables:
+        CHART_PAYLOAD_FORMAT: 'object' (default) for the figure as a JSON object with
+            typed arrays, 'reference' for only its content hash, or 'string' for the
+            figure JSON as a string, for clients that parse it themselves.
+        CHART_TYPED_ARRAY_MIN_LENGTH: Numeric arrays shorter than this stay JSON
+            numbers. Defaults to 16.
+        CHART_STORE_MAX_BYTES: Size of the charts kept for `GET /charts/{chart_id}`.
+            Defaults to 32MB.
+    """
+    return ChartPayloads(
+        chart_format=os.getenv("CHART_PAYLOAD_FORMAT", "object"),
+        min_length=int(os.getenv("CHART_TYPED_ARRAY_MIN_LENGTH", "16")),
+        store=ChartStore(max_bytes=int(os.getenv("CHART_STORE_MAX_BYTES", str(32 * 1024 * 1024)))))
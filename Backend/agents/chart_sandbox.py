@@ -0,0 +1,392 @@
+from typing import Optional
+from agents.columnar import ColumnarResult
+from agents.downsampling import figure_json, point_budget
+from agents.logger import setup_logger
+import _string
+import ast
+import builtins
+import multiprocessing
+import os
+import queue
+import string
+import sys
+import threading
+import time
+import types
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; the workers then run without rlimits.
+    resource = None
+
+logger = setup_logger(__name__)
+
+# Top level packages generated plotting code may import.
+ALLOWED_IMPORTS = frozenset({
+    "plotly", "pandas", "numpy", "math", "statistics", "datetime", "collections",
+    "itertools", "functools", "json", "re", "decimal", "calendar", "bson",
+})
+
+_BLOCKED_BUILTINS = frozenset({
+    "open", "exec", "eval", "compile", "input", "breakpoint", "help", "exit", "quit",
+    "globals", "locals", "vars", "memoryview", "__import__",
+})
+
+# Modules inside the allowed packages that load native code, run processes or do file
+# and network I/O beyond the public plotting API.
+_BLOCKED_MODULES = ("numpy.ctypeslib", "numpy.f2py", "numpy.distutils", "numpy.testing",
+                    "pandas.io", "pandas.testing", "pandas.util")
+
+# Attributes that reach frames, and through them globals and the real builtins.
+_BLOCKED_ATTRIBUTES = frozenset({
+    "gi_frame", "gi_code", "cr_frame", "cr_code", "ag_frame", "ag_code", "tb_frame",
+    "tb_next", "f_back", "f_builtins", "f_globals", "f_locals", "f_code",
+})
+
+_ATTRIBUTE_GUARD = "__sandbox_getattr__"
+
+
+def code_inputs(code, table: ColumnarResult) -> dict:
+    """
+    The variables generated code reads: the documents as `data` and a pandas
+    DataFrame of the flattened fields as `frame`. Each is only built when the code
+    refers to it.
+
+    Args:
+        code: The compiled generated code.
+        table (ColumnarResult): The data to plot.
+    """
+    names = set(code.co_names)
+    for constant in code.co_consts:
+        if hasattr(constant, "co_names"):
+            names.update(constant.co_names)
+    inputs = {}
+    if "data" in names:
+        inputs["data"] = table.to_records()
+    if "frame" in names:
+        inputs["frame"] = table.to_pandas()
+    return inputs
+
+
+def _module_allowed(name):
+    return (name.split(".")[0] in ALLOWED_IMPORTS
+            and not any(name == blocked or name.startswith(blocked + ".")
+                        for blocked in _BLOCKED_MODULES))
+
+
+_BLOCKED_VALUES = tuple(getattr(builtins, name) for name in _BLOCKED_BUILTINS
+                        if hasattr(builtins, name))
+
+
+def _checked_value(value, name):
+    if isinstance(value, types.ModuleType) and not _module_allowed(value.__name__):
+        raise ImportError(f"Access to module '{value.__name__}' through '{name}' "
+                          f"is not allowed in generated code")
+    if any(value is blocked for blocked in _BLOCKED_VALUES):
+        raise AttributeError(f"Access to '{name}' is not allowed in generated code")
+    return value
+
+
+class _SafeFormatter(string.Formatter):
+    # str.format resolves "{0.attr}" fields itself, outside the compiled attribute guard.
+    def get_field(self, field_name, args, kwargs):
+        first, rest = _string.formatter_field_name_split(field_name)
+        value = self.get_value(first, args, kwargs)
+        for is_attribute, key in rest:
+            value = _guarded_getattr(value, key) if is_attribute else value[key]
+        return value, first
+
+
+_formatter = _SafeFormatter()
+
+
+def _guarded_getattr(value, name, *default):
+    if not isinstance(name, str) or name.startswith("_") or name in _BLOCKED_ATTRIBUTES:
+        raise AttributeError(f"Access to attribute '{name}' is not allowed in generated code")
+    if isinstance(value, str) and name == "format":
+        return lambda *args, **kwargs: _formatter.vformat(value, args, kwargs)
+    if isinstance(value, str) and name == "format_map":
+        return lambda mapping: _formatter.vformat(value, (), mapping)
+    return _checked_value(getattr(value, name, *default), name)
+
+
+def _guarded_setattr(value, name, attribute):
+    if not isinstance(name, str) or name.startswith("_"):
+        raise AttributeError(f"Setting attribute '{name}' is not allowed in generated code")
+    setattr(value, name, attribute)
+
+
+def _guarded_delattr(value, name):
+    if not isinstance(name, str) or name.startswith("_"):
+        raise AttributeError(f"Deleting attribute '{name}' is not allowed in generated code")
+    delattr(value, name)
+
+
+class _AttributeGuard(ast.NodeTransformer):
+    """
+    Rejects dunder names and private attributes, and rewrites attribute reads into
+    `_guarded_getattr` calls so a read that yields a disallowed module fails.
+    """
+
+    def visit_Name(self, node):
+        if node.id.startswith("__"):
+            raise SyntaxError(f"Name '{node.id}' is not allowed in generated code")
+        return node
+
+    def visit_Attribute(self, node):
+        if node.attr.startswith("_") or node.attr in _BLOCKED_ATTRIBUTES:
+            raise SyntaxError(f"Attribute '{node.attr}' is not allowed in generated code")
+        self.generic_visit(node)
+        if not isinstance(node.ctx, ast.Load):
+            return node
+        return ast.copy_location(ast.Call(
+            func=ast.Name(id=_ATTRIBUTE_GUARD, ctx=ast.Load()),
+            args=[node.value, ast.Constant(node.attr)], keywords=[]), node)
+
+    def visit_alias(self, node):
+        if any(part.startswith("_") for part in node.name.split(".")):
+            raise SyntaxError(f"Import of '{node.name}' is not allowed in generated code")
+        return node
+
+
+def _restricted_compile(code):
+    tree = _AttributeGuard().visit(ast.parse(code, "<generated>"))
+    return compile(ast.fix_missing_locations(tree), "<generated>", "exec")
+
+
+def _restricted_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level != 0 or not _module_allowed(name):
+        raise ImportError(f"Import of '{name}' is not allowed in generated code")
+    module = builtins.__import__(name, globals, locals, fromlist, level)
+    for attribute in fromlist or ():
+        if attribute != "*":
+            _checked_value(getattr(module, attribute, None), attribute)
+    return module
+
+
+def _restricted_builtins():
+    # Dunder entries such as __loader__ and __spec__ lead back to the import machinery.
+    safe = {name: value for name, value in vars(builtins).items()
+            if name not in _BLOCKED_BUILTINS and not name.startswith("_")}
+    safe["__build_class__"] = builtins.__build_class__
+    safe["__name__"] = "generated"
+    safe["__import__"] = _restricted_import
+    safe["getattr"] = _guarded_getattr
+    safe["setattr"] = _guarded_setattr
+    safe["delattr"] = _guarded_delattr
+    safe[_ATTRIBUTE_GUARD] = _guarded_getattr
+    return safe
+
+
+def _virtual_memory_bytes():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _limit_memory(memory_mb):
+    if resource is None or not os.path.exists("/proc/self/statm"):
+        return
+    # The address space already holds the preloaded libraries; budget on top of it.
+    limit = _virtual_memory_bytes() + memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _limit_cpu(cpu_seconds):
+    if resource is None:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = usage.ru_utime + usage.ru_stime
+    # Exceeding the soft limit raises SIGXCPU, which ends the worker; the pool replaces it.
+    soft = int(used + cpu_seconds) + 1
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, resource.RLIM_INFINITY))
+
+
+def _drop_privileges(user):
+    import pwd
+    entry = pwd.getpwnam(user)
+    os.setgroups([])
+    os.setgid(entry.pw_gid)
+    os.setuid(entry.pw_uid)
+
+
+def _worker_main(connection, memory_mb, cpu_seconds, user=None):
+    # The API's environment holds the OpenAI key and the MongoDB URI; generated code
+    # never needs it.
+    os.environ.clear()
+    # Preload what generated code imports, so a task only pays for running it.
+    import numpy  # noqa: F401
+    import pandas  # noqa: F401
+    import plotly.graph_objects  # noqa: F401
+    import plotly.express  # noqa: F401
+    plotly.graph_objects.Figure(plotly.graph_objects.Bar(x=[0], y=[0])).to_json()
+    for name in ALLOWED_IMPORTS:
+        __import__(name)
+
+    sys.stdin = open(os.devnull)
+    _limit_memory(memory_mb)
+    if user:
+        _drop_privileges(user)
+    safe_builtins = _restricted_builtins()
+    budget = point_budget()
+    while True:
+        try:
+            code, table = connection.recv()
+        except EOFError:
+            return
+        _limit_cpu(cpu_seconds)
+        try:
+            compiled = _restricted_compile(code)
+            context = {"__builtins__": safe_builtins, **code_inputs(compiled, table)}
+            exec(compiled, context, context)
+            figure = context.get("fig")
+            if figure is None:
+                connection.send(("error", "No plot object named 'fig' was generated"))
+            else:
+                connection.send(("chart", figure_json(figure, budget)))
+        except MemoryError:
+            connection.send(("error", "The generated code exceeded the memory limit"))
+        except BaseException as e:
+            connection.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class _Worker:
+    def __init__(self, context, memory_mb, cpu_seconds, user):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_connection, memory_mb, cpu_seconds, user),
+            name="chart-sandbox", daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.tasks = 0
+
+    def stop(self):
+        self.connection.close()
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(timeout=1)
+
+
+class ChartSandbox:
+    """
+    Runs generated plotting code in a pool of pre-started worker processes.
+
+    Each worker preloads NumPy, pandas and Plotly, clears its environment and runs
+    one task at a time under a per-task CPU time limit and a memory limit. A task
+    that exceeds `timeout_seconds` of wall time or kills its worker gets no chart,
+    and the worker is replaced. Workers are also replaced after
+    `max_tasks_per_worker` tasks so leaks cannot accumulate. The data is sent as a
+    `ColumnarResult`, whose numeric arrays pickle as flat buffers.
+
+    The code runs with restricted builtins and imports (`ALLOWED_IMPORTS`). It may
+    not use dunder names or private attributes, and an attribute read or
+    `getattr` that yields a module outside the allowed packages, or a blocked
+    builtin, fails; so `pandas.io.common.os` cannot be reached. This is a
+    language-level restriction, not an OS sandbox: the public APIs of the allowed
+    packages still work, so code can read and write files the worker's user can
+    access (`pandas.read_csv`, `DataFrame.to_csv`, `plotly.io.write_html`) and
+    fetch URLs through them, and `/proc/self/environ` still shows the environment
+    the worker started with. Set `user` to run the workers as an unprivileged
+    account (the API must run as root), which also makes `/proc/self` unreadable
+    to them; network isolation needs the container or host to provide it.
+    """
+
+    def __init__(self, workers: int = 2, timeout_seconds: float = 10, cpu_seconds: int = 5,
+                 memory_mb: int = 1024, max_tasks_per_worker: int = 100,
+                 user: Optional[str] = None):
+        self.timeout_seconds = timeout_seconds
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.user = user
+        self.max_tasks_per_worker = max_tasks_per_worker
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self._context = multiprocessing.get_context(method)
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._stats = {"tasks": 0, "errors": 0, "timeouts": 0, "replaced_workers": 0}
+        for _ in range(workers):
+            self._idle.put(self._start_worker())
+
+    def run(self, code: str, table: ColumnarResult) -> Optional[str]:
+        """
+        Runs generated code that builds a Plotly figure named `fig` from `data`.
+
+        Args:
+            code (str): The generated Python code.
+            table (ColumnarResult): The data, passed to the code as described in `code_inputs`.
+
+        Returns:
+            str: The figure JSON, or None when the code failed, timed out or hit a limit.
+        """
+        deadline = time.monotonic() + self.timeout_seconds
+        try:
+            worker = self._idle.get(timeout=self.timeout_seconds)
+        except queue.Empty:
+            logger.error("No chart sandbox worker became available")
+            self._increment("timeouts")
+            return None
+        healthy = False
+        try:
+            self._increment("tasks")
+            worker.tasks += 1
+            worker.connection.send((code, table))
+            if not worker.connection.poll(max(0.0, deadline - time.monotonic())):
+                logger.error(f"Generated code exceeded {self.timeout_seconds}s and was stopped")
+                self._increment("timeouts")
+                return None
+            kind, value = worker.connection.recv()
+            healthy = True
+            if kind == "error":
+                logger.error(f"Error occurred while executing the generated code: {value}")
+                self._increment("errors")
+                return None
+            return value
+        except (EOFError, OSError) as e:
+            logger.error(f"Chart sandbox worker stopped while running generated code, "
+                         f"likely at the CPU limit: {e!r}")
+            self._increment("errors")
+            return None
+        finally:
+            if healthy and worker.tasks < self.max_tasks_per_worker:
+                self._idle.put(worker)
+            else:
+                worker.stop()
+                self._increment("replaced_workers")
+                self._idle.put(self._start_worker())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def _start_worker(self):
+        return _Worker(self._context, self.memory_mb, self.cpu_seconds, self.user)
+
+    def _increment(self, counter):
+        with self._lock:
+            self._stats[counter] += 1
+
+
+def create_chart_sandbox() -> Optional[ChartSandbox]:
+    """
+    Builds the chart sandbox from the environment, or returns None when it is disabled
+    and generated code runs in the API process.
+
+    Environment variables:
+        CHART_SANDBOX_ENABLED: 'false' runs generated code in process. Defaults to 'true'.
+        CHART_SANDBOX_WORKERS: Worker processes. Defaults to 2.
+        CHART_SANDBOX_TIMEOUT_SECONDS: Wall time per chart. Defaults to 10.
+        CHART_SANDBOX_CPU_SECONDS: CPU time per chart. Defaults to 5.
+        CHART_SANDBOX_MEMORY_MB: Memory a worker may allocate beyond its preloaded
+            libraries. Defaults to 1024.
+        CHART_SANDBOX_USER: Unprivileged user the workers switch to when the API runs
+            as root, e.g. 'nobody'; it must be able to read the Python installation.
+            Unset keeps the API's user.
+    """
+    if os.getenv("CHART_SANDBOX_ENABLED", "true") != "true":
+        return None
+    logger.info("Starting chart sandbox workers")
+    return ChartSandbox(
+        workers=int(os.getenv("CHART_SANDBOX_WORKERS", "2")),
+        timeout_seconds=float(os.getenv("CHART_SANDBOX_TIMEOUT_SECONDS", "10")),
+        cpu_seconds=int(os.getenv("CHART_SANDBOX_CPU_SECONDS", "5")),
+        memory_mb=int(os.getenv("CHART_SANDBOX_MEMORY_MB", "1024")),
+        user=os.getenv("CHART_SANDBOX_USER") or None)
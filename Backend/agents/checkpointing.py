@@ -0,0 +1,275 @@
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Iterator, Optional, Sequence
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import BaseCheckpointSaver, ChannelVersions, Checkpoint, CheckpointMetadata, CheckpointTuple
+from langgraph.checkpoint.memory import InMemorySaver
+from agents.logger import setup_logger
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+
+logger = setup_logger(__name__)
+
+# Per-request payloads that can be large and are never needed by a later turn.
+DEFAULT_EXCLUDED_CHANNELS = ("mongoQueryResult", "chart")
+
+
+class _InMemoryStorage:
+    """Thread bookkeeping and compaction for an `InMemorySaver`."""
+
+    def __init__(self, saver: InMemorySaver):
+        self.saver = saver
+        self._last_seen = OrderedDict()
+
+    def touch(self, thread_id):
+        self._last_seen[thread_id] = time.time()
+        self._last_seen.move_to_end(thread_id)
+
+    def threads_to_evict(self, idle_before, max_threads):
+        expired = [thread_id for thread_id, last_seen in self._last_seen.items()
+                   if last_seen < idle_before]
+        remaining = len(self._last_seen) - len(expired)
+        if max_threads is not None and remaining > max_threads:
+            live = [thread_id for thread_id in self._last_seen if thread_id not in expired]
+            expired.extend(live[:remaining - max_threads])
+        return expired
+
+    def forget(self, thread_id):
+        self._last_seen.pop(thread_id, None)
+
+    def compact(self, thread_id, keep):
+        saver = self.saver
+        for checkpoint_ns, checkpoints in saver.storage.get(thread_id, {}).items():
+            if len(checkpoints) <= keep:
+                continue
+            stale = sorted(checkpoints)[:-keep]
+            for checkpoint_id in stale:
+                del checkpoints[checkpoint_id]
+                saver.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+            # Channel values are stored once per version; drop the versions no
+            # remaining checkpoint refers to.
+            referenced = set()
+            for saved_checkpoint, _, _ in checkpoints.values():
+                channel_versions = saver.serde.loads_typed(saved_checkpoint)["channel_versions"]
+                referenced.update(channel_versions.items())
+            for key in [key for key in saver.blobs
+                        if key[0] == thread_id and key[1] == checkpoint_ns
+                        and (key[2], key[3]) not in referenced]:
+                del saver.blobs[key]
+
+
+class _SqliteStorage:
+    """
+    Thread bookkeeping and compaction for a `SqliteSaver`. Activity is kept in
+    the same database, so every worker sharing the file sees it.
+    """
+
+    def __init__(self, saver):
+        self.saver = saver
+        with saver.cursor() as cursor:
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS thread_activity "
+                "(thread_id TEXT PRIMARY KEY, last_seen REAL NOT NULL)")
+
+    def touch(self, thread_id):
+        with self.saver.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO thread_activity (thread_id, last_seen) VALUES (?, ?) "
+                "ON CONFLICT(thread_id) DO UPDATE SET last_seen = excluded.last_seen",
+                (thread_id, time.time()))
+
+    def threads_to_evict(self, idle_before, max_threads):
+        with self.saver.cursor(transaction=False) as cursor:
+            cursor.execute(
+                "SELECT thread_id FROM thread_activity WHERE last_seen < ?", (idle_before,))
+            return [row[0] for row in cursor.fetchall()]
+
+    def forget(self, thread_id):
+        with self.saver.cursor() as cursor:
+            cursor.execute("DELETE FROM thread_activity WHERE thread_id = ?", (thread_id,))
+
+    def compact(self, thread_id, keep):
+        with self.saver.cursor() as cursor:
+            for table in ("checkpoints", "writes"):
+                cursor.execute(
+                    f"DELETE FROM {table} WHERE thread_id = ? AND checkpoint_id NOT IN "
+                    "(SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? "
+                    "ORDER BY checkpoint_id DESC LIMIT ?)",
+                    (thread_id, thread_id, keep))
+
+
+class CompactingCheckpointSaver(BaseCheckpointSaver):
+    """
+    Wraps a LangGraph checkpointer to keep its storage bounded.
+
+    - Values of `excluded_channels` are left out of checkpoints and pending writes,
+      so large per-request payloads such as query results and charts are never stored.
+    - Only the `keep_checkpoints` most recent checkpoints of a thread are kept.
+    - Threads idle for longer than `ttl_seconds` are deleted, and with `max_threads`
+      set, the least recently active threads beyond that number are deleted too.
+
+    The async methods run the wrapped saver in a worker thread, so synchronous
+    savers such as `SqliteSaver` serve `graph.astream` as well.
+    """
+
+    def __init__(self, saver: BaseCheckpointSaver, storage,
+                 excluded_channels: Sequence[str] = DEFAULT_EXCLUDED_CHANNELS,
+                 ttl_seconds: float = 86400, keep_checkpoints: int = 2,
+                 max_threads: Optional[int] = None, purge_interval_seconds: float = 60):
+        super().__init__(serde=saver.serde)
+        self.saver = saver
+        self.storage = storage
+        self.excluded_channels = frozenset(excluded_channels)
+        self.ttl_seconds = ttl_seconds
+        self.keep_checkpoints = max(1, keep_checkpoints)
+        self.max_threads = max_threads
+        self.purge_interval_seconds = purge_interval_seconds
+        self._lock = threading.RLock()
+        self._last_purge = 0.0
+
+    @property
+    def config_specs(self):
+        return self.saver.config_specs
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        with self._lock:
+            return self.saver.get_tuple(config)
+
+    def list(self, config: Optional[RunnableConfig], *, filter: Optional[dict[str, Any]] = None,
+             before: Optional[RunnableConfig] = None,
+             limit: Optional[int] = None) -> Iterator[CheckpointTuple]:
+        with self._lock:
+            checkpoints = list(self.saver.list(config, filter=filter, before=before, limit=limit))
+        yield from checkpoints
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint,
+            metadata: CheckpointMetadata, new_versions: ChannelVersions) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint = {
+            **checkpoint,
+            "channel_values": {
+                channel: value for channel, value in checkpoint["channel_values"].items()
+                if channel not in self.excluded_channels},
+        }
+        with self._lock:
+            saved_config = self.saver.put(config, checkpoint, metadata, new_versions)
+            self.storage.touch(thread_id)
+            self.storage.compact(thread_id, self.keep_checkpoints)
+            self._purge_if_due()
+        return saved_config
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]],
+                   task_id: str, task_path: str = "") -> None:
+        writes = [(channel, value) for channel, value in writes
+                  if channel not in self.excluded_channels]
+        if not writes:
+            return
+        with self._lock:
+            self.saver.put_writes(config, writes, task_id, task_path)
+
+    def copy_thread(self, source_id: str, target_id: str) -> None:
+        """
+        Starts thread `target_id` with the latest checkpoint of `source_id`, for a
+        request that shares the answer of another session's identical request.
+        """
+        with self._lock:
+            saved = self.saver.get_tuple({"configurable": {"thread_id": source_id}})
+            if saved is None:
+                return
+            config = {"configurable": {"thread_id": target_id, "checkpoint_ns": ""}}
+            self.saver.put(config, saved.checkpoint, saved.metadata,
+                           saved.checkpoint["channel_versions"])
+            self.storage.touch(target_id)
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self._lock:
+            self.saver.delete_thread(thread_id)
+            self.storage.forget(thread_id)
+
+    def purge_expired(self) -> int:
+        """
+        Deletes idle threads and, with `max_threads` set, the least recently active
+        threads beyond that number.
+
+        Returns:
+            int: The number of threads deleted.
+        """
+        with self._lock:
+            threads = self.storage.threads_to_evict(
+                time.time() - self.ttl_seconds, self.max_threads)
+            for thread_id in threads:
+                self.delete_thread(thread_id)
+            self._last_purge = time.monotonic()
+        if threads:
+            logger.info(f"Deleted checkpoints of {len(threads)} expired threads")
+        return len(threads)
+
+    def get_next_version(self, current, channel):
+        return self.saver.get_next_version(current, channel)
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config: Optional[RunnableConfig], *,
+                    filter: Optional[dict[str, Any]] = None,
+                    before: Optional[RunnableConfig] = None,
+                    limit: Optional[int] = None) -> AsyncIterator[CheckpointTuple]:
+        checkpoints = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for checkpoint in checkpoints:
+            yield checkpoint
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint,
+                   metadata: CheckpointMetadata, new_versions: ChannelVersions) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]],
+                          task_id: str, task_path: str = "") -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def acopy_thread(self, source_id: str, target_id: str) -> None:
+        await asyncio.to_thread(self.copy_thread, source_id, target_id)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+    def _purge_if_due(self):
+        if time.monotonic() - self._last_purge >= self.purge_interval_seconds:
+            self.purge_expired()
+
+
+def create_checkpointer() -> CompactingCheckpointSaver:
+    """
+    Builds the graph checkpointer from the environment.
+
+    Environment variables:
+        CHECKPOINTER_BACKEND: 'memory' (default) keeps checkpoints in the process;
+            'sqlite' stores them in a SQLite file that several workers can share.
+        CHECKPOINTER_SQLITE_PATH: Database file of the 'sqlite' backend.
+            Defaults to 'checkpoints.sqlite'.
+        CHECKPOINTER_TTL_SECONDS: Idle time after which a thread is deleted. Defaults to 86400.
+        CHECKPOINTER_KEEP_CHECKPOINTS: Checkpoints kept per thread. Defaults to 2.
+        CHECKPOINTER_MAX_THREADS: Maximum number of threads kept by the 'memory'
+            backend. Defaults to 1000.
+    """
+    backend = os.getenv("CHECKPOINTER_BACKEND", "memory")
+    max_threads = None
+    if backend == "sqlite":
+        from langgraph.checkpoint.sqlite import SqliteSaver
+        path = os.getenv("CHECKPOINTER_SQLITE_PATH", "checkpoints.sqlite")
+        saver = SqliteSaver(sqlite3.connect(path, check_same_thread=False))
+        storage = _SqliteStorage(saver)
+    elif backend == "memory":
+        saver = InMemorySaver()
+        storage = _InMemoryStorage(saver)
+        max_threads = int(os.getenv("CHECKPOINTER_MAX_THREADS", "1000"))
+    else:
+        raise ValueError(f"Unknown checkpointer backend: {backend}")
+    logger.info(f"Using the '{backend}' checkpointer")
+    return CompactingCheckpointSaver(
+        saver, storage,
+        ttl_seconds=float(os.getenv("CHECKPOINTER_TTL_SECONDS", "86400")),
+        keep_checkpoints=int(os.getenv("CHECKPOINTER_KEEP_CHECKPOINTS", "2")),
+        max_threads=max_threads)
@@ -0,0 +1,85 @@
+from typing import Callable, Generic, TypeVar
+from agents.logger import setup_logger
+import os
+import threading
+
+logger = setup_logger(__name__)
+
+T = TypeVar("T")
+
+
+class LazySingleton(Generic[T]):
+    """
+    Creates a shared object on first use instead of at import time.
+
+    Calling the instance returns the object, building it with `factory` the first
+    time. Creation is guarded by a lock, so concurrent first calls build it once.
+    `override` replaces the object, which lets benchmarks and tests swap in stubs
+    before anything is built.
+    """
+
+    def __init__(self, factory: Callable[[], T]):
+        self._factory = factory
+        self._value = None
+        self._created = False
+        self._lock = threading.Lock()
+
+    def __call__(self) -> T:
+        if not self._created:
+            with self._lock:
+                if not self._created:
+                    self._value = self._factory()
+                    self._created = True
+        return self._value
+
+    @property
+    def created(self) -> bool:
+        return self._created
+
+    def override(self, value: T):
+        with self._lock:
+            self._value = value
+            self._created = True
+
+
+def _create_llm_manager():
+    from llmManager import LLMManager
+    return LLMManager()
+
+
+def _create_mongo_client():
+    from pymongo import MongoClient
+    logger.info("Creating MongoDB client")
+    return MongoClient(os.getenv('MONGODB_CONNECTION_STRING'))
+
+
+def _create_async_mongo_client():
+    from pymongo import AsyncMongoClient
+    logger.info("Creating async MongoDB client")
+    return AsyncMongoClient(os.getenv('MONGODB_CONNECTION_STRING'))
+
+
+llm_manager = LazySingleton(_create_llm_manager)
+mongo_client = LazySingleton(_create_mongo_client)
+async_mongo_client = LazySingleton(_create_async_mongo_client)
+
+
+def get_llm_manager():
+    """
+    Returns the `LLMManager` shared by every module.
+    """
+    return llm_manager()
+
+
+def get_database():
+    """
+    Returns the configured MongoDB database of the shared client.
+    """
+    return mongo_client()[os.getenv('MONGODB_DATABASE_NAME')]
+
+
+def get_async_database():
+    """
+    Returns the configured MongoDB database of the shared async client.
+    """
+    return async_mongo_client()[os.getenv('MONGODB_DATABASE_NAME')]
@@ -0,0 +1,123 @@
+from typing import Awaitable, Callable, Hashable, Optional, Tuple
+from agents.logger import setup_logger
+import asyncio
+import os
+import threading
+
+logger = setup_logger(__name__)
+
+
+def normalize_question(question: str) -> str:
+    """Lower-cases a question and drops the whitespace and punctuation that do not change it."""
+    return " ".join(question.lower().split()).rstrip("?.! ")
+
+
+def _retrieve_exception(task: asyncio.Task):
+    # A shared execution whose callers all went away must not log "exception was never retrieved".
+    if not task.cancelled():
+        task.exception()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Lets concurrent callers with the same key share one execution.
+
+    The first caller of a key runs the work; callers arriving while it is in
+    flight wait for it and receive the same value, or the same exception. Nothing
+    is kept once the execution completes, so this only removes duplicate work
+    during bursts; the caches handle repeats over time.
+
+    The shared value is the same object for every caller. Callers that modify it
+    must copy it first.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._tasks = {}
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._stats = {"executions": 0, "coalesced": 0}
+
+    async def arun(self, key: Hashable, factory: Callable[[], Awaitable]) -> Tuple[object, bool]:
+        """
+        Awaits the execution in flight for `key`, starting it with `factory` if there is none.
+
+        The execution runs in its own task, in the context of the caller that started
+        it, so one caller being cancelled does not cancel it for the others.
+
+        Returns:
+            tuple: The value and whether it was shared from another caller's execution.
+        """
+        loop = asyncio.get_running_loop()
+        flight_key = (id(loop), key)
+        task = self._tasks.get(flight_key)
+        shared = task is not None
+        if shared:
+            self._count("coalesced")
+            logger.info(f"Joining the in-flight {self.name} execution")
+        else:
+            task = loop.create_task(factory())
+            task.add_done_callback(_retrieve_exception)
+            task.add_done_callback(lambda _: self._tasks.pop(flight_key, None))
+            self._tasks[flight_key] = task
+            self._count("executions")
+        return await asyncio.shield(task), shared
+
+    def run(self, key: Hashable, function: Callable[[], object]) -> Tuple[object, bool]:
+        """
+        Sync variant of `arun` for callers on different threads.
+
+        Returns:
+            tuple: The value and whether it was shared from another caller's execution.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            shared = call is not None
+            if shared:
+                self._stats["coalesced"] += 1
+            else:
+                call = self._calls[key] = _Call()
+                self._stats["executions"] += 1
+        if shared:
+            logger.info(f"Joining the in-flight {self.name} execution")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+        try:
+            call.value = function()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value, False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, in_flight=len(self._tasks) + len(self._calls))
+
+    def _count(self, counter):
+        with self._lock:
+            self._stats[counter] += 1
+
+
+def create_single_flight(name: str) -> Optional[SingleFlight]:
+    """
+    Builds a `SingleFlight` from the environment, or returns None when coalescing is disabled.
+
+    Environment variables:
+        SINGLE_FLIGHT_ENABLED: 'false' runs every request on its own. Defaults to 'true'.
+    """
+    if os.getenv("SINGLE_FLIGHT_ENABLED", "true") != "true":
+        return None
+    return SingleFlight(name)
@@ -0,0 +1,229 @@
+from datetime import date, datetime, timezone
+from typing import Iterable, Optional, Union
+from bson import ObjectId
+import numpy as np
+
+_MISSING = object()
+_SCALARS = (str, int, float, bool, datetime, date, ObjectId)
+
+
+def _flatten_into(raw, document, row, prefix=""):
+    # Appends the document's values to their columns, padding columns first seen late.
+    for key, value in document.items():
+        name = prefix + key
+        if value.__class__ is dict and value:
+            _flatten_into(raw, value, row, name + ".")
+            continue
+        values = raw.get(name)
+        if values is None:
+            values = raw[name] = []
+        if len(values) != row:
+            values.extend([_MISSING] * (row - len(values)))
+        values.append(value)
+
+
+def _is_scalar_lists(values):
+    if not all(value.__class__ in (list, tuple) for value in values):
+        return False
+    kinds = {item.__class__ for value in values for item in value}
+    return all(kind is type(None) or issubclass(kind, _SCALARS) for kind in kinds)
+
+
+def _to_utc_naive(value):
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _object_array(values, missing):
+    array = np.empty(len(values), dtype=object)
+    for index, value in enumerate(values):
+        array[index] = value
+    array[missing] = None
+    return array
+
+
+def _scalar_array(values, missing):
+    present = [value for value, absent in zip(values, missing) if not absent]
+    kinds = {type(value) for value in present}
+    has_missing = bool(missing.any())
+    try:
+        if kinds == {bool}:
+            if not has_missing:
+                return np.array(values, dtype=bool)
+        elif kinds and kinds <= {int, float}:
+            if kinds == {int} and not has_missing:
+                return np.array(values, dtype=np.int64)
+            return np.array([np.nan if absent else value for value, absent in zip(values, missing)],
+                            dtype=np.float64)
+        elif kinds and kinds <= {datetime}:
+            return np.array([None if absent else _to_utc_naive(value)
+                             for value, absent in zip(values, missing)], dtype="datetime64[ms]")
+        elif kinds == {ObjectId}:
+            return _object_array([str(value) for value in values], missing)
+    except OverflowError:
+        pass
+    return _object_array(values, missing)
+
+
+class ColumnarResult:
+    """
+    An aggregation result stored as one NumPy array per flattened field.
+
+    Nested documents are flattened to dotted names (`imdb.rating`). Numbers become
+    int64 or float64 arrays (float64 with NaN where a document lacks the field), dates
+    datetime64 arrays and `ObjectId`s strings. Arrays of scalars such as `genres`
+    are stored like Arrow list columns: the concatenated items plus the offset where
+    each row's items start, so per-item work (counting genres) is vectorized too.
+    Everything else is kept in object arrays.
+
+    The charting code reads the arrays directly. `to_records` rebuilds documents
+    for code that expects them, and `to_pandas` builds a DataFrame over the arrays.
+    """
+
+    def __init__(self, length: int, columns: dict, lists: Optional[dict] = None,
+                 missing: Optional[dict] = None, integers: Optional[set] = None):
+        self._length = length
+        self.columns = columns
+        self.lists = lists or {}
+        self._missing = missing or {}
+        # Integer fields some documents lack, stored as float64 so they can hold NaN.
+        self._integers = integers or set()
+        self._fields = list(columns) + [name for name in self.lists if name not in columns]
+
+    @classmethod
+    def from_documents(cls, documents: Iterable[dict]) -> "ColumnarResult":
+        """
+        Builds the columns in one pass over `documents`, which may be a cursor.
+        """
+        raw = {}
+        rows = 0
+        for document in documents:
+            _flatten_into(raw, document, rows)
+            rows += 1
+        for values in raw.values():
+            values.extend([_MISSING] * (rows - len(values)))
+
+        columns, lists, missing, integers = {}, {}, {}, set()
+        for name, values in raw.items():
+            absent = np.array([value is _MISSING or value is None for value in values], dtype=bool)
+            if absent.any():
+                missing[name] = absent
+            present = [value for value, skip in zip(values, absent) if not skip]
+            if present and _is_scalar_lists(present):
+                lengths = np.fromiter((0 if skip else len(value) for value, skip in zip(values, absent)),
+                                      dtype=np.int64, count=rows)
+                offsets = np.zeros(rows + 1, dtype=np.int64)
+                np.cumsum(lengths, out=offsets[1:])
+                items = [item for value in present for item in value]
+                lists[name] = (offsets, _scalar_array(items, np.array([item is None for item in items],
+                                                                      dtype=bool)))
+            else:
+                columns[name] = _scalar_array(values, absent)
+                if columns[name].dtype.kind == "f" and all(type(value) is int for value in present):
+                    integers.add(name)
+        return cls(rows, columns, lists, missing, integers)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __repr__(self) -> str:
+        return f"ColumnarResult({self._length} rows, fields={self._fields})"
+
+    @property
+    def fields(self) -> list:
+        """The flattened field names, in the order they first appear."""
+        return list(self._fields)
+
+    @property
+    def nbytes(self) -> int:
+        """The size of the numeric arrays; object arrays count their pointers only."""
+        arrays = list(self.columns.values()) + [array for pair in self.lists.values() for array in pair]
+        return sum(array.nbytes for array in arrays)
+
+    def is_list(self, name: str) -> bool:
+        return name in self.lists
+
+    def missing(self, name: str) -> np.ndarray:
+        """A boolean array marking the rows without a value for `name`."""
+        if name not in self.columns and name not in self.lists:
+            return np.ones(self._length, dtype=bool)
+        return self._missing.get(name, np.zeros(self._length, dtype=bool))
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        The array of a field. List fields are returned as an object array of lists.
+        """
+        if name in self.columns:
+            return self.columns[name]
+        if name in self.lists:
+            offsets, items = self.lists[name]
+            array = np.empty(self._length, dtype=object)
+            absent = self.missing(name)
+            for index in range(self._length):
+                array[index] = None if absent[index] else items[offsets[index]:offsets[index + 1]].tolist()
+            return array
+        return np.full(self._length, None, dtype=object)
+
+    def explode(self, name: str) -> tuple:
+        """
+        The items of a list field with the row each belongs to.
+
+        Returns:
+            tuple: An array of row indexes and the array of items, of equal length.
+        """
+        offsets, items = self.lists[name]
+        rows = np.repeat(np.arange(self._length), np.diff(offsets))
+        return rows, items
+
+    def take(self, indexes) -> "ColumnarResult":
+        """The rows at `indexes`, as a new result."""
+        indexes = np.asarray(indexes, dtype=np.int64)
+        columns = {name: array[indexes] for name, array in self.columns.items()}
+        lists = {}
+        for name, (offsets, items) in self.lists.items():
+            starts, ends = offsets[indexes], offsets[indexes + 1]
+            lengths = ends - starts
+            new_offsets = np.zeros(len(indexes) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=new_offsets[1:])
+            positions = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+            lists[name] = (new_offsets, items[positions])
+        missing = {name: absent[indexes] for name, absent in self._missing.items()}
+        return ColumnarResult(len(indexes), columns, lists, missing, self._integers)
+
+    def record(self, index: int) -> dict:
+        """Rebuilds the document at `index`, with nested fields and Python values."""
+        document = {}
+        for name in self._fields:
+            if self.missing(name)[index]:
+                continue
+            if name in self.lists:
+                offsets, items = self.lists[name]
+                value = items[offsets[index]:offsets[index + 1]].tolist()
+            else:
+                value = self.columns[name][index]
+                value = value.item() if isinstance(value, np.generic) else value
+                if name in self._integers:
+                    value = int(value)
+            target = document
+            *parents, leaf = name.split(".")
+            for parent in parents:
+                target = target.setdefault(parent, {})
+            target[leaf] = value
+        return document
+
+    def to_records(self) -> list:
+        """Rebuilds all documents; see `record`."""
+        return [self.record(index) for index in range(self._length)]
+
+    def to_pandas(self):
+        """A pandas DataFrame with one column per flattened field."""
+        import pandas as pd
+        return pd.DataFrame({name: self.column(name) for name in self._fields})
+
+
+def as_columnar(documents: Union[ColumnarResult, Iterable[dict], None]) -> ColumnarResult:
+    """Returns `documents` as a `ColumnarResult`, converting documents if needed."""
+    if isinstance(documents, ColumnarResult):
+        return documents
+    return ColumnarResult.from_documents(documents or [])
@@ -0,0 +1,368 @@
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+from agents.logger import setup_logger
+import base64
+import math
+import numpy as np
+import os
+
+logger = setup_logger(__name__)
+
+OTHER_LABEL = "Other"
+
+# Per-point attributes of a trace, reduced with its x and y.
+_POINT_KEYS = ("text", "hovertext", "customdata", "ids", "width")
+_MARKER_POINT_KEYS = ("color", "size", "symbol", "opacity")
+
+
+@dataclass(frozen=True)
+class PointBudget:
+    """
+    The most points a chart sends: `points` x/y points over all its traces, and
+    `categories` bars or pie slices per trace, the last one being 'Other'.
+    """
+    points: int = 2000
+    categories: int = 30
+
+
+def as_numbers(values) -> Optional[np.ndarray]:
+    """
+    Reads an array or list of numbers, dates or ISO date strings as float64, with
+    NaN for missing values and dates as milliseconds since the epoch.
+
+    Returns:
+        np.ndarray: The numbers, or None when the values are labels.
+    """
+    array = np.asarray(values)
+    if array.dtype.kind in "iuf":
+        return array.astype(np.float64)
+    if array.dtype.kind == "M":
+        numbers = array.astype("datetime64[ms]").astype(np.int64).astype(np.float64)
+        numbers[np.isnat(array)] = np.nan
+        return numbers
+    if array.dtype.kind not in "OU" or not len(array):
+        return None
+    present = [value for value in array.tolist() if value is not None]
+    if present and all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in present):
+        return np.array([np.nan if value is None else value for value in array.tolist()], dtype=np.float64)
+    if present and all(isinstance(value, str) for value in present):
+        try:
+            return as_numbers(np.array([None if value is None else value for value in array.tolist()],
+                                       dtype="datetime64[ms]"))
+        except ValueError:
+            return None
+    return None
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets: the indexes of `threshold` points of a series
+    sorted by `x` that keep its visual shape. The first and last points are kept;
+    the others are split into equal buckets and each bucket keeps the point that
+    forms the largest triangle with the point kept before it and the average of
+    the next bucket. Points with a missing `x` or `y` must be left out beforehand.
+    """
+    length = len(x)
+    if threshold >= length or threshold < 3:
+        return np.arange(length)
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    buckets = threshold - 2
+    edges = np.linspace(1, length - 1, buckets + 1).astype(np.int64)
+    counts = np.diff(edges)
+    # The average of each bucket, and for each point the average of the bucket after its own.
+    averages_x = np.add.reduceat(x[:length - 1], edges[:-1]) / counts
+    averages_y = np.add.reduceat(y[:length - 1], edges[:-1]) / counts
+    next_x = np.repeat(np.append(averages_x[1:], x[-1]), counts)
+    next_y = np.repeat(np.append(averages_y[1:], y[-1]), counts)
+    # Twice the triangle area with the kept point (ax, ay) is |ax * p + ay * q + r|.
+    middle_x, middle_y = x[1:length - 1], y[1:length - 1]
+    p, q, r = middle_y - next_y, next_x - middle_x, middle_x * next_y - next_x * middle_y
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, length - 1
+    anchor_x, anchor_y = x[0], y[0]
+    for bucket in range(buckets):
+        start, end = edges[bucket] - 1, edges[bucket + 1] - 1
+        areas = np.abs(anchor_x * p[start:end] + anchor_y * q[start:end] + r[start:end])
+        chosen = start + 1 + int(areas.argmax())
+        kept[bucket + 1] = chosen
+        anchor_x, anchor_y = x[chosen], y[chosen]
+    return kept
+
+
+def grid_sample(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    The indexes of at most `threshold` points of a scatter plot, one per occupied
+    cell of a grid over the plot, in their original order. The grid starts at
+    sqrt(threshold) cells a side and is refined while that keeps half the budget
+    unused, so sparse regions and outliers keep their points. Points with a missing
+    `x` or `y` must be left out beforehand.
+    """
+    length = len(x)
+    if threshold >= length:
+        return np.arange(length)
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+
+    def occupied(cells):
+        columns = _cell(x, cells)
+        rows = _cell(y, cells)
+        _, first = np.unique(columns * cells + rows, return_index=True)
+        return np.sort(first)
+
+    cells = max(1, math.isqrt(threshold))
+    kept = occupied(cells)
+    while len(kept) < threshold // 2 and cells < length:
+        finer = occupied(cells * 2)
+        if len(finer) > threshold:
+            break
+        kept, cells = finer, cells * 2
+    return kept
+
+
+def _cell(values, cells):
+    low, high = values.min(), values.max()
+    if high <= low:
+        return np.zeros(len(values), dtype=np.int64)
+    return np.minimum(((values - low) / (high - low) * cells).astype(np.int64), cells - 1)
+
+
+def histogram_bins(values: np.ndarray, max_bins: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Bins values as NumPy's 'auto' rule does, with at most `max_bins` bins.
+
+    Returns:
+        tuple: The bin edges and the count of each bin.
+    """
+    values = values[np.isfinite(values)]
+    edges = np.histogram_bin_edges(values, bins="auto")
+    if len(edges) - 1 > max_bins:
+        edges = np.histogram_bin_edges(values, bins=max_bins)
+    counts, _ = np.histogram(values, bins=edges)
+    return edges, counts
+
+
+def top_n(values: np.ndarray, n: int) -> Tuple[np.ndarray, Optional[float]]:
+    """
+    Keeps the `n` - 1 largest of the values of a bar chart or pie chart, in their
+    original order, and totals the rest for an 'Other' bar or slice.
+
+    The total is only meaningful when the values add up, counts or sums, so it is
+    given for non-negative integers only; averages and ratios just lose the rest.
+
+    Returns:
+        tuple: The indexes kept and the total of the rest, or None.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) <= n:
+        return np.arange(len(values)), None
+    order = np.argsort(np.where(np.isnan(values), -np.inf, -values), kind="stable")
+    kept, rest = np.sort(order[:n - 1]), order[n - 1:]
+    finite = values[np.isfinite(values)]
+    additive = len(finite) and (finite >= 0).all() and (finite == np.round(finite)).all()
+    return kept, int(np.nansum(values[rest])) if additive else None
+
+
+def select_points(x, y, threshold: int, method: str) -> Optional[np.ndarray]:
+    """
+    The indexes of at most `threshold` points of a trace, by `lttb` ('lttb') or
+    `grid_sample` ('grid'). Points without a number in `x` or `y` are dropped; an `x`
+    of labels, or None, is read as the point positions.
+
+    Returns:
+        np.ndarray: The indexes kept, in `x` order for 'lttb' and in their original
+            order for 'grid', or None when `y` is not numeric.
+    """
+    numbers_y = as_numbers(y) if y is not None else None
+    if numbers_y is None:
+        return None
+    numbers_x = as_numbers(x) if x is not None else None
+    if numbers_x is None or len(numbers_x) != len(numbers_y):
+        numbers_x = np.arange(len(numbers_y), dtype=np.float64)
+    present = np.flatnonzero(np.isfinite(numbers_x) & np.isfinite(numbers_y))
+    if method == "lttb":
+        order = present[np.argsort(numbers_x[present], kind="stable")]
+        return order[lttb(numbers_x[order], numbers_y[order], threshold)]
+    return present[grid_sample(numbers_x[present], numbers_y[present], threshold)]
+
+
+def histogram_trace(values, max_bins: int) -> Optional[dict]:
+    """
+    The 'x', 'y', 'histfunc' and 'xbins' of a histogram trace of pre-binned
+    `values` (see `histogram_bins`), which Plotly draws like the raw values.
+
+    Returns:
+        dict: The trace fields, or None when the values are not numbers or dates.
+    """
+    numbers = as_numbers(values)
+    if numbers is None or not np.isfinite(numbers).any():
+        return None
+    edges, counts = histogram_bins(numbers, max_bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    if _is_dates(values):
+        # Plotly reads bins of dates back as dates; the bin size is left to it.
+        return {"x": np.round(centers).astype("datetime64[ms]").astype(str).tolist(), "y": counts.tolist(),
+                "histfunc": "sum", "nbinsx": len(counts)}
+    return {"x": centers.tolist(), "y": counts.tolist(), "histfunc": "sum",
+            "xbins": {"start": float(edges[0]), "end": float(edges[-1]), "size": float(edges[1] - edges[0])}}
+
+
+def _is_dates(values):
+    array = np.asarray(values)
+    if array.dtype.kind in "MU":
+        return True
+    return array.dtype.kind == "O" and any(isinstance(value, str) for value in array.tolist())
+
+
+def reduction(trace: int, method: str, points: int, kept: int) -> dict:
+    """A record of one reduced trace, for the figure's `layout.meta`."""
+    return {"trace": trace, "method": method, "points": points, "kept": kept}
+
+
+def annotate(figure: dict, reductions: List[dict]):
+    """
+    Records how much a figure was reduced under `layout.meta.downsampling`: the
+    points before and after over all traces and the `reduction` of each trace.
+    """
+    if not reductions:
+        return
+    layout = figure.setdefault("layout", {})
+    meta = layout.setdefault("meta", {})
+    if not isinstance(meta, dict):
+        return
+    meta["downsampling"] = {"points": sum(item["points"] for item in reductions),
+                            "kept": sum(item["kept"] for item in reductions),
+                            "traces": reductions}
+
+
+def _decode(value):
+    # Lists, NumPy arrays and Plotly.js typed array specifications as arrays;
+    # anything else is not per point.
+    if isinstance(value, np.ndarray):
+        return value
+    if isinstance(value, (list, tuple)):
+        return np.array(value, dtype=object) if value and isinstance(value[0], (list, dict)) else np.asarray(value)
+    if isinstance(value, dict) and "bdata" in value and "dtype" in value and "shape" not in value:
+        return np.frombuffer(base64.b64decode(value["bdata"]), dtype=value["dtype"].rstrip("c"))
+    return None
+
+
+def _take(trace, keys, length, kept, other, decoded=None):
+    # Reduces the per-point arrays of `trace` under `keys` to the points kept,
+    # appending an empty value for the 'Other' point. `decoded` holds arrays
+    # already decoded, by key.
+    for key in keys:
+        array = (decoded or {}).get(key)
+        if array is None:
+            array = _decode(trace.get(key))
+        if array is not None and array.ndim == 1 and len(array) == length:
+            values = array[kept].tolist()
+            trace[key] = values + [None] if other else values
+
+
+def _reduce_points(trace, index, budget, x, y, method):
+    kept = select_points(x, y, budget, method)
+    if kept is None:
+        return None
+    length = len(y)
+    if x is None:
+        # Without x Plotly places points at x0 + i * dx, so the kept positions are kept explicitly.
+        trace["x"] = (trace.get("x0", 0) + trace.get("dx", 1) * kept).tolist()
+    _take(trace, ("x", "y") + _POINT_KEYS, length, kept, False, {"x": x, "y": y})
+    if isinstance(trace.get("marker"), dict):
+        _take(trace["marker"], _MARKER_POINT_KEYS, length, kept, False)
+    return reduction(index, method, length, len(kept))
+
+
+def _reduce_categories(trace, index, categories, label_key, value_key):
+    labels, values = _decode(trace.get(label_key)), as_numbers(_decode(trace.get(value_key)))
+    if labels is None or values is None or len(labels) != len(values) or len(values) <= categories:
+        return None
+    length = len(values)
+    kept, other = top_n(values, categories)
+    _take(trace, (label_key, value_key) + _POINT_KEYS, length, kept, other is not None)
+    if isinstance(trace.get("marker"), dict):
+        _take(trace["marker"], _MARKER_POINT_KEYS + ("colors",), length, kept, other is not None)
+    if other is not None:
+        trace[label_key][-1], trace[value_key][-1] = OTHER_LABEL, other
+    return reduction(index, "top_n", length, len(trace[value_key]))
+
+
+def _prebin_histogram(trace, index, budget):
+    values = _decode(trace.get("x"))
+    if values is None or len(values) <= budget or any(key in trace for key in ("y", "histfunc", "xbins")):
+        return None
+    binned = histogram_trace(values, budget)
+    if binned is None:
+        return None
+    trace.update(binned)
+    for key in _POINT_KEYS:
+        trace.pop(key, None)
+    return reduction(index, "histogram", len(values), len(binned["y"]))
+
+
+def downsample_figure(figure: dict, budget: PointBudget) -> List[dict]:
+    """
+    Reduces the traces of a Plotly figure to the point budget in place: lines by
+    `lttb`, scatter plots by `grid_sample`, histograms of raw values to their bins
+    and bar and pie charts to their largest categories plus 'Other'. Traces of
+    other types and within the budget are left as they are.
+
+    Returns:
+        list: The `reduction` of each reduced trace, also recorded by `annotate`.
+    """
+    traces = [trace for trace in figure.get("data") or [] if isinstance(trace, dict)]
+    share = max(budget.points // max(len(traces), 1), 3)
+    reductions = []
+    for index, trace in enumerate(traces):
+        trace_type = trace.get("type", "scatter")
+        result = None
+        if trace_type in ("scatter", "scattergl"):
+            x, y = _decode(trace.get("x")), _decode(trace.get("y"))
+            if y is not None and len(y) > share and (x is None or len(x) == len(y)):
+                method = "lttb" if "lines" in trace.get("mode", "lines") else "grid"
+                result = _reduce_points(trace, index, share, x, y, method)
+        elif trace_type == "bar":
+            horizontal = trace.get("orientation") == "h"
+            label_key, value_key = ("y", "x") if horizontal else ("x", "y")
+            labels = _decode(trace.get(label_key))
+            if labels is not None and as_numbers(labels) is None:
+                result = _reduce_categories(trace, index, budget.categories, label_key, value_key)
+            elif labels is not None and len(labels) > share and not horizontal:
+                result = _reduce_points(trace, index, share, labels, _decode(trace.get("y")), "lttb")
+        elif trace_type == "pie":
+            result = _reduce_categories(trace, index, budget.categories, "labels", "values")
+        elif trace_type == "histogram":
+            result = _prebin_histogram(trace, index, share)
+        if result is not None:
+            reductions.append(result)
+    annotate(figure, reductions)
+    return reductions
+
+
+def figure_json(figure, budget: Optional[PointBudget]) -> str:
+    """
+    The JSON of a Plotly `Figure`, as its `to_json` writes it, with the traces
+    reduced to `budget` (see `downsample_figure`) before they are encoded.
+    """
+    if budget is None:
+        return figure.to_json()
+    import plotly.io
+    data = figure.to_dict()
+    downsample_figure(data, budget)
+    return plotly.io.to_json(data, validate=False)
+
+
+def point_budget() -> Optional[PointBudget]:
+    """
+    Reads the chart point budget from the environment, or returns None when charts
+    are sent with every point.
+
+    Environment variables:
+        CHART_POINT_BUDGET: Points per chart over all its traces; 0 turns
+            downsampling off. Defaults to 2000.
+        CHART_MAX_CATEGORIES: Bars or pie slices per trace, 'Other' included.
+            Defaults to 30.
+    """
+    points = int(os.getenv("CHART_POINT_BUDGET", "2000"))
+    if points <= 0:
+        return None
+    return PointBudget(points=points, categories=int(os.getenv("CHART_MAX_CATEGORIES", "30")))
@@ -0,0 +1,55 @@
+from collections import Counter
+from typing import List, Sequence, Tuple
+from agents.pipeline_cache import normalize_question
+import math
+
+
+def terms(text: str) -> List[str]:
+    """
+    Splits text into lower-case words with a crude plural stemming, so that
+    "countries" matches "country" and "genres" matches "genre".
+    """
+    words = []
+    for word in normalize_question(text).split():
+        if len(word) > 4 and word.endswith("ies"):
+            word = word[:-3] + "y"
+        elif len(word) > 3:
+            word = word.rstrip("s")
+        words.append(word)
+    return words
+
+
+class TfidfIndex:
+    """
+    Ranks short documents, such as example questions, by TF-IDF cosine similarity
+    to a text. Small enough to rebuild whenever the documents change.
+    """
+
+    def __init__(self, documents: Sequence[str]):
+        counts = [Counter(terms(document)) for document in documents]
+        self.frequencies = Counter(term for document in counts for term in document)
+        self.size = len(counts)
+        self._idf = {term: math.log((1 + self.size) / (1 + count)) + 1
+                     for term, count in self.frequencies.items()}
+        self._vectors = [self._normalized(document) for document in counts]
+
+    def vector(self, text: str) -> dict:
+        """The unit TF-IDF vector of a text; terms unknown to the index are dropped."""
+        return self._normalized(Counter(terms(text)))
+
+    def search(self, text: str, k: int) -> List[Tuple[float, int]]:
+        """
+        Returns the `k` documents most similar to a text.
+
+        Returns:
+            list: (similarity, document index) pairs, most similar first.
+        """
+        vector = self.vector(text)
+        scored = [(sum(weight * document.get(term, 0.0) for term, weight in vector.items()), index)
+                  for index, document in enumerate(self._vectors)]
+        return sorted(scored, key=lambda item: (-item[0], item[1]))[:k]
+
+    def _normalized(self, counts):
+        vector = {term: count * self._idf.get(term, 0.0) for term, count in counts.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        return {term: weight / norm for term, weight in vector.items()} if norm else {}
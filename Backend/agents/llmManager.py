@@ -1,6 +1,6 @@
+from agents.llm_backends import ModelBackend, create_hedged_model
 from agents.logger import setup_logger
-from langchain_groq import ChatGroq
-from langchain_openai import ChatOpenAI
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 import os
 import getpass
 
@@ -9,32 +9,85 @@ if "OPENAI_API_KEY" not in os.environ:
     os.environ["OPENAI_API_KEY"] = getpass.getpass("Enter your OpenAI API key: ")
 # _set_if_undefined("GROQ_API_KEY")
 
+
+def _openai_models(timeout):
+    llm = ChatOpenAI(
+            temperature=0,
+            model="gpt-4o",
+            max_tokens=None,
+            timeout=timeout,
+            max_retries=2,
+        )
+    slm = ChatOpenAI(
+            temperature=0,
+            model="gpt-4o-mini",
+            max_tokens=None,
+            timeout=timeout,
+            max_retries=2,
+        )
+    return llm, slm
+
+
+def _groq_models(timeout):
+    try:
+        from langchain_groq import ChatGroq
+    except ImportError:
+        logger.warning("langchain-groq is not installed; the groq LLM backend is disabled")
+        return None
+    llm = ChatGroq(
+        model=os.getenv("GROQ_MODEL"),
+        temperature=0.0,
+        max_retries=2,
+        timeout=timeout,
+    )
+    slm = ChatGroq(
+        model=os.getenv("GROQ_SMALL_MODEL", os.getenv("GROQ_MODEL")),
+        temperature=0.0,
+        max_retries=2,
+        timeout=timeout,
+    )
+    return llm, slm
+
+
+_PROVIDERS = {"openai": _openai_models, "groq": _groq_models}
+
+
 class LLMManager:
+    """
+    Holds the chat models and embeddings of the agents.
+
+    Environment variables:
+        LLM_BACKENDS: Comma separated providers of the chat models, in order of
+            preference ("openai", "groq"). Defaults to "openai". With more than one,
+            `llm` and `slm` hedge and fall back across them (see `create_hedged_model`).
+        LLM_DEADLINE_SECONDS: Time limit of a chat model call. Defaults to 60.
+        GROQ_MODEL, GROQ_SMALL_MODEL: The Groq models standing in for gpt-4o and gpt-4o-mini.
+    """
+
     def __init__(self):
         try:
             logger.info("Initializing LLMManager")
-            # self.llm = ChatGroq(
-            #     model=os.getenv("GROQ_MODEL"),
-            #     temperature=0.0,
-            #     max_retries=2,
-            #     streaming=True,
-            #     verbose=True,
-            # )
-            self.llm = ChatOpenAI(
-                    temperature=0,
-                    model="gpt-4o",
-                    max_tokens=None,
-                    timeout=None,
-                    max_retries=2,
-                )
-            self.slm = ChatOpenAI(
-                    temperature=0,
-                    model="gpt-4o-mini",
-                    max_tokens=None,
-                    timeout=None,
+            timeout = float(os.getenv("LLM_DEADLINE_SECONDS", "60"))
+            llms, slms = [], []
+            for provider in os.getenv("LLM_BACKENDS", "openai").split(","):
+                provider = provider.strip().lower()
+                if provider not in _PROVIDERS:
+                    raise ValueError(f"Unknown LLM backend '{provider}'")
+                models = _PROVIDERS[provider](timeout)
+                if models is None:
+                    continue
+                llms.append(ModelBackend(provider, models[0]))
+                slms.append(ModelBackend(provider, models[1]))
+            if not llms:
+                raise ValueError("No LLM backend is available")
+            self.llm = create_hedged_model(llms)
+            self.slm = create_hedged_model(slms)
+            self.embeddings = OpenAIEmbeddings(
+                    model=os.getenv("EMBEDDING_MODEL", "text-embedding-3-small"),
                     max_retries=2,
                 )
-            logger.info("LLMManager initialized successfully")
+            logger.info(f"LLMManager initialized successfully with the backends "
+                        f"{', '.join(backend.name for backend in llms)}")
         except Exception as e:
             logger.error(f"Error initializing LLMManager: {e}")
-            raise
\ No newline at end of file
+            raise
@@ -0,0 +1,402 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, AsyncIterator, List, Optional, Sequence
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import Field, PrivateAttr
+from agents.logger import setup_logger
+import asyncio
+import math
+import os
+import threading
+import time
+
+logger = setup_logger(__name__)
+
+# The backends' own runs are not reported to the callbacks of the request; the
+# hedged model's run reports the answer that was used, once.
+_NO_CALLBACKS = {"callbacks": []}
+
+
+class BackendUnavailable(RuntimeError):
+    """Raised when the circuit breakers of all backends are open."""
+
+
+class BackendHealth:
+    """
+    Latency window and circuit breaker of one backend, shared by every model bound
+    to it (for example the same model with and without tools).
+
+    The breaker opens after `failure_threshold` consecutive failures, rejects calls
+    for `reset_seconds`, then lets a single trial call through: a success closes it
+    again, a failure keeps it open for another `reset_seconds`.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30, window: int = 100):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._latencies = deque(maxlen=window)
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "failures": 0, "opened": 0, "hedges_won": 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def available(self) -> bool:
+        """Whether the breaker would let a call through now, without taking the trial."""
+        with self._lock:
+            state = self._state()
+            return state == "closed" or (state == "half_open" and not self._trial_in_flight)
+
+    def acquire(self) -> bool:
+        """Lets a call through when the breaker allows it; takes the trial when half open."""
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+            self._stats["calls"] += 1
+            if self._opened_at is not None:
+                logger.info("Closing the circuit breaker after a successful trial call")
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["failures"] += 1
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    self._stats["opened"] += 1
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def release(self):
+        """Ends a call that was abandoned, such as the slower of two hedged calls."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_hedge_won(self):
+        with self._lock:
+            self._stats["hedges_won"] += 1
+
+    def latency_percentile(self, fraction: float, min_samples: int = 1) -> Optional[float]:
+        with self._lock:
+            if len(self._latencies) < max(min_samples, 1):
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[max(math.ceil(len(ordered) * fraction) - 1, 0)]
+
+    def stats(self) -> dict:
+        with self._lock:
+            state = self._state()
+            stats = dict(self._stats)
+        p50, p95 = self.latency_percentile(0.5), self.latency_percentile(0.95)
+        return {**stats, "state": state, "p50_seconds": p50, "p95_seconds": p95}
+
+
+class ModelBackend:
+    """A chat model (or a runnable built on one, such as a tool binding) and its health."""
+
+    def __init__(self, name: str, model, health: Optional[BackendHealth] = None):
+        self.name = name
+        self.model = model
+        self.health = health or BackendHealth()
+
+    def bound(self, model) -> "ModelBackend":
+        return ModelBackend(self.name, model, self.health)
+
+
+class HedgedChatModel(BaseChatModel):
+    """
+    A chat model that sends each call to the fastest healthy backend and protects
+    the call's latency with the others.
+
+    - Selection: backends whose circuit breaker is closed are ordered by their
+      median latency; backends without `min_samples` latencies keep their
+      configured order ahead of measured ones, so every backend gets measured.
+    - Hedging: when the first backend has not answered after the `hedge_percentile`
+      of its latencies (or `hedge_delay_seconds` before it has `min_samples`), the
+      call is also sent to the next backend and the first answer is used. A failed
+      call moves on to the next backend straight away.
+    - Deadline: the call fails with `TimeoutError` after `deadline_seconds`, counting
+      as a failure of the backends still running.
+
+    Streaming calls are hedged on the time to the first chunk. Tools are bound to
+    every backend, which share their health with the unbound model. Sync calls run
+    on a pool of `sync_workers` threads shared by the model and its bound copies.
+    """
+
+    backends: List[Any] = Field(default_factory=list)
+    deadline_seconds: float = 60.0
+    hedge_percentile: float = 0.95
+    hedge_delay_seconds: float = 2.0
+    min_hedge_delay_seconds: float = 0.05
+    min_samples: int = 20
+    max_hedges: int = 1
+    sync_workers: int = 16
+    _executor: Optional[ThreadPoolExecutor] = PrivateAttr(default=None)
+
+    def model_post_init(self, context: Any) -> None:
+        super().model_post_init(context)
+        # model_copy, as in bind_tools, keeps private attributes, so copies share the pool.
+        self._executor = ThreadPoolExecutor(max_workers=self.sync_workers,
+                                            thread_name_prefix="llm-hedge")
+
+    @property
+    def _llm_type(self) -> str:
+        return "hedged"
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any) -> "HedgedChatModel":
+        return self.model_copy(update={
+            "backends": [backend.bound(backend.model.bind_tools(tools, **kwargs))
+                         for backend in self.backends]})
+
+    def stats(self) -> dict:
+        return {backend.name: backend.health.stats() for backend in self.backends}
+
+    def _candidates(self):
+        available = [(index, backend) for index, backend in enumerate(self.backends)
+                     if backend.health.available()]
+        if not available:
+            raise BackendUnavailable("The circuit breakers of all LLM backends are open")
+
+        def order(item):
+            index, backend = item
+            median = backend.health.latency_percentile(0.5, self.min_samples)
+            return (0, index) if median is None else (1, median)
+        return [backend for _, backend in sorted(available, key=order)]
+
+    def _hedge_delay(self, backend) -> float:
+        delay = backend.health.latency_percentile(self.hedge_percentile, self.min_samples)
+        return max(self.min_hedge_delay_seconds, self.hedge_delay_seconds if delay is None else delay)
+
+    async def _arace(self, start_call):
+        """
+        Runs `start_call(backend)` coroutines against the candidates until one succeeds.
+
+        Returns:
+            tuple: The backend that answered first and its result.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline_seconds
+        candidates = iter(self._candidates())
+        pending, started, last_error, exhausted = {}, 0, None, False
+
+        def launch():
+            nonlocal started, exhausted
+            for backend in candidates:
+                if backend.health.acquire():
+                    pending[loop.create_task(self._atimed(backend, start_call))] = backend
+                    started += 1
+                    return backend
+            exhausted = True
+            return None
+
+        first = launch()
+        if first is None:
+            raise BackendUnavailable("The circuit breakers of all LLM backends are open")
+        hedge_at = loop.time() + self._hedge_delay(first)
+        try:
+            while pending:
+                now = loop.time()
+                can_hedge = started <= self.max_hedges and not exhausted
+                timeout = deadline - now
+                if can_hedge:
+                    timeout = min(timeout, max(hedge_at - now, 0))
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    backend = pending.pop(task)
+                    if task.exception() is None:
+                        if started > 1 and backend is not first:
+                            backend.health.record_hedge_won()
+                        return backend, task.result()
+                    last_error = task.exception()
+                    logger.warning(f"LLM backend '{backend.name}' failed: {last_error}")
+                if loop.time() >= deadline:
+                    for backend in pending.values():
+                        backend.health.record_failure()
+                    raise TimeoutError(f"No LLM backend answered within {self.deadline_seconds}s")
+                if (not pending or (not done and can_hedge)) and launch() is not None:
+                    if len(pending) > 1:
+                        logger.info(f"Hedging the LLM call after {self._hedge_delay(first):.2f}s")
+                    hedge_at = loop.time() + self._hedge_delay(first)
+            raise last_error or BackendUnavailable("No LLM backend could take the call")
+        finally:
+            for task in pending:
+                task.cancel()
+            # Lets the abandoned calls unwind, so their streams can be closed.
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _atimed(self, backend, start_call):
+        start = time.perf_counter()
+        try:
+            result = await start_call(backend)
+        except asyncio.CancelledError:
+            backend.health.release()
+            raise
+        except Exception:
+            backend.health.record_failure()
+            raise
+        backend.health.record_success(time.perf_counter() - start)
+        return result
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                         **kwargs: Any) -> ChatResult:
+        _, message = await self._arace(
+            lambda backend: backend.model.ainvoke(messages, _NO_CALLBACKS, stop=stop, **kwargs))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        streams = {}
+
+        async def first_chunk(backend):
+            stream = backend.model.astream(messages, _NO_CALLBACKS, stop=stop, **kwargs)
+            streams[backend.name] = stream
+            return await stream.__anext__()
+
+        try:
+            backend, chunk = await self._arace(first_chunk)
+            yield ChatGenerationChunk(message=_as_chunk(chunk))
+            async for chunk in streams[backend.name]:
+                yield ChatGenerationChunk(message=_as_chunk(chunk))
+        finally:
+            for stream in streams.values():
+                await stream.aclose()
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None,
+                  **kwargs: Any) -> ChatResult:
+        # Running threads cannot be cancelled; a call abandoned for a faster hedge
+        # finishes in the background, bounded by its client's own timeout, and still
+        # updates its backend's latency and breaker. Calls still pending at the
+        # deadline count as failures then, as on the async path, and are not recorded
+        # again when they finish. Calls still queued for a thread are cancelled.
+        deadline = time.monotonic() + self.deadline_seconds
+        candidates = iter(self._candidates())
+        pending, started, last_error, exhausted = {}, 0, None, False
+        timed_out = threading.Event()
+
+        def launch():
+            nonlocal started, exhausted
+            for backend in candidates:
+                if backend.health.acquire():
+                    future = self._executor.submit(self._timed, backend, messages, stop, kwargs, timed_out)
+                    pending[future] = backend
+                    started += 1
+                    return backend
+            exhausted = True
+            return None
+
+        first = launch()
+        if first is None:
+            raise BackendUnavailable("The circuit breakers of all LLM backends are open")
+        hedge_at = time.monotonic() + self._hedge_delay(first)
+        try:
+            while pending:
+                now = time.monotonic()
+                can_hedge = started <= self.max_hedges and not exhausted
+                timeout = deadline - now
+                if can_hedge:
+                    timeout = min(timeout, max(hedge_at - now, 0))
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    backend = pending.pop(future)
+                    if future.exception() is None:
+                        if started > 1 and backend is not first:
+                            backend.health.record_hedge_won()
+                        return ChatResult(generations=[ChatGeneration(message=future.result())])
+                    last_error = future.exception()
+                    logger.warning(f"LLM backend '{backend.name}' failed: {last_error}")
+                if time.monotonic() >= deadline:
+                    timed_out.set()
+                    for future, backend in pending.items():
+                        if future.cancel():
+                            backend.health.release()
+                        else:
+                            backend.health.record_failure()
+                    pending.clear()
+                    raise TimeoutError(f"No LLM backend answered within {self.deadline_seconds}s")
+                if (not pending or (not done and can_hedge)) and launch() is not None:
+                    if len(pending) > 1:
+                        logger.info(f"Hedging the LLM call after {self._hedge_delay(first):.2f}s")
+                    hedge_at = time.monotonic() + self._hedge_delay(first)
+            raise last_error or BackendUnavailable("No LLM backend could take the call")
+        finally:
+            for future, backend in pending.items():
+                if future.cancel():
+                    backend.health.release()
+
+    def _timed(self, backend, messages, stop, kwargs, timed_out):
+        start = time.perf_counter()
+        try:
+            result = backend.model.invoke(messages, _NO_CALLBACKS, stop=stop, **kwargs)
+        except Exception:
+            if not timed_out.is_set():
+                backend.health.record_failure()
+            raise
+        if not timed_out.is_set():
+            backend.health.record_success(time.perf_counter() - start)
+        return result
+
+
+def _as_chunk(message) -> AIMessageChunk:
+    if isinstance(message, AIMessageChunk):
+        return message
+    return AIMessageChunk(content=message.content, additional_kwargs=message.additional_kwargs,
+                          tool_call_chunks=[], id=message.id)
+
+
+def create_hedged_model(backends: List[ModelBackend]):
+    """
+    Wraps the backends in a `HedgedChatModel`, or returns the only backend's model.
+
+    Environment variables:
+        LLM_DEADLINE_SECONDS: Time limit of a call across all backends. Defaults to 60.
+        LLM_HEDGE_PERCENTILE: Latency percentile of the first backend after which the
+            call is also sent to the next one. Defaults to 0.95.
+        LLM_HEDGE_DELAY_SECONDS: Hedge delay until a backend has enough latencies. Defaults to 2.
+        LLM_HEDGE_MIN_SAMPLES: Latencies needed to use the percentile. Defaults to 20.
+        LLM_BREAKER_FAILURES: Consecutive failures that open a backend's circuit
+            breaker. Defaults to 5.
+        LLM_BREAKER_RESET_SECONDS: How long an open breaker rejects calls. Defaults to 30.
+        LLM_SYNC_WORKERS: Threads running the backends' sync calls. Defaults to 16.
+    """
+    if len(backends) == 1:
+        return backends[0].model
+    for backend in backends:
+        backend.health.failure_threshold = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+        backend.health.reset_seconds = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+    return HedgedChatModel(
+        backends=backends,
+        deadline_seconds=float(os.getenv("LLM_DEADLINE_SECONDS", "60")),
+        hedge_percentile=float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95")),
+        hedge_delay_seconds=float(os.getenv("LLM_HEDGE_DELAY_SECONDS", "2")),
+        min_samples=int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20")),
+        sync_workers=int(os.getenv("LLM_SYNC_WORKERS", "16")))
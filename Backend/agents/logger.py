@@ -1,4 +1,6 @@
 import logging
+import os
+import reprlib
 
 
 def setup_logger(name, level=logging.INFO):
@@ -14,3 +16,25 @@ def setup_logger(name, level=logging.INFO):
     logger.addHandler(handler)
 
     return logger
+
+
+# Payloads such as query results and chart JSON are logged abbreviated; the
+# repr of a container stops after a few items instead of being built in full.
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "500"))
+_payload_repr = reprlib.Repr()
+_payload_repr.maxlist = _payload_repr.maxtuple = 5
+_payload_repr.maxdict = 20
+_payload_repr.maxstring = 200
+_payload_repr.maxother = 200
+_payload_repr.maxlevel = 4
+
+
+def abbreviate(payload, max_chars: int = LOG_PAYLOAD_MAX_CHARS) -> str:
+    """
+    Shortens a payload for a log line to at most `max_chars` characters, noting
+    the length of strings that were cut.
+    """
+    text = payload if isinstance(payload, str) else _payload_repr.repr(payload)
+    if len(text) > max_chars:
+        return f"{text[:max_chars]}... ({len(text)} characters)"
+    return text
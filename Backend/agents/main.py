@@ -1,12 +1,25 @@
 from workflowManager import WorkflowManager
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
-from models.models import Query, QueryResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import PlainTextResponse, RedirectResponse, Response, StreamingResponse
+from models.models import Query, QueryResponse, ResultPage
 from langchain.globals import set_debug, set_verbose
-from llmManager import LLMManager
-from agents.logger import setup_logger
+from agents.clients import LazySingleton, get_llm_manager, llm_manager
+from agents.coalescing import create_single_flight, normalize_question
+from agents.logger import abbreviate, setup_logger
+from agents.metrics import current_request_metrics, registry, request_metrics_scope
+from agents.mongodb_retriever import (
+    aget_movies_page, movie_flights, pipeline_cache, pipeline_validator, prompt_builder, query_guard,
+    result_cache, rollups)
+from agents.plot_generator import chart_payloads, chart_sandbox, plan_cache
+from agents.session_store import session_store
+from bson import json_util
+import asyncio
+import json
 import os
+import time
+import uuid
 
 logger = setup_logger(__name__)
 
@@ -15,15 +28,25 @@ if os.getenv("ENABLE_DEBUGGING") == "true":
 else:
     set_verbose(True)
 
-try:
-    logger.info("Initializing managers")
-    llm_manager = LLMManager()
-    workflow_manager = WorkflowManager(
-        llm_manager=llm_manager)
-    logger.info("Managers initialized successfully")
-except Exception as e:
-    logger.error(f"Error initializing managers: {e}")
-    raise
+
+def _create_workflow_manager():
+    try:
+        logger.info("Initializing managers")
+        workflow_manager = WorkflowManager(
+            llm_manager=get_llm_manager())
+        logger.info("Managers initialized successfully")
+        return workflow_manager
+    except Exception as e:
+        logger.error(f"Error initializing managers: {e}")
+        raise
+
+
+# Built on first use so the server starts accepting connections immediately.
+workflow_manager = LazySingleton(_create_workflow_manager)
+# Identical questions arriving together, for example after a demo link is shared,
+# run the graph once.
+query_flights = create_single_flight("query")
+timing_headers = os.getenv("METRICS_TIMING_HEADERS", "false") == "true"
 
 app = FastAPI()
 
@@ -34,7 +57,30 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
+# Compresses responses other than the event streams; /charts serves stored compressed bodies.
+if os.getenv("RESPONSE_COMPRESSION", "true") == "true":
+    app.add_middleware(
+        GZipMiddleware,
+        minimum_size=int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", "1000")),
+        compresslevel=int(os.getenv("RESPONSE_COMPRESSION_LEVEL", "6")))
+
+
+@app.on_event("startup")
+async def warmUp():
+    """
+    Builds the managers and starts the chart sandbox workers in the background after
+    start up, so the first request does not pay for it. Set WARM_UP_ON_STARTUP to
+    'false' to build them on first use instead. Starts maintaining the rollups when
+    they are enabled.
+    """
+    if rollups is not None:
+        rollups.start()
+    if os.getenv("WARM_UP_ON_STARTUP", "true") == "true":
+        loop = asyncio.get_running_loop()
+        loop.run_in_executor(None, workflow_manager)
+        loop.run_in_executor(None, chart_sandbox)
 
 
 @app.get("/")
@@ -49,29 +95,267 @@ async def redirect_root_to_docs():
 
 
 @app.post("/query")
-async def runQuery(query: Query) -> QueryResponse:
+async def runQuery(query: Query, response: Response) -> QueryResponse:
     """
     Asynchronously processes a query and returns a response.
 
+    With METRICS_TIMING_HEADERS set to 'true', the response carries the wall time
+    of each graph node in a `Server-Timing` header, and the request's LLM calls,
+    tokens, MongoDB round trips, documents, bytes and cache hits in `X-` headers.
+
     Args:
-        query (Query): The query object containing the query string.
+        query (Query): The query object containing the query string and, for follow-up
+            questions, the session ID of the conversation.
+        response (Response): The response whose headers are set.
 
     Returns:
-        QueryResponse: The response object containing the answer and chart.
+        QueryResponse: The response object containing the answer, chart and session ID.
 
     Raises:
         HTTPException: If an error occurs while processing the query, an HTTP 500 error is raised with the error details.
     """
     try:
         logger.info(f"Processing query: {query.query}")
-        finalResponse = QueryResponse(answer='', chart='')
-        finalResponse = workflow_manager.invoke(query.query)
-        logger.info(f"Query processed successfully: {finalResponse.answer}")
+        with request_metrics_scope() as metrics:
+            finalResponse = await _coalesced_invoke(query)
+        if timing_headers:
+            response.headers.update(metrics.headers())
+        logger.info(f"Query processed successfully: {abbreviate(finalResponse.answer)}")
         return finalResponse
     except Exception as e:
         logger.error(f"Error processing query: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def _workflow_manager():
+    # The first call builds the graph, chat models and MongoDB clients synchronously,
+    # possibly while the warm-up holds the singleton's lock; keep it off the event loop.
+    if workflow_manager.created:
+        return workflow_manager()
+    return await asyncio.to_thread(workflow_manager)
+
+
+async def _coalesced_invoke(query: Query) -> QueryResponse:
+    # Questions of an existing session only share with the same session, since its
+    # history shapes the answer. New sessions share regardless, and each caller
+    # joining another's execution is given its own copy of the resulting session.
+    manager = await _workflow_manager()
+    if query_flights is None:
+        return await manager.ainvoke(query.query, query.session_id)
+    key = (normalize_question(query.query), query.session_id)
+    start = time.perf_counter()
+    response, shared = await query_flights.arun(
+        key, lambda: manager.ainvoke(query.query, query.session_id))
+    if not shared:
+        return response
+    # The graph ran in the other caller's request; this one only waited for it.
+    metrics = current_request_metrics()
+    if metrics is not None:
+        metrics.add("coalesced", seconds=time.perf_counter() - start)
+    if query.session_id is None:
+        session_id = str(uuid.uuid4())
+        await manager.acopy_session(response.session_id, session_id)
+        return response.model_copy(update={"session_id": session_id})
+    return response
+
+
+@app.get("/query/{result_id}/page")
+async def readResultPage(result_id: str, offset: int = 0) -> ResultPage:
+    """
+    Reads a further page of a truncated query result.
+
+    Args:
+        result_id (str): The `result_id` of a previous query response.
+        offset (int): The position of the first document to return, usually the
+            `next_offset` of the previous page.
+
+    Returns:
+        ResultPage: The documents of the page, the total number of documents and the
+            offset of the following page.
+
+    Raises:
+        HTTPException: An HTTP 404 error when the result is unknown or has expired, or
+            an HTTP 500 error if reading the page fails.
+    """
+    if offset < 0:
+        raise HTTPException(status_code=400, detail="The offset must not be negative")
+    try:
+        page = await aget_movies_page(result_id, offset)
+    except Exception as e:
+        logger.error(f"Error reading result page: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    if page is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired result")
+    # Extended JSON keeps ObjectIds and dates serializable.
+    documents = json.loads(json_util.dumps(page.documents))
+    return ResultPage(documents=documents, offset=page.offset, total=page.total,
+                      next_offset=page.next_offset)
+
+@app.get("/cache/stats")
+async def cacheStats() -> dict:
+    """
+    Returns the hit, miss and eviction counters of the query caches, the size of
+    the session store, the parse failure, repair and reject counters of the
+    pipeline validator, the explain counters of the query guard, how many
+    requests joined an identical request in flight, the latency and circuit
+    breaker state of each LLM backend, how many schema fields and examples the
+    prompt builder chose, how many pipelines the rollups answered and the sizes of
+    the chart payloads.
+
+    Returns:
+        dict: The counters of each enabled cache, of the session store, of the
+            pipeline validator, of the query guard, of request coalescing, of the
+            LLM backends, of the prompt builder, of the rollups and of the chart
+            payloads, keyed by name.
+    """
+    stats = {}
+    # Caches that have not been used yet have nothing to report.
+    if pipeline_cache.created and pipeline_cache() is not None:
+        stats["pipeline"] = pipeline_cache().stats()
+    if result_cache.created and result_cache() is not None:
+        stats["result"] = result_cache().stats()
+    if plan_cache.created and plan_cache() is not None:
+        stats["visualization_plan"] = plan_cache().stats()
+    stats["sessions"] = session_store.stats()
+    stats["pipeline_validation"] = pipeline_validator.stats()
+    if query_guard is not None:
+        stats["query_guard"] = query_guard.stats()
+    if query_flights is not None:
+        stats["coalescing"] = {"query": query_flights.stats(), "get_movies": movie_flights.stats()}
+    if llm_manager.created and hasattr(llm_manager().llm, "stats"):
+        stats["llm_backends"] = {"llm": llm_manager().llm.stats(), "slm": llm_manager().slm.stats()}
+    if prompt_builder is not None:
+        stats["prompt_builder"] = prompt_builder.stats()
+    if rollups is not None:
+        stats["rollups"] = rollups.store.stats()
+    stats["charts"] = chart_payloads.stats()
+    return stats
+
+
+@app.get("/charts/{chart_id}")
+async def readChart(chart_id: str, request: Request) -> Response:
+    """
+    Returns a chart of an earlier response by its `chart_id`.
+
+    The `chart_id` is the content hash of the figure, so it doubles as a strong
+    ETag and the response may be cached indefinitely: a request whose
+    `If-None-Match` names the chart is answered with 304 Not Modified. The body is
+    brotli or gzip compressed when the client accepts it.
+
+    Args:
+        chart_id (str): The `chart_id` of a response.
+        request (Request): The request, for its `If-None-Match` and `Accept-Encoding` headers.
+
+    Returns:
+        Response: The Plotly figure JSON, with numeric arrays as typed arrays.
+
+    Raises:
+        HTTPException: An HTTP 404 error when the chart is unknown or was evicted.
+    """
+    etag = f'"{chart_id}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable",
+               "Vary": "Accept-Encoding"}
+    if etag in [tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    stored = chart_payloads.store.get(chart_id, request.headers.get("accept-encoding", ""))
+    if stored is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired chart")
+    body, encoding = stored
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@app.get("/metrics")
+async def metrics() -> PlainTextResponse:
+    """
+    Returns the request, graph node, LLM, MongoDB and cache metrics in the
+    Prometheus text format.
+
+    Returns:
+        PlainTextResponse: The metrics, for a Prometheus scrape.
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/indexes/recommendations")
+async def indexRecommendations() -> list:
+    """
+    Recommends indexes on the movies collection for the generated query shapes that
+    had to scan it, most executed first.
+
+    Returns:
+        list: The recommended index keys with the number of shapes and executions
+            they would serve. Empty when the query guard is disabled.
+    """
+    if query_guard is None:
+        return []
+    return query_guard.index_report()
+
+
+def _format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+@app.post("/query/stream")
+async def streamQuery(query: Query) -> StreamingResponse:
+    """
+    Processes a query and streams its progress as server-sent events.
+
+    Router decisions, generated MongoDB pipelines, partial answer tokens and the final
+    Plotly JSON are pushed as separate events while the graph runs, followed by a
+    'done' event carrying the same payload as the /query endpoint.
+
+    Args:
+        query (Query): The query object containing the query string.
+
+    Returns:
+        StreamingResponse: A `text/event-stream` response. If an error occurs while
+        processing the query, an 'error' event with the error details ends the stream.
+    """
+    logger.info(f"Streaming query: {query.query}")
+
+    async def event_stream():
+        try:
+            manager = await _workflow_manager()
+            async for event, data in manager.astream(query.query, query.session_id):
+                yield _format_sse(event, data)
+        except Exception as e:
+            logger.error(f"Error streaming query: {e}")
+            yield _format_sse("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/graph")
+async def renderGraph(format: str = "mermaid") -> Response:
+    """
+    Renders the workflow graph.
+
+    Args:
+        format (str): 'mermaid' (default) for the Mermaid source, or 'png' for an image
+            rendered by the mermaid.ink API, which needs network access.
+
+    Returns:
+        Response: The Mermaid source as plain text, or the PNG image.
+
+    Raises:
+        HTTPException: An HTTP 400 error for an unknown format, or an HTTP 500 error
+            if rendering fails.
+    """
+    if format not in ("mermaid", "png"):
+        raise HTTPException(status_code=400, detail=f"Unsupported graph format: {format}")
+    try:
+        manager = await _workflow_manager()
+        graph = await asyncio.to_thread(manager.render_graph, format)
+    except Exception as e:
+        logger.error(f"Error rendering workflow graph: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    if format == "png":
+        return Response(content=graph, media_type="image/png")
+    return PlainTextResponse(graph)
+
 if __name__ == "__main__":
     try:
         logger.info("Starting the GenAI Langgraph application")
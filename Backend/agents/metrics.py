@@ -0,0 +1,316 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import get_buffer_string
+from langchain_core.outputs import LLMResult
+from agents.logger import setup_logger
+from agents.tokens import count_tokens
+import asyncio
+import functools
+import threading
+import time
+
+logger = setup_logger(__name__)
+
+PREFIX = "text2nosql"
+# Node label of work done outside the graph, such as reading further result pages.
+OUTSIDE_GRAPH = "none"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_DESCRIPTIONS = {
+    "requests_total": ("counter", "Requests processed by the graph."),
+    "request_seconds": ("histogram", "Wall time of requests."),
+    "node_seconds": ("histogram", "Wall time of graph nodes."),
+    "llm_calls_total": ("counter", "Chat model calls."),
+    "llm_tokens_total": ("counter", "Chat model tokens, by type (prompt or completion)."),
+    "mongo_round_trips_total": ("counter", "MongoDB aggregate and explain commands sent."),
+    "mongo_documents_total": ("counter", "Documents read from aggregation cursors."),
+    "mongo_bytes_total": ("counter", "BSON bytes read from aggregation cursors."),
+    "cache_hits_total": ("counter", "Cache hits, by cache."),
+    "chart_points_total": ("counter", "Points of downsampled chart traces, by method."),
+    "chart_points_kept_total": ("counter", "Points kept of downsampled chart traces, by method."),
+}
+
+# The per-request counters, in the order they are reported.
+COUNTERS = ("llm_calls", "prompt_tokens", "completion_tokens", "mongo_round_trips",
+            "mongo_documents", "mongo_bytes", "cache_hits")
+
+
+def _labels_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class MetricsRegistry:
+    """
+    Process-wide counters and histograms, rendered in the Prometheus text format.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # One count per bucket, then the sum and the count of observations.
+                histogram = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def value(self, name: str, **labels) -> float:
+        """The value of a counter, or the observation count of a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key][-1]
+            return self._counters.get(key, 0)
+
+    def render(self) -> str:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+        lines = []
+        for name, (kind, description) in _DESCRIPTIONS.items():
+            metric = f"{PREFIX}_{name}"
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} {kind}")
+            if kind == "counter":
+                for (counter, labels), value in sorted(counters.items()):
+                    if counter == name:
+                        lines.append(f"{metric}{_labels_text(labels)} {value:g}")
+                continue
+            for (histogram, labels), values in sorted(histograms.items()):
+                if histogram != name:
+                    continue
+                for bound, count in zip(self.buckets, values):
+                    lines.append(f"{metric}_bucket{_labels_text(labels + (('le', f'{bound:g}'),))} {count}")
+                lines.append(f"{metric}_bucket{_labels_text(labels + (('le', '+Inf'),))} {values[-1]}")
+                lines.append(f"{metric}_sum{_labels_text(labels)} {values[-2]:g}")
+                lines.append(f"{metric}_count{_labels_text(labels)} {values[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class RequestMetrics:
+    """
+    What one request cost, per graph node: wall time, chat model calls and tokens,
+    MongoDB round trips, documents and bytes, and cache hits.
+    """
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self.seconds: Optional[float] = None
+        self.nodes: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def add(self, node: str, **values):
+        with self._lock:
+            counters = self.nodes.setdefault(node, dict.fromkeys(("seconds",) + COUNTERS, 0))
+            for name, value in values.items():
+                counters[name] += value
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self._start
+
+    def totals(self) -> dict:
+        with self._lock:
+            return {name: sum(counters[name] for counters in self.nodes.values()) for name in COUNTERS}
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            nodes = {node: dict(counters) for node, counters in self.nodes.items()}
+        return {"seconds": self.seconds, **self.totals(), "nodes": nodes}
+
+    def headers(self) -> dict:
+        """
+        The metrics as response headers: `Server-Timing` with the wall time of each
+        node and of the request, and one `X-` header per counter.
+        """
+        with self._lock:
+            timings = [f"{node};dur={counters['seconds'] * 1000:.1f}"
+                       for node, counters in self.nodes.items() if node != OUTSIDE_GRAPH]
+        if self.seconds is not None:
+            timings.append(f"total;dur={self.seconds * 1000:.1f}")
+        headers = {"Server-Timing": ", ".join(timings)}
+        for name, value in self.totals().items():
+            headers["X-" + "-".join(part.capitalize() for part in name.split("_"))] = str(int(value))
+        return headers
+
+
+_request_metrics: ContextVar[Optional[RequestMetrics]] = ContextVar("request_metrics", default=None)
+_current_node: ContextVar[str] = ContextVar("current_node", default=OUTSIDE_GRAPH)
+
+
+def current_request_metrics() -> Optional[RequestMetrics]:
+    return _request_metrics.get()
+
+
+@contextmanager
+def request_metrics_scope():
+    """
+    Collects the metrics of a request. Nested scopes share the outermost one, which
+    records the request in the registry when it ends.
+
+    Yields:
+        RequestMetrics: The metrics of the request.
+    """
+    metrics = _request_metrics.get()
+    if metrics is not None:
+        yield metrics
+        return
+    metrics = RequestMetrics()
+    token = _request_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        metrics.finish()
+        registry.inc("requests_total")
+        registry.observe("request_seconds", metrics.seconds)
+        try:
+            _request_metrics.reset(token)
+        except ValueError:
+            # An abandoned streaming generator is closed from another context.
+            pass
+
+
+def _record(registry_values: dict, **values):
+    node = _current_node.get()
+    metrics = _request_metrics.get()
+    if metrics is not None:
+        metrics.add(node, **values)
+    for name, value in registry_values.items():
+        registry.inc(name, value, node=node)
+
+
+@contextmanager
+def node_scope(node: str):
+    """Attributes the work done inside to `node` and records its wall time."""
+    token = _current_node.set(node)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _current_node.reset(token)
+        registry.observe("node_seconds", seconds, node=node)
+        metrics = _request_metrics.get()
+        if metrics is not None:
+            metrics.add(node, seconds=seconds)
+
+
+def instrument_node(node: str, function):
+    """
+    Wraps a sync or async graph node function in `node_scope`.
+    """
+    if asyncio.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def async_node(*args, **kwargs):
+            with node_scope(node):
+                return await function(*args, **kwargs)
+        return async_node
+
+    @functools.wraps(function)
+    def node_function(*args, **kwargs):
+        with node_scope(node):
+            return function(*args, **kwargs)
+    return node_function
+
+
+def record_llm_call(prompt_tokens: int, completion_tokens: int):
+    _record({"llm_calls_total": 1}, llm_calls=1, prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens)
+    node = _current_node.get()
+    registry.inc("llm_tokens_total", prompt_tokens, node=node, type="prompt")
+    registry.inc("llm_tokens_total", completion_tokens, node=node, type="completion")
+
+
+def record_mongo_round_trip():
+    _record({"mongo_round_trips_total": 1}, mongo_round_trips=1)
+
+
+def record_documents(count: int, nbytes: int):
+    _record({"mongo_documents_total": count, "mongo_bytes_total": nbytes},
+            mongo_documents=count, mongo_bytes=nbytes)
+
+
+def record_downsampling(method: str, points: int, kept: int):
+    registry.inc("chart_points_total", points, method=method)
+    registry.inc("chart_points_kept_total", kept, method=method)
+
+
+def record_cache_hit(cache: str):
+    registry.inc("cache_hits_total", cache=cache)
+    metrics = _request_metrics.get()
+    if metrics is not None:
+        metrics.add(_current_node.get(), cache_hits=1)
+
+
+def _usage(response: LLMResult):
+    prompt_tokens = completion_tokens = 0
+    found = False
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                found = True
+                prompt_tokens += usage.get("input_tokens", 0)
+                completion_tokens += usage.get("output_tokens", 0)
+    if not found:
+        usage = (response.llm_output or {}).get("token_usage")
+        if usage:
+            found = True
+            prompt_tokens, completion_tokens = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    return (prompt_tokens, completion_tokens) if found else None
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Counts chat model calls and tokens. Uses the usage the provider reports, and
+    estimates tokens with `count_tokens` for models that report none.
+    """
+    run_inline = True
+
+    def __init__(self):
+        self._prompts: Dict[UUID, list] = {}
+        self._lock = threading.Lock()
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[list], *,
+                            run_id: UUID, **kwargs: Any) -> None:
+        with self._lock:
+            self._prompts[run_id] = messages
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        with self._lock:
+            prompts = self._prompts.pop(run_id, [])
+        usage = _usage(response)
+        if usage is None:
+            usage = (sum(count_tokens(get_buffer_string(messages)) for messages in prompts),
+                     sum(count_tokens(generation.text) for generations in response.generations
+                         for generation in generations))
+        record_llm_call(*usage)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        with self._lock:
+            self._prompts.pop(run_id, None)
+
+
+metrics_callback = MetricsCallbackHandler()
@@ -1,62 +1,383 @@
-from pymongo import MongoClient
 from langchain.chains import LLMChain
-from llmManager import LLMManager
-from langchain.memory import ConversationBufferMemory
-from datetime import datetime
+from langchain_core.messages import AIMessage, HumanMessage
 from prompts.mongoDB_movies_Prompt import get_movies_collection_prompt, movies_collection_schema , examples
-from agents.logger import setup_logger
-import re
-import os
+from agents.coalescing import create_single_flight, normalize_question
+from agents.clients import LazySingleton, get_async_database, get_database, get_llm_manager
+from agents.logger import abbreviate, setup_logger
+from agents.metrics import record_cache_hit, record_mongo_round_trip
+from agents.pipeline_cache import create_pipeline_cache, history_digest
+from agents.pipeline_validation import create_pipeline_validator
+from agents.progress import emit_progress
+from agents.prompt_builder import create_prompt_builder
+from agents.query_guard import create_query_guard
+from agents.request_context import current_request, current_session_id
+from agents.result_budget import (
+    AggregationResult, create_chart_budget, create_result_budget, create_result_cursor_store)
+from agents.result_cache import create_result_cache
+from agents.rollups import create_rollups
+from agents.session_store import session_store
+from bson import json_util
+from dataclasses import replace
+from langgraph.constants import TAG_NOSTREAM
+from typing import Optional
 import json
 
 logger = setup_logger(__name__)
 
-client = MongoClient(os.getenv('MONGODB_CONNECTION_STRING'))
-db = client[os.getenv('MONGODB_DATABASE_NAME')]
-collection = db["movies"]
-llm = LLMManager().llm
-memory = ConversationBufferMemory(
-    llm=llm, input_key="user_question", memory_key="chat_history",  return_messages=True)
+# Clients, chains and caches are built on first use, so importing this module
+# neither connects to MongoDB nor creates the chat models.
+collection = LazySingleton(lambda: get_database()["movies"])
+async_collection = LazySingleton(lambda: get_async_database()["movies"])
+# The chat history comes from the session store of the current request, see `_chain_inputs`.
+nosql_llm_chain = LazySingleton(lambda: LLMChain(
+    llm=get_llm_manager().llm, prompt=get_movies_collection_prompt(), verbose=True))
+pipeline_cache = LazySingleton(
+    lambda: create_pipeline_cache(embeddings=get_llm_manager().embeddings))
+result_cache = LazySingleton(lambda: create_result_cache(get_database(), collection()))
+result_budget = create_result_budget()
+# Charts are drawn from the whole result, up to a much larger budget than a page.
+chart_budget = create_chart_budget()
+result_cursors = create_result_cursor_store()
+# Generated pipelines are parsed without eval and checked against the schema
+# before they cost a MongoDB round trip.
+pipeline_validator = create_pipeline_validator()
+# New pipeline shapes are explained before they run, see `QueryGuard`.
+query_guard = create_query_guard(collection)
+# Concurrent identical questions of sessions with the same pipeline history share
+# one generation and aggregation.
+movie_flights = create_single_flight("get_movies")
+# Picks the schema fields and examples each pipeline generation prompt carries.
+prompt_builder = create_prompt_builder()
+# Group-bys of common dimensions kept up to date from the collection's changes;
+# pipelines they can answer never reach the collection.
+rollups = create_rollups(collection, get_database)
 
-nosql_llm_chain = LLMChain(
-    llm=llm, prompt=get_movies_collection_prompt(), verbose=True, memory=memory)
 
-def iso_date_replacer(match):
-    iso_date_str = match.group(1)
-    # Convert the extracted string into a Python datetime object
-    return f'datetime.fromisoformat("{iso_date_str[:-1]}")'
+def _pipeline_history():
+    return session_store.get_history(current_session_id(), "pipeline")
 
-def get_movies(query):
+
+def prompt_context(question):
+    """
+    The schema description and examples of the pipeline generation prompts for a
+    question: those the prompt builder chose, or all of them when it is disabled.
+    """
+    if prompt_builder is None:
+        return {"movies_collection_schema": movies_collection_schema, "examples": examples}
+    return prompt_builder.context(question)
+
+
+def _chain_inputs(query):
+    return {
+        "user_question": query,
+        "chat_history": _pipeline_history().messages,
+        **prompt_context(query)
+    }
+
+
+def _remember_pipeline(query, pipeline):
+    _pipeline_history().add_messages(
+        [HumanMessage(query), AIMessage(json_util.dumps(pipeline))])
+
+
+# The pipeline text is not an answer; keep its tokens off the message stream
+# and publish the parsed pipeline as a single progress event instead.
+_chain_config = {"tags": [TAG_NOSTREAM]}
+
+
+def _publish_pipeline(pipeline):
+    logger.info(f"Query generated: {abbreviate(pipeline)}")
+    emit_progress("pipeline", {"pipeline": json.loads(json_util.dumps(pipeline))})
+
+
+def _generate_pipeline(query, context):
+    cache = pipeline_cache()
+    if cache is not None:
+        pipeline = cache.get(query, context)
+        if pipeline is not None:
+            logger.info("Pipeline cache hit")
+            record_cache_hit("pipeline")
+            return pipeline, True
+    response = nosql_llm_chain().invoke(_chain_inputs(query), config=_chain_config)
+    return pipeline_validator.parse(response['text']), False
+
+
+async def _agenerate_pipeline(query, context):
+    cache = pipeline_cache()
+    if cache is not None:
+        pipeline = await cache.aget(query, context)
+        if pipeline is not None:
+            logger.info("Pipeline cache hit")
+            record_cache_hit("pipeline")
+            return pipeline, True
+    response = await nosql_llm_chain().ainvoke(_chain_inputs(query), config=_chain_config)
+    return pipeline_validator.parse(response['text']), False
+
+
+def _time_limit():
+    return {"maxTimeMS": query_guard.max_time_ms} if query_guard is not None else {}
+
+
+def _run_aggregation(pipeline, budget=result_budget):
+    if rollups is not None:
+        documents = rollups.answer(pipeline)
+        if documents is not None:
+            for doc in documents:
+                doc.pop('_id', None)
+            return documents, False
+    cache = result_cache()
+    if cache is not None:
+        documents = cache.get(pipeline)
+        if documents is not None:
+            logger.info("Result cache hit")
+            record_cache_hit("result")
+            return documents, False
+    record_mongo_round_trip()
+    results = collection().aggregate(pipeline, batchSize=budget.batch_size, **_time_limit())
+    try:
+        documents, cut_short = budget.collect(results)
+    finally:
+        results.close()
+    for doc in documents:
+        doc.pop('_id', None)
+    # A page cut short depends on the byte budget, not only on the pipeline.
+    if cache is not None and not cut_short:
+        cache.put(pipeline, documents)
+    return documents, cut_short
+
+
+async def _arun_aggregation(pipeline, budget=result_budget):
+    if rollups is not None:
+        documents = rollups.answer(pipeline)
+        if documents is not None:
+            for doc in documents:
+                doc.pop('_id', None)
+            return documents, False
+    cache = result_cache()
+    if cache is not None:
+        documents = await cache.aget(pipeline)
+        if documents is not None:
+            logger.info("Result cache hit")
+            record_cache_hit("result")
+            return documents, False
+    record_mongo_round_trip()
+    results = await async_collection().aggregate(pipeline, batchSize=budget.batch_size,
+                                                 **_time_limit())
+    try:
+        documents, cut_short = await budget.acollect(results)
+    finally:
+        await results.close()
+    for doc in documents:
+        doc.pop('_id', None)
+    if cache is not None and not cut_short:
+        await cache.aput(pipeline, documents)
+    return documents, cut_short
+
+
+def _split_page(documents, cut_short, budget):
+    page = documents[:budget.max_documents]
+    return page, cut_short or len(documents) > len(page)
+
+
+def _total(documents):
+    return documents[0]["total"] if documents else 0
+
+
+def _read_page(base_pipeline, offset=0, total=None, budget=result_budget) -> AggregationResult:
+    documents, cut_short = _run_aggregation(budget.page_pipeline(base_pipeline, offset), budget)
+    page, continues = _split_page(documents, cut_short, budget)
+    if total is None:
+        # Counting costs another round trip; only pay for it when the result continues.
+        total = offset + len(page)
+        if continues:
+            total = _total(_run_aggregation(result_budget.count_pipeline(base_pipeline))[0])
+    return AggregationResult(page, total, offset)
+
+
+async def _aread_page(base_pipeline, offset=0, total=None, budget=result_budget) -> AggregationResult:
+    documents, cut_short = await _arun_aggregation(
+        budget.page_pipeline(base_pipeline, offset), budget)
+    page, continues = _split_page(documents, cut_short, budget)
+    if total is None:
+        total = offset + len(page)
+        if continues:
+            counted, _ = await _arun_aggregation(result_budget.count_pipeline(base_pipeline))
+            total = _total(counted)
+    return AggregationResult(page, total, offset)
+
+
+def _remember_result(base_pipeline, result: AggregationResult):
+    if result.truncated:
+        result.result_id = result_cursors.put(base_pipeline, result.total)
+    context = current_request()
+    if context is not None:
+        context.pipeline = base_pipeline
+        context.result_id = result.result_id
+        context.total_results = result.total
+    summary = result.as_dict()
+    del summary["documents"]
+    emit_progress("result", summary)
+
+
+def pipeline_chat_history():
+    """
+    Returns the earlier questions and pipelines of the current session, as chat messages.
+    """
+    return _pipeline_history().messages
+
+
+def _guarded(pipeline):
+    # Pipelines the rollups answer do not scan the collection.
+    return query_guard is not None and not (rollups is not None and rollups.store.covers(pipeline))
+
+
+def _budget(chart):
+    return chart_budget if chart else result_budget
+
+
+def _execute(pipeline, chart=False):
+    if _guarded(pipeline):
+        pipeline = query_guard.check(pipeline)
+    base_pipeline = result_budget.base_pipeline(pipeline)
+    return pipeline, base_pipeline, _read_page(base_pipeline, budget=_budget(chart))
+
+
+async def _aexecute(pipeline, chart=False):
+    if _guarded(pipeline):
+        pipeline = await query_guard.acheck(pipeline, async_collection())
+    base_pipeline = result_budget.base_pipeline(pipeline)
+    return pipeline, base_pipeline, await _aread_page(base_pipeline, budget=_budget(chart))
+
+
+def _deliver(query, pipeline, base_pipeline, result: AggregationResult) -> AggregationResult:
+    # Records the result in the caller's session and request. A coalesced result
+    # is shared, so each caller gets its own copy to attach its `result_id` to.
+    result = replace(result)
+    _publish_pipeline(pipeline)
+    _remember_pipeline(query, pipeline)
+    _remember_result(base_pipeline, result)
+    return result
+
+
+def run_pipeline(query, pipeline, chart=False) -> AggregationResult:
+    """
+    Runs an aggregation pipeline generated for a question and reads the first
+    page of its results within the result budget. The pipeline is remembered in
+    the session, so follow-up questions can refer to it. The query guard may
+    rewrite the pipeline first, or reject it.
+
+    Args:
+        query (str): The natural language question the pipeline answers.
+        pipeline (list): The aggregation pipeline.
+        chart (bool): Read the result to draw a chart from, up to the chart budget
+            (`CHART_MAX_DOCUMENTS`) instead of one page.
+
+    Returns:
+        AggregationResult: The first page, the total number of results and, when
+            the result continues, the `result_id` for reading further pages.
+
+    Raises:
+        PipelineRejected: When the query guard finds the pipeline too expensive.
+    """
+    return _deliver(query, *_execute(pipeline, chart))
+
+
+async def arun_pipeline(query, pipeline, chart=False) -> AggregationResult:
+    """
+    Async variant of `run_pipeline`.
+    """
+    return _deliver(query, *(await _aexecute(pipeline, chart)))
+
+
+def _flight_key(query, chart):
+    # The generated pipeline depends on the question and the session's earlier pipelines.
+    history = tuple(str(message.content) for message in _pipeline_history().messages)
+    return normalize_question(query), history, chart
+
+
+def _fetch_movies(query, chart):
+    # The prompt carries the session's earlier pipelines, so cached pipelines are
+    # only reused within the same conversation.
+    context = history_digest(_pipeline_history().messages)
+    pipeline, cached = _generate_pipeline(query, context)
+    executed = _execute(pipeline, chart)
+    # Only pipelines that ran successfully are worth reusing.
+    if not cached and pipeline_cache() is not None:
+        pipeline_cache().put(query, pipeline, context)
+    return executed
+
+
+async def _afetch_movies(query, chart):
+    context = history_digest(_pipeline_history().messages)
+    pipeline, cached = await _agenerate_pipeline(query, context)
+    executed = await _aexecute(pipeline, chart)
+    if not cached and pipeline_cache() is not None:
+        await pipeline_cache().aput(query, pipeline, context)
+    return executed
+
+
+def get_movies(query, chart=False) -> AggregationResult:
+    """
+    Generates an aggregation pipeline for the question and runs it with `run_pipeline`.
+    Identical questions asked concurrently in the same context share one execution.
+
+    Args:
+        query (str): The natural language question.
+        chart (bool): Read the result to draw a chart from, see `run_pipeline`.
+
+    Returns:
+        AggregationResult: The first page of the results.
+    """
+    try:
+        logger.info(f"Executing query: {query}")
+        if movie_flights is None:
+            executed = _fetch_movies(query, chart)
+        else:
+            executed, _ = movie_flights.run(_flight_key(query, chart), lambda: _fetch_movies(query, chart))
+        return _deliver(query, *executed)
+    except Exception as e:
+        logger.error(f"Error retrieving movies: {e}")
+        raise
+
+
+async def aget_movies(query, chart=False) -> AggregationResult:
+    """
+    Async variant of `get_movies`. Uses `ainvoke` on the pipeline generation
+    chain and the async MongoDB client, so neither the LLM round trip nor the
+    aggregation blocks the event loop.
+    """
     try:
         logger.info(f"Executing query: {query}")
-        response = nosql_llm_chain.invoke(
-            {
-                "user_question": query,
-                "movies_collection_schema": movies_collection_schema,
-                "examples": examples
-            })
-        iso_date_pattern = re.compile(r'ISODate\("([^"]+)"\)')
-        query_modified = re.sub(
-            iso_date_pattern, iso_date_replacer, response['text'])  
-        query_modified = query_modified.replace('null', 'None').replace(
-            '```json', '').replace('```', '').replace('\n', '').replace('mongodb','')
-        if 'Output:' in query_modified:
-            query_modified = query_modified.split('Output: ')[1]
-        try:
-            # Safely parse the modified query string
-            pipeline = eval(query_modified)
-        except Exception as e:
-            logger.error(f"JSON decode error: {e}")
-            logger.error(f"Query: {query_modified}")
-            pipeline = json.loads(query_modified)
-
-        logger.info(f"Query generated: {pipeline}")
-        results = collection.aggregate(pipeline)
-        documents = []
-        for doc in results:
-            documents.append(doc)
-            doc.pop('_id', None)
-        return documents
+        if movie_flights is None:
+            executed = await _afetch_movies(query, chart)
+        else:
+            executed, _ = await movie_flights.arun(
+                _flight_key(query, chart), lambda: _afetch_movies(query, chart))
+        return _deliver(query, *executed)
     except Exception as e:
         logger.error(f"Error retrieving movies: {e}")
         raise
+
+
+async def aget_movies_page(result_id: str, offset: int) -> Optional[AggregationResult]:
+    """
+    Reads a further page of a truncated result.
+
+    Args:
+        result_id (str): The `result_id` of the truncated result.
+        offset (int): The position of the first document to return.
+
+    Returns:
+        AggregationResult: The page, or None when the result is unknown or expired.
+    """
+    try:
+        cursor = result_cursors.get(result_id)
+        if cursor is None:
+            return None
+        base_pipeline, total = cursor
+        result = await _aread_page(base_pipeline, offset, total)
+        result.result_id = result_id
+        return result
+    except Exception as e:
+        logger.error(f"Error reading result page: {e}")
+        raise
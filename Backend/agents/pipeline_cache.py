@@ -0,0 +1,250 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+from agents.logger import setup_logger
+import copy
+import hashlib
+import numpy as np
+import os
+import re
+import threading
+import time
+
+logger = setup_logger(__name__)
+
+_quoted_pattern = re.compile(r'"([^"]+)"|\'([^\']+)\'')
+_number_pattern = re.compile(r'\d+(?:\.\d+)?')
+_proper_noun_pattern = re.compile(r'\b[A-Z][\w.\'-]*(?:\s+[A-Z][\w.\'-]*)*')
+_non_word_pattern = re.compile(r'[^\w\s.\'-]')
+
+
+def normalize_question(question: str) -> str:
+    """
+    Normalizes a question for exact cache lookups: case, punctuation and
+    whitespace differences are ignored.
+    """
+    normalized = _non_word_pattern.sub(' ', question.lower())
+    return ' '.join(normalized.split()).strip(' .')
+
+
+def question_literals(question: str) -> frozenset:
+    """
+    Extracts the literal values of a question: numbers, quoted strings and
+    capitalized names. Two questions can only share a pipeline through a
+    similarity match when these are identical, so "movies from 2001" never
+    reuses the pipeline of "movies from 2002".
+    """
+    literals = set(_number_pattern.findall(question))
+    for double_quoted, single_quoted in _quoted_pattern.findall(question):
+        literals.add((double_quoted or single_quoted).lower())
+    # The first word is capitalized because it starts the sentence, not because it is a name.
+    for match in _proper_noun_pattern.finditer(question):
+        if match.start() > 0:
+            literals.add(match.group(0).rstrip("'").lower())
+    return frozenset(literals)
+
+
+def history_digest(messages) -> str:
+    """
+    Digest of the chat history a generation prompt carries, for keeping cached
+    pipelines to the conversation they were generated in. Empty without history.
+    """
+    if not messages:
+        return ""
+    digest = hashlib.sha256()
+    for message in messages:
+        digest.update(f"{message.type}\0{message.content}\0".encode("utf-8"))
+    return digest.hexdigest()
+
+
+@dataclass
+class _Entry:
+    pipeline: list
+    expires_at: float
+    literals: frozenset
+    context: str = ""
+    embedding: Optional[np.ndarray] = None
+
+
+class PipelineCache:
+    """
+    Caches the aggregation pipeline generated for a natural language question.
+
+    Lookups try an exact match on the normalized question first and then, when an
+    embeddings model is configured, the most similar cached question above
+    `similarity_threshold`. Questions asked after earlier ones depend on the
+    conversation, so the `context` they were cached with, a `history_digest`,
+    must match as well. Entries expire after `ttl_seconds` and the least
+    recently used entry is evicted once `max_entries` is reached.
+    """
+
+    def __init__(self, max_entries: int = 512, ttl_seconds: float = 3600,
+                 similarity_threshold: float = 0.95, embeddings=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.embeddings = embeddings
+        self._entries = OrderedDict()
+        self._embedding_memo = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "semantic_hits": 0, "misses": 0,
+                       "evictions": 0, "expirations": 0}
+
+    def get(self, question: str, context: str = "") -> Optional[list]:
+        """
+        Returns a copy of the pipeline cached for the question in the same `context`,
+        or None on a miss.
+        """
+        key = normalize_question(question)
+        pipeline = self._get_exact(context, key)
+        if pipeline is None and self.embeddings is not None:
+            pipeline = self._get_similar(
+                context, key, question_literals(question), self._embed(key))
+        return self._record_lookup(pipeline)
+
+    async def aget(self, question: str, context: str = "") -> Optional[list]:
+        """
+        Async variant of `get`; the question embedding is computed with `aembed_query`.
+        """
+        key = normalize_question(question)
+        pipeline = self._get_exact(context, key)
+        if pipeline is None and self.embeddings is not None:
+            pipeline = self._get_similar(
+                context, key, question_literals(question), await self._aembed(key))
+        return self._record_lookup(pipeline)
+
+    def put(self, question: str, pipeline: list, context: str = ""):
+        """
+        Stores a pipeline that has been parsed and executed successfully.
+        """
+        key = normalize_question(question)
+        embedding = self._embed(key) if self.embeddings is not None else None
+        self._store(context, key, question_literals(question), pipeline, embedding)
+
+    async def aput(self, question: str, pipeline: list, context: str = ""):
+        """
+        Async variant of `put`.
+        """
+        key = normalize_question(question)
+        embedding = await self._aembed(key) if self.embeddings is not None else None
+        self._store(context, key, question_literals(question), pipeline, embedding)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._embedding_memo.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries)}
+
+    def _get_exact(self, context, key):
+        with self._lock:
+            entry = self._live_entry((context, key))
+            if entry is None:
+                return None
+            self._entries.move_to_end((context, key))
+            self._stats["hits"] += 1
+            return copy.deepcopy(entry.pipeline)
+
+    def _get_similar(self, context, key, literals, embedding):
+        with self._lock:
+            best_key, best_score = None, self.similarity_threshold
+            for candidate_key in list(self._entries):
+                entry = self._live_entry(candidate_key)
+                if entry is None or entry.embedding is None or entry.literals != literals \
+                        or entry.context != context:
+                    continue
+                score = float(np.dot(entry.embedding, embedding))
+                if score >= best_score:
+                    best_key, best_score = candidate_key, score
+            if best_key is None:
+                return None
+            self._entries.move_to_end(best_key)
+            self._stats["semantic_hits"] += 1
+            logger.info(
+                f"Pipeline cache similarity hit ({best_score:.3f}): '{key}' -> '{best_key[1]}'")
+            return copy.deepcopy(self._entries[best_key].pipeline)
+
+    def _record_lookup(self, pipeline):
+        if pipeline is None:
+            with self._lock:
+                self._stats["misses"] += 1
+        return pipeline
+
+    def _store(self, context, key, literals, pipeline, embedding):
+        with self._lock:
+            self._entries[context, key] = _Entry(
+                pipeline=copy.deepcopy(pipeline),
+                expires_at=time.monotonic() + self.ttl_seconds,
+                literals=literals,
+                context=context,
+                embedding=embedding)
+            self._entries.move_to_end((context, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def _live_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= time.monotonic():
+            del self._entries[key]
+            self._stats["expirations"] += 1
+            return None
+        return entry
+
+    def _embed(self, key):
+        embedding = self._memoized_embedding(key)
+        if embedding is None:
+            embedding = self._remember_embedding(key, self.embeddings.embed_query(key))
+        return embedding
+
+    async def _aembed(self, key):
+        embedding = self._memoized_embedding(key)
+        if embedding is None:
+            embedding = self._remember_embedding(
+                key, await self.embeddings.aembed_query(key))
+        return embedding
+
+    def _memoized_embedding(self, key):
+        # A miss is usually followed by a put for the same question; keep its
+        # embedding around so it is only computed once.
+        with self._lock:
+            embedding = self._embedding_memo.get(key)
+            if embedding is not None:
+                self._embedding_memo.move_to_end(key)
+            return embedding
+
+    def _remember_embedding(self, key, vector):
+        embedding = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        if norm:
+            embedding = embedding / norm
+        with self._lock:
+            self._embedding_memo[key] = embedding
+            while len(self._embedding_memo) > self.max_entries:
+                self._embedding_memo.popitem(last=False)
+        return embedding
+
+
+def create_pipeline_cache(embeddings=None) -> Optional[PipelineCache]:
+    """
+    Builds the pipeline cache from the environment, or returns None when it is disabled.
+
+    Environment variables:
+        PIPELINE_CACHE_ENABLED: 'false' disables the cache. Defaults to 'true'.
+        PIPELINE_CACHE_MAX_ENTRIES: LRU capacity. Defaults to 512.
+        PIPELINE_CACHE_TTL_SECONDS: Entry lifetime. Defaults to 3600.
+        PIPELINE_CACHE_SEMANTIC_ENABLED: 'false' keeps exact matching only. Defaults to 'true'.
+        PIPELINE_CACHE_SIMILARITY_THRESHOLD: Minimum cosine similarity of a
+            similarity match. Defaults to 0.95.
+    """
+    if os.getenv("PIPELINE_CACHE_ENABLED", "true") != "true":
+        return None
+    semantic_enabled = os.getenv("PIPELINE_CACHE_SEMANTIC_ENABLED", "true") == "true"
+    return PipelineCache(
+        max_entries=int(os.getenv("PIPELINE_CACHE_MAX_ENTRIES", "512")),
+        ttl_seconds=float(os.getenv("PIPELINE_CACHE_TTL_SECONDS", "3600")),
+        similarity_threshold=float(
+            os.getenv("PIPELINE_CACHE_SIMILARITY_THRESHOLD", "0.95")),
+        embeddings=embeddings if semantic_enabled else None)
@@ -0,0 +1,424 @@
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+from agents.logger import setup_logger
+from bson import json_util
+import difflib
+import json
+import os
+import re
+import threading
+
+logger = setup_logger(__name__)
+
+ALLOWED_STAGES = frozenset({
+    "$match", "$group", "$project", "$sort", "$limit", "$skip", "$unwind", "$count",
+    "$addFields", "$set", "$unset", "$sortByCount", "$bucket", "$bucketAuto", "$facet",
+    "$replaceRoot", "$replaceWith", "$sample",
+})
+# Server-side JavaScript is never needed to answer a question about movies.
+FORBIDDEN_OPERATORS = frozenset({"$where", "$function", "$accumulator"})
+
+_shell_constructors = (
+    (re.compile(r'(?:new\s+)?(?:ISODate|Date)\(\s*"([^"]+)"\s*\)'), "date"),
+    (re.compile(r'ObjectId\(\s*"([0-9a-fA-F]{24})"\s*\)'), "oid"),
+    (re.compile(r'Number(?:Long|Int)\(\s*"?(-?\d+)"?\s*\)'), "number"),
+)
+_schema_line = re.compile(r'^(\s*)- \*\*([\w.]+)\*\*')
+_identifier = re.compile(r'[$A-Za-z_][\w$.]*')
+_trailing_comma = re.compile(r',\s*[\]}]')
+
+
+class PipelineParseError(ValueError):
+    """Raised when generated text does not contain a readable pipeline."""
+
+
+class PipelineRejected(ValueError):
+    """Raised when a pipeline fails validation and cannot be repaired."""
+
+
+def _shell_replacement(kind, match):
+    value = match.group(1)
+    if kind == "date":
+        # Extended JSON needs a full timestamp; ISODate also accepts plain dates.
+        date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        return json.dumps({"$date": date.isoformat()})
+    if kind == "oid":
+        return json.dumps({"$oid": value})
+    return value
+
+
+def _strip_wrapping(text):
+    text = re.sub(r'```[a-zA-Z]*', '', text)
+    if 'Output:' in text:
+        text = text.split('Output:', 1)[1]
+    return text.strip()
+
+
+def _relax_json(text):
+    # Rewrites JavaScript and Python literal syntax outside of strings into JSON:
+    # single quoted strings, unquoted keys, None/True/False and trailing commas.
+    output, index, length = [], 0, len(text)
+    while index < length:
+        char = text[index]
+        if char in "\"'":
+            end = index + 1
+            while end < length and text[end] != char:
+                end += 2 if text[end] == "\\" else 1
+            body = text[index + 1:end]
+            if char == "'":
+                body = body.replace("\\'", "'").replace('"', '\\"')
+            output.append(f'"{body}"')
+            index = end + 1
+            continue
+        identifier = _identifier.match(text, index)
+        if identifier:
+            word = identifier.group(0)
+            after = text[index + len(word):].lstrip()
+            if after.startswith(":"):
+                output.append(f'"{word}"')
+            else:
+                output.append({"None": "null", "True": "true", "False": "false"}.get(word, word))
+            index += len(word)
+            continue
+        if char == "," and _trailing_comma.match(text, index):
+            index += 1
+            continue
+        output.append(char)
+        index += 1
+    return "".join(output)
+
+
+def parse_extended_json(text: str, expected: type = list):
+    """
+    Parses MongoDB Extended JSON out of model output, without `eval`.
+
+    Code fences and an 'Output:' prefix are dropped, and the shell constructors
+    `ISODate(...)`, `new Date(...)`, `ObjectId(...)` and `NumberLong(...)` become
+    their Extended JSON forms. Text that is not strict JSON is retried after
+    `_relax_json` rewrites JavaScript and Python literal syntax.
+
+    Args:
+        text (str): The model output.
+        expected (type): `list` for a pipeline, `dict` for an object such as a plan.
+
+    Returns:
+        tuple: The parsed value and the repairs needed to read it.
+
+    Raises:
+        PipelineParseError: When no value of the expected type can be read.
+    """
+    text = _strip_wrapping(text)
+    for pattern, kind in _shell_constructors:
+        text = pattern.sub(lambda match, kind=kind: _shell_replacement(kind, match), text)
+    opening, closing = ("[", "]") if expected is list else ("{", "}")
+    start, end = text.find(opening), text.rfind(closing)
+    repairs = []
+    brace = text.find("{")
+    if expected is list and brace != -1 and (start == -1 or brace < start):
+        # Stages listed without the enclosing array.
+        text = f"[{text[brace:text.rfind('}') + 1]}]"
+        start, end = 0, len(text) - 1
+        repairs.append("wrapped the stages in an array")
+    if start == -1 or end < start:
+        raise PipelineParseError(f"No JSON {expected.__name__} found in: {text[:200]}")
+    candidate = text[start:end + 1]
+    try:
+        value = json_util.loads(candidate)
+    except ValueError:
+        try:
+            value = json_util.loads(_relax_json(candidate))
+            repairs.append("relaxed JSON syntax")
+        except ValueError as e:
+            raise PipelineParseError(f"Unreadable JSON: {e}") from e
+    if not isinstance(value, expected):
+        raise PipelineParseError(f"Expected a JSON {expected.__name__}, got {type(value).__name__}")
+    return value, repairs
+
+
+def schema_fields(schema_text: str) -> frozenset:
+    """
+    Reads the field paths out of a Markdown schema description such as
+    `movies_collection_schema`, where nesting is given by indentation.
+    """
+    fields, stack = set(), []
+    for line in schema_text.splitlines():
+        match = _schema_line.match(line)
+        if not match:
+            continue
+        indent, name = len(match.group(1)), match.group(2)
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+        path = ".".join([parent for _, parent in stack] + [name])
+        fields.add(path)
+        stack.append((indent, name))
+    return frozenset(fields)
+
+
+@dataclass
+class ValidationResult:
+    pipeline: list
+    repairs: list = field(default_factory=list)
+    warnings: list = field(default_factory=list)
+
+
+class PipelineValidator:
+    """
+    Parses generated pipelines safely and checks them before they reach MongoDB.
+
+    A pipeline is rejected when it uses a stage outside `ALLOWED_STAGES`, server-side
+    JavaScript, or a field path that is not in the collection schema and has no
+    close match. The sub-pipelines of a `$facet` are checked the same way. Cheap repairs are applied instead of rejecting: relaxed JSON
+    syntax, a single stage not wrapped in an array, misspelled field paths with one
+    close match in the schema (`imdb_rating` -> `imdb.rating`), and a `$sort` ahead
+    of a `$match`, which is swapped so the `$match` can use an index. A first stage
+    that cannot use one of `indexed_fields` is only reported.
+    """
+
+    def __init__(self, fields: Iterable[str], indexed_fields: Iterable[str] = ("_id",),
+                 repair_cutoff: float = 0.8):
+        self.fields = frozenset(fields)
+        self.indexed_fields = frozenset(indexed_fields)
+        self.repair_cutoff = repair_cutoff
+        self._lock = threading.Lock()
+        self._stats = {"parsed": 0, "parse_failures": 0, "repairs": 0, "rejects": 0, "unindexed": 0}
+
+    def parse(self, text: str, pipeline_key: Optional[str] = None):
+        """
+        Parses and validates a pipeline generated by the model.
+
+        Args:
+            text (str): The model output.
+            pipeline_key (str, optional): When given, the output is a JSON object, such
+                as a visualization plan, holding the pipeline under this key.
+
+        Returns:
+            list | dict: The validated pipeline, or the object with its pipeline validated.
+
+        Raises:
+            PipelineParseError: When the text holds no pipeline.
+            PipelineRejected: When the pipeline fails validation.
+        """
+        try:
+            value, repairs = parse_extended_json(text, dict if pipeline_key else list)
+            if pipeline_key and not isinstance(value.get(pipeline_key), (list, dict)):
+                raise PipelineParseError(f"No aggregation pipeline under '{pipeline_key}'")
+        except PipelineParseError as e:
+            self._count("parse_failures")
+            logger.error(f"Could not parse the generated pipeline: {e}")
+            raise
+        self._count("parsed")
+        if not pipeline_key:
+            return self.validate(value, repairs).pipeline
+        value[pipeline_key] = self.validate(value[pipeline_key], repairs).pipeline
+        return value
+
+    def validate(self, pipeline, repairs: Optional[list] = None) -> ValidationResult:
+        """
+        Validates a parsed pipeline and applies the cheap repairs.
+
+        Returns:
+            ValidationResult: The possibly repaired pipeline, the repairs made and warnings.
+
+        Raises:
+            PipelineRejected: When the pipeline fails validation.
+        """
+        result = ValidationResult(pipeline, list(repairs or []))
+        try:
+            if isinstance(pipeline, dict):
+                result.pipeline = [pipeline]
+                result.repairs.append("wrapped a single stage in an array")
+            result.pipeline, _ = self._check_stages(
+                result.pipeline, self._with_prefixes(self.fields), result)
+            self._check_indexes(result)
+        except PipelineRejected as e:
+            self._count("rejects")
+            logger.error(f"Rejected the generated pipeline: {e}")
+            raise
+        if result.repairs:
+            self._count("repairs")
+            logger.info(f"Repaired the generated pipeline: {', '.join(result.repairs)}")
+        for warning in result.warnings:
+            logger.info(f"Generated pipeline: {warning}")
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, counter):
+        with self._lock:
+            self._stats[counter] += 1
+
+    def _check_stages(self, pipeline, known, result, in_facet=False):
+        # Returns the checked stages and the fields after them, or None once untracked.
+        if not isinstance(pipeline, list):
+            raise PipelineRejected(f"A pipeline must be an array of stages: {pipeline}")
+        stages = []
+        for stage in pipeline:
+            if not isinstance(stage, dict) or len(stage) != 1:
+                raise PipelineRejected(f"A stage must be an object with one operator: {stage}")
+            (name, body), = stage.items()
+            if name not in ALLOWED_STAGES:
+                raise PipelineRejected(
+                    f"Stage {name} is not allowed; use one of {', '.join(sorted(ALLOWED_STAGES))}")
+            self._check_forbidden(body)
+            if name == "$facet":
+                if in_facet:
+                    raise PipelineRejected("A $facet stage cannot be nested in another $facet")
+                body, known = self._check_facet(body, known, result)
+            elif known is not None:
+                body = self._check_stage_fields(name, body, known, result)
+                known = self._fields_after(name, body, known)
+            stages.append({name: body})
+        # A $sort before a $match keeps the $match from using an index; the order does not matter.
+        for index in range(len(stages) - 1):
+            if "$sort" in stages[index] and "$match" in stages[index + 1]:
+                stages[index], stages[index + 1] = stages[index + 1], stages[index]
+                result.repairs.append("moved $match ahead of $sort")
+        return stages, known
+
+    def _check_facet(self, body, known, result):
+        # Each output field holds the documents of its own sub-pipeline as an array.
+        if not isinstance(body, dict) or not body:
+            raise PipelineRejected(f"$facet must map output fields to pipelines: {body}")
+        checked, after = {}, set()
+        for output, pipeline in body.items():
+            checked[output], inner = self._check_stages(pipeline, known, result, in_facet=True)
+            if after is not None and inner is not None:
+                after |= self._with_prefixes([output]) | {f"{output}.{path}" for path in inner}
+            else:
+                after = None
+        return checked, after
+
+    def _check_forbidden(self, value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if key in FORBIDDEN_OPERATORS:
+                    raise PipelineRejected(f"Operator {key} is not allowed")
+                self._check_forbidden(item)
+        elif isinstance(value, list):
+            for item in value:
+                self._check_forbidden(item)
+
+    def _check_stage_fields(self, name, body, known, result):
+        if name == "$match":
+            return self._check_query(body, known, result)
+        if name == "$sort":
+            return {self._checked_path(key, known, result): order for key, order in body.items()}
+        if name in ("$group", "$project", "$addFields", "$set", "$bucket", "$sortByCount"):
+            return self._check_expression(body, known, result)
+        if name == "$unwind":
+            return self._check_expression(body, known, result)
+        return body
+
+    def _check_query(self, query, known, result):
+        if not isinstance(query, dict):
+            return query
+        checked = {}
+        for key, value in query.items():
+            if key in ("$and", "$or", "$nor") and isinstance(value, list):
+                checked[key] = [self._check_query(item, known, result) for item in value]
+            elif key == "$expr":
+                checked[key] = self._check_expression(value, known, result)
+            elif key.startswith("$"):
+                checked[key] = value
+            else:
+                checked[self._checked_path(key, known, result)] = value
+        return checked
+
+    def _check_expression(self, value, known, result):
+        # Field references are strings starting with a single '$'.
+        if isinstance(value, str) and value.startswith("$") and not value.startswith("$$"):
+            return "$" + self._checked_path(value[1:], known, result)
+        if isinstance(value, dict):
+            return {key: self._check_expression(item, known, result) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._check_expression(item, known, result) for item in value]
+        return value
+
+    def _checked_path(self, path, known, result):
+        # Array positions ('genres.0') are not part of the schema.
+        normalized = ".".join(part for part in path.split(".") if not part.isdigit())
+        if normalized in known:
+            return path
+        matches = difflib.get_close_matches(normalized.lower(), sorted(known), n=2,
+                                            cutoff=self.repair_cutoff)
+        if len(matches) == 1 or (matches and difflib.SequenceMatcher(
+                None, normalized.lower(), matches[0]).ratio() == 1.0):
+            result.repairs.append(f"field {path} -> {matches[0]}")
+            return matches[0]
+        raise PipelineRejected(
+            f"Unknown field '{path}'" + (f"; did you mean {' or '.join(matches)}?" if matches else ""))
+
+    def _fields_after(self, name, body, known):
+        # The fields the next stage can refer to, or None once they cannot be tracked.
+        if name in ("$addFields", "$set"):
+            return known | self._with_prefixes(body)
+        if name == "$unset":
+            removed = {body} if isinstance(body, str) else set(body)
+            return {path for path in known
+                    if not any(path == item or path.startswith(item + ".") for item in removed)}
+        if name == "$group":
+            return self._with_prefixes(list(body) + self._id_paths(body.get("_id")))
+        if name == "$project":
+            included = [key for key, value in body.items() if value not in (0, False)]
+            excluded = [key for key, value in body.items() if value in (0, False)]
+            if included and included != ["_id"]:
+                kept = {path for path in known
+                        if any(path == key or path.startswith(key + ".") for key in included)}
+                return kept | self._with_prefixes(included) | ({"_id"} if "_id" not in excluded else set())
+            return {path for path in known
+                    if not any(path == key or path.startswith(key + ".") for key in excluded)}
+        if name == "$count":
+            return {body}
+        if name == "$sortByCount":
+            return {"_id", "count"}
+        if name in ("$bucket", "$bucketAuto"):
+            return self._with_prefixes(["_id", "count"] + list((body.get("output") or {}).keys()))
+        if name in ("$match", "$sort", "$limit", "$skip", "$unwind", "$sample"):
+            return known
+        return None
+
+    def _id_paths(self, group_id):
+        if isinstance(group_id, dict):
+            return [f"_id.{key}" for key in group_id]
+        return []
+
+    def _with_prefixes(self, paths):
+        expanded = set()
+        for path in paths:
+            parts = path.split(".")
+            expanded.update(".".join(parts[:size]) for size in range(1, len(parts) + 1))
+        return expanded
+
+    def _check_indexes(self, result):
+        first = result.pipeline[0] if result.pipeline else {}
+        query = first.get("$match")
+        if query is None:
+            result.warnings.append("the first stage is not a $match, so no index narrows the input")
+        elif not any(path.split(".")[0] in self.indexed_fields or path in self.indexed_fields
+                     or path == "$text" for path in query):
+            result.warnings.append(f"the first $match uses no indexed field ({', '.join(sorted(self.indexed_fields))})")
+        else:
+            return
+        self._count("unindexed")
+
+
+def create_pipeline_validator() -> PipelineValidator:
+    """
+    Builds the pipeline validator for the `movies` collection from the environment.
+
+    Environment variables:
+        PIPELINE_INDEXED_FIELDS: Comma separated fields with an index. Defaults to '_id'.
+        PIPELINE_REPAIR_CUTOFF: Similarity from which an unknown field is replaced by
+            a schema field. Defaults to 0.8.
+    """
+    from prompts.mongoDB_movies_Prompt import movies_collection_schema
+    indexed = [name.strip() for name in os.getenv("PIPELINE_INDEXED_FIELDS", "_id").split(",")
+               if name.strip()]
+    return PipelineValidator(
+        schema_fields(movies_collection_schema), indexed,
+        repair_cutoff=float(os.getenv("PIPELINE_REPAIR_CUTOFF", "0.8")))
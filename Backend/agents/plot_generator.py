@@ -1,19 +1,63 @@
-import json
-import matplotlib.pyplot as plt
-from langchain.chains import LLMChain
-from llmManager import LLMManager
-from mongodb_retriever import get_movies
+import asyncio
+from langchain_core.output_parsers import StrOutputParser
+from agents.chart_builder import chart_from_templates
+from agents.chart_payload import create_chart_payloads
+from agents.downsampling import figure_json, point_budget
+from agents.chart_sandbox import code_inputs, create_chart_sandbox
+from agents.columnar import ColumnarResult, as_columnar
+from agents.clients import LazySingleton, get_llm_manager
+from agents.metrics import record_cache_hit
+from agents.mongodb_retriever import (
+    aget_movies, arun_pipeline, get_movies, pipeline_chat_history, pipeline_validator, prompt_builder,
+    prompt_context, run_pipeline)
+from agents.pipeline_cache import create_pipeline_cache, history_digest
+from agents.request_context import current_request
+from langgraph.constants import TAG_NOSTREAM
 from prompts.mongoDB_movies_Prompt import movies_collection_schema
-from prompts.visualizationPrompt import create_code_generation_prompt, create_query_generation_prompt
+from prompts.visualizationPrompt import (
+    create_code_generation_prompt, create_query_generation_prompt, create_visualization_plan_prompt)
 from langchain_core.tools import tool
-from logger import setup_logger
+from logger import abbreviate, setup_logger
+import json
 import re
 
 logger = setup_logger(__name__)
 
-llm = LLMManager().llm
+
+def create_visualization_chains(llm):
+    """
+    Builds the query rephrasing and plotting code generation chains.
+
+    Args:
+        llm: The chat model both chains use.
+
+    Returns:
+        tuple: The query generation chain and the code generation chain. Both return plain text.
+    """
+    query_generation_chain = create_query_generation_prompt() | llm | StrOutputParser()
+    code_generation_chain = create_code_generation_prompt() | llm | StrOutputParser()
+    return query_generation_chain, code_generation_chain
 
 
+visualization_chains = LazySingleton(
+    lambda: create_visualization_chains(get_llm_manager().llm))
+visualization_plan_chain = LazySingleton(
+    lambda: create_visualization_plan_prompt() | get_llm_manager().llm | StrOutputParser())
+# Plans that ran successfully, keyed by question and conversation like the pipeline cache.
+plan_cache = LazySingleton(
+    lambda: create_pipeline_cache(embeddings=get_llm_manager().embeddings))
+chart_sandbox = LazySingleton(create_chart_sandbox)
+# Encodes the figure JSON of the chart nodes for responses and keeps it for /charts.
+chart_payloads = create_chart_payloads()
+# Without rows there is nothing to plot, nor to show the code generation model.
+_NO_DATA_ANSWER = "No movies matched the question, so there is nothing to chart."
+
+
+def _rephrase_schema(question):
+    if prompt_builder is None:
+        return movies_collection_schema
+    return prompt_builder.schema(question, prompt_builder.select_examples(question))
+
 def rephrase_user_query_for_visualization(state):
     """
     Rephrases the user's query for visualization purposes by generating a new query.
@@ -23,14 +67,29 @@ def rephrase_user_query_for_visualization(state):
         dict: A dictionary containing the rephrased question under the key 'rephrasedQuestion'.
     """
     try:
-        query_generation_prompt = create_query_generation_prompt()
-        query_generation_chain = LLMChain(
-            llm=llm, prompt=query_generation_prompt, verbose=True)
-
+        query_generation_chain, _ = visualization_chains()
         new_user_query = query_generation_chain.invoke({
             "user_query": state['question'],
-            "collection_schema": movies_collection_schema
-        })['text']
+            "collection_schema": _rephrase_schema(state['question'])
+        })
+
+        logger.info(f"Generated Query: {new_user_query}")
+        return {"rephrasedQuestion": new_user_query}
+    except Exception as e:
+        logger.error(f"Error rephrasing user query for visualization: {e}")
+        raise
+
+
+async def arephrase_user_query_for_visualization(state):
+    """
+    Async variant of `rephrase_user_query_for_visualization`.
+    """
+    try:
+        query_generation_chain, _ = visualization_chains()
+        new_user_query = await query_generation_chain.ainvoke({
+            "user_query": state['question'],
+            "collection_schema": _rephrase_schema(state['question'])
+        })
 
         logger.info(f"Generated Query: {new_user_query}")
         return {"rephrasedQuestion": new_user_query}
@@ -48,90 +107,337 @@ def generate_mongo_query(state):
     Args:
         state (dict): A dictionary containing the 'question' key used to generate the query.
     Returns:
-        dict or str: A dictionary with the key 'mongoQueryResult' containing the retrieved data,
-                     or a string message indicating no data was retrieved.
+        dict: A dictionary with the key 'mongoQueryResult' containing the retrieved data
+              as a `ColumnarResult`.
+    """
+    try:
+        retrieved_data = get_movies(state['question'], chart=True).documents
+
+        # Check if retrieved_data is empty
+        if not retrieved_data:
+            return {"mongoQueryResult": ColumnarResult.from_documents([])}
+        else:
+            logger.info(f"Retrieved {len(retrieved_data)} documents: {abbreviate(retrieved_data)}")
+        return {"mongoQueryResult": ColumnarResult.from_documents(retrieved_data)}
+    except Exception as e:
+        logger.error(f"Error generating MongoDB query: {e}")
+        raise
+
+
+async def agenerate_mongo_query(state):
+    """
+    Async variant of `generate_mongo_query` backed by `aget_movies`.
     """
     try:
-        retrieved_data = get_movies(state['question'])
+        retrieved_data = (await aget_movies(state['question'], chart=True)).documents
 
         # Check if retrieved_data is empty
         if not retrieved_data:
-            return {"mongoQueryResult": []}
+            return {"mongoQueryResult": ColumnarResult.from_documents([])}
         else:
-            logger.info(f"Retrieved Data: {retrieved_data}")
-        return {"mongoQueryResult": retrieved_data}
+            logger.info(f"Retrieved {len(retrieved_data)} documents: {abbreviate(retrieved_data)}")
+        return {"mongoQueryResult": ColumnarResult.from_documents(retrieved_data)}
     except Exception as e:
         logger.error(f"Error generating MongoDB query: {e}")
         raise
 
 
+def _code_generation_inputs(state):
+    retrieved_data = as_columnar(state['mongoQueryResult'])
+    # `_id` values are already strings in the columnar result.
+    sample_record = retrieved_data.record(0)  # Show the full sample record
+    column_names = list(sample_record.keys())
+    number_of_rows = len(retrieved_data)
+    return {
+        "column_names": column_names,
+        "number_of_rows": number_of_rows,
+        "sample_record": sample_record,
+        "collection_schema": movies_collection_schema,
+        "user_query": state['question']
+    }
+
+
+def _execute_generated_code(code_response_text, retrieved_data):
+    generated_code = re.sub(r'```python|```', '',
+                            code_response_text).strip()
+
+    logger.info(f"Generated Python Code:\n{generated_code}")
+    retrieved_data = as_columnar(retrieved_data)
+
+    sandbox = chart_sandbox()
+    if sandbox is not None:
+        # Runs in a worker process with restricted imports and CPU, memory and time limits.
+        chart_response = sandbox.run(generated_code, retrieved_data)
+        logger.info(f'Final response plot: {abbreviate(chart_response)}')
+        return {"chart": chart_response}
+
+    try:
+        # Execute the generated code to produce `fig`
+        compiled_code = compile(generated_code, "<generated>", "exec")
+        local_context = code_inputs(compiled_code, retrieved_data)
+        exec(compiled_code, local_context, local_context)
+        final_response_plot = local_context.get('fig')
+        if not final_response_plot:
+            logger.error("No plot was generated.")
+            return {"chart": None}
+
+        chart_response = figure_json(final_response_plot, point_budget())
+        logger.info(f'Final response plot: {abbreviate(chart_response)}')
+        return {"chart": chart_response}
+
+    except KeyError as e:
+        logger.error(
+            "No plot object named 'fig' was found in the generated code.")
+        return {"chart": None}
+
+    except Exception as e:
+        logger.error(
+            f"Error occurred while executing the generated code: {str(e)}")
+        return {"chart": None}
+
+
+def _generate_code_chart(state):
+    if not len(as_columnar(state['mongoQueryResult'])):
+        logger.info("No data to chart; skipping code generation")
+        return {"chart": None, "answer": _NO_DATA_ANSWER}
+    # Use the LLM chain to generate Python code for plotting
+    _, code_generation_chain = visualization_chains()
+    code_response = code_generation_chain.invoke(
+        _code_generation_inputs(state))
+
+    return _execute_generated_code(
+        code_response, state['mongoQueryResult'])
+
+
+async def _agenerate_code_chart(state):
+    if not len(as_columnar(state['mongoQueryResult'])):
+        logger.info("No data to chart; skipping code generation")
+        return {"chart": None, "answer": _NO_DATA_ANSWER}
+    _, code_generation_chain = visualization_chains()
+    code_response = await code_generation_chain.ainvoke(
+        _code_generation_inputs(state))
+
+    return await asyncio.to_thread(
+        _execute_generated_code,
+        code_response, state['mongoQueryResult'])
+
+
+def _report_truncation(state, update):
+    # Charts are drawn from at most `CHART_MAX_DOCUMENTS` rows; a chart of a result
+    # cut short says so in the answer and under `layout.meta.truncated`.
+    context = current_request()
+    total = context.total_results if context is not None else None
+    rows = len(as_columnar(state['mongoQueryResult']))
+    if not update.get('chart') or total is None or total <= rows:
+        return update
+    logger.info(f"Chart drawn from {rows} of {total} results")
+    figure = json.loads(update['chart'])
+    meta = figure.setdefault("layout", {}).setdefault("meta", {})
+    if isinstance(meta, dict):
+        meta["truncated"] = {"rows": rows, "total": total}
+    return {**update, "chart": json.dumps(figure),
+            "answer": f"The chart is drawn from the first {rows} of {total} results."}
+
+
+def _template_chart(state):
+    context = current_request()
+    return chart_from_templates(state['mongoQueryResult'],
+                                context.pipeline if context else None, state['question'])
+
+
 def generate_chart_based_on_query(state):
     """
     Generates a chart based on the provided query state.
-    This function retrieves data from the state, extracts relevant information,
+    Common chart shapes are built from templates (see `chart_from_templates`).
+    Otherwise this function extracts relevant information from the data,
     generates Python code for plotting using a language model, and executes the
     generated code to produce a plot.
     Args:
         state (dict): A dictionary containing the following keys:
-            - 'mongoQueryResult': The result of a MongoDB query, expected to be a list of documents.
+            - 'mongoQueryResult': The result of a MongoDB query, as a `ColumnarResult`.
             - 'question': The user's query or question that guides the chart generation.
     Returns:
         dict or str: A dictionary containing the generated chart in JSON format if successful,
                      or an error message string if an error occurs during code execution.
     """
     try:
-        retrieved_data = state['mongoQueryResult']
-        column_names = list(retrieved_data[0].keys())
-        number_of_rows = len(retrieved_data)
-        id = "_id"
-        for record in retrieved_data:
-            for key in record:
-                if key == id:
-                    record[key] = str(record[key])
-        sample_record = retrieved_data[0]  # Show the full sample record
-        code_generation_prompt = create_code_generation_prompt()
-        code_generation_chain = LLMChain(
-            llm=llm, prompt=code_generation_prompt, verbose=True)
-
-        # Use the LLM chain to generate Python code for plotting
-        code_response = code_generation_chain.invoke({
-            "column_names": column_names,
-            "number_of_rows": number_of_rows,
-            "sample_record": sample_record,
-            "collection_schema": movies_collection_schema,
-            "user_query": state['question']
-        })
+        chart = _template_chart(state)
+        if chart is not None:
+            return _report_truncation(state, {"chart": chart})
+        return _report_truncation(state, _generate_code_chart(state))
 
-        generated_code = re.sub(r'```python|```', '',
-                                code_response['text']).strip()
+    except Exception as e:
+        logger.error(f"Error generating chart based on query: {e}")
+        raise
 
-        logger.info(f"Generated Python Code:\n{generated_code}")
 
-        local_context = {"data": retrieved_data}
+async def agenerate_chart_based_on_query(state):
+    """
+    Async variant of `generate_chart_based_on_query`. The code generation call
+    uses `ainvoke` and the CPU-bound `exec` of the generated code runs in a
+    worker thread so it does not block the event loop.
+    """
+    try:
+        chart = await asyncio.to_thread(_template_chart, state)
+        if chart is not None:
+            return _report_truncation(state, {"chart": chart})
+        return _report_truncation(state, await _agenerate_code_chart(state))
 
-        try:
-            # Execute the generated code to produce `fig`
-            # Todo: Run this code using sandbox tools like e2b(https://e2b.dev/)
-            exec(generated_code, local_context, local_context)
-            final_response_plot = local_context.get('fig')
-            if not final_response_plot:
-                logger.error("No plot was generated.")
-                return {"chart": None}
+    except Exception as e:
+        logger.error(f"Error generating chart based on query: {e}")
+        raise
 
-            chart_response = final_response_plot.to_json()
-            logger.info(f'Final response plot: {chart_response}')
-            return {"chart": chart_response}
 
-        except KeyError as e:
-            logger.error(
-                "No plot object named 'fig' was found in the generated code.")
-            return {"chart": None}
+def _parse_plan(text):
+    return pipeline_validator.parse(text, pipeline_key='pipeline')
 
-        except Exception as e:
-            logger.error(
-                f"Error occurred while executing the generated code: {str(e)}")
-            return {"chart": None}
 
+def _plan_inputs(state):
+    return {
+        "user_query": state['question'],
+        "chat_history": pipeline_chat_history(),
+        **prompt_context(state['question'])
+    }
+
+
+def _plan_update(plan, cached, context):
+    logger.info(f"Visualization plan: {plan}")
+    # The history digest is kept with the plan, because running it adds to the history.
+    return {"rephrasedQuestion": plan.get('rephrased_question'),
+            "visualizationPlan": {**plan, "cached": cached, "context": context}}
+
+
+def plan_visualization(state):
+    """
+    Plans a visualization with a single LLM call, or a cached plan of an earlier
+    question. The plan holds the rephrased question, the aggregation pipeline
+    and the chart specification, so the following nodes need no further LLM calls.
+
+    Args:
+        state (dict): A dictionary containing the user's question under the key 'question'.
+
+    Returns:
+        dict: The rephrased question under 'rephrasedQuestion' and the plan under
+            'visualizationPlan'.
+    """
+    try:
+        # The prompt carries the session's earlier pipelines, so cached plans are
+        # only reused within the same conversation.
+        context = history_digest(pipeline_chat_history())
+        cache = plan_cache()
+        plan = cache.get(state['question'], context) if cache is not None else None
+        if plan is not None:
+            logger.info("Visualization plan cache hit")
+            record_cache_hit("visualization_plan")
+            return _plan_update(plan, True, context)
+        response = visualization_plan_chain().invoke(
+            _plan_inputs(state), config={"tags": [TAG_NOSTREAM]})
+        return _plan_update(_parse_plan(response), False, context)
     except Exception as e:
-        logger.error(f"Error generating chart based on query: {e}")
+        logger.error(f"Error planning visualization: {e}")
+        raise
+
+
+async def aplan_visualization(state):
+    """
+    Async variant of `plan_visualization`.
+    """
+    try:
+        context = history_digest(pipeline_chat_history())
+        cache = plan_cache()
+        plan = await cache.aget(state['question'], context) if cache is not None else None
+        if plan is not None:
+            logger.info("Visualization plan cache hit")
+            record_cache_hit("visualization_plan")
+            return _plan_update(plan, True, context)
+        response = await visualization_plan_chain().ainvoke(
+            _plan_inputs(state), config={"tags": [TAG_NOSTREAM]})
+        return _plan_update(_parse_plan(response), False, context)
+    except Exception as e:
+        logger.error(f"Error planning visualization: {e}")
+        raise
+
+
+def _plan_to_cache(plan):
+    return {key: value for key, value in plan.items() if key not in ('cached', 'context')}
+
+
+def run_planned_query(state):
+    """
+    Runs the aggregation pipeline of the visualization plan, reading the result
+    up to the chart budget rather than one page.
+
+    Args:
+        state (dict): A dictionary containing 'question' and 'visualizationPlan'.
+
+    Returns:
+        dict: The retrieved documents as a `ColumnarResult` under 'mongoQueryResult'.
+    """
+    try:
+        plan = state['visualizationPlan']
+        result = run_pipeline(state['question'], plan['pipeline'], chart=True)
+        cache = plan_cache()
+        # Only plans whose pipeline ran successfully are worth reusing.
+        if not plan.get('cached') and cache is not None:
+            cache.put(state['question'], _plan_to_cache(plan), plan.get('context', ''))
+        return {"mongoQueryResult": ColumnarResult.from_documents(result.documents)}
+    except Exception as e:
+        logger.error(f"Error running planned query: {e}")
+        raise
+
+
+async def arun_planned_query(state):
+    """
+    Async variant of `run_planned_query`.
+    """
+    try:
+        plan = state['visualizationPlan']
+        result = await arun_pipeline(state['question'], plan['pipeline'], chart=True)
+        cache = plan_cache()
+        if not plan.get('cached') and cache is not None:
+            await cache.aput(state['question'], _plan_to_cache(plan), plan.get('context', ''))
+        return {"mongoQueryResult": ColumnarResult.from_documents(result.documents)}
+    except Exception as e:
+        logger.error(f"Error running planned query: {e}")
+        raise
+
+
+def generate_planned_chart(state):
+    """
+    Builds the chart described by the visualization plan, or else a chart template
+    that fits the data. Falls back to generating plotting code when neither does.
+
+    Args:
+        state (dict): A dictionary containing 'question', 'visualizationPlan' and
+            'mongoQueryResult'.
+
+    Returns:
+        dict: The Plotly figure JSON under 'chart'.
+    """
+    try:
+        plan = state['visualizationPlan']
+        chart = chart_from_templates(state['mongoQueryResult'], plan['pipeline'],
+                                     state['question'], plan.get('chart'))
+        if chart is not None:
+            return _report_truncation(state, {"chart": chart})
+        return _report_truncation(state, _generate_code_chart(state))
+    except Exception as e:
+        logger.error(f"Error generating planned chart: {e}")
+        raise
+
+
+async def agenerate_planned_chart(state):
+    """
+    Async variant of `generate_planned_chart`.
+    """
+    try:
+        plan = state['visualizationPlan']
+        chart = await asyncio.to_thread(
+            chart_from_templates, state['mongoQueryResult'], plan['pipeline'],
+            state['question'], plan.get('chart'))
+        if chart is not None:
+            return _report_truncation(state, {"chart": chart})
+        return _report_truncation(state, await _agenerate_code_chart(state))
+    except Exception as e:
+        logger.error(f"Error generating planned chart: {e}")
         raise
@@ -0,0 +1,23 @@
+from langgraph.config import get_stream_writer
+
+
+def emit_progress(event, data):
+    """
+    Publishes an intermediate result on the graph's custom stream.
+
+    Nodes and the tools they call use this to surface progress (for example the
+    generated aggregation pipeline) to streaming clients before the graph has
+    finished. Outside of a graph run, or when the caller did not ask for the
+    custom stream, this is a no-op.
+
+    Args:
+        event (str): The name of the event, used as the SSE event type.
+        data (dict): The JSON serializable event payload.
+    """
+    try:
+        writer = get_stream_writer()
+    except (RuntimeError, KeyError):
+        # Not inside a graph run: either no runnable context at all, or a chain
+        # invoked on its own without the graph runtime in its config.
+        return
+    writer({"event": event, "data": data})
@@ -0,0 +1,178 @@
+from dataclasses import dataclass
+from typing import Iterable, List, Mapping, Optional, Sequence
+from agents.lexical_index import TfidfIndex, terms
+from agents.logger import setup_logger
+import json
+import os
+import re
+import threading
+
+logger = setup_logger(__name__)
+
+_example_pattern = re.compile(r"Input(\d+):\s*(.+?)\s*\n\s*Output\1:\s*(.+?)\s*\n")
+_field_line = re.compile(r"^(\s*)- \*\*([\w.]+)\*\*")
+_type_note = re.compile(r"\((?:Array of )?\w+\)")
+_referenced_field = re.compile(r'"\$?([A-Za-z_][\w]*)(?:\.[\w.]+)?"')
+
+
+@dataclass(frozen=True)
+class PromptExample:
+    question: str
+    output: str
+
+
+def parse_examples(text: str) -> List[PromptExample]:
+    """Reads the `InputN:` / `OutputN:` pairs of an examples block such as `examples`."""
+    return [PromptExample(question, output) for _, question, output in _example_pattern.findall(text)]
+
+
+def format_examples(examples: Sequence[PromptExample]) -> str:
+    """Writes examples back in the `InputN:` / `OutputN:` form of the prompts."""
+    return "\n".join(f"        Input{number}: {example.question}\n        Output{number}: {example.output}\n"
+                     for number, example in enumerate(examples, 1))
+
+
+def schema_blocks(schema_text: str) -> dict:
+    """
+    Splits a Markdown schema description such as `movies_collection_schema` into
+    the lines of each top-level field, nested fields included, in schema order.
+    """
+    lines = schema_text.strip("\n").splitlines()
+    indents = [len(match.group(1)) for match in map(_field_line.match, lines) if match]
+    top = min(indents, default=0)
+    blocks, name = {}, None
+    for line in lines:
+        match = _field_line.match(line)
+        if match and len(match.group(1)) == top:
+            name = match.group(2)
+            blocks[name] = []
+        if name is not None and line.strip():
+            blocks[name].append(line.rstrip())
+    return blocks
+
+
+class PromptBuilder:
+    """
+    Chooses the schema fields and examples the pipeline generation prompts need
+    for a question, instead of sending the whole schema and every example.
+
+    Examples are ranked by TF-IDF similarity of their question and the `k` nearest
+    are kept. A top-level schema field is kept when it is in `core_fields`, when an
+    example kept refers to it, or when the question shares a term with its name,
+    description or `keywords` that few fields share (at most `max_field_share` of
+    them, so words like "movie" or "list" select nothing). The example bank can
+    grow at run time with `add`.
+    """
+
+    def __init__(self, schema_text: str, examples: Iterable[PromptExample], k: int = 3,
+                 core_fields: Sequence[str] = (), keywords: Optional[Mapping[str, str]] = None,
+                 max_field_share: float = 0.15):
+        self.k = k
+        self.core_fields = frozenset(core_fields)
+        self.max_field_share = max_field_share
+        self._blocks = schema_blocks(schema_text)
+        keywords = keywords or {}
+        self._field_terms = {
+            name: set(terms(" ".join([name.replace("_", " ")]
+                                     + [_type_note.sub(" ", line.replace("*", " ")) for line in lines]
+                                     + [keywords.get(name, "")])))
+            for name, lines in self._blocks.items()}
+        shares = {}
+        for field_terms in self._field_terms.values():
+            for term in field_terms:
+                shares[term] = shares.get(term, 0) + 1
+        limit = max(1, int(len(self._blocks) * max_field_share))
+        self._distinctive = {term for term, count in shares.items() if count <= limit}
+        self._examples: List[PromptExample] = []
+        self._index = TfidfIndex([])
+        self._lock = threading.Lock()
+        self._stats = {"prompts": 0, "fields": 0, "examples": 0}
+        self.add(*examples)
+
+    def add(self, *examples: PromptExample):
+        """Adds examples to the bank and rebuilds the index."""
+        with self._lock:
+            self._examples.extend(examples)
+            self._index = TfidfIndex([example.question for example in self._examples])
+
+    def select_examples(self, question: str) -> List[PromptExample]:
+        with self._lock:
+            index, examples = self._index, self._examples
+        return [examples[position] for _, position in index.search(question, self.k)]
+
+    def select_fields(self, question: str, examples: Sequence[PromptExample] = ()) -> List[str]:
+        question_terms = set(terms(question)) & self._distinctive
+        referenced = {name for example in examples for name in _referenced_field.findall(example.output)}
+        return [name for name, field_terms in self._field_terms.items()
+                if name in self.core_fields or name in referenced or question_terms & field_terms]
+
+    def schema(self, question: str, examples: Sequence[PromptExample] = ()) -> str:
+        """The schema description with only the fields chosen for a question."""
+        return self._schema_text(self.select_fields(question, examples))
+
+    def context(self, question: str) -> dict:
+        """
+        Chooses the examples and schema fields for a question.
+
+        Returns:
+            dict: The schema under 'movies_collection_schema' and the examples under
+                'examples', as the pipeline generation prompts take them.
+        """
+        examples = self.select_examples(question)
+        fields = self.select_fields(question, examples)
+        with self._lock:
+            self._stats["prompts"] += 1
+            self._stats["fields"] += len(fields)
+            self._stats["examples"] += len(examples)
+        return {"movies_collection_schema": self._schema_text(fields), "examples": format_examples(examples)}
+
+    def _schema_text(self, fields):
+        return "\n".join(line for name in fields for line in self._blocks[name])
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["bank_size"] = len(self._examples)
+        stats["schema_fields"] = len(self._blocks)
+        return stats
+
+
+def load_examples(path: str) -> List[PromptExample]:
+    """
+    Reads examples from a JSON lines file of {"question": ..., "pipeline": [...]} entries.
+    """
+    with open(path) as examples_file:
+        entries = [json.loads(line) for line in examples_file if line.strip()]
+    return [PromptExample(entry["question"], json.dumps(entry["pipeline"])) for entry in entries]
+
+
+def create_prompt_builder() -> Optional[PromptBuilder]:
+    """
+    Builds the prompt builder of the `movies` collection from the environment, or
+    returns None when the prompts carry the whole schema and every example.
+
+    Environment variables:
+        PROMPT_BUILDER_ENABLED: 'false' sends the whole schema and every example.
+            Defaults to 'true'.
+        PROMPT_EXAMPLES_K: Examples per prompt. Defaults to 3.
+        PROMPT_EXAMPLES_PATH: A JSON lines file of further examples, with the
+            'question' and its 'pipeline'.
+        PROMPT_CORE_FIELDS: Comma separated fields every prompt keeps. Defaults to
+            '_id,title,year,genres,imdb'.
+    """
+    if os.getenv("PROMPT_BUILDER_ENABLED", "true") != "true":
+        return None
+    from prompts.mongoDB_movies_Prompt import examples, movies_collection_schema, schema_field_keywords
+    bank = parse_examples(examples)
+    path = os.getenv("PROMPT_EXAMPLES_PATH")
+    if path:
+        try:
+            bank += load_examples(path)
+        except Exception as e:
+            logger.error(f"Error loading prompt examples from {path}: {e}")
+            raise
+    core_fields = [name.strip() for name in os.getenv("PROMPT_CORE_FIELDS", "_id,title,year,genres,imdb").split(",")
+                   if name.strip()]
+    logger.info(f"Prompt builder using {len(bank)} examples")
+    return PromptBuilder(movies_collection_schema, bank, k=int(os.getenv("PROMPT_EXAMPLES_K", "3")),
+                         core_fields=core_fields, keywords=schema_field_keywords)
@@ -0,0 +1,370 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+from agents.logger import setup_logger
+from agents.metrics import record_mongo_round_trip
+from agents.pipeline_validation import PipelineRejected
+import copy
+import json
+import os
+import threading
+
+logger = setup_logger(__name__)
+
+# Stages that need their whole input before they return anything, so a $limit
+# after them does not stop a collection scan early.
+_BLOCKING_STAGES = frozenset({"$group", "$sort", "$count", "$bucket", "$bucketAuto",
+                              "$sortByCount", "$facet"})
+_RANGE_OPERATORS = frozenset({"$gt", "$gte", "$lt", "$lte", "$ne", "$nin", "$regex", "$exists"})
+
+
+def _related_paths(first: str, second: str) -> bool:
+    # Whether one field path is the other, or a parent or child of it.
+    return first == second or first.startswith(second + ".") or second.startswith(first + ".")
+
+
+def pipeline_shape(pipeline: list) -> str:
+    """
+    The structure of a pipeline with its literal values left out, so pipelines that
+    only differ in the values they match share an explain plan.
+    """
+    def shape(value):
+        if isinstance(value, dict):
+            return {key: shape(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [shape(item) for item in value[:1]]
+        if isinstance(value, str) and value.startswith("$"):
+            return value
+        return "?"
+    return json.dumps(shape(pipeline), sort_keys=True)
+
+
+def _find(value, key):
+    # Every value stored under `key` anywhere in a nested explain document.
+    if isinstance(value, dict):
+        for name, item in value.items():
+            if name == key:
+                yield item
+            yield from _find(item, key)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _find(item, key)
+
+
+@dataclass
+class ExplainSummary:
+    """What an explain plan says about the cost of a pipeline shape."""
+    collection_scan: bool = False
+    indexes: list = field(default_factory=list)
+    docs_examined: Optional[int] = None
+    returned: Optional[int] = None
+    # Set when the plan could not be read; such shapes are allowed.
+    error: Optional[str] = None
+
+    @classmethod
+    def from_explain(cls, explain: dict) -> "ExplainSummary":
+        stages = set(_find(explain, "stage"))
+        examined = [value for value in _find(explain, "totalDocsExamined") if isinstance(value, int)]
+        returned = [value for value in _find(explain, "nReturned") if isinstance(value, int)]
+        return cls(collection_scan="COLLSCAN" in stages,
+                   indexes=sorted(set(_find(explain, "indexName"))),
+                   docs_examined=max(examined) if examined else None,
+                   returned=min(returned) if returned else None)
+
+    @property
+    def ratio(self) -> Optional[float]:
+        """Documents examined per document returned, from executionStats explains."""
+        if self.docs_examined is None or self.returned is None:
+            return None
+        return self.docs_examined / max(self.returned, 1)
+
+
+@dataclass
+class _ShapeUsage:
+    executions: int = 0
+    equality: tuple = ()
+    sort: tuple = ()
+    range: tuple = ()
+    collection_scan: bool = False
+
+
+class QueryGuard:
+    """
+    Keeps generated aggregations from scanning the collection without bound.
+
+    Every pipeline first gets the rewrites that are always safe: a `$match` that
+    follows a `$project`, `$addFields` or `$set` it does not depend on is moved ahead
+    of it, so it can use an index. Each new pipeline shape (`pipeline_shape`) is then
+    explained once and the summary cached. A shape is over budget when its plan
+    scans the collection and the documents it examines (or the collection size,
+    for 'queryPlanner' explains) exceed `max_docs_examined`, or when it examines more
+    than `max_ratio` documents per document returned. Over budget pipelines without
+    a blocking stage get a `$limit`; others are rejected with `PipelineRejected`.
+
+    The shapes seen are also kept to recommend indexes, see `index_report`.
+    """
+
+    def __init__(self, collection, verbosity: str = "queryPlanner", max_docs_examined: int = 100_000,
+                 max_ratio: float = 10_000, limit: int = 1000, max_time_ms: int = 10_000,
+                 max_shapes: int = 1024):
+        self._collection = collection
+        self.verbosity = verbosity
+        self.max_docs_examined = max_docs_examined
+        self.max_ratio = max_ratio
+        self.limit = limit
+        self.max_time_ms = max_time_ms
+        self.max_shapes = max_shapes
+        self._explains: OrderedDict = OrderedDict()
+        self._usage: OrderedDict = OrderedDict()
+        self._collection_size: Optional[int] = None
+        self._lock = threading.Lock()
+        self._stats = {"explains": 0, "explain_cache_hits": 0, "collection_scans": 0,
+                       "rewrites": 0, "rejects": 0}
+
+    def check(self, pipeline: list) -> list:
+        """
+        Returns the pipeline to run, rewritten where needed.
+
+        Raises:
+            PipelineRejected: When the pipeline is over budget and cannot be bounded.
+        """
+        pipeline = self._rewrite(pipeline)
+        shape = pipeline_shape(pipeline)
+        summary = self._cached(shape)
+        if summary is None:
+            summary = self._explain(pipeline)
+            if summary.error is None and self._collection_size is None and summary.docs_examined is None:
+                self._collection_size = self._count_documents()
+            self._remember(shape, summary)
+        return self._decide(pipeline, shape, summary)
+
+    async def acheck(self, pipeline: list, async_collection) -> list:
+        """
+        Async variant of `check`, explaining through `async_collection`.
+        """
+        pipeline = self._rewrite(pipeline)
+        shape = pipeline_shape(pipeline)
+        summary = self._cached(shape)
+        if summary is None:
+            try:
+                record_mongo_round_trip()
+                explain = await async_collection.database.command(
+                    "explain", {"aggregate": async_collection.name, "pipeline": pipeline, "cursor": {}},
+                    verbosity=self.verbosity, maxTimeMS=self.max_time_ms)
+                summary = self._summarize(explain)
+            except Exception as e:
+                summary = self._explain_failed(e)
+            if summary.error is None and self._collection_size is None and summary.docs_examined is None:
+                try:
+                    self._collection_size = await async_collection.estimated_document_count()
+                except Exception as e:
+                    logger.warning(f"Could not count the collection: {e}")
+            self._remember(shape, summary)
+        return self._decide(pipeline, shape, summary)
+
+    def explain_summary(self, pipeline: list) -> Optional[ExplainSummary]:
+        """The cached summary of the pipeline's shape, if it was explained."""
+        return self._cached(pipeline_shape(self._rewrite(pipeline)), count_hit=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "shapes": len(self._explains)}
+
+    def index_report(self) -> list:
+        """
+        Recommends indexes for the shapes that scanned the collection.
+
+        Keys follow the equality, sort, range order of the first `$match` and the
+        `$sort` after it. Shapes with the same keys are merged.
+
+        Returns:
+            list: One dict per recommended index with its 'keys', the number of
+                'shapes' and 'executions' it would serve, ordered by executions.
+        """
+        recommendations = {}
+        with self._lock:
+            usages = list(self._usage.values())
+        for usage in usages:
+            if not usage.collection_scan:
+                continue
+            keys = []
+            for name, direction in ([(name, 1) for name in usage.equality] + list(usage.sort)
+                                    + [(name, 1) for name in usage.range]):
+                if name not in [key for key, _ in keys]:
+                    keys.append((name, direction))
+            if not keys:
+                continue
+            entry = recommendations.setdefault(tuple(keys), {"keys": dict(keys), "shapes": 0, "executions": 0})
+            entry["shapes"] += 1
+            entry["executions"] += usage.executions
+        return sorted(recommendations.values(), key=lambda entry: -entry["executions"])
+
+    def _rewrite(self, pipeline):
+        pipeline = copy.deepcopy(pipeline)
+        moved = True
+        while moved:
+            moved = False
+            for index in range(len(pipeline) - 1):
+                stage, following = pipeline[index], pipeline[index + 1]
+                if "$match" in following and self._match_can_precede(stage, following["$match"]):
+                    pipeline[index], pipeline[index + 1] = following, stage
+                    moved = True
+                    self._count("rewrites")
+                    logger.info(f"Moved $match ahead of {next(iter(stage))}")
+        return pipeline
+
+    def _match_can_precede(self, stage, query):
+        fields = [key for key in query if not key.startswith("$")]
+        if not fields or any(key.startswith("$") for key in query):
+            return False
+        if "$project" in stage:
+            body = stage["$project"]
+            exclusion = all(value in (0, False) for value in body.values())
+            for name in fields:
+                named = [key for key in body if _related_paths(key, name)]
+                # A field passes through unchanged when the projection includes it or a
+                # parent of it, or is an exclusion that does not touch it at all.
+                if not named and not exclusion:
+                    return False
+                if any(body[key] not in (1, True) or len(key) > len(name) for key in named):
+                    return False
+            return True
+        if "$addFields" in stage or "$set" in stage:
+            body = stage.get("$addFields") or stage.get("$set")
+            return not any(_related_paths(key, name) for key in body for name in fields)
+        return False
+
+    def _decide(self, pipeline, shape, summary):
+        self._record_usage(shape, pipeline, summary)
+        if summary.error is not None:
+            return pipeline
+        examined = summary.docs_examined
+        if examined is None and summary.collection_scan:
+            examined = self._collection_size
+        ratio = summary.ratio
+        over_budget = (summary.collection_scan and examined is not None and examined > self.max_docs_examined) \
+            or (ratio is not None and ratio > self.max_ratio)
+        if not over_budget:
+            return pipeline
+        reason = f"examines {examined} documents" + (f", {ratio:.0f} per document returned" if ratio else "")
+        stages = [next(iter(stage)) for stage in pipeline]
+        if not any(stage in _BLOCKING_STAGES for stage in stages) and "$limit" not in stages:
+            self._count("rewrites")
+            logger.warning(f"Pipeline {reason}; limiting it to {self.limit} documents")
+            return pipeline + [{"$limit": self.limit}]
+        self._count("rejects")
+        logger.error(f"Rejected a pipeline that {reason}: {pipeline}")
+        raise PipelineRejected(f"The query would scan too much of the collection ({reason}); "
+                               "narrow it with a $match on an indexed field")
+
+    def _record_usage(self, shape, pipeline, summary):
+        with self._lock:
+            usage = self._usage.get(shape)
+            if usage is None:
+                usage = self._usage[shape] = self._usage_of(pipeline)
+                while len(self._usage) > self.max_shapes:
+                    self._usage.popitem(last=False)
+            usage.executions += 1
+            usage.collection_scan = summary.collection_scan
+
+    def _usage_of(self, pipeline):
+        usage = _ShapeUsage()
+        stages = iter(pipeline)
+        first = next(stages, {})
+        query = first.get("$match") or {}
+        equality, ranges = [], []
+        for name, condition in query.items():
+            if name.startswith("$"):
+                continue
+            if isinstance(condition, dict) and any(key in _RANGE_OPERATORS for key in condition):
+                ranges.append(name)
+            else:
+                equality.append(name)
+        following = next(stages, {})
+        sort = following.get("$sort") or first.get("$sort") or {}
+        usage.equality, usage.range = tuple(equality), tuple(ranges)
+        usage.sort = tuple((name, direction) for name, direction in sort.items()
+                           if isinstance(direction, int))
+        return usage
+
+    def _cached(self, shape, count_hit=True):
+        with self._lock:
+            summary = self._explains.get(shape)
+            if summary is not None:
+                self._explains.move_to_end(shape)
+                if count_hit:
+                    self._stats["explain_cache_hits"] += 1
+            return summary
+
+    def _remember(self, shape, summary):
+        with self._lock:
+            self._explains[shape] = summary
+            while len(self._explains) > self.max_shapes:
+                self._explains.popitem(last=False)
+
+    def _explain(self, pipeline):
+        try:
+            collection = self._collection()
+            record_mongo_round_trip()
+            explain = collection.database.command(
+                "explain", {"aggregate": collection.name, "pipeline": pipeline, "cursor": {}},
+                verbosity=self.verbosity, maxTimeMS=self.max_time_ms)
+            return self._summarize(explain)
+        except Exception as e:
+            return self._explain_failed(e)
+
+    def _summarize(self, explain):
+        summary = ExplainSummary.from_explain(explain)
+        self._count("explains")
+        if summary.collection_scan:
+            self._count("collection_scans")
+        logger.info(f"Explained a new pipeline shape: scan={summary.collection_scan}, "
+                    f"indexes={summary.indexes}, examined={summary.docs_examined}, "
+                    f"returned={summary.returned}")
+        return summary
+
+    def _explain_failed(self, error):
+        # The guard must not take the retriever down with it; the shape runs unchecked.
+        logger.warning(f"Could not explain the pipeline, running it unchecked: {error}")
+        return ExplainSummary(error=str(error))
+
+    def _count_documents(self):
+        try:
+            return self._collection().estimated_document_count()
+        except Exception as e:
+            logger.warning(f"Could not count the collection: {e}")
+            return None
+
+    def _count(self, counter):
+        with self._lock:
+            self._stats[counter] += 1
+
+
+def create_query_guard(collection) -> Optional[QueryGuard]:
+    """
+    Builds the explain guard from the environment, or returns None when it is disabled.
+
+    Args:
+        collection: A callable returning the collection to explain against, so
+            creating the guard does not connect to MongoDB.
+
+    Environment variables:
+        QUERY_GUARD_ENABLED: 'false' runs generated pipelines unchecked. Defaults to 'true'.
+        QUERY_GUARD_EXPLAIN_VERBOSITY: 'queryPlanner' (plans only) or 'executionStats'
+            (also runs the pipeline, within the time limit). Defaults to 'queryPlanner'.
+        QUERY_GUARD_MAX_DOCS_EXAMINED: Scanned documents from which a pipeline is
+            limited or rejected. Defaults to 100000.
+        QUERY_GUARD_MAX_RATIO: Examined per returned documents from which a pipeline
+            is limited or rejected. Defaults to 10000.
+        QUERY_GUARD_LIMIT: The $limit added to over budget pipelines. Defaults to 1000.
+        QUERY_GUARD_MAX_TIME_MS: Time limit of explains and aggregations. Defaults to 10000.
+    """
+    if os.getenv("QUERY_GUARD_ENABLED", "true") != "true":
+        return None
+    return QueryGuard(
+        collection,
+        verbosity=os.getenv("QUERY_GUARD_EXPLAIN_VERBOSITY", "queryPlanner"),
+        max_docs_examined=int(os.getenv("QUERY_GUARD_MAX_DOCS_EXAMINED", "100000")),
+        max_ratio=float(os.getenv("QUERY_GUARD_MAX_RATIO", "10000")),
+        limit=int(os.getenv("QUERY_GUARD_LIMIT", "1000")),
+        max_time_ms=int(os.getenv("QUERY_GUARD_MAX_TIME_MS", "10000")))
@@ -0,0 +1,33 @@
+"""
+Renders the workflow graph to a file.
+
+Start up no longer draws the graph, so use this command (or the /graph endpoint)
+when the picture is needed. From the Backend directory:
+    PYTHONPATH=agents:. python -m agents.render_graph --output workflow_graph.png
+    PYTHONPATH=agents:. python -m agents.render_graph --format mermaid --output workflow_graph.mmd
+The 'png' format calls the mermaid.ink API; 'mermaid' works offline.
+"""
+import argparse
+
+from agents.clients import get_llm_manager
+from agents.logger import setup_logger
+from workflowManager import WorkflowManager
+
+logger = setup_logger(__name__)
+
+
+def main(args):
+    workflow_manager = WorkflowManager(llm_manager=get_llm_manager())
+    graph = workflow_manager.render_graph(args.format)
+    mode = "wb" if isinstance(graph, bytes) else "w"
+    with open(args.output, mode) as graph_file:
+        graph_file.write(graph)
+    logger.info(f"Workflow graph written to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--format", choices=("png", "mermaid"), default="png")
+    parser.add_argument("--output", default="workflow_graph.png")
+    main(parser.parse_args())
@@ -0,0 +1,60 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Optional
+import uuid
+
+
+@dataclass
+class RequestContext:
+    """
+    Per-request data that code deep inside the graph, such as the tools the
+    agent calls, needs without it being threaded through every signature.
+    """
+    session_id: str
+    # Set by the MongoDB retriever from the request's last query.
+    pipeline: Optional[list] = None
+    result_id: Optional[str] = None
+    total_results: Optional[int] = None
+    # Node work started before the router decided it is needed; see `agents.speculation`.
+    speculative_tasks: dict = field(default_factory=dict)
+
+
+_current_request: ContextVar[Optional[RequestContext]] = ContextVar(
+    "current_request", default=None)
+
+
+@contextmanager
+def request_scope(session_id: Optional[str] = None):
+    """
+    Binds a `RequestContext` to the current context for the duration of a request.
+    LangGraph copies the context into the threads and tasks that run the nodes.
+
+    Args:
+        session_id (str, optional): The conversation the request belongs to. A new
+            session ID is generated when it is missing.
+
+    Yields:
+        RequestContext: The context of the request.
+    """
+    context = RequestContext(session_id=session_id or str(uuid.uuid4()))
+    token = _current_request.set(context)
+    try:
+        yield context
+    finally:
+        for task in context.speculative_tasks.values():
+            task.cancel()
+        try:
+            _current_request.reset(token)
+        except ValueError:
+            # An abandoned streaming generator is closed from another context.
+            pass
+
+
+def current_request() -> Optional[RequestContext]:
+    return _current_request.get()
+
+
+def current_session_id(default: str = "default") -> str:
+    context = _current_request.get()
+    return context.session_id if context else default
@@ -0,0 +1,232 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+from agents.logger import setup_logger
+from agents.metrics import record_documents
+from bson import BSON
+import copy
+import os
+import threading
+import time
+import uuid
+
+logger = setup_logger(__name__)
+
+
+def _included_fields(pipeline) -> set:
+    included = set()
+    for stage in pipeline:
+        projection = stage.get("$project") if isinstance(stage, dict) else None
+        if isinstance(projection, dict):
+            included.update(name for name, value in projection.items()
+                            if value not in (0, False))
+    return included
+
+
+@dataclass
+class AggregationResult:
+    """
+    A page of aggregation results together with what is needed to fetch the rest.
+
+    Attributes:
+        documents: The documents of this page.
+        total: The number of documents the whole pipeline returns.
+        offset: The position of the first document of this page.
+        result_id: Identifier for fetching further pages, set when more documents exist.
+    """
+    documents: List[dict]
+    total: int
+    offset: int = 0
+    result_id: Optional[str] = None
+
+    @property
+    def truncated(self) -> bool:
+        return self.offset + len(self.documents) < self.total
+
+    @property
+    def next_offset(self) -> Optional[int]:
+        return self.offset + len(self.documents) if self.truncated else None
+
+    def as_dict(self) -> dict:
+        return {"documents": self.documents, "returned": len(self.documents),
+                "total": self.total, "offset": self.offset, "truncated": self.truncated,
+                "next_offset": self.next_offset, "result_id": self.result_id}
+
+
+class ResultBudget:
+    """
+    Bounds what a generated aggregation pipeline can pull out of MongoDB.
+
+    `base_pipeline` appends a `$project` stage removing `excluded_fields` (unless an
+    inclusion `$project` of the pipeline asks for them) and `page_pipeline` a
+    `$limit` stage, so at most one page of `max_documents` documents is read. `collect` drains a
+    cursor within the document and `max_bytes` budgets, so memory per request
+    stays bounded even for pipelines that ignore the limit.
+    """
+
+    def __init__(self, max_documents: int = 100, max_bytes: int = 1024 * 1024,
+                 batch_size: Optional[int] = None,
+                 excluded_fields: Sequence[str] = ("plot_embedding",)):
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        # One extra document tells whether the result continues past the page.
+        self.batch_size = batch_size or max_documents + 1
+        self.excluded_fields = tuple(excluded_fields)
+
+    def base_pipeline(self, pipeline) -> list:
+        """
+        Returns the pipeline with the excluded fields projected out.
+        """
+        stages = copy.deepcopy(list(pipeline))
+        excluded = [name for name in self.excluded_fields
+                    if name not in _included_fields(stages)]
+        if excluded:
+            stages.append({"$project": {name: 0 for name in excluded}})
+        return stages
+
+    def page_pipeline(self, base_pipeline, offset: int = 0) -> list:
+        """
+        Returns the pipeline reading one page, starting at `offset`, of a base pipeline.
+        """
+        stages = list(base_pipeline)
+        if offset:
+            stages.append({"$skip": offset})
+        stages.append({"$limit": self.max_documents + 1})
+        return stages
+
+    def count_pipeline(self, base_pipeline) -> list:
+        return list(base_pipeline) + [{"$count": "total"}]
+
+    def collect(self, cursor):
+        """
+        Reads one page pipeline's cursor within the budgets. Reads at most one
+        document more than a page, which tells whether the result continues.
+
+        Returns:
+            tuple[list, bool]: The documents read and whether the byte budget cut them short.
+        """
+        documents, remaining_bytes = [], self.max_bytes
+        try:
+            for document in cursor:
+                remaining_bytes -= len(BSON.encode(document))
+                if remaining_bytes < 0:
+                    logger.info(f"Result page cut at {len(documents)} documents by the byte budget")
+                    return documents, True
+                documents.append(document)
+                if len(documents) > self.max_documents:
+                    break
+            return documents, False
+        finally:
+            record_documents(len(documents), self.max_bytes - remaining_bytes)
+
+    async def acollect(self, cursor):
+        """
+        Async variant of `collect`.
+        """
+        documents, remaining_bytes = [], self.max_bytes
+        try:
+            async for document in cursor:
+                remaining_bytes -= len(BSON.encode(document))
+                if remaining_bytes < 0:
+                    logger.info(f"Result page cut at {len(documents)} documents by the byte budget")
+                    return documents, True
+                documents.append(document)
+                if len(documents) > self.max_documents:
+                    break
+            return documents, False
+        finally:
+            record_documents(len(documents), self.max_bytes - remaining_bytes)
+
+
+@dataclass
+class _Cursor:
+    pipeline: list
+    total: int
+    expires_at: float
+
+
+class ResultCursorStore:
+    """
+    Remembers the pipelines of truncated results, so further pages can be read by
+    `result_id`. Cursors expire after `ttl_seconds` and the least recently used
+    cursor is dropped once `max_entries` is reached.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 1800):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._cursors = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, base_pipeline, total: int) -> str:
+        result_id = uuid.uuid4().hex
+        with self._lock:
+            self._cursors[result_id] = _Cursor(
+                base_pipeline, total, time.monotonic() + self.ttl_seconds)
+            while len(self._cursors) > self.max_entries:
+                self._cursors.popitem(last=False)
+        return result_id
+
+    def get(self, result_id: str):
+        """
+        Returns the base pipeline and total of a cursor, or None when it is unknown or expired.
+        """
+        with self._lock:
+            cursor = self._cursors.get(result_id)
+            if cursor is None:
+                return None
+            if cursor.expires_at <= time.monotonic():
+                del self._cursors[result_id]
+                return None
+            self._cursors.move_to_end(result_id)
+            return cursor.pipeline, cursor.total
+
+
+def create_result_budget() -> ResultBudget:
+    """
+    Builds the result budget from the environment.
+
+    Environment variables:
+        RESULT_MAX_DOCUMENTS: Documents returned per page. Defaults to 100.
+        RESULT_MAX_BYTES: BSON size budget of a page. Defaults to 1MB.
+        RESULT_BATCH_SIZE: Cursor batch size. Defaults to one page.
+        RESULT_EXCLUDED_FIELDS: Comma separated fields removed from results unless a
+            pipeline projects them explicitly. Defaults to 'plot_embedding'; the text
+            fields questions ask about, like 'plot' and 'cast', are kept.
+    """
+    batch_size = os.getenv("RESULT_BATCH_SIZE")
+    excluded_fields = os.getenv("RESULT_EXCLUDED_FIELDS", "plot_embedding")
+    return ResultBudget(
+        max_documents=int(os.getenv("RESULT_MAX_DOCUMENTS", "100")),
+        max_bytes=int(os.getenv("RESULT_MAX_BYTES", str(1024 * 1024))),
+        batch_size=int(batch_size) if batch_size else None,
+        excluded_fields=[name.strip() for name in excluded_fields.split(",") if name.strip()])
+
+
+def create_chart_budget() -> ResultBudget:
+    """
+    Builds the budget of the results charts are drawn from. Charts aggregate their
+    rows on the server, so they read far more than a page of rows sent as is.
+
+    Environment variables:
+        CHART_MAX_DOCUMENTS: Documents a chart is drawn from. Defaults to 100000.
+        CHART_MAX_BYTES: BSON size budget of a chart's documents. Defaults to 32MB.
+        CHART_BATCH_SIZE: Cursor batch size. Defaults to 1000.
+    """
+    return ResultBudget(
+        max_documents=int(os.getenv("CHART_MAX_DOCUMENTS", "100000")),
+        max_bytes=int(os.getenv("CHART_MAX_BYTES", str(32 * 1024 * 1024))),
+        batch_size=int(os.getenv("CHART_BATCH_SIZE", "1000")))
+
+
+def create_result_cursor_store() -> ResultCursorStore:
+    """
+    Builds the store of continuation cursors from the environment.
+
+    Environment variables:
+        RESULT_CURSOR_MAX_ENTRIES: Cursors kept. Defaults to 1000.
+        RESULT_CURSOR_TTL_SECONDS: Cursor lifetime. Defaults to 1800.
+    """
+    return ResultCursorStore(
+        max_entries=int(os.getenv("RESULT_CURSOR_MAX_ENTRIES", "1000")),
+        ttl_seconds=float(os.getenv("RESULT_CURSOR_TTL_SECONDS", "1800")))
@@ -0,0 +1,299 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from importlib import import_module
+from typing import Optional
+from agents.logger import setup_logger
+from bson import BSON, ObjectId
+from pymongo.errors import PyMongoError
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+
+logger = setup_logger(__name__)
+
+# MongoDB rejects documents larger than 16MB, so larger results are never shared.
+_MAX_SHARED_ENTRY_BYTES = 15 * 1024 * 1024
+
+
+def _canonicalize(value, preserve_order=False):
+    if isinstance(value, dict):
+        items = [(key, _canonicalize(item, preserve_order=(key == "$sort")))
+                 for key, item in value.items()]
+        if preserve_order:
+            # The key order of a $sort specification is its meaning.
+            return {"$ordered": [[key, item] for key, item in items]}
+        return dict(items)
+    if isinstance(value, (list, tuple)):
+        return [_canonicalize(item) for item in value]
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return {"$date": value.astimezone(timezone.utc).isoformat(timespec="milliseconds")}
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    return value
+
+
+def canonical_pipeline_key(pipeline) -> str:
+    """
+    Returns a stable hash of an aggregation pipeline.
+
+    The hash does not depend on the key order of the stage documents or on how
+    datetimes were expressed (naive datetimes are treated as UTC). `$sort`
+    specifications keep their key order because it changes the result.
+    """
+    canonical = json.dumps(_canonicalize(pipeline), sort_keys=True,
+                           separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _encode(documents) -> bytes:
+    return BSON.encode({"documents": documents})
+
+
+def _decode(payload: bytes) -> list:
+    return BSON(payload).decode()["documents"]
+
+
+class ResultCacheBackend(ABC):
+    """
+    Storage interface of the result cache. Values are BSON encoded document
+    lists, so every read hands out fresh copies.
+
+    Backends implement `get`, `set` and `clear`; one missing any of them cannot
+    be created.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        """Returns the payload stored under `key`, or None."""
+
+    @abstractmethod
+    def set(self, key: str, payload: bytes):
+        """Stores a payload under `key`."""
+
+    @abstractmethod
+    def clear(self):
+        """Drops every entry."""
+
+    def stats(self) -> dict:
+        return {}
+
+    async def aget(self, key: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key: str, payload: bytes):
+        await asyncio.to_thread(self.set, key, payload)
+
+
+class InMemoryResultBackend(ResultCacheBackend):
+    """
+    Process local LRU store bounded by the total size of the cached results.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl_seconds: float = 86400):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            payload, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return payload
+
+    def set(self, key, payload):
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (payload, time.monotonic() + self.ttl_seconds)
+            self._bytes += len(payload)
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes,
+                    "max_bytes": self.max_bytes, "evictions": self._evictions}
+
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aset(self, key, payload):
+        self.set(key, payload)
+
+    def _remove(self, key):
+        payload, _ = self._entries.pop(key)
+        self._bytes -= len(payload)
+
+
+class MongoResultBackend(ResultCacheBackend):
+    """
+    Shared store in a MongoDB collection, so every worker benefits from results
+    cached by the others. Expired entries are removed by a TTL index.
+    """
+
+    def __init__(self, cache_collection, ttl_seconds: float = 86400):
+        self.collection = cache_collection
+        self.ttl_seconds = ttl_seconds
+        self.collection.create_index("expiresAt", expireAfterSeconds=0)
+
+    def get(self, key):
+        entry = self.collection.find_one(
+            {"_id": key, "expiresAt": {"$gt": datetime.now(timezone.utc)}})
+        return bytes(entry["payload"]) if entry else None
+
+    def set(self, key, payload):
+        if len(payload) > _MAX_SHARED_ENTRY_BYTES:
+            return
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl_seconds)
+        self.collection.replace_one(
+            {"_id": key}, {"_id": key, "payload": payload, "expiresAt": expires_at},
+            upsert=True)
+
+    def clear(self):
+        self.collection.delete_many({})
+
+    def stats(self):
+        return {"entries": self.collection.estimated_document_count()}
+
+
+class ResultCache:
+    """
+    Caches aggregation results keyed by `canonical_pipeline_key`.
+    """
+
+    def __init__(self, backend: ResultCacheBackend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "invalidations": 0}
+
+    def get(self, pipeline) -> Optional[list]:
+        return self._record_lookup(self.backend.get(canonical_pipeline_key(pipeline)))
+
+    async def aget(self, pipeline) -> Optional[list]:
+        return self._record_lookup(
+            await self.backend.aget(canonical_pipeline_key(pipeline)))
+
+    def put(self, pipeline, documents: list):
+        self.backend.set(canonical_pipeline_key(pipeline), self._encode(documents))
+
+    async def aput(self, pipeline, documents: list):
+        await self.backend.aset(canonical_pipeline_key(pipeline), self._encode(documents))
+
+    def invalidate(self):
+        self.backend.clear()
+        self._increment("invalidations")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, **self.backend.stats()}
+
+    def _encode(self, documents):
+        self._increment("stores")
+        return _encode(documents)
+
+    def _record_lookup(self, payload):
+        if payload is None:
+            self._increment("misses")
+            return None
+        self._increment("hits")
+        return _decode(payload)
+
+    def _increment(self, counter):
+        with self._lock:
+            self._stats[counter] += 1
+
+
+class ChangeStreamInvalidator:
+    """
+    Clears the result cache whenever the watched collection changes. Runs a
+    daemon thread that reopens the change stream after errors.
+    """
+
+    def __init__(self, watched_collection, cache: ResultCache, retry_seconds: float = 5):
+        self.watched_collection = watched_collection
+        self.cache = cache
+        self.retry_seconds = retry_seconds
+        self._thread = threading.Thread(
+            target=self._run, name="result-cache-invalidator", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                with self.watched_collection.watch() as stream:
+                    for change in stream:
+                        logger.info(
+                            f"Invalidating result cache after {change.get('operationType')} on "
+                            f"{self.watched_collection.name}")
+                        self.cache.invalidate()
+            except PyMongoError as e:
+                logger.error(f"Result cache change stream failed: {e}")
+                time.sleep(self.retry_seconds)
+
+
+def _create_backend(backend_name, database, ttl_seconds):
+    if backend_name == "memory":
+        return InMemoryResultBackend(
+            max_bytes=int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+            ttl_seconds=ttl_seconds)
+    if backend_name == "mongo":
+        return MongoResultBackend(
+            database[os.getenv("RESULT_CACHE_COLLECTION", "query_result_cache")],
+            ttl_seconds=ttl_seconds)
+    # Any other value names a custom backend class as 'package.module:ClassName'.
+    module_name, _, class_name = backend_name.partition(":")
+    backend = getattr(import_module(module_name), class_name)()
+    if not isinstance(backend, ResultCacheBackend):
+        raise TypeError(f"{backend_name} is not a ResultCacheBackend")
+    return backend
+
+
+def create_result_cache(database, watched_collection) -> Optional[ResultCache]:
+    """
+    Builds the result cache from the environment, or returns None when it is disabled.
+
+    Environment variables:
+        RESULT_CACHE_BACKEND: 'memory' (default), 'mongo' for a store shared by all
+            workers, 'none' to disable, or 'package.module:ClassName' for a custom
+            `ResultCacheBackend`.
+        RESULT_CACHE_MAX_BYTES: Size bound of the in-memory backend. Defaults to 64MB.
+        RESULT_CACHE_TTL_SECONDS: Entry lifetime. Defaults to one day.
+        RESULT_CACHE_COLLECTION: Collection used by the 'mongo' backend.
+        RESULT_CACHE_INVALIDATE_ON_CHANGE: 'true' clears the cache on every change
+            to the watched collection. Requires a replica set.
+    """
+    backend_name = os.getenv("RESULT_CACHE_BACKEND", "memory")
+    if backend_name == "none":
+        return None
+    ttl_seconds = float(os.getenv("RESULT_CACHE_TTL_SECONDS", "86400"))
+    cache = ResultCache(_create_backend(backend_name, database, ttl_seconds))
+    if os.getenv("RESULT_CACHE_INVALIDATE_ON_CHANGE") == "true":
+        ChangeStreamInvalidator(watched_collection, cache).start()
+    logger.info(f"Result cache enabled with the '{backend_name}' backend")
+    return cache
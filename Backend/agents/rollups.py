@@ -0,0 +1,853 @@
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence
+from agents.logger import setup_logger
+from agents.metrics import record_cache_hit, record_mongo_round_trip
+import copy
+import math
+import os
+import threading
+import time
+
+logger = setup_logger(__name__)
+
+# The id of the document holding the maintenance state in the rollup collection;
+# the group documents have {"d": dimension, "k": key} ids.
+STATE_ID = "state"
+DEFAULT_DIMENSIONS = "genres[],countries[],year,imdb.rating,awards.wins"
+DEFAULT_MEASURES = "imdb.rating,awards.wins,runtime"
+_MISSING = object()
+
+
+class _Unsupported(Exception):
+    """A pipeline stage or expression the rollups cannot evaluate."""
+
+
+def _get(document, path):
+    value = document
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+def _set(document, path, value):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+    document[parts[-1]] = value
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class RollupSpec:
+    """
+    The group-bys the rollups hold: the count of documents per key of each
+    dimension, and per key the sum, numeric count and presence count of each measure.
+
+    Args:
+        dimensions (dict): Field path to whether the field is an array, which a
+            pipeline unwinds before grouping by it.
+        measures (list): Field paths that are summed and averaged per key.
+    """
+
+    def __init__(self, dimensions: Dict[str, bool], measures: Sequence[str]):
+        self.dimensions = dict(dimensions)
+        self.measures = list(measures)
+
+    def fields(self) -> List[str]:
+        return list(dict.fromkeys(list(self.dimensions) + self.measures))
+
+
+def _key(value):
+    # Scalar dimensions holding an array group by the whole array, as $group does.
+    return tuple(value) if isinstance(value, list) else value
+
+
+def contribution(document: dict, spec: RollupSpec) -> list:
+    """
+    What a document adds to the rollups: its keys for each dimension and, for each
+    measure, its numeric value (or None) and whether the field is present. Stored
+    in the ledger, so the contribution can be taken back when the document changes.
+    """
+    dimensions = []
+    for dimension, is_array in spec.dimensions.items():
+        value = _get(document, dimension)
+        if is_array:
+            # $unwind drops missing, null and empty arrays, and unwinds a scalar as itself.
+            keys = [] if value is _MISSING or value is None else (value if isinstance(value, list) else [value])
+        else:
+            keys = [None if value is _MISSING else _key(value)]
+        dimensions.append([dimension, list(keys)])
+    measures = []
+    for measure in spec.measures:
+        value = _get(document, measure)
+        measures.append([measure, value if _is_number(value) else None, value is not _MISSING])
+    return [dimensions, measures]
+
+
+def deltas(old: Optional[list], new: Optional[list]) -> dict:
+    """
+    The changes to the rollup groups when a document's contribution goes from
+    `old` to `new`; None stands for an absent document.
+
+    Returns:
+        dict: (dimension, key) to the increments of its counters, by counter path
+            ('count', 'sum.<measure>', 'numeric.<measure>', 'exists.<measure>').
+    """
+    changes = defaultdict(lambda: defaultdict(float))
+    for sign, part in ((-1, old), (1, new)):
+        if part is None:
+            continue
+        dimensions, measures = part
+        for dimension, keys in dimensions:
+            for key in keys:
+                counters = changes[(dimension, _key(key))]
+                counters["count"] += sign
+                for measure, value, present in measures:
+                    if value is not None:
+                        counters[f"sum.{measure}"] += sign * value
+                        counters[f"numeric.{measure}"] += sign
+                    if present:
+                        counters[f"exists.{measure}"] += sign
+    result = {}
+    for group, counters in changes.items():
+        counters = {name: _as_int(value) for name, value in counters.items() if value}
+        if counters:
+            result[group] = counters
+    return result
+
+
+def _as_int(value):
+    return int(value) if float(value).is_integer() else value
+
+
+def _group_id(dimension, key):
+    return {"d": dimension, "k": list(key) if isinstance(key, tuple) else key}
+
+
+class RollupStore:
+    """
+    The rollup groups held in memory, and the evaluation of pipelines over them.
+
+    `answer` recognises pipelines that group the whole collection by a dimension,
+    optionally after unwinding it (required for array dimensions), projecting, or
+    matching documents where one measure exists, with accumulators that count
+    documents or sum or average measures; `$sortByCount` too. The stages after the
+    group (`$project`, `$addFields`, `$set`, `$unset`, `$match`, `$sort`, `$skip`,
+    `$limit` and `$count`, with field paths and simple arithmetic) are evaluated on
+    the groups. Any other pipeline is left to MongoDB, as is every pipeline once the
+    groups were loaded more than `max_age_seconds` ago or were unloaded.
+    """
+
+    def __init__(self, spec: RollupSpec, max_age_seconds: Optional[float] = None):
+        self.spec = spec
+        self.max_age_seconds = max_age_seconds
+        self._groups: Dict[str, Dict] = {}
+        self.loaded = False
+        self.loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._stats = {"answered": 0, "declined": 0, "changes": 0}
+
+    def load(self, documents: Iterable[dict]):
+        """Replaces the groups with rollup documents such as those of the rollup collection."""
+        groups = {dimension: {} for dimension in self.spec.dimensions}
+        for document in documents:
+            identifier = document.get("_id")
+            if not isinstance(identifier, dict) or identifier.get("d") not in groups:
+                continue
+            groups[identifier["d"]][_key(identifier["k"])] = {
+                name: copy.deepcopy(document.get(name, 0 if name == "count" else {}))
+                for name in ("count", "sum", "numeric", "exists")}
+        with self._lock:
+            self._groups = groups
+            self.loaded = True
+            self.loaded_at = time.monotonic()
+
+    def unload(self):
+        """Stops answering from the groups until they are loaded again."""
+        with self._lock:
+            self.loaded = False
+            self.loaded_at = None
+
+    def build(self, documents: Iterable[dict]):
+        """Computes the groups from the base documents."""
+        self._groups = {dimension: {} for dimension in self.spec.dimensions}
+        for document in documents:
+            self.apply(deltas(None, contribution(document, self.spec)))
+        self._stats["changes"] = 0
+        self.loaded = True
+        self.loaded_at = time.monotonic()
+
+    def apply(self, changes: dict):
+        """Applies the output of `deltas` to the groups."""
+        with self._lock:
+            for (dimension, key), counters in changes.items():
+                group = self._groups.setdefault(dimension, {}).setdefault(
+                    key, {"count": 0, "sum": {}, "numeric": {}, "exists": {}})
+                for name, value in counters.items():
+                    if name == "count":
+                        group["count"] += value
+                        continue
+                    _set(group, name, _value(group, name) + value)
+            self._stats["changes"] += 1
+
+    def documents(self) -> List[dict]:
+        """The groups as rollup documents, as stored in the rollup collection."""
+        with self._lock:
+            return [{"_id": _group_id(dimension, key), **copy.deepcopy(group)}
+                    for dimension, keys in self._groups.items() for key, group in keys.items()]
+
+    def answer(self, pipeline: list) -> Optional[List[dict]]:
+        """
+        Evaluates a pipeline over the rollups.
+
+        Returns:
+            list: The documents the pipeline returns on the base collection, or None
+                when the rollups cannot answer it.
+        """
+        documents = self._answer(pipeline)
+        with self._lock:
+            self._stats["declined" if documents is None else "answered"] += 1
+        return documents
+
+    def covers(self, pipeline: list) -> bool:
+        """Whether `answer` would answer a pipeline."""
+        return self._answer(pipeline) is not None
+
+    def _current(self):
+        loaded_at = self.loaded_at
+        if not self.loaded or loaded_at is None:
+            return False
+        return self.max_age_seconds is None or time.monotonic() - loaded_at <= self.max_age_seconds
+
+    def _answer(self, pipeline):
+        if not self._current():
+            return None
+        try:
+            plan = self._plan(pipeline)
+            return None if plan is None else _run_stages(self._group_documents(*plan[:3]), plan[3])
+        except _Unsupported:
+            return None
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["groups"] = sum(len(keys) for keys in self._groups.values())
+        stats["current"] = self._current()
+        stats["age_seconds"] = None if self.loaded_at is None else time.monotonic() - self.loaded_at
+        return stats
+
+    def _plan(self, pipeline):
+        """
+        Splits a pipeline into the dimension it groups by, the measure it requires
+        to exist, its accumulators and the stages after the group, or returns None.
+        """
+        exists, unwound, projected = None, None, None
+        for index, stage in enumerate(pipeline):
+            if not isinstance(stage, dict) or len(stage) != 1:
+                return None
+            (name, body), = stage.items()
+            if name == "$match":
+                if exists is not None or not isinstance(body, dict) or len(body) != 1:
+                    return None
+                (field, condition), = body.items()
+                if field not in self.spec.measures or condition not in ({"$exists": True}, {"$exists": 1}):
+                    return None
+                exists = field
+            elif name == "$project":
+                included = {field for field, value in body.items() if value in (1, True)}
+                if any(value not in (0, 1, True, False) for value in body.values()) or not included:
+                    return None
+                projected = included if projected is None else projected & included
+            elif name == "$unwind":
+                path = body.get("path") if isinstance(body, dict) and set(body) == {"path"} else body
+                if unwound is not None or not isinstance(path, str) or not path.startswith("$"):
+                    return None
+                unwound = path[1:]
+            elif name in ("$group", "$sortByCount"):
+                if name == "$group":
+                    dimension, accumulators = self._accumulators(body, exists)
+                    rest = list(pipeline[index + 1:])
+                else:
+                    dimension = body[1:] if isinstance(body, str) and body.startswith("$") else None
+                    accumulators = {"count": ("count", None)}
+                    rest = [{"$sort": {"count": -1}}] + list(pipeline[index + 1:])
+                if dimension not in self.spec.dimensions:
+                    return None
+                if (unwound is not None) != self.spec.dimensions[dimension] or unwound not in (None, dimension):
+                    return None
+                needed = {dimension} | {measure for _, measure in accumulators.values() if measure}
+                needed |= {exists} if exists else set()
+                if projected is not None and not all(
+                        any(field == kept or field.startswith(kept + ".") for kept in projected)
+                        for field in needed):
+                    return None
+                return dimension, exists, accumulators, rest
+            else:
+                return None
+        return None
+
+    def _accumulators(self, body, exists):
+        if not isinstance(body, dict) or not isinstance(body.get("_id"), str) or not body["_id"].startswith("$"):
+            return None, {}
+        accumulators = {}
+        for name, expression in body.items():
+            if name == "_id":
+                continue
+            if not isinstance(expression, dict) or len(expression) != 1:
+                raise _Unsupported(name)
+            (operator, operand), = expression.items()
+            if operator == "$count" and operand == {} or operator == "$sum" and operand == 1:
+                accumulators[name] = ("count", None)
+            elif operator in ("$sum", "$avg") and isinstance(operand, str) and operand[1:] in self.spec.measures:
+                measure = operand[1:]
+                # Under an existence filter only that measure's own counters apply.
+                if exists is not None and measure != exists:
+                    raise _Unsupported(name)
+                accumulators[name] = (operator[1:], measure)
+            else:
+                raise _Unsupported(name)
+        return body["_id"][1:], accumulators
+
+    def _group_documents(self, dimension, exists, accumulators):
+        documents = []
+        with self._lock:
+            groups = list(self._groups.get(dimension, {}).items())
+        # Groups are only read here; `apply` and `load` never hand out their dictionaries.
+        for key, group in groups:
+            count = group["count"] if exists is None else _value(group, f"exists.{exists}")
+            if count <= 0:
+                continue
+            document = {"_id": list(key) if isinstance(key, tuple) else key}
+            for name, (operation, measure) in accumulators.items():
+                if operation == "count":
+                    document[name] = count
+                elif operation == "sum":
+                    document[name] = _value(group, f"sum.{measure}")
+                else:
+                    numeric = _value(group, f"numeric.{measure}")
+                    document[name] = _value(group, f"sum.{measure}") / numeric if numeric else None
+            documents.append(document)
+        return documents
+
+
+def _value(group, path):
+    value = _get(group, path)
+    return 0 if value is _MISSING else value
+
+
+# Evaluation of the stages after the group. Everything unsupported raises
+# `_Unsupported`, so MongoDB answers the pipeline instead.
+
+def _evaluate(document, expression):
+    if isinstance(expression, str):
+        if expression.startswith("$"):
+            value = _get(document, expression[1:])
+            return None if value is _MISSING else value
+        return expression
+    if _is_number(expression) or expression is None or isinstance(expression, bool):
+        return expression
+    if not isinstance(expression, dict) or len(expression) != 1:
+        raise _Unsupported(expression)
+    (operator, operand), = expression.items()
+    if operator == "$literal":
+        return operand
+    arguments = [_evaluate(document, item) for item in (operand if isinstance(operand, list) else [operand])]
+    if operator == "$ifNull":
+        return next((value for value in arguments if value is not None), None)
+    if any(value is None for value in arguments):
+        return None
+    if not all(_is_number(value) for value in arguments):
+        raise _Unsupported(operator)
+    if operator == "$add":
+        return sum(arguments)
+    if operator == "$multiply":
+        return math.prod(arguments)
+    if operator == "$subtract" and len(arguments) == 2:
+        return arguments[0] - arguments[1]
+    if operator == "$divide" and len(arguments) == 2 and arguments[1]:
+        return arguments[0] / arguments[1]
+    if operator == "$floor":
+        return math.floor(arguments[0])
+    if operator == "$ceil":
+        return math.ceil(arguments[0])
+    if operator == "$round":
+        rounded = round(arguments[0], int(arguments[1]) if len(arguments) > 1 else 0)
+        return rounded
+    raise _Unsupported(operator)
+
+
+def _project(documents, body):
+    values = [value for field, value in body.items() if field != "_id"]
+    if values and all(value in (0, False) for value in values) and body.get("_id", 0) in (0, False):
+        result = []
+        nested = any("." in field for field in body)
+        for document in documents:
+            document = copy.deepcopy(document) if nested else dict(document)
+            for field in body:
+                parts = field.split(".")
+                parent = _get(document, ".".join(parts[:-1])) if len(parts) > 1 else document
+                if isinstance(parent, dict):
+                    parent.pop(parts[-1], None)
+            result.append(document)
+        return result
+    result = []
+    for document in documents:
+        projected = {}
+        if body.get("_id", 1) not in (0, False) and "_id" in document:
+            projected["_id"] = document["_id"]
+        for field, value in body.items():
+            if field == "_id" and value in (0, 1, True, False):
+                continue
+            if isinstance(value, (bool, int, float)):
+                if not value:
+                    raise _Unsupported("$project mixing inclusion and exclusion")
+                found = _get(document, field)
+                if found is not _MISSING:
+                    _set(projected, field, found)
+            else:
+                _set(projected, field, _evaluate(document, value))
+        result.append(projected)
+    return result
+
+
+def _sort_key(value):
+    # MongoDB orders values of different types: null, numbers, strings, ..., booleans.
+    if value is _MISSING or value is None:
+        return (1, 0)
+    if isinstance(value, bool):
+        return (8, value)
+    if _is_number(value):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    return (9, str(value))
+
+
+def _compare(value, operator, operand):
+    if operator == "$eq":
+        return value == operand
+    if operator == "$ne":
+        return value != operand
+    if operator == "$in":
+        return value in operand
+    if operator == "$nin":
+        return value not in operand
+    if operator == "$exists":
+        return (value is not _MISSING) == bool(operand)
+    if value is _MISSING or value is None or _sort_key(value)[0] != _sort_key(operand)[0]:
+        return False
+    if operator == "$gt":
+        return value > operand
+    if operator == "$gte":
+        return value >= operand
+    if operator == "$lt":
+        return value < operand
+    if operator == "$lte":
+        return value <= operand
+    raise _Unsupported(operator)
+
+
+def _matches(document, query):
+    for field, condition in query.items():
+        if field in ("$and", "$or"):
+            results = (_matches(document, part) for part in condition)
+            if not (all(results) if field == "$and" else any(results)):
+                return False
+            continue
+        if field.startswith("$"):
+            raise _Unsupported(field)
+        value = _get(document, field)
+        if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+            if not all(_compare(value, operator, operand) for operator, operand in condition.items()):
+                return False
+        elif value is _MISSING or value != condition:
+            return False
+    return True
+
+
+def _run_stages(documents, stages):
+    for stage in stages:
+        if not isinstance(stage, dict) or len(stage) != 1:
+            raise _Unsupported(stage)
+        (name, body), = stage.items()
+        if name == "$project":
+            documents = _project(documents, body)
+        elif name in ("$addFields", "$set"):
+            documents = [copy.deepcopy(document) for document in documents]
+            for document in documents:
+                for field, expression in body.items():
+                    _set(document, field, _evaluate(document, expression))
+        elif name == "$unset":
+            documents = _project(documents, {field: 0 for field in ([body] if isinstance(body, str) else body)})
+        elif name == "$match":
+            documents = [document for document in documents if _matches(document, body)]
+        elif name == "$sort":
+            for field, direction in reversed(list(body.items())):
+                documents = sorted(documents, key=lambda document: _sort_key(_get(document, field)),
+                                   reverse=direction == -1)
+        elif name == "$skip":
+            documents = documents[body:]
+        elif name == "$limit":
+            documents = documents[:body]
+        elif name == "$count":
+            documents = [{body: len(documents)}] if documents else []
+        else:
+            raise _Unsupported(name)
+    return documents
+
+
+class Rollups:
+    """
+    Keeps the rollups of a collection in a rollup collection and serves them from
+    a `RollupStore`.
+
+    The contribution of every document is kept in a ledger collection, so a
+    changed document takes back its old contribution and adds its new one; no
+    change needs a rebuild. The ledger entry is swapped with a compare-and-set
+    before the rollup groups are incremented, so processes applying the same
+    change count it once. The entry stays marked pending, with an id of the change
+    that the incremented groups record, until every group has it; a change
+    interrupted for longer than `change_timeout_seconds` is completed by the next
+    process touching the document or starting maintenance, and groups that
+    already have it skip it. Changes come from, by `mode`:
+
+    - 'watch': a change stream of the collection (Atlas and replica sets). Inserts,
+      updates, replacements and deletes are applied as they happen.
+    - 'poll': documents whose `timestamp_field` (`lastupdated`) moved past the last
+      one seen, every `poll_seconds`. Deletes are not seen; `rebuild` repairs them.
+    - 'off': another process maintains the rollups; this one only reloads them.
+
+    The store is reloaded from the rollup collection every `refresh_seconds`. The
+    first start builds the rollups from a scan of the collection. When maintenance
+    fails, the store stops answering and maintenance starts over after a backoff of
+    up to `max_retry_seconds`; a store not reloaded for `max_age_seconds`, for
+    example because maintenance hangs, stops answering too.
+    """
+
+    def __init__(self, collection_callable, database_callable, spec: RollupSpec,
+                 name: str = "movies_rollups", mode: str = "watch", timestamp_field: str = "lastupdated",
+                 poll_seconds: float = 30, refresh_seconds: float = 30, max_age_seconds: float = 300,
+                 max_retry_seconds: float = 60, change_timeout_seconds: float = 60):
+        self._collection = collection_callable
+        self._database = database_callable
+        self.name = name
+        self.spec = spec
+        self.mode = mode
+        self.timestamp_field = timestamp_field
+        self.poll_seconds = poll_seconds
+        self.refresh_seconds = refresh_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self.change_timeout_seconds = change_timeout_seconds
+        self.store = RollupStore(spec, max_age_seconds=max_age_seconds)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def collection(self):
+        return self._collection()
+
+    @property
+    def rollup_collection(self):
+        return self._database()[self.name]
+
+    @property
+    def ledger_collection(self):
+        return self._database()[f"{self.name}_ledger"]
+
+    def answer(self, pipeline: list) -> Optional[List[dict]]:
+        """See `RollupStore.answer`; records a 'rollup' cache hit when it answers."""
+        documents = self.store.answer(pipeline)
+        if documents is not None:
+            logger.info("Pipeline answered from the rollups")
+            record_cache_hit("rollup")
+        return documents
+
+    def start(self):
+        """Starts maintaining and reloading the rollups in a background thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="rollups", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        delay = first_delay = min(1.0, self.max_retry_seconds)
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self._maintain()
+            except Exception as e:
+                # Changes are not applied until maintenance is back; the collection answers meanwhile.
+                self.store.unload()
+                if time.monotonic() - started > self.max_retry_seconds:
+                    delay = first_delay
+                logger.error(f"Error maintaining the rollups, retrying in {delay:g}s: {e}")
+                self._stop.wait(delay)
+                delay = min(delay * 2, self.max_retry_seconds)
+        self.store.unload()
+
+    def _maintain(self):
+        state = self.rollup_collection.find_one({"_id": STATE_ID})
+        if state is None and self.mode != "off":
+            state = self.rebuild()
+        elif self.mode != "off":
+            self.recover()
+        if self.mode == "watch":
+            # Loads the groups once the change stream is open, see `_watch`.
+            self._watch(state)
+            return
+        if self.mode == "poll":
+            self.sync()
+        self.reload()
+        while not self._stop.wait(self.poll_seconds if self.mode == "poll" else self.refresh_seconds):
+            if self.mode == "poll":
+                self.sync()
+            self.reload()
+
+    def reload(self):
+        """Loads the rollup groups into the store, once they have been built."""
+        if self.rollup_collection.find_one({"_id": STATE_ID}) is None:
+            return
+        record_mongo_round_trip()
+        self.store.load(self.rollup_collection.find({"_id.d": {"$exists": True}}))
+
+    def rebuild(self) -> dict:
+        """
+        Builds the rollups and the ledger from a scan of the collection.
+
+        Returns:
+            dict: The new maintenance state.
+        """
+        try:
+            logger.info("Building the rollups")
+            start = time.perf_counter()
+            state = {"_id": STATE_ID}
+            if self.mode == "watch":
+                # Changes made during the scan are replayed from here; applying a
+                # change the scan already saw leaves the ledger unchanged.
+                with self.collection.watch() as stream:
+                    state["resume_token"] = stream.resume_token
+            projection = {field: 1 for field in self.spec.fields() + [self.timestamp_field]}
+            store, ledger, watermark = RollupStore(self.spec), [], None
+            store.build([])
+            for document in self.collection.find({}, projection):
+                entry = contribution(document, self.spec)
+                ledger.append({"_id": document["_id"], "c": entry})
+                store.apply(deltas(None, entry))
+                stamp = document.get(self.timestamp_field)
+                if stamp is not None and (watermark is None or stamp > watermark):
+                    watermark = stamp
+            state["watermark"] = watermark
+            self.ledger_collection.delete_many({})
+            for offset in range(0, len(ledger), 1000):
+                self.ledger_collection.insert_many(ledger[offset:offset + 1000])
+            self.rollup_collection.delete_many({})
+            groups = store.documents()
+            if groups:
+                self.rollup_collection.insert_many(groups)
+            self.rollup_collection.replace_one({"_id": STATE_ID}, state, upsert=True)
+            logger.info(f"Built {len(groups)} rollup groups from {len(ledger)} documents "
+                        f"in {time.perf_counter() - start:.1f}s")
+            return state
+        except Exception as e:
+            logger.error(f"Error building the rollups: {e}")
+            raise
+
+    def apply_document(self, document_id, document: Optional[dict]) -> dict:
+        """
+        Moves the rollups from the recorded contribution of a document to that of
+        its current version, or takes it back when `document` is None (deleted).
+
+        Returns:
+            dict: The changes applied, see `deltas`.
+        """
+        from bson import ObjectId
+        from pymongo.errors import DuplicateKeyError
+        new = None if document is None else contribution(document, self.spec)
+        while True:
+            entry = self.ledger_collection.find_one({"_id": document_id})
+            if entry is not None and "pending" in entry:
+                # Another change of the document is being applied, or was interrupted.
+                if not self._recover(entry):
+                    time.sleep(0.05)
+                continue
+            old = None if entry is None else entry["c"]
+            if old == new:
+                return {}
+            pending = {"id": ObjectId(), "old": old, "at": time.time()}
+            try:
+                if entry is None:
+                    self.ledger_collection.insert_one({"_id": document_id, "c": new, "pending": pending})
+                elif self.ledger_collection.update_one(
+                        {"_id": document_id, "c": old, "pending": {"$exists": False}},
+                        {"$set": {"c": new, "pending": pending}}).matched_count == 0:
+                    continue
+            except DuplicateKeyError:
+                continue
+            break
+        changes = deltas(old, new)
+        self._increment(changes, pending["id"])
+        if self._finish(document_id, pending["id"], new is None, recovered=False):
+            self._forget(changes, pending["id"])
+        if changes:
+            self.store.apply(changes)
+        return changes
+
+    def recover(self) -> int:
+        """
+        Completes the changes whose application was interrupted, for example by a
+        crash, more than `change_timeout_seconds` ago.
+
+        Returns:
+            int: The number of changes completed.
+        """
+        self.ledger_collection.create_index("pending.at", sparse=True)
+        cutoff = time.time() - self.change_timeout_seconds
+        return sum(self._recover(entry) for entry in
+                   self.ledger_collection.find({"pending.at": {"$lt": cutoff}}))
+
+    def _recover(self, entry) -> bool:
+        # Returns False while the change may still be in flight in another process.
+        pending = entry["pending"]
+        if pending["at"] > time.time() - self.change_timeout_seconds:
+            return False
+        claimed = self.ledger_collection.update_one(
+            {"_id": entry["_id"], "pending.id": pending["id"], "pending.at": pending["at"]},
+            {"$set": {"pending.at": time.time(), "pending.recovered": True}})
+        if claimed.matched_count == 0:
+            return True
+        logger.warning(f"Completing an interrupted rollup change of document {entry['_id']}")
+        # Groups the change already reached skip it; the store catches up on its next reload.
+        self._increment(deltas(pending["old"], entry["c"]), pending["id"])
+        self._finish(entry["_id"], pending["id"], entry["c"] is None, recovered=True)
+        return True
+
+    def _increment(self, changes, change_id):
+        # Each group records the ids of the changes applied to it while they are
+        # pending, so applying a change again, when it is recovered, is a no-op.
+        from pymongo import UpdateOne
+        from pymongo.errors import BulkWriteError
+        updates = [({"_id": _group_id(dimension, key), "applied": {"$ne": change_id}},
+                    {"$inc": counters, "$addToSet": {"applied": change_id}})
+                   for (dimension, key), counters in changes.items()]
+        if not updates:
+            return
+        try:
+            self.rollup_collection.bulk_write(
+                [UpdateOne(query, update, upsert=True) for query, update in updates], ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != 11000 for error in errors):
+                raise
+            # The upsert found the group existing: created concurrently, or with the
+            # change applied already. The group exists now, so updating is enough.
+            for error in errors:
+                self.rollup_collection.update_one(*updates[error["index"]])
+
+    def _finish(self, document_id, change_id, deleted, recovered) -> bool:
+        query = {"_id": document_id, "pending.id": change_id}
+        if not recovered:
+            query["pending.recovered"] = {"$exists": False}
+        if deleted:
+            return self.ledger_collection.delete_one(query).deleted_count > 0
+        return self.ledger_collection.update_one(query, {"$unset": {"pending": ""}}).matched_count > 0
+
+    def _forget(self, changes, change_id):
+        # Only once the ledger entry is final; a change claimed by `_recover` keeps its
+        # id in the groups, so a late retry of it stays a no-op.
+        from pymongo import UpdateOne
+        if changes:
+            self.rollup_collection.bulk_write(
+                [UpdateOne({"_id": _group_id(dimension, key)}, {"$pull": {"applied": change_id}})
+                 for dimension, key in changes], ordered=False)
+
+    def sync(self, batch_size: int = 1000) -> int:
+        """
+        Applies the documents whose timestamp is at or past the watermark.
+
+        Returns:
+            int: The number of documents read.
+        """
+        state = self.rollup_collection.find_one({"_id": STATE_ID}) or {}
+        watermark, read = state.get("watermark"), 0
+        while True:
+            query = {} if watermark is None else {self.timestamp_field: {"$gte": watermark}}
+            projection = {field: 1 for field in self.spec.fields() + [self.timestamp_field]}
+            documents = list(self.collection.find(query, projection)
+                             .sort(self.timestamp_field, 1).limit(batch_size))
+            for document in documents:
+                self.apply_document(document["_id"], document)
+            read += len(documents)
+            latest = documents[-1].get(self.timestamp_field) if documents else watermark
+            self.rollup_collection.update_one({"_id": STATE_ID}, {"$set": {"watermark": latest}}, upsert=True)
+            # Documents sharing the watermark are read again next time and change nothing.
+            if len(documents) < batch_size or latest == watermark:
+                return read
+            watermark = latest
+
+    def _watch(self, state):
+        resume_token = (state or {}).get("resume_token")
+        while not self._stop.is_set():
+            with self.collection.watch(full_document="updateLookup", resume_after=resume_token) as stream:
+                while not self._stop.is_set():
+                    loaded_at = self.store.loaded_at
+                    if loaded_at is None or time.monotonic() - loaded_at > self.refresh_seconds:
+                        self.reload()
+                    event = stream.try_next()
+                    if event is None:
+                        continue
+                    operation = event["operationType"]
+                    if operation in ("insert", "update", "replace", "delete"):
+                        self.apply_document(event["documentKey"]["_id"],
+                                            None if operation == "delete" else event.get("fullDocument"))
+                    resume_token = stream.resume_token
+                    self.rollup_collection.update_one(
+                        {"_id": STATE_ID}, {"$set": {"resume_token": resume_token}}, upsert=True)
+
+
+def parse_dimensions(text: str) -> Dict[str, bool]:
+    """Reads 'genres[],year' as {'genres': True, 'year': False}; '[]' marks array fields."""
+    dimensions = {}
+    for name in text.split(","):
+        name = name.strip()
+        if name:
+            dimensions[name.removesuffix("[]")] = name.endswith("[]")
+    return dimensions
+
+
+def create_rollups(collection_callable, database_callable) -> Optional[Rollups]:
+    """
+    Builds the rollups of the `movies` collection from the environment, or returns
+    None when every pipeline goes to the collection.
+
+    Environment variables:
+        ROLLUPS_ENABLED: 'true' enables the rollups. Defaults to 'false'.
+        ROLLUP_COLLECTION: The collection of the rollup groups; the ledger is
+            '<name>_ledger'. Defaults to 'movies_rollups'.
+        ROLLUP_DIMENSIONS: Comma separated fields to group by, '[]' marking array
+            fields. Defaults to 'genres[],countries[],year,imdb.rating,awards.wins'.
+        ROLLUP_MEASURES: Comma separated fields to sum and average. Defaults to
+            'imdb.rating,awards.wins,runtime'.
+        ROLLUP_MAINTENANCE: 'watch', 'poll' or 'off', see `Rollups`. Defaults to 'watch'.
+        ROLLUP_POLL_SECONDS: Interval of the 'poll' maintenance. Defaults to 30.
+        ROLLUP_REFRESH_SECONDS: Interval of reloading the rollup groups. Defaults to 30.
+        ROLLUP_MAX_AGE_SECONDS: Rollup groups not reloaded for this long are not
+            answered from. Defaults to 300.
+    """
+    if os.getenv("ROLLUPS_ENABLED", "false") != "true":
+        return None
+    name = os.getenv("ROLLUP_COLLECTION", "movies_rollups")
+    spec = RollupSpec(
+        parse_dimensions(os.getenv("ROLLUP_DIMENSIONS", DEFAULT_DIMENSIONS)),
+        [measure.strip() for measure in os.getenv("ROLLUP_MEASURES", DEFAULT_MEASURES).split(",")
+         if measure.strip()])
+    return Rollups(collection_callable, database_callable, spec, name=name,
+                   mode=os.getenv("ROLLUP_MAINTENANCE", "watch"),
+                   poll_seconds=float(os.getenv("ROLLUP_POLL_SECONDS", "30")),
+                   refresh_seconds=float(os.getenv("ROLLUP_REFRESH_SECONDS", "30")),
+                   max_age_seconds=float(os.getenv("ROLLUP_MAX_AGE_SECONDS", "300")))
@@ -0,0 +1,78 @@
+from collections import Counter
+from typing import Optional, Sequence, Tuple
+from agents.lexical_index import TfidfIndex
+from agents.logger import setup_logger
+import os
+import re
+
+logger = setup_logger(__name__)
+
+# Words that only appear in requests for a chart. "plot" is left out because
+# "the plot of Titanic" asks for a summary.
+_VISUALIZATION_PATTERN = re.compile(
+    r"\b(chart|graph|visuali[sz]\w*|histogram|heatmap|scatter)\b|\b(bar|pie|line) chart")
+
+
+class LocalRouteClassifier:
+    """
+    Routes obvious questions without calling the router model.
+
+    Questions naming a chart type are routed to 'Visualization' outright. Other
+    questions are compared with labelled examples by TF-IDF cosine similarity; the
+    `neighbours` nearest vote, weighted by similarity. The confidence is the share
+    of the vote the winning route got, times the similarity of its nearest example.
+    """
+
+    def __init__(self, examples: Sequence[Tuple[str, str]], neighbours: int = 3,
+                 min_confidence: float = 0.6):
+        self.neighbours = neighbours
+        self.min_confidence = min_confidence
+        self._index = TfidfIndex([question for question, _ in examples])
+        self._routes = [route for _, route in examples]
+
+    def classify(self, question: str) -> Tuple[Optional[str], float]:
+        """
+        Returns the most likely route of a question and the confidence in it.
+
+        Returns:
+            tuple: The route, or None when no example shares a term with the
+                question, and a confidence between 0 and 1.
+        """
+        if _VISUALIZATION_PATTERN.search(question.lower()):
+            return "Visualization", 1.0
+        scored = [(similarity, self._routes[index])
+                  for similarity, index in self._index.search(question, self.neighbours)]
+        votes = Counter()
+        for similarity, route in scored:
+            votes[route] += similarity
+        if not votes or scored[0][0] <= 0:
+            return None, 0.0
+        route, weight = votes.most_common(1)[0]
+        nearest = max(similarity for similarity, candidate in scored if candidate == route)
+        return route, weight / sum(votes.values()) * nearest
+
+    def route(self, question: str) -> Optional[str]:
+        """The route of a question when the classifier is confident enough, else None."""
+        route, confidence = self.classify(question)
+        if route is not None and confidence >= self.min_confidence:
+            logger.info(f"Routed locally to {route} with confidence {confidence:.2f}")
+            return route
+        return None
+
+
+def create_route_classifier() -> Optional[LocalRouteClassifier]:
+    """
+    Builds the local route classifier from the environment, or returns None when
+    every question goes to the router model.
+
+    Environment variables:
+        ROUTER_LOCAL_CLASSIFIER_ENABLED: 'true' enables the classifier. Defaults to 'false'.
+        ROUTER_LOCAL_MIN_CONFIDENCE: Confidence from which the router model is skipped.
+            Defaults to 0.6.
+    """
+    if os.getenv("ROUTER_LOCAL_CLASSIFIER_ENABLED", "false") != "true":
+        return None
+    from prompts.routerPrompt import router_examples
+    return LocalRouteClassifier(
+        router_examples,
+        min_confidence=float(os.getenv("ROUTER_LOCAL_MIN_CONFIDENCE", "0.6")))
@@ -0,0 +1,127 @@
+from typing import Optional
+from agents.coalescing import normalize_question
+from agents.logger import setup_logger
+from prompts.routerPrompt import get_batch_router_prompt, members
+import asyncio
+import os
+import re
+import threading
+
+logger = setup_logger(__name__)
+
+_ANSWER_LINE = re.compile(r"^\s*(\d+)\s*[:.)-]\s*([A-Za-z]+)")
+
+
+def parse_batch_routes(text: str, count: int) -> list:
+    """
+    Reads the `<number>: <classification>` lines of a batch router response.
+
+    Returns:
+        list: The route of each of the `count` questions, None where the response
+            has no valid classification for it.
+    """
+    routes = [None] * count
+    for line in text.splitlines():
+        match = _ANSWER_LINE.match(line)
+        if match is None:
+            continue
+        index, route = int(match.group(1)) - 1, match.group(2)
+        if 0 <= index < count and route in members:
+            routes[index] = route
+    return routes
+
+
+class RouterBatcher:
+    """
+    Classifies the questions that reach the router within a short window with one
+    call to the router model.
+
+    The first question of a batch starts a `window_seconds` timer; the batch is sent
+    when it expires or when `max_batch` questions are waiting. Identical questions
+    in a batch are classified once. A question the response does not classify is
+    answered with None, and the router falls back to classifying it on its own.
+    """
+
+    def __init__(self, llm, window_seconds: float = 0.02, max_batch: int = 16):
+        self._chain = get_batch_router_prompt() | llm
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self._pending = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # The event loop only keeps weak references to tasks; hold running batches here.
+        self._tasks = set()
+        self._lock = threading.Lock()
+        self._stats = {"batches": 0, "questions": 0, "unclassified": 0}
+
+    async def route(self, question: str) -> Optional[str]:
+        """
+        Waits for the batch of `question` to be classified.
+
+        Returns:
+            str: The route, or None when the batch response did not classify the question.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((question, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window_seconds, self._flush)
+        return await future
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._classify(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _classify(self, batch):
+        # The model sees the wording of the first occurrence of each question.
+        wording = {}
+        for question, _ in batch:
+            wording.setdefault(normalize_question(question), question)
+        questions = list(wording)
+        try:
+            numbered = "\n".join(f"{index}. {wording[question]}"
+                                 for index, question in enumerate(questions, start=1))
+            logger.info(f"Routing a batch of {len(questions)} questions")
+            response = await self._chain.ainvoke({"questions": numbered})
+            routes = dict(zip(questions, parse_batch_routes(response.content, len(questions))))
+        except Exception as e:
+            logger.error(f"Error routing a batch of questions: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        with self._lock:
+            self._stats["batches"] += 1
+            self._stats["questions"] += len(batch)
+            self._stats["unclassified"] += sum(route is None for route in routes.values())
+        for question, future in batch:
+            if not future.done():
+                future.set_result(routes[normalize_question(question)])
+
+
+def create_router_batcher(llm) -> Optional[RouterBatcher]:
+    """
+    Builds the router batcher from the environment, or returns None when batching is disabled.
+
+    Environment variables:
+        ROUTER_BATCH_WINDOW_MS: How long the first question of a batch waits for
+            others. '0' (default) routes every question with its own call.
+        ROUTER_BATCH_MAX_SIZE: Questions from which a batch is sent without waiting
+            for the window. Defaults to 16.
+    """
+    window_ms = float(os.getenv("ROUTER_BATCH_WINDOW_MS", "0"))
+    if window_ms <= 0:
+        return None
+    return RouterBatcher(llm, window_seconds=window_ms / 1000,
+                         max_batch=int(os.getenv("ROUTER_BATCH_MAX_SIZE", "16")))
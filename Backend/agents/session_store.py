@@ -0,0 +1,168 @@
+from collections import OrderedDict
+from typing import List, Sequence
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, get_buffer_string
+from agents.logger import setup_logger
+from agents.tokens import count_tokens
+import os
+import threading
+import time
+
+logger = setup_logger(__name__)
+
+
+def _message_tokens(message: BaseMessage) -> int:
+    return count_tokens(get_buffer_string([message]))
+
+
+class BoundedChatMessageHistory(BaseChatMessageHistory):
+    """
+    Message history that keeps only the most recent messages of a conversation,
+    within `max_messages` and a `max_tokens` budget. Older messages are dropped
+    first, so the history sent to the LLM has a constant upper bound.
+    """
+
+    def __init__(self, max_messages: int = 20, max_tokens: int = 2000):
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self._messages: List[BaseMessage] = []
+        self._token_counts: List[int] = []
+        self._lock = threading.Lock()
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        with self._lock:
+            return list(self._messages)
+
+    @property
+    def token_count(self) -> int:
+        with self._lock:
+            return sum(self._token_counts)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        with self._lock:
+            for message in messages:
+                self._messages.append(message)
+                self._token_counts.append(_message_tokens(message))
+            self._trim()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._messages.clear()
+            self._token_counts.clear()
+
+    def _trim(self):
+        total = sum(self._token_counts)
+        while self._messages and (
+                len(self._messages) > self.max_messages or total > self.max_tokens):
+            self._messages.pop(0)
+            total -= self._token_counts.pop(0)
+
+
+class _Session:
+    def __init__(self):
+        self.histories = {}
+        self.last_access = time.monotonic()
+
+    def token_count(self):
+        return sum(history.token_count for history in self.histories.values())
+
+
+class SessionStore:
+    """
+    Holds the conversation histories of every session.
+
+    Each session owns one `BoundedChatMessageHistory` per namespace (for example
+    the agent conversation and the pipeline generation conversation). Sessions
+    idle for longer than `idle_ttl_seconds` are evicted, at most `max_sessions`
+    are kept, and when the histories of all sessions together exceed
+    `max_total_tokens` the least recently used sessions are evicted.
+    """
+
+    def __init__(self, max_messages: int = 20, max_tokens: int = 2000,
+                 idle_ttl_seconds: float = 1800, max_sessions: int = 1000,
+                 max_total_tokens: int = 2_000_000):
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_sessions = max_sessions
+        self.max_total_tokens = max_total_tokens
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._evictions = 0
+
+    def get_history(self, session_id: str, namespace: str = "agent") -> BoundedChatMessageHistory:
+        """
+        Returns the history of a session, creating the session if needed.
+        Usable as the `get_session_history` factory of `RunnableWithMessageHistory`.
+        """
+        with self._lock:
+            self._evict()
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = _Session()
+            session.last_access = time.monotonic()
+            self._sessions.move_to_end(session_id)
+            history = session.histories.get(namespace)
+            if history is None:
+                history = session.histories[namespace] = BoundedChatMessageHistory(
+                    self.max_messages, self.max_tokens)
+            return history
+
+    def copy(self, source_id: str, target_id: str):
+        """
+        Starts session `target_id` with copies of the histories of `source_id`, for
+        a request that shares the answer of another session's identical request.
+        """
+        with self._lock:
+            source = self._sessions.get(source_id)
+            histories = dict(source.histories) if source is not None else {}
+        for namespace, history in histories.items():
+            self.get_history(target_id, namespace).add_messages(history.messages)
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"sessions": len(self._sessions),
+                    "tokens": sum(session.token_count() for session in self._sessions.values()),
+                    "evictions": self._evictions}
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session.last_access <= self.idle_ttl_seconds \
+                    and len(self._sessions) < self.max_sessions:
+                break
+            del self._sessions[session_id]
+            self._evictions += 1
+        total_tokens = sum(session.token_count() for session in self._sessions.values())
+        while self._sessions and total_tokens > self.max_total_tokens:
+            _, session = self._sessions.popitem(last=False)
+            total_tokens -= session.token_count()
+            self._evictions += 1
+
+
+def create_session_store() -> SessionStore:
+    """
+    Builds the session store from the environment.
+
+    Environment variables:
+        SESSION_MAX_MESSAGES: Messages kept per history. Defaults to 20.
+        SESSION_MAX_TOKENS: Token budget per history. Defaults to 2000.
+        SESSION_IDLE_TTL_SECONDS: Idle time after which a session is evicted. Defaults to 1800.
+        SESSION_MAX_SESSIONS: Maximum number of sessions kept. Defaults to 1000.
+        SESSION_MAX_TOTAL_TOKENS: Token budget of all sessions together. Defaults to 2000000.
+    """
+    return SessionStore(
+        max_messages=int(os.getenv("SESSION_MAX_MESSAGES", "20")),
+        max_tokens=int(os.getenv("SESSION_MAX_TOKENS", "2000")),
+        idle_ttl_seconds=float(os.getenv("SESSION_IDLE_TTL_SECONDS", "1800")),
+        max_sessions=int(os.getenv("SESSION_MAX_SESSIONS", "1000")),
+        max_total_tokens=int(os.getenv("SESSION_MAX_TOTAL_TOKENS", "2000000")))
+
+
+session_store = create_session_store()
@@ -0,0 +1,50 @@
+from typing import Coroutine, Hashable, Optional
+from agents.logger import setup_logger
+from agents.request_context import current_request
+import asyncio
+
+logger = setup_logger(__name__)
+
+
+def _retrieve_exception(task: asyncio.Task):
+    # Speculative work nobody awaited must not log "exception was never retrieved".
+    if not task.cancelled():
+        task.exception()
+
+
+def speculate(key: Hashable, coroutine: Coroutine) -> Optional[asyncio.Task]:
+    """
+    Starts work a later node of the request will probably need.
+
+    The task is kept on the request until `take_speculation` claims it, and is
+    cancelled by `cancel_speculation` or at the end of the request otherwise.
+
+    Args:
+        key: Identifies the work, for example the node name and the question.
+        coroutine: The work to start.
+
+    Returns:
+        asyncio.Task: The started task, or None outside of a request.
+    """
+    context = current_request()
+    if context is None:
+        coroutine.close()
+        return None
+    task = asyncio.ensure_future(coroutine)
+    task.add_done_callback(_retrieve_exception)
+    context.speculative_tasks[key] = task
+    return task
+
+
+def take_speculation(key: Hashable) -> Optional[asyncio.Task]:
+    """Claims the speculative task started under `key`, if any."""
+    context = current_request()
+    return context.speculative_tasks.pop(key, None) if context else None
+
+
+def cancel_speculation(key: Hashable):
+    """Cancels the speculative task started under `key`, if it was not claimed."""
+    task = take_speculation(key)
+    if task is not None:
+        logger.info(f"Cancelling speculative work: {key[0] if isinstance(key, tuple) else key}")
+        task.cancel()
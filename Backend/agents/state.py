@@ -1,14 +1,23 @@
 from typing import List, Any, Annotated, Dict, Optional, Sequence
 from typing_extensions import TypedDict
-import operator
+import os
 from langgraph.prebuilt.chat_agent_executor import AgentState
+from agents.columnar import ColumnarResult
+
+_max_state_messages = int(os.getenv("SESSION_MAX_MESSAGES", "20"))
+
+
+def append_messages_window(left: Sequence[Any], right: Sequence[Any]) -> List[Any]:
+    """Appends messages like `operator.add`, keeping only the most recent ones."""
+    return (list(left) + list(right))[-_max_state_messages:]
 
 
 class MultiAgentState(AgentState):
-    messages: Annotated[Sequence[Any], operator.add]
+    messages: Annotated[Sequence[Any], append_messages_window]
     question: str
     question_type: str
     answer: str
     rephrasedQuestion: Optional[str]
-    mongoQueryResult: Optional[list]
+    visualizationPlan: Optional[dict]
+    mongoQueryResult: Optional[ColumnarResult]
     chart: Optional[str]
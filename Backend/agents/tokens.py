@@ -0,0 +1,32 @@
+from functools import lru_cache
+from agents.logger import setup_logger
+import os
+
+logger = setup_logger(__name__)
+
+# Rough characters-per-token ratio of English text and JSON for OpenAI tokenizers.
+_CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(os.getenv("TOKEN_ENCODING", "o200k_base"))
+    except Exception as e:
+        # tiktoken downloads its encodings on first use; fall back when offline.
+        logger.warning(f"tiktoken is unavailable, estimating token counts: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Counts the tokens of a text with tiktoken, or estimates them from its
+    length when tiktoken or its encoding files are not available.
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text) // _CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
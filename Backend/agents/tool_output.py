@@ -0,0 +1,158 @@
+from collections import Counter
+from datetime import datetime
+from agents.logger import setup_logger
+from agents.result_budget import AggregationResult
+from agents.tokens import count_tokens
+from bson import json_util
+import os
+import statistics
+
+logger = setup_logger(__name__)
+
+
+def _flatten(document, prefix=""):
+    flat = {}
+    for key, value in document.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict) and value:
+            flat.update(_flatten(value, f"{name}."))
+        else:
+            flat[name] = value
+    return flat
+
+
+def _columns(rows):
+    columns = []
+    seen = set()
+    for row in rows:
+        for name in row:
+            if name not in seen:
+                seen.add(name)
+                columns.append(name)
+    return columns
+
+
+def _format_value(value, max_chars):
+    if value is None:
+        text = ""
+    elif isinstance(value, float):
+        text = f"{value:g}"
+    elif isinstance(value, datetime):
+        text = value.date().isoformat() if value.time() == datetime.min.time() \
+            else value.isoformat(timespec="seconds")
+    elif isinstance(value, (list, tuple)):
+        text = ", ".join(_format_value(item, max_chars) for item in value)
+    elif isinstance(value, dict):
+        text = json_util.dumps(value)
+    else:
+        text = str(value)
+    text = " ".join(text.split()).replace("|", "\\|")
+    if len(text) > max_chars:
+        text = text[:max_chars - 1] + "…"
+    return text
+
+
+def _column_statistics(rows, columns, top_values, max_chars):
+    lines = []
+    for name in columns:
+        values = [row[name] for row in rows if row.get(name) is not None]
+        if not values:
+            continue
+        numbers = [value for value in values
+                   if isinstance(value, (int, float)) and not isinstance(value, bool)]
+        if len(numbers) == len(values):
+            lines.append(f"- {name}: min {min(numbers):g}, max {max(numbers):g}, "
+                         f"mean {statistics.fmean(numbers):g}")
+            continue
+        counts = Counter()
+        for value in values:
+            items = value if isinstance(value, (list, tuple)) else [value]
+            counts.update(_format_value(item, max_chars) for item in items
+                          if not isinstance(item, dict))
+        if counts and len(counts) < len(values):
+            common = ", ".join(f"{item} ({count})" for item, count in counts.most_common(top_values))
+            lines.append(f"- {name}: {len(counts)} distinct, most common {common}")
+    return lines
+
+
+class ToolOutputCompactor:
+    """
+    Turns an aggregation result into compact text for the agent's scratchpad.
+
+    Documents are flattened (`imdb.rating`) and rendered as a Markdown table, which
+    states every field name once instead of once per document. Results of at least
+    `stats_min_rows` rows are preceded by per-column statistics, so the agent can
+    answer questions about the whole page even when rows are cut. Rows are dropped
+    from the end until the output fits in `max_tokens`.
+    """
+
+    def __init__(self, max_tokens: int = 2000, stats_min_rows: int = 10,
+                 max_cell_chars: int = 200, top_values: int = 5):
+        self.max_tokens = max_tokens
+        self.stats_min_rows = stats_min_rows
+        self.max_cell_chars = max_cell_chars
+        self.top_values = top_values
+
+    def compact(self, result: AggregationResult) -> str:
+        """
+        Renders the result within the token budget.
+
+        Args:
+            result (AggregationResult): The result of a `GetMovies` call.
+
+        Returns:
+            str: The result as text of at most `max_tokens` tokens.
+        """
+        if not result.documents:
+            return "No movies matched the query."
+        rows = [_flatten(document) for document in result.documents]
+        columns = _columns(rows)
+        header = [self._summary_line(result)]
+        if len(rows) >= self.stats_min_rows:
+            statistics_lines = _column_statistics(
+                rows, columns, self.top_values, self.max_cell_chars)
+            if statistics_lines:
+                header += [f"Statistics of the {len(rows)} returned documents:"] + statistics_lines
+        table = [f"| {' | '.join(columns)} |", f"|{'---|' * len(columns)}"]
+        table += [f"| {' | '.join(_format_value(row.get(name), self.max_cell_chars) for name in columns)} |"
+                  for row in rows]
+
+        # Largest number of rows that fits the budget, by binary search on the rendered text.
+        low, high = 0, len(rows)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if count_tokens(self._render(header, table, middle, len(rows))) <= self.max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        output = self._render(header, table, low, len(rows))
+        if low < len(rows):
+            logger.info(f"Tool output kept {low} of {len(rows)} rows within {self.max_tokens} tokens")
+        return output
+
+    def _summary_line(self, result):
+        line = f"Returned {len(result.documents)} of {result.total} matching documents."
+        if result.truncated:
+            line += " The result was truncated; mention that only part of it is shown."
+        return line
+
+    def _render(self, header, table, row_count, total_rows):
+        lines = header + ["", *table[:2 + row_count]]
+        if row_count < total_rows:
+            lines.append(f"({total_rows - row_count} more rows omitted to fit the token budget)")
+        return "\n".join(lines)
+
+
+def create_tool_output_compactor() -> ToolOutputCompactor:
+    """
+    Builds the tool output compactor from the environment.
+
+    Environment variables:
+        TOOL_OUTPUT_MAX_TOKENS: Token budget of one tool response. Defaults to 2000.
+        TOOL_OUTPUT_STATS_MIN_ROWS: Rows from which column statistics are added. Defaults to 10.
+        TOOL_OUTPUT_MAX_CELL_CHARS: Characters kept per table cell. Defaults to 200.
+    """
+    return ToolOutputCompactor(
+        max_tokens=int(os.getenv("TOOL_OUTPUT_MAX_TOKENS", "2000")),
+        stats_min_rows=int(os.getenv("TOOL_OUTPUT_STATS_MIN_ROWS", "10")),
+        max_cell_chars=int(os.getenv("TOOL_OUTPUT_MAX_CELL_CHARS", "200")))
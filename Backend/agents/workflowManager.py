@@ -1,29 +1,34 @@
 from langgraph.graph import StateGraph, END
-from agents.mongodb_retriever import get_movies
-from agents.plot_generator import generate_chart_based_on_query, generate_mongo_query, rephrase_user_query_for_visualization
+from agents.plot_generator import (
+    agenerate_chart_based_on_query, agenerate_mongo_query, agenerate_planned_chart,
+    aplan_visualization, arephrase_user_query_for_visualization, arun_planned_query, chart_payloads,
+    generate_chart_based_on_query, generate_mongo_query, generate_planned_chart,
+    plan_visualization, rephrase_user_query_for_visualization, run_planned_query)
 from models.models import QueryResponse
 from prompts.mongoDB_movies_Prompt import get_text2nosql_prompt
 from prompts.routerPrompt import get_router_prompt
 from state import MultiAgentState
 from llmManager import LLMManager
 from langchain_core.messages import HumanMessage
+from langchain_core.runnables import RunnableLambda
 from langchain_core.runnables.graph import MermaidDrawMethod
 from tools.text2NoSqlTools import text2NoSqlTools
 from langchain.agents import AgentExecutor, create_tool_calling_agent
-from langgraph.checkpoint.memory import MemorySaver
-from langchain_community.chat_message_histories import ChatMessageHistory
-from langchain_core.chat_history import BaseChatMessageHistory
+from agents.checkpointing import create_checkpointer
 from agents.logger import setup_logger
+from agents.metrics import instrument_node, metrics_callback, request_metrics_scope
+from agents.request_context import current_session_id, request_scope
+from agents.route_classifier import create_route_classifier
+from agents.router_batching import create_router_batcher
+from agents.speculation import cancel_speculation, speculate, take_speculation
+from agents.session_store import session_store
 from langchain.memory import ConversationSummaryMemory
 from langchain_core.runnables.history import RunnableWithMessageHistory
+from typing import AsyncIterator, Tuple
 import os
 
 logger = setup_logger(__name__)
 
-store = {}
-session_id = "movie-session"
-text2nosql_memory = ChatMessageHistory(session_id=session_id)
-
 
 class WorkflowManager:
     def __init__(self, llm_manager: LLMManager):
@@ -34,18 +39,27 @@ class WorkflowManager:
             self._slm = llm_manager.slm
             self.memory = ConversationSummaryMemory(
                 llm=self._llm, input_key="input", memory_key="chat_history")
+            # Chains and agents are stateless across requests; build them once.
+            self._router_chain = get_router_prompt() | self._slm
+            self._route_classifier = create_route_classifier()
+            self._router_batcher = create_router_batcher(self._slm)
+            self._speculative_routing = os.getenv("ROUTER_SPECULATIVE", "false") == "true"
+            self._text2nosql_agent = self._create_text2nosql_agent()
             self.graph = self._initialize_workflow()
             logger.info("WorkflowManager initialized successfully")
         except Exception as e:
             logger.error(f"Error initializing WorkflowManager: {e}")
             raise
 
-    def invoke(self, query) -> QueryResponse:
+    def invoke(self, query, session_id=None) -> QueryResponse:
         """
         Processes a query by streaming data through a graph and returns a response.
 
         Args:
             query (str): The query to be processed.
+            session_id (str, optional): The conversation the query belongs to. Each session
+                has its own bounded history and graph thread. A new session is started
+                when it is missing.
 
         Returns:
             QueryResponse: An object containing the answer and chart generated from the query.
@@ -60,96 +74,305 @@ class WorkflowManager:
         Raises:
             Any exceptions raised by the graph streaming process.
         """
-        finalResponse = QueryResponse(answer='', chart='')
-        config = {"configurable": {"thread_id": "1"}, "recursion_limit": 100}
-        input = {"question": query}
-        response = []
-        for stream_data in self.graph.stream(input, config):
-            if "__end__" not in stream_data:
-                response.append(stream_data)
-                if (stream_data.get('router_node')):
-                    continue
-                node_response = (
-                    stream_data.get('text2NoSql_node')
-                )
-                visualization_response = (
-                    stream_data.get('visualization_node') or
-                    stream_data.get('generate_mongo_query_node') or
-                    stream_data.get('generate_chart_node')
-                )
-                if node_response:
-                    finalResponse.answer = node_response.get('answer')
-                elif visualization_response:
-                    finalResponse.chart = visualization_response.get('chart')
-        if finalResponse.answer == '' and finalResponse.chart == '':
+        with request_scope(session_id) as context, request_metrics_scope():
+            finalResponse = QueryResponse(answer='', chart='', session_id=context.session_id)
+            input, config = self._graph_input(query, context.session_id)
+            for stream_data in self.graph.stream(input, config):
+                self._apply_stream_data(finalResponse, stream_data)
+            return self._finalize_response(finalResponse, context)
+
+    async def ainvoke(self, query, session_id=None) -> QueryResponse:
+        """
+        Async variant of `invoke` built on `graph.astream`.
+
+        Every node in the graph has an async implementation, so LLM round trips and
+        MongoDB aggregations are awaited instead of blocking the event loop. Use this
+        from async request handlers.
+
+        Args:
+            query (str): The query to be processed.
+            session_id (str, optional): The conversation the query belongs to.
+
+        Returns:
+            QueryResponse: An object containing the answer and chart generated from the query.
+        """
+        with request_scope(session_id) as context, request_metrics_scope():
+            finalResponse = QueryResponse(answer='', chart='', session_id=context.session_id)
+            input, config = self._graph_input(query, context.session_id)
+            async for stream_data in self.graph.astream(input, config):
+                self._apply_stream_data(finalResponse, stream_data)
+            return self._finalize_response(finalResponse, context)
+
+    async def astream(self, query, session_id=None) -> AsyncIterator[Tuple[str, dict]]:
+        """
+        Runs the graph and yields progress events as soon as they are produced.
+
+        Args:
+            query (str): The query to be processed.
+            session_id (str, optional): The conversation the query belongs to.
+
+        Yields:
+            tuple[str, dict]: An event name and its JSON serializable payload:
+                - 'route': the router decision.
+                - 'rephrased_question': the visualization branch's rephrased question.
+                - 'pipeline': an aggregation pipeline generated for the question.
+                - 'result': the size of an aggregation result and, when it was
+                  truncated, the `result_id` for reading further pages.
+                - 'documents': the number of documents the aggregation returned.
+                - 'token': a partial answer token from the text2NoSql agent.
+                - 'answer': the complete answer.
+                - 'chart': the chart fields of the response, 'chart', 'figure' and
+                  'chart_id', in the configured `CHART_PAYLOAD_FORMAT`.
+                - 'done': the final `QueryResponse`, identical to what `ainvoke` returns
+                  except that a chart already sent in a 'chart' event is only
+                  referred to by its 'chart_id'.
+        """
+        with request_scope(session_id) as context, request_metrics_scope():
+            finalResponse = QueryResponse(answer='', chart='', session_id=context.session_id)
+            input, config = self._graph_input(query, context.session_id)
+            sent_chart, sent_fields = None, None
+            async for mode, chunk in self.graph.astream(
+                    input, config, stream_mode=["updates", "messages", "custom"]):
+                if mode == "messages":
+                    message, metadata = chunk
+                    if (metadata.get("langgraph_node") == "text2NoSql_node"
+                            and isinstance(message.content, str) and message.content):
+                        yield "token", {"content": message.content}
+                elif mode == "custom":
+                    yield chunk["event"], chunk["data"]
+                else:
+                    for event in self._stream_data_events(chunk):
+                        yield event
+                    chart_response = chunk.get('generate_chart_node')
+                    if chart_response and chart_response.get('chart'):
+                        sent_chart = chart_response['chart']
+                        sent_fields = chart_payloads.encode(sent_chart)
+                        yield "chart", sent_fields
+                    self._apply_stream_data(finalResponse, chunk)
+            if sent_chart is not None and finalResponse.chart == sent_chart:
+                # The client has the chart from the 'chart' event; only its content hash is repeated.
+                response = self._finalize_response(finalResponse, context, encode_chart=False)
+                response.chart, response.chart_id = '', sent_fields['chart_id']
+            else:
+                response = self._finalize_response(finalResponse, context)
+            yield "done", response.model_dump()
+
+    async def acopy_session(self, source_id: str, target_id: str):
+        """
+        Starts session `target_id` as a copy of `source_id`: its chat histories and
+        its graph checkpoint, so follow-up questions continue from the same state.
+        """
+        session_store.copy(source_id, target_id)
+        await self.checkpointer.acopy_thread(source_id, target_id)
+
+    def _graph_input(self, query, session_id):
+        # The session doubles as the checkpointer thread, so graph state is per conversation too.
+        # The callback counts chat model calls and tokens for the request metrics.
+        config = {"configurable": {"thread_id": session_id}, "recursion_limit": 100,
+                  "callbacks": [metrics_callback]}
+        return {"question": query}, config
+
+    def _stream_data_events(self, stream_data):
+        router_response = stream_data.get('router_node')
+        if router_response:
+            yield "route", {"question_type": router_response.get('question_type')}
+        rephrase_response = stream_data.get('visualization_node')
+        if rephrase_response:
+            yield "rephrased_question", {
+                "rephrasedQuestion": rephrase_response.get('rephrasedQuestion')}
+        mongo_response = stream_data.get('generate_mongo_query_node')
+        if mongo_response:
+            yield "documents", {"count": len(mongo_response.get('mongoQueryResult') or [])}
+        answer_response = stream_data.get('text2NoSql_node')
+        if answer_response:
+            yield "answer", {"answer": answer_response.get('answer')}
+        chart_response = stream_data.get('generate_chart_node')
+        if chart_response and chart_response.get('answer'):
+            # A note on the chart, such as the result it was drawn from being cut short.
+            yield "answer", {"answer": chart_response['answer']}
+
+    def _apply_stream_data(self, finalResponse: QueryResponse, stream_data):
+        if "__end__" in stream_data or stream_data.get('router_node'):
+            return
+        node_response = (
+            stream_data.get('text2NoSql_node')
+        )
+        visualization_response = (
+            stream_data.get('visualization_node') or
+            stream_data.get('generate_mongo_query_node') or
+            stream_data.get('generate_chart_node')
+        )
+        if node_response:
+            finalResponse.answer = node_response.get('answer')
+        elif visualization_response:
+            finalResponse.chart = visualization_response.get('chart')
+            if visualization_response.get('answer'):
+                finalResponse.answer = visualization_response['answer']
+
+    def _finalize_response(self, finalResponse: QueryResponse, context, encode_chart=True) -> QueryResponse:
+        finalResponse.result_id = context.result_id
+        finalResponse.total_results = context.total_results
+        if not finalResponse.answer and not finalResponse.chart:
             finalResponse.answer = "Unable to process the query. Could you provide more information?"
+        if encode_chart:
+            for field, value in chart_payloads.encode(finalResponse.chart).items():
+                setattr(finalResponse, field, value)
         return finalResponse
 
     def _initialize_workflow(self):
         try:
             logger.info("Generating workflow graph")
-            memory = MemorySaver()
+            self.checkpointer = create_checkpointer()
             enableDebugging = os.getenv("ENABLE_DEBUGGING") == "true"
             graph = self._create_workflow().compile(
-                checkpointer=memory, debug=enableDebugging)
+                checkpointer=self.checkpointer, debug=enableDebugging)
             graph.name = "Text To NoSQL Graph"
-            # Draw the graph and get the bytes
-            image_bytes = graph.get_graph().draw_mermaid_png(
-                draw_method=MermaidDrawMethod.API,
-            )
-
-            # Save the bytes to an image file
-            with open("workflow_graph.png", "wb") as image_file:
-                image_file.write(image_bytes)
             logger.info("Workflow graph generated successfully")
             return graph
         except Exception as e:
             logger.error(f"Error generating workflow graph: {e}")
             raise
 
+    def render_graph(self, image_format: str = "mermaid"):
+        """
+        Renders the workflow graph on demand. Start up never renders it, because
+        the PNG renderer calls the remote mermaid.ink API.
+
+        Args:
+            image_format (str): 'mermaid' returns the Mermaid source and works offline,
+                'png' returns the image rendered by the mermaid.ink API.
+
+        Returns:
+            str | bytes: The Mermaid source, or the PNG bytes.
+        """
+        try:
+            if image_format == "mermaid":
+                return self.graph.get_graph().draw_mermaid()
+            if image_format == "png":
+                return self.graph.get_graph().draw_mermaid_png(
+                    draw_method=MermaidDrawMethod.API)
+            raise ValueError(f"Unsupported graph format: {image_format}")
+        except Exception as e:
+            logger.error(f"Error rendering workflow graph: {e}")
+            raise
+
     def _router_agent(self, state: MultiAgentState):
         try:
             logger.info(f"Routing question: {state['question']}")
-            supervisor_chain = get_router_prompt() | self._slm
             messages = [HumanMessage(state['question'])]
-            response = supervisor_chain.invoke({"question": messages})
-
-            if 'content_filter_result' in response:
-                logger.warning(
-                    "The response was filtered due to content management policy.")
-                return {"question_type": "Error", 'messages': messages}
+            local_route = self._local_route(state['question'])
+            if local_route:
+                return {"question_type": local_route, 'messages': messages}
+            response = self._router_chain.invoke({"question": messages})
+            return self._parse_router_response(response, messages)
+        except Exception as e:
+            logger.error(f"Error in router_agent: {e}")
+            raise
 
-            logger.info(f"Routing to: {response.content}")
-            return {"question_type": response.content, 'messages': messages}
+    async def _arouter_agent(self, state: MultiAgentState):
+        try:
+            logger.info(f"Routing question: {state['question']}")
+            messages = [HumanMessage(state['question'])]
+            local_route = self._local_route(state['question'])
+            if local_route:
+                return {"question_type": local_route, 'messages': messages}
+            speculation_key = self._speculate_visualization(state)
+            try:
+                routed = await self._aroute_with_model(state['question'], messages)
+            except BaseException:
+                if speculation_key:
+                    cancel_speculation(speculation_key)
+                raise
+            if speculation_key and routed["question_type"] != "Visualization":
+                cancel_speculation(speculation_key)
+            return routed
         except Exception as e:
             logger.error(f"Error in router_agent: {e}")
             raise
 
+    async def _aroute_with_model(self, question, messages):
+        if self._router_batcher is not None:
+            route = await self._router_batcher.route(question)
+            if route is not None:
+                logger.info(f"Routing to: {route}")
+                return {"question_type": route, 'messages': messages}
+        response = await self._router_chain.ainvoke({"question": messages})
+        return self._parse_router_response(response, messages)
+
+    def _local_route(self, question):
+        if self._route_classifier is None:
+            return None
+        return self._route_classifier.route(question)
+
+    def _speculate_visualization(self, state):
+        # The visualization node's first LLM call starts while the router model runs.
+        # A local guess that the question is not about a chart skips it.
+        if not self._speculative_routing:
+            return None
+        if self._route_classifier is not None:
+            guess, _ = self._route_classifier.classify(state['question'])
+            if guess not in (None, "Visualization"):
+                return None
+        key = ("visualization_node", state['question'])
+        logger.info("Starting the visualization node speculatively")
+        speculate(key, self._avisualization_node({"question": state['question']}))
+        return key
+
+    async def _aspeculative_visualization_node(self, state: MultiAgentState):
+        task = take_speculation(("visualization_node", state['question']))
+        if task is not None:
+            logger.info("Using the speculatively started visualization node")
+            return await task
+        return await self._avisualization_node(state)
+
+    def _parse_router_response(self, response, messages):
+        if 'content_filter_result' in response:
+            logger.warning(
+                "The response was filtered due to content management policy.")
+            return {"question_type": "Error", 'messages': messages}
+
+        logger.info(f"Routing to: {response.content}")
+        return {"question_type": response.content, 'messages': messages}
+
+    def _create_text2nosql_agent(self):
+        text2NoSqlAgent = create_tool_calling_agent(
+            llm=self._llm,
+            prompt=get_text2nosql_prompt(),
+            tools=text2NoSqlTools,
+        )
+        text2nosql_agent_executor = AgentExecutor(
+            agent=text2NoSqlAgent,
+            tools=text2NoSqlTools,
+            verbose=True,
+            handle_parsing_errors=True,
+            max_iterations=10,
+            return_intermediate_steps=False)
+        return RunnableWithMessageHistory(
+            text2nosql_agent_executor,
+            lambda session_id: session_store.get_history(session_id, "agent"),
+            input_messages_key="input",
+            history_messages_key="chat_history",
+        )
+
     def _text2NoSql_node(self, state: MultiAgentState):
         try:
             logger.info(
                 f"Processing inspection node for question: {state['question']}")
-            text2NoSqlAgent = create_tool_calling_agent(
-                llm=self._llm,
-                prompt=get_text2nosql_prompt(),
-                tools=text2NoSqlTools,
-            )
-            text2nosql_agent_executor = AgentExecutor(
-                agent=text2NoSqlAgent,
-                tools=text2NoSqlTools,
-                verbose=True,
-                handle_parsing_errors=True,
-                max_iterations=10,
-                return_intermediate_steps=False)
-            agent_with_chat_history = RunnableWithMessageHistory(
-                text2nosql_agent_executor,
-                lambda session_id: text2nosql_memory,
-                input_messages_key="input",
-                history_messages_key="chat_history",
-            )
-            response = agent_with_chat_history.invoke(
+            response = self._text2nosql_agent.invoke(
+                {"input": [HumanMessage(state['question'])]},
+                config={"configurable": {"session_id": current_session_id()}})
+            return {'answer': response["output"]}
+        except Exception as e:
+            logger.error(f"Error in text2NoSql_node: {e}")
+            raise
+
+    async def _atext2NoSql_node(self, state: MultiAgentState):
+        try:
+            logger.info(
+                f"Processing inspection node for question: {state['question']}")
+            response = await self._text2nosql_agent.ainvoke(
                 {"input": [HumanMessage(state['question'])]},
-                config={"configurable": {"session_id": session_id}})
+                config={"configurable": {"session_id": current_session_id()}})
             return {'answer': response["output"]}
         except Exception as e:
             logger.error(f"Error in text2NoSql_node: {e}")
@@ -183,19 +406,47 @@ class WorkflowManager:
             raise
 
     def _add_nodes_to_workflow(self, workflow):
-        workflow.add_node("router_node", self._router_agent)
+        # Each node carries a sync and an async implementation so the same
+        # compiled graph serves both `graph.stream` and `graph.astream`.
+        # `instrument_node` records the wall time and the work of each node.
+        workflow.add_node(
+            "router_node",
+            RunnableLambda(instrument_node("router_node", self._router_agent),
+                           afunc=instrument_node("router_node", self._arouter_agent)))
         workflow.set_entry_point("router_node")
-        workflow.add_node("text2NoSql_node", self._text2NoSql_node)
+        workflow.add_node(
+            "text2NoSql_node",
+            RunnableLambda(instrument_node("text2NoSql_node", self._text2NoSql_node),
+                           afunc=instrument_node("text2NoSql_node", self._atext2NoSql_node)))
+        if os.getenv("VISUALIZATION_PLANNER", "single") == "legacy":
+            # One LLM call each to rephrase the question, generate the pipeline
+            # and generate the plotting code.
+            visualization_node = rephrase_user_query_for_visualization
+            self._avisualization_node = arephrase_user_query_for_visualization
+            mongo_query_nodes = (generate_mongo_query, agenerate_mongo_query)
+            chart_nodes = (generate_chart_based_on_query, agenerate_chart_based_on_query)
+        else:
+            # A single LLM call plans the question, pipeline and chart together.
+            visualization_node = plan_visualization
+            self._avisualization_node = aplan_visualization
+            mongo_query_nodes = (run_planned_query, arun_planned_query)
+            chart_nodes = (generate_planned_chart, agenerate_planned_chart)
+        # The async visualization node may run speculatively within the router node;
+        # it is instrumented itself so its work is not counted as the router's.
+        self._avisualization_node = instrument_node("visualization_node", self._avisualization_node)
         workflow.add_node(
             "visualization_node",
-            rephrase_user_query_for_visualization)
+            RunnableLambda(instrument_node("visualization_node", visualization_node),
+                           afunc=self._aspeculative_visualization_node))
         workflow.add_node(
             "generate_mongo_query_node",
-            generate_mongo_query)
+            RunnableLambda(instrument_node("generate_mongo_query_node", mongo_query_nodes[0]),
+                           afunc=instrument_node("generate_mongo_query_node", mongo_query_nodes[1])))
         workflow.add_node(
             "generate_chart_node",
-            generate_chart_based_on_query)
-        workflow.add_node("no_context_node", self._no_context_node)
+            RunnableLambda(instrument_node("generate_chart_node", chart_nodes[0]),
+                           afunc=instrument_node("generate_chart_node", chart_nodes[1])))
+        workflow.add_node("no_context_node", instrument_node("no_context_node", self._no_context_node))
 
     def _add_edges_to_workflow(self, workflow):
         workflow.add_edge("text2NoSql_node", END)
@@ -0,0 +1,124 @@
+"""
+Size and parse time of chart payloads in each `CHART_PAYLOAD_FORMAT`.
+
+Charts are drawn from mflix-shaped movie documents (`benchmarks.mflix`) the way
+the chart nodes draw them: from templates (`agents.chart_builder`) and with
+Plotly, as generated code does. Each is encoded as the response of the /query
+endpoint carries it:
+
+- string: the figure JSON escaped into the 'chart' string, parsed twice.
+- object: the figure under 'figure', with numeric arrays as typed arrays
+  (`agents.chart_payload`), parsed once and its typed arrays decoded.
+
+Reported per chart: the response bytes as sent, gzip compressed as the
+middleware compresses them and brotli compressed when the `brotli` package is
+installed, and the median time to parse the response and decode its arrays.
+Parse times are Python's `json` and NumPy, as a proxy for `JSON.parse` and typed
+array views in the browser. A repeated chart read from `GET /charts/{chart_id}`
+with its ETag is answered with an empty 304 either way.
+
+Usage (from the Backend directory):
+    python -m benchmarks.chart_payload_benchmark --documents 20000
+"""
+import argparse
+import base64
+import gzip
+import json
+import logging
+import statistics
+import time
+from collections import Counter
+
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+
+from agents.chart_builder import build_chart
+from agents.chart_payload import ChartPayloads, brotli
+from benchmarks.mflix import GENRES, mflix_documents
+
+
+def _charts(documents):
+    genres = Counter(genre for document in documents for genre in document["genres"])
+    rated = [document for document in documents if "rating" in document["imdb"]]
+    by_year = {}
+    for document in rated:
+        by_year.setdefault(document["year"], []).append(document["imdb"]["rating"])
+    years = sorted(by_year)
+    decades = sorted({document["year"] // 10 * 10 for document in documents})
+    cells = Counter((genre, document["year"] // 10 * 10) for document in documents for genre in document["genres"])
+    yield "bar: movies per genre", build_chart(
+        {"type": "bar", "x": "genre", "y": "count"},
+        [{"genre": genre, "count": count} for genre, count in genres.most_common()])
+    yield "scatter: votes by runtime", build_chart(
+        {"type": "scatter", "x": "runtime", "y": "imdb.votes"}, documents)
+    yield "scatter: rating by year", build_chart(
+        {"type": "scatter", "x": "year", "y": "imdb.rating"}, rated)
+    yield "histogram: runtime", build_chart({"type": "histogram", "x": "runtime"}, documents)
+    yield "line (Plotly): rating per year", px.line(
+        x=years, y=[statistics.mean(by_year[year]) for year in years], template="plotly_dark").to_json()
+    yield "heatmap (Plotly): genre by decade", go.Figure(go.Heatmap(
+        x=decades, y=GENRES, z=[[cells[genre, decade] for decade in decades] for genre in GENRES])).to_json()
+
+
+def _decode_arrays(value):
+    if isinstance(value, dict):
+        if "bdata" in value and "dtype" in value:
+            return np.frombuffer(base64.b64decode(value["bdata"]), dtype=value["dtype"])
+        return {key: _decode_arrays(item) for key, item in value.items()}
+    if isinstance(value, list) and value and isinstance(value[0], (dict, list)):
+        return [_decode_arrays(item) for item in value]
+    return value
+
+
+def _parse(chart_format, body):
+    response = json.loads(body)
+    if chart_format == "string":
+        return json.loads(response["chart"])
+    return _decode_arrays(response["figure"])
+
+
+def _timed(function, repeats):
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def _print_row(name, chart_format, size, compressed, brotli_size, parse):
+    brotli_column = f"{brotli_size / 1024:>8.1f}" if brotli is not None else f"{'-':>8}"
+    print(f"{name:<34}{chart_format:<8}{size / 1024:>8.1f}{compressed / 1024:>8.1f}"
+          f"{brotli_column}{parse * 1000:>8.2f}")
+
+
+def main(args):
+    logging.disable(logging.INFO)
+    documents = list(mflix_documents(args.documents))
+    formats = {name: ChartPayloads(name, min_length=args.min_length) for name in ("string", "object")}
+    print(f"{args.documents} movies; sizes in KB, parse times in ms")
+    print(f"{'chart':<34}{'format':<8}{'bytes':>8}{'gzip':>8}{'br':>8}{'parse':>8}")
+    totals = {name: [0, 0, 0, 0.0] for name in formats}
+    for name, chart in _charts(documents):
+        for chart_format, payloads in formats.items():
+            fields = payloads.encode(chart)
+            body = json.dumps({"answer": "", **fields}, separators=(",", ":")).encode("utf-8")
+            compressed = len(gzip.compress(body, compresslevel=6))
+            brotli_size = len(brotli.compress(body, quality=9)) if brotli is not None else 0
+            parse = _timed(lambda: _parse(chart_format, body), args.repeats)
+            for index, value in enumerate((len(body), compressed, brotli_size, parse)):
+                totals[chart_format][index] += value
+            _print_row(name, chart_format, len(body), compressed, brotli_size, parse)
+    print()
+    for chart_format, (size, compressed, brotli_size, parse) in totals.items():
+        _print_row("total", chart_format, size, compressed, brotli_size, parse)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=20000)
+    parser.add_argument("--min-length", type=int, default=16, help="Shortest array sent as a typed array")
+    parser.add_argument("--repeats", type=int, default=5)
+    main(parser.parse_args())
@@ -0,0 +1,112 @@
+"""
+Duplicate LLM and MongoDB work during a spike of identical questions.
+
+Every wave, all clients send a question at the same moment, drawn from a few
+popular questions written in slightly different ways. The waves run through the
+/query handler with stubbed LLM and MongoDB backends, in three modes:
+
+- off: every request runs the whole graph.
+- coalescing: identical in-flight questions share one graph execution, and one
+  `get_movies` execution within the graph.
+- coalescing+batching: as above, and the router model classifies the questions
+  arriving within `--batch-window-ms` in one call.
+
+The caches are disabled, so the counts show the work done within a spike rather
+than what the caches would save after it.
+
+Usage (from the Backend directory):
+    python -m benchmarks.coalescing_benchmark --clients 32 --waves 3
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import logging
+import math
+import os
+import statistics
+import time
+import warnings
+
+os.environ["PIPELINE_CACHE_ENABLED"] = "false"
+os.environ["RESULT_CACHE_BACKEND"] = "none"
+
+from benchmarks.stubs import install_stubs
+
+POPULAR_QUESTIONS = [
+    "Show me all the movies directed by Christopher Nolan",
+    "show me all the movies directed by Christopher Nolan?",
+    "Get me the movies released in 2000 with rating greater than 8",
+    "Plot the number of movies per genre",
+    "Plot the number of movies  per genre.",
+]
+
+
+async def _run_mode(handler, clients, waves):
+    latencies = []
+    start = time.perf_counter()
+    for wave in range(waves):
+        async def client(index):
+            issued = time.perf_counter()
+            await handler(POPULAR_QUESTIONS[(index + wave) % len(POPULAR_QUESTIONS)])
+            latencies.append(time.perf_counter() - issued)
+        await asyncio.gather(*(client(index) for index in range(clients)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return (len(latencies) / elapsed, statistics.median(latencies),
+            latencies[math.ceil(len(latencies) * 0.95) - 1])
+
+
+async def main(args):
+    logging.disable(logging.INFO)
+    warnings.simplefilter("ignore")
+    llm_manager = install_stubs(args.llm_latency, args.mongo_latency)
+    import agents.main as server
+    import agents.mongodb_retriever as mongodb_retriever
+    from agents.coalescing import SingleFlight
+    from models.models import Query
+    from workflowManager import WorkflowManager
+
+    async def handler(question):
+        return await server._coalesced_invoke(Query(query=question))
+
+    def collection_round_trips():
+        return (mongodb_retriever.collection().round_trips
+                + mongodb_retriever.async_collection().round_trips)
+
+    os.environ["ROUTER_BATCH_WINDOW_MS"] = "0"
+    unbatched = WorkflowManager(llm_manager=llm_manager)
+    os.environ["ROUTER_BATCH_WINDOW_MS"] = str(args.batch_window_ms)
+    batched = WorkflowManager(llm_manager=llm_manager)
+    modes = {"off": (False, unbatched), "coalescing": (True, unbatched),
+             "coalescing+batching": (True, batched)}
+
+    print(f"{args.clients} clients per wave, {args.waves} waves, LLM latency "
+          f"{args.llm_latency}s, Mongo latency {args.mongo_latency}s")
+    print(f"{'mode':<22}{'LLM calls':>10}{'router':>8}{'Mongo':>7}{'req/s':>9}"
+          f"{'p50 s':>8}{'p95 s':>8}")
+    for name, (coalescing, manager) in modes.items():
+        server.query_flights = SingleFlight("query") if coalescing else None
+        server.workflow_manager.override(manager)
+        mongodb_retriever.movie_flights = SingleFlight("get_movies") if coalescing else None
+        llm_calls = llm_manager.llm.calls + llm_manager.slm.calls
+        router_calls = llm_manager.slm.calls
+        round_trips = collection_round_trips()
+        with contextlib.redirect_stdout(io.StringIO()):
+            throughput, p50, p95 = await _run_mode(handler, args.clients, args.waves)
+        llm_calls = llm_manager.llm.calls + llm_manager.slm.calls - llm_calls
+        router_calls = llm_manager.slm.calls - router_calls
+        round_trips = collection_round_trips() - round_trips
+        print(f"{name:<22}{llm_calls:>10}{router_calls:>8}{round_trips:>7}{throughput:>9.1f}"
+              f"{p50:>8.3f}{p95:>8.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--waves", type=int, default=3)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--mongo-latency", type=float, default=0.05)
+    parser.add_argument("--batch-window-ms", type=float, default=20)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,103 @@
+"""
+Time and peak memory from cursor to chart data, with documents versus columns.
+
+Generates mflix-shaped movie documents and feeds them through a cursor-like
+iterator, as pymongo decodes them, into two versions of the chart stage:
+
+- documents: the cursor is read into a list of dicts, `_id`s are stringified in
+  place and the list is normalized into a pandas DataFrame, which is then used to
+  count movies per genre and average `imdb.rating` per year.
+- columnar: the cursor is read straight into a `ColumnarResult` and the same two
+  aggregates are computed on its NumPy arrays.
+
+Both versions end by building the same Plotly figure JSON. Time is measured on
+documents generated beforehand; peak memory is the tracemalloc peak of a run fed
+by a generator, so documents only stay alive if the stage keeps them. The last
+column is the pickled size of what the chart sandbox would be sent.
+
+Usage (from the Backend directory):
+    python -m benchmarks.columnar_benchmark --documents 20000 --repeat 3
+"""
+import argparse
+import gc
+import pickle
+import statistics
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+from agents.columnar import ColumnarResult
+from benchmarks.mflix import mflix_documents
+
+
+def _figure(genres, genre_counts, years, mean_ratings):
+    figure = go.Figure([go.Bar(x=genres, y=genre_counts, name="movies"),
+                        go.Scatter(x=years, y=mean_ratings, name="rating", yaxis="y2")])
+    return figure.to_json()
+
+
+def with_documents(cursor):
+    documents = list(cursor)
+    for record in documents:
+        for key in record:
+            if key == "_id":
+                record[key] = str(record[key])
+    frame = pd.json_normalize(documents)
+    genre_counts = frame.explode("genres")["genres"].value_counts()
+    ratings = frame.groupby("year")["imdb.rating"].mean()
+    return _figure(genre_counts.index.tolist(), genre_counts.tolist(),
+                   ratings.index.tolist(), ratings.tolist())
+
+
+def with_columns(cursor):
+    table = ColumnarResult.from_documents(cursor)
+    _, genres = table.explode("genres")
+    names, counts = np.unique(genres.astype(str), return_counts=True)
+    order = np.argsort(-counts, kind="stable")
+    years, ratings = table.column("year"), table.column("imdb.rating")
+    rated = ~np.isnan(ratings)
+    unique_years, positions = np.unique(years[rated], return_inverse=True)
+    means = np.bincount(positions, weights=ratings[rated]) / np.bincount(positions)
+    return _figure(names[order].tolist(), counts[order].tolist(),
+                   unique_years.tolist(), means.tolist())
+
+
+def _measure(stage, count, repeat):
+    times = []
+    for _ in range(repeat):
+        documents = list(mflix_documents(count))
+        gc.collect()
+        start = time.perf_counter()
+        stage(iter(documents))
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    stage(mflix_documents(count))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(times), peak / 2 ** 20
+
+
+def main(args):
+    # Warm up imports and Plotly's validators outside the measurements.
+    for stage in (with_documents, with_columns):
+        stage(mflix_documents(100))
+    print(f"Cursor to figure for {args.documents} mflix-shaped documents "
+          f"(median of {args.repeat})")
+    payloads = {"documents": list(mflix_documents(args.documents)),
+                "columnar": ColumnarResult.from_documents(mflix_documents(args.documents))}
+    print(f"{'representation':<16}{'seconds':>10}{'peak MiB':>11}{'payload MiB':>14}")
+    for name, stage in (("documents", with_documents), ("columnar", with_columns)):
+        seconds, peak = _measure(stage, args.documents, args.repeat)
+        payload = len(pickle.dumps(payloads[name], protocol=pickle.HIGHEST_PROTOCOL)) / 2 ** 20
+        print(f"{name:<16}{seconds:>10.3f}{peak:>11.1f}{payload:>14.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    main(parser.parse_args())
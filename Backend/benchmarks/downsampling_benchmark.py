@@ -0,0 +1,178 @@
+"""
+Time, size and fidelity of charts of large results with and without
+downsampling to the point budget (`agents.downsampling`).
+
+Each chart is drawn from `--points` rows both ways, from templates
+(`agents.chart_builder.build_chart`) and with Plotly as generated code draws it
+(`figure_json` against `Figure.to_json`):
+
+- line: a random walk over dates, reduced by LTTB. Fidelity is the largest gap
+  between the full and the reduced line, interpolated on the full x values, as a
+  share of the y range, and whether the extremes were kept.
+- scatter: mflix runtime against votes, reduced by grid sampling. Fidelity is the
+  share of the cells of a 30x30 grid occupied by the full scatter that the
+  reduced one still occupies.
+- histogram: mflix runtimes, pre-binned. Fidelity is whether the bin counts add
+  up to the rows.
+- bar: votes per movie title, the largest categories plus 'Other'. Fidelity is
+  whether the bars add up to the full total.
+
+First, planned charts of `--graph-rows` movies go through `run_planned_query` and
+`generate_planned_chart` as the graph runs them, with MongoDB as an in-memory
+collection (`benchmarks.mflix`); the run fails unless each chart read more rows
+than the point budget and its figure was downsampled.
+
+Usage (from the Backend directory):
+    python -m benchmarks.downsampling_benchmark --points 10000 50000 200000
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import plotly.graph_objects as go
+
+from agents.chart_builder import build_chart
+from agents.columnar import as_columnar
+from agents.downsampling import PointBudget, as_numbers, figure_json
+from agents.request_context import request_scope
+from benchmarks.mflix import mflix_documents
+from benchmarks.replay_benchmark import install_replay
+from benchmarks.stubs import scripted_responder
+
+# Planned charts whose pipelines return a row per movie.
+GRAPH_PLANS = {
+    "line": {"pipeline": [{"$sort": {"released": 1}},
+                          {"$project": {"_id": 0, "released": 1, "votes": "$imdb.votes"}}],
+             "chart": {"type": "line", "x": "released", "y": "votes"}},
+    "scatter": {"pipeline": [{"$project": {"_id": 0, "runtime": 1, "votes": "$imdb.votes"}}],
+                "chart": {"type": "scatter", "x": "runtime", "y": "votes"}},
+    "histogram": {"pipeline": [{"$project": {"_id": 0, "runtime": 1}}],
+                  "chart": {"type": "histogram", "x": "runtime"}},
+    "bar": {"pipeline": [{"$project": {"_id": 0, "title": 1, "votes": "$imdb.votes"}}],
+            "chart": {"type": "bar", "x": "title", "y": "votes"}},
+}
+
+
+def _rows(count, seed):
+    rng = np.random.default_rng(seed)
+    walk = np.cumsum(rng.normal(size=count))
+    start = datetime(1990, 1, 1)
+    movies = list(mflix_documents(count, seed=seed))
+    for index, movie in enumerate(movies):
+        movie["date"] = start + timedelta(hours=index)
+        movie["walk"] = float(walk[index])
+    return as_columnar(movies)
+
+
+def _specs():
+    yield "line", {"type": "line", "x": "date", "y": "walk"}
+    yield "scatter", {"type": "scatter", "x": "runtime", "y": "imdb.votes"}
+    yield "histogram", {"type": "histogram", "x": "runtime"}
+    yield "bar", {"type": "bar", "x": "title", "y": "imdb.votes"}
+
+
+def _plotly_figure(table, spec):
+    # The figure generated code would draw for the same chart.
+    x = table.column(spec["x"])
+    if spec["type"] == "histogram":
+        return go.Figure(go.Histogram(x=x))
+    y = table.column(spec["y"])
+    if spec["type"] == "bar":
+        return go.Figure(go.Bar(x=x, y=y))
+    return go.Figure(go.Scatter(x=x, y=y, mode="lines" if spec["type"] == "line" else "markers"))
+
+
+def _cells(x, y, low, high):
+    cells = np.clip(((np.column_stack([x, y]) - low) / (high - low) * 30).astype(np.int64), 0, 29)
+    return set(map(tuple, cells))
+
+
+def _fidelity(table, spec, figure):
+    full_x, full_y = as_numbers(table.column(spec["x"])), as_numbers(table.column(spec.get("y") or spec["x"]))
+    trace = figure["data"][0]
+    if spec["type"] == "line":
+        x, y = as_numbers(trace["x"]), as_numbers(trace["y"])
+        gap = np.abs(np.interp(full_x, x, y) - full_y).max() / (full_y.max() - full_y.min())
+        extremes = full_y.max() in y and full_y.min() in y
+        return f"max gap {gap:.1%}, extremes {'kept' if extremes else 'lost'}"
+    if spec["type"] == "scatter":
+        present = np.isfinite(full_x) & np.isfinite(full_y)
+        points = np.column_stack([full_x[present], full_y[present]])
+        low, high = points.min(axis=0), points.max(axis=0)
+        full = _cells(points[:, 0], points[:, 1], low, high)
+        kept = _cells(as_numbers(trace["x"]), as_numbers(trace["y"]), low, high)
+        return f"{len(kept & full) / len(full):.1%} of cells kept"
+    if spec["type"] == "histogram":
+        return f"counts add up: {sum(trace['y']) == np.isfinite(full_x).sum()}"
+    return f"total kept: {np.isclose(sum(trace['y']), np.nansum(full_y))}"
+
+
+def _graph_check(count, seed, budget):
+    # The chart nodes read the result up to CHART_MAX_DOCUMENTS and reduce it to CHART_POINT_BUDGET.
+    os.environ["CHART_POINT_BUDGET"] = str(budget.points)
+    os.environ["CHART_MAX_CATEGORIES"] = str(budget.categories)
+    install_replay(scripted_responder, documents=list(mflix_documents(count, seed=seed)))
+    from agents.plot_generator import generate_planned_chart, run_planned_query
+    print(f"through the graph: {count} movies")
+    for name, plan in GRAPH_PLANS.items():
+        with request_scope():
+            state = {"question": f"Plot {name} of movies", "visualizationPlan": plan}
+            state.update(run_planned_query(state))
+            rows = len(state["mongoQueryResult"])
+            chart = generate_planned_chart(state)["chart"]
+        reduced = json.loads(chart)["layout"].get("meta", {}).get("downsampling")
+        if rows <= budget.points or reduced is None:
+            raise RuntimeError(f"The {name} chart of {rows} rows was not downsampled")
+        print(f"{name:<11}{rows:>8} rows read, {reduced['points']} points, {reduced['kept']} kept")
+    print()
+
+
+def _timed(function, repeats):
+    durations, result = [], None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        durations.append(time.perf_counter() - start)
+    return result, statistics.median(durations)
+
+
+def main(args):
+    logging.disable(logging.INFO)
+    budget = PointBudget(points=args.budget, categories=args.categories)
+    _graph_check(args.graph_rows, args.seed, budget)
+    print(f"budget {budget.points} points, {budget.categories} categories; sizes in KB, times in ms")
+    print(f"{'chart':<11}{'rows':>8}{'source':>9}{'full KB':>9}{'reduced':>9}{'full ms':>9}{'reduced':>9}"
+          f"{'kept':>7}  fidelity")
+    for points in args.points:
+        table = _rows(points, args.seed)
+        for name, spec in _specs():
+            figure = _plotly_figure(table, spec)
+            sources = (
+                ("template", lambda: build_chart(spec, table), lambda: build_chart(spec, table, budget)),
+                ("plotly", figure.to_json, lambda: figure_json(figure, budget)))
+            for source, full_function, reduced_function in sources:
+                full, full_seconds = _timed(full_function, args.repeats)
+                reduced, reduced_seconds = _timed(reduced_function, args.repeats)
+                reduced_figure = json.loads(reduced)
+                kept = reduced_figure["layout"].get("meta", {}).get("downsampling", {}).get("kept", points)
+                fidelity = _fidelity(table, spec, reduced_figure) if source == "template" else ""
+                print(f"{name:<11}{points:>8}{source:>9}{len(full) / 1024:>9.0f}{len(reduced) / 1024:>9.0f}"
+                      f"{full_seconds * 1000:>9.1f}{reduced_seconds * 1000:>9.1f}{kept:>7}  {fidelity}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--points", type=int, nargs="+", default=[10000, 50000, 200000])
+    parser.add_argument("--graph-rows", type=int, default=20000,
+                        help="Movies the charts through the graph are drawn from")
+    parser.add_argument("--budget", type=int, default=2000)
+    parser.add_argument("--categories", type=int, default=30)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=7)
+    main(parser.parse_args())
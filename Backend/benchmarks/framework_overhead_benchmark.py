@@ -0,0 +1,116 @@
+"""
+Per-request framework overhead of the graph nodes.
+
+Runs each LLM-backed node against a zero-latency stub chat model, so the
+measured time is pure LangChain/LangGraph overhead: prompt formatting, chain
+and agent construction, callbacks and parsing. Each node is measured twice:
+with the chains rebuilt for every request (the previous behaviour) and with
+the chains prebuilt once at start up.
+
+Usage (from the Backend directory):
+    python -m benchmarks.framework_overhead_benchmark --iterations 200
+    python -m benchmarks.framework_overhead_benchmark --max-overhead-ms 5
+The second form exits with status 1 when a prebuilt node exceeds the budget,
+which makes it usable as a regression check.
+"""
+import argparse
+import contextlib
+import io
+import logging
+import sys
+import time
+import warnings
+
+from benchmarks.stubs import SAMPLE_DOCUMENTS, install_stubs
+
+
+def _measure(function, iterations, reset):
+    function()  # warm up
+    elapsed = 0.0
+    for _ in range(iterations):
+        # Start every call from an empty conversation so only the framework
+        # overhead is compared.
+        reset()
+        start = time.perf_counter()
+        function()
+        elapsed += time.perf_counter() - start
+    return elapsed / iterations * 1000
+
+
+def main(args):
+    logging.disable(logging.INFO)
+    warnings.simplefilter("ignore")
+    llm_manager = install_stubs()
+    import agents.plot_generator as plot_generator
+    from agents.request_context import current_session_id
+    from agents.session_store import session_store
+    from langchain_core.messages import HumanMessage
+    from prompts.mongoDB_movies_Prompt import movies_collection_schema
+    from prompts.routerPrompt import get_router_prompt
+    from workflowManager import WorkflowManager
+
+    workflow_manager = WorkflowManager(llm_manager=llm_manager)
+    qna_state = {"question": "Show me all the movies directed by Christopher Nolan"}
+    chart_state = {"question": "Plot the number of movies per genre",
+                   "mongoQueryResult": SAMPLE_DOCUMENTS}
+
+    def rebuilt_router():
+        chain = get_router_prompt() | llm_manager.slm
+        chain.invoke({"question": [HumanMessage(qna_state["question"])]})
+
+    def rebuilt_agent():
+        agent = workflow_manager._create_text2nosql_agent()
+        agent.invoke({"input": [HumanMessage(qna_state["question"])]},
+                     config={"configurable": {"session_id": current_session_id()}})
+
+    def rebuilt_rephrase():
+        chain, _ = plot_generator.create_visualization_chains(llm_manager.llm)
+        chain.invoke({"user_query": chart_state["question"],
+                      "collection_schema": movies_collection_schema})
+
+    def rebuilt_code_generation():
+        _, chain = plot_generator.create_visualization_chains(llm_manager.llm)
+        chain.invoke(plot_generator._code_generation_inputs(dict(chart_state)))
+
+    cases = [
+        ("router_node", rebuilt_router,
+         lambda: workflow_manager._router_agent(qna_state)),
+        ("text2NoSql_node", rebuilt_agent,
+         lambda: workflow_manager._text2NoSql_node(qna_state)),
+        ("visualization_node", rebuilt_rephrase,
+         lambda: plot_generator.rephrase_user_query_for_visualization(chart_state)),
+        ("chart code generation", rebuilt_code_generation,
+         lambda: plot_generator.visualization_chains()[1].invoke(
+             plot_generator._code_generation_inputs(dict(chart_state)))),
+    ]
+
+    def reset():
+        session_store.delete(current_session_id())
+
+    rows = []
+    # The chains are verbose; keep their console output out of the report.
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name, rebuilt, prebuilt in cases:
+            rows.append((name, _measure(rebuilt, args.iterations, reset),
+                         _measure(prebuilt, args.iterations, reset)))
+
+    print(f"Mean framework overhead per call over {args.iterations} iterations")
+    print(f"{'node':<24}{'rebuilt ms':>12}{'prebuilt ms':>13}{'saved':>8}")
+    for name, rebuilt_ms, prebuilt_ms in rows:
+        saved = 1 - prebuilt_ms / rebuilt_ms if rebuilt_ms else 0
+        print(f"{name:<24}{rebuilt_ms:>12.3f}{prebuilt_ms:>13.3f}{saved:>8.0%}")
+
+    if args.max_overhead_ms is not None:
+        regressions = [name for name, _, prebuilt_ms in rows
+                       if prebuilt_ms > args.max_overhead_ms]
+        if regressions:
+            print(f"Overhead above {args.max_overhead_ms}ms: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--max-overhead-ms", type=float, default=None)
+    main(parser.parse_args())
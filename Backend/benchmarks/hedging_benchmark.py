@@ -0,0 +1,139 @@
+"""
+Tail latency of LLM calls with one backend, with fallback and with hedging.
+
+Two stub chat models stand in for the providers. Each call draws its latency
+from a lognormal distribution around `--median` seconds (the secondary's around
+`--secondary-median`), and `--slow-rate` of the calls are `--slow-factor` times
+slower, like a provider's queueing spikes. `--failure-rate` of the calls fail,
+and the primary is down for the middle `--outage` fraction of the run. The same
+seeded draws feed three modes:
+
+- single: every call goes to the primary, like a bare ChatOpenAI.
+- fallback: a failed call moves on to the secondary; the circuit breaker skips
+  the primary while it is down.
+- hedged: as fallback, and a call the primary has not answered after its
+  `--percentile` latency is also sent to the secondary.
+
+Closed-loop clients send `--calls` calls in total through `ainvoke`, with a
+`--deadline` per call. Reported are the p50/p95/p99 latency, the failed calls
+and how many backend calls each answer cost.
+
+Usage (from the Backend directory):
+    python -m benchmarks.hedging_benchmark --clients 8 --calls 2000
+"""
+import argparse
+import asyncio
+import logging
+import math
+import random
+import time
+import warnings
+
+from agents.llm_backends import BackendHealth, HedgedChatModel, ModelBackend
+from benchmarks.stubs import StubChatModel
+
+
+class BackendOutage(RuntimeError):
+    pass
+
+
+class LatencyDistribution:
+    """Draws the latency of each call, and fails some of them."""
+
+    def __init__(self, median, args, seed, down=None):
+        self.median = median
+        self.args = args
+        self.random = random.Random(seed)
+        # Tells whether the backend is down at the moment.
+        self.down = down or (lambda: False)
+        self.calls = 0
+
+    def __call__(self) -> float:
+        self.calls += 1
+        if self.down():
+            raise BackendOutage("The backend is down")
+        if self.random.random() < self.args.failure_rate:
+            raise BackendOutage("The backend returned an error")
+        seconds = self.median * math.exp(self.random.gauss(0, self.args.sigma))
+        if self.random.random() < self.args.slow_rate:
+            seconds *= self.args.slow_factor
+        return seconds
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(math.ceil(len(ordered) * fraction) - 1, 0)]
+
+
+async def _run(mode, args):
+    completed = 0
+    outage_start = (1 - args.outage) / 2 * args.calls
+    primary = LatencyDistribution(args.median, args, args.seed,
+                                  lambda: outage_start <= completed < outage_start + args.outage * args.calls)
+    secondary = LatencyDistribution(args.secondary_median, args, args.seed + 1)
+    backends = [ModelBackend("primary", StubChatModel(latency=primary, responder=lambda _: "ok"),
+                             BackendHealth(args.breaker_failures, args.breaker_reset)),
+                ModelBackend("secondary", StubChatModel(latency=secondary, responder=lambda _: "ok"),
+                             BackendHealth(args.breaker_failures, args.breaker_reset))]
+    if mode == "single":
+        # No circuit breaker either: a bare model keeps calling a backend that is down.
+        backends[0].health.failure_threshold = math.inf
+        model = HedgedChatModel(backends=backends[:1], deadline_seconds=args.deadline,
+                                hedge_delay_seconds=args.deadline)
+    else:
+        model = HedgedChatModel(backends=backends, deadline_seconds=args.deadline,
+                                hedge_percentile=args.percentile,
+                                # Fallback never hedges: the hedge would come after the deadline.
+                                hedge_delay_seconds=args.deadline if mode == "fallback" else args.median * 3,
+                                min_samples=20, max_hedges=0 if mode == "fallback" else 1)
+    latencies, failures = [], 0
+
+    async def client():
+        nonlocal completed, failures
+        while completed < args.calls:
+            completed += 1
+            start = time.perf_counter()
+            try:
+                await model.ainvoke("question")
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                failures += 1
+
+    await asyncio.gather(*(client() for _ in range(args.clients)))
+    return {"mode": mode, "p50": _percentile(latencies, 0.5), "p95": _percentile(latencies, 0.95),
+            "p99": _percentile(latencies, 0.99), "failures": failures,
+            "backend_calls": (primary.calls + secondary.calls) / args.calls,
+            "hedges_won": backends[1].health.stats()["hedges_won"]}
+
+
+async def main(args):
+    logging.disable(logging.WARNING)
+    warnings.simplefilter("ignore")
+    print(f"{args.calls} calls from {args.clients} clients, median {args.median}s/{args.secondary_median}s, "
+          f"{args.slow_rate:.0%} x{args.slow_factor} slow, {args.failure_rate:.0%} failing, "
+          f"primary down for {args.outage:.0%} of the run, deadline {args.deadline}s")
+    print(f"{'mode':<10}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}{'failed':>8}{'calls/answer':>14}{'hedges won':>12}")
+    for mode in ("single", "fallback", "hedged"):
+        result = await _run(mode, args)
+        print(f"{mode:<10}{result['p50']:>9.3f}{result['p95']:>9.3f}{result['p99']:>9.3f}"
+              f"{result['failures']:>8}{result['backend_calls']:>14.2f}{result['hedges_won']:>12}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--median", type=float, default=0.02)
+    parser.add_argument("--secondary-median", type=float, default=0.03)
+    parser.add_argument("--sigma", type=float, default=0.3, help="Spread of the lognormal latencies")
+    parser.add_argument("--slow-rate", type=float, default=0.05)
+    parser.add_argument("--slow-factor", type=float, default=10)
+    parser.add_argument("--failure-rate", type=float, default=0.01)
+    parser.add_argument("--outage", type=float, default=0.1)
+    parser.add_argument("--percentile", type=float, default=0.9)
+    parser.add_argument("--deadline", type=float, default=2.0)
+    parser.add_argument("--breaker-failures", type=int, default=5)
+    parser.add_argument("--breaker-reset", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=7)
+    asyncio.run(main(parser.parse_args()))
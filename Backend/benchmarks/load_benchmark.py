@@ -0,0 +1,103 @@
+"""
+Concurrency benchmark for the /query execution path.
+
+Compares the old handler shape (an `async def` endpoint calling the blocking
+`WorkflowManager.invoke`) with the async path (`await WorkflowManager.ainvoke`)
+on a single event loop, using stubbed LLM and MongoDB backends with injected
+latency.
+
+Usage (from the Backend directory):
+    python -m benchmarks.load_benchmark --llm-latency 0.2 --mongo-latency 0.05
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import logging
+import math
+import statistics
+import time
+import warnings
+
+from benchmarks.stubs import install_stubs
+
+QUESTIONS = [
+    "Get me the movies released in 2000 with rating greater than 8",
+    "Generate a bar chart of movie counts for each genre",
+    "Show me all the movies directed by Christopher Nolan",
+    "Plot the number of movies per genre",
+]
+
+
+async def _run_level(handler, concurrency, requests_per_client):
+    latencies = []
+    start = time.perf_counter()
+
+    async def client(index):
+        # Closed-loop client: every request is issued when the previous one
+        # completes, and the first one when the level starts. Measuring from the
+        # issue time counts the time a request waits behind a blocked loop.
+        issued = start
+        for request in range(requests_per_client):
+            question = QUESTIONS[(index + request) % len(QUESTIONS)]
+            await handler(question)
+            completed = time.perf_counter()
+            latencies.append(completed - issued)
+            issued = completed
+
+    await asyncio.gather(*(client(index) for index in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    p95 = latencies[math.ceil(len(latencies) * 0.95) - 1]
+    return len(latencies) / elapsed, statistics.median(latencies), p95
+
+
+async def main(args):
+    logging.disable(logging.INFO)
+    warnings.simplefilter("ignore")
+    llm_manager = install_stubs(args.llm_latency, args.mongo_latency)
+    from workflowManager import WorkflowManager
+    workflow_manager = WorkflowManager(llm_manager=llm_manager)
+
+    async def blocking_handler(question):
+        return workflow_manager.invoke(question)
+
+    async def async_handler(question):
+        return await workflow_manager.ainvoke(question)
+
+    handlers = {"blocking": blocking_handler, "async": async_handler}
+    results = {name: [] for name in handlers}
+    for concurrency in args.concurrency:
+        for name, handler in handlers.items():
+            # The chains are verbose; keep their console output out of the report.
+            with contextlib.redirect_stdout(io.StringIO()):
+                throughput, p50, p95 = await _run_level(
+                    handler, concurrency, args.requests_per_client)
+            results[name].append((concurrency, throughput, p50, p95))
+
+    print(f"LLM latency {args.llm_latency}s, Mongo latency {args.mongo_latency}s, "
+          f"{args.requests_per_client} requests per client")
+    print(f"{'mode':<10}{'clients':>8}{'req/s':>10}{'p50 s':>10}{'p95 s':>10}")
+    for name, rows in results.items():
+        for concurrency, throughput, p50, p95 in rows:
+            print(f"{name:<10}{concurrency:>8}{throughput:>10.2f}{p50:>10.3f}{p95:>10.3f}")
+
+    # A worker "handles" a concurrency level while p95 stays within the SLO,
+    # expressed as a multiple of the single-client p50 of the same mode.
+    for name, rows in results.items():
+        baseline = rows[0][2]
+        handled = [concurrency for concurrency, _, _, p95 in rows
+                   if p95 <= baseline * args.slo_factor]
+        print(f"{name}: sustains up to {max(handled) if handled else 0} concurrent "
+              f"clients with p95 <= {args.slo_factor}x single-client latency")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--mongo-latency", type=float, default=0.05)
+    parser.add_argument("--requests-per-client", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--slo-factor", type=float, default=2.0)
+    asyncio.run(main(parser.parse_args()))
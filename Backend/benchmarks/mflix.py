@@ -0,0 +1,467 @@
+"""
+An in-memory stand-in for the `sample_mflix.movies` collection.
+
+`mflix_documents` generates movie documents with the fields, value ranges and
+gaps of the real collection. `MemoryCollection` runs aggregation pipelines on
+them in Python, covering the stages and operators the prompts produce, and
+answers the query guard's explain command with a collection scan plan. Stages
+or operators it does not know raise `NotImplementedError`, so an unsupported
+recorded pipeline fails loudly instead of returning wrong results.
+"""
+import asyncio
+import copy
+import random
+import re
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from bson import ObjectId
+
+GENRES = ["Drama", "Comedy", "Action", "Romance", "Thriller", "Crime", "Documentary",
+          "Adventure", "Horror", "Family", "Animation", "Sci-Fi", "Mystery", "Fantasy",
+          "Western", "War", "Musical", "Biography"]
+COUNTRIES = ["USA", "UK", "France", "India", "Germany", "Japan", "Italy", "Canada"]
+LANGUAGES = ["English", "French", "Hindi", "German", "Japanese", "Italian", "Spanish"]
+RATED = ["G", "PG", "PG-13", "R", "TV-G", "NOT RATED"]
+DIRECTORS = ["Christopher Nolan", "Steven Spielberg", "Martin Scorsese", "Greta Gerwig",
+             "Akira Kurosawa", "Agnes Varda"] + [f"Director {index}" for index in range(400)]
+ACTORS = ["Tom Hanks", "Meryl Streep", "A.C. Abadie", "Leonardo DiCaprio", "Cate Blanchett",
+          "Toshiro Mifune"] + [f"Actor {index}" for index in range(2000)]
+
+
+def mflix_documents(count, seed=7):
+    """Movie documents with the fields and gaps of `sample_mflix.movies`."""
+    rng = random.Random(seed)
+    for index in range(count):
+        year = rng.randint(1920, 2016)
+        released = datetime(year, 1, 1) + timedelta(days=rng.randint(0, 364))
+        document = {
+            "_id": ObjectId(),
+            "title": f"Movie {index}",
+            "year": year,
+            "runtime": rng.randint(60, 200),
+            "genres": rng.sample(GENRES, rng.randint(1, 3)),
+            "cast": rng.sample(ACTORS, 4),
+            "countries": rng.sample(COUNTRIES, rng.randint(1, 2)),
+            "languages": rng.sample(LANGUAGES, rng.randint(1, 2)),
+            "directors": [rng.choice(DIRECTORS)],
+            "rated": rng.choice(RATED),
+            "released": released,
+            "lastupdated": released + timedelta(days=rng.randint(1000, 30000)),
+            "plot": f"A story about {rng.choice(GENRES).lower()} in {rng.choice(COUNTRIES)}.",
+            "poster": f"https://example.org/posters/{index}.jpg",
+            "imdb": {"rating": round(rng.uniform(1, 10), 1), "votes": rng.randint(5, 10 ** 6),
+                     "id": rng.randint(1, 10 ** 7)},
+            "awards": {"wins": rng.randint(0, 20), "nominations": rng.randint(0, 40),
+                       "text": "Nominated for 1 Oscar."},
+            "type": "movie",
+            "num_mflix_comments": rng.randint(0, 50),
+        }
+        if rng.random() < 0.7:
+            document["tomatoes"] = {"viewer": {"rating": round(rng.uniform(1, 5), 1),
+                                               "numReviews": rng.randint(0, 10 ** 5)},
+                                    "critic": {"rating": round(rng.uniform(1, 10), 1)}}
+        if rng.random() < 0.1:
+            del document["imdb"]["rating"]
+        yield document
+
+
+_MISSING = object()
+
+
+def _get(document, path):
+    # Dotted paths descend into arrays of documents as MongoDB does.
+    value = document
+    for part in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        elif isinstance(value, list):
+            items = [item.get(part, _MISSING) for item in value if isinstance(item, dict)]
+            value = [item for item in items if item is not _MISSING]
+        else:
+            return _MISSING
+        if value is _MISSING:
+            return _MISSING
+    return value
+
+
+def _set(document, path, value):
+    *parents, leaf = path.split(".")
+    for part in parents:
+        document = document.setdefault(part, {})
+    document[leaf] = value
+
+
+def _sort_key(value):
+    # MongoDB's order of types: missing and null, numbers, strings, objects, arrays, dates.
+    if value is _MISSING or value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (5, value)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, datetime):
+        return (6, value)
+    return (3, str(value))
+
+
+def _compare(value, operand, operator):
+    if value is _MISSING or value is None or operand is None:
+        return False
+    try:
+        return operator(value, operand)
+    except TypeError:
+        return False
+
+
+_COMPARISONS = {
+    "$gt": lambda a, b: a > b, "$gte": lambda a, b: a >= b,
+    "$lt": lambda a, b: a < b, "$lte": lambda a, b: a <= b,
+}
+
+
+def _matches_condition(value, condition):
+    if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+        return all(_matches_operator(value, operator, operand)
+                   for operator, operand in condition.items() if operator != "$options")
+    if isinstance(condition, re.Pattern):
+        return _matches_operator(value, "$regex", condition)
+    if isinstance(value, list) and not isinstance(condition, list):
+        return condition in value
+    return value == condition
+
+
+def _matches_operator(value, operator, operand):
+    candidates = value if isinstance(value, list) else [value]
+    if operator in _COMPARISONS:
+        return any(_compare(item, operand, _COMPARISONS[operator]) for item in candidates)
+    if operator == "$eq":
+        return _matches_condition(value, operand)
+    if operator == "$ne":
+        return not _matches_condition(value, operand)
+    if operator == "$in":
+        return any(item in operand for item in candidates) or (value is _MISSING and None in operand)
+    if operator == "$nin":
+        return not any(item in operand for item in candidates)
+    if operator == "$all":
+        return isinstance(value, list) and all(item in value for item in operand)
+    if operator == "$exists":
+        return (value is not _MISSING) == bool(operand)
+    if operator == "$size":
+        return isinstance(value, list) and len(value) == operand
+    if operator == "$regex":
+        pattern = operand if isinstance(operand, re.Pattern) else re.compile(operand)
+        return any(isinstance(item, str) and pattern.search(item) for item in candidates)
+    if operator == "$elemMatch":
+        return isinstance(value, list) and any(_matches_condition(item, operand) for item in value)
+    if operator == "$not":
+        return not _matches_condition(value, operand)
+    raise NotImplementedError(f"Query operator {operator}")
+
+
+def _matches(document, query):
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(_matches(document, part) for part in condition):
+                return False
+        elif key == "$or":
+            if not any(_matches(document, part) for part in condition):
+                return False
+        elif key == "$nor":
+            if any(_matches(document, part) for part in condition):
+                return False
+        elif key == "$expr":
+            if not _evaluate(document, condition):
+                return False
+        elif key.startswith("$"):
+            raise NotImplementedError(f"Query operator {key}")
+        else:
+            condition = condition if not (isinstance(condition, dict) and "$regex" in condition) else {
+                "$regex": re.compile(condition["$regex"], re.I if "i" in condition.get("$options", "") else 0)}
+            if not _matches_condition(_get(document, key), condition):
+                return False
+    return True
+
+
+def _number(value):
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+
+_EXPRESSIONS = {
+    "$add": lambda *values: sum(values) if all(_number(v) is not None for v in values) else None,
+    "$subtract": lambda a, b: a - b if None not in (a, b) else None,
+    "$multiply": lambda a, b: a * b if None not in (a, b) else None,
+    "$divide": lambda a, b: a / b if None not in (a, b) and b else None,
+    "$floor": lambda a: int(a // 1) if _number(a) is not None else None,
+    "$year": lambda a: a.year if isinstance(a, datetime) else None,
+    "$month": lambda a: a.month if isinstance(a, datetime) else None,
+    "$size": lambda a: len(a) if isinstance(a, list) else None,
+    "$toString": lambda a: None if a is None else str(a),
+    "$concat": lambda *values: "".join(values) if all(isinstance(v, str) for v in values) else None,
+    "$gt": lambda a, b: _sort_key(a) > _sort_key(b),
+    "$gte": lambda a, b: _sort_key(a) >= _sort_key(b),
+    "$lt": lambda a, b: _sort_key(a) < _sort_key(b),
+    "$lte": lambda a, b: _sort_key(a) <= _sort_key(b),
+    "$eq": lambda a, b: a == b,
+    "$ne": lambda a, b: a != b,
+    "$ifNull": lambda a, b: b if a is None else a,
+    "$arrayElemAt": lambda a, i: a[i] if isinstance(a, list) and -len(a) <= i < len(a) else None,
+}
+
+
+def _evaluate(document, expression):
+    if isinstance(expression, str) and expression.startswith("$$"):
+        raise NotImplementedError(f"Variable {expression}")
+    if isinstance(expression, str) and expression.startswith("$"):
+        value = _get(document, expression[1:])
+        return None if value is _MISSING else value
+    if isinstance(expression, list):
+        return [_evaluate(document, item) for item in expression]
+    if isinstance(expression, dict):
+        if len(expression) == 1 and next(iter(expression)).startswith("$"):
+            operator, operands = next(iter(expression.items()))
+            if operator == "$round":
+                operands = operands if isinstance(operands, list) else [operands, 0]
+                value, places = (_evaluate(document, item) for item in operands)
+                return round(value, places) if _number(value) is not None else None
+            if operator == "$cond":
+                if isinstance(operands, dict):
+                    operands = [operands["if"], operands["then"], operands["else"]]
+                condition, then, otherwise = operands
+                return _evaluate(document, then if _evaluate(document, condition) else otherwise)
+            if operator not in _EXPRESSIONS:
+                raise NotImplementedError(f"Expression operator {operator}")
+            operands = operands if isinstance(operands, list) else [operands]
+            return _EXPRESSIONS[operator](*(_evaluate(document, item) for item in operands))
+        return {key: _evaluate(document, value) for key, value in expression.items()}
+    return expression
+
+
+class _Accumulator:
+    def __init__(self, operator, expression):
+        if operator not in ("$sum", "$avg", "$min", "$max", "$first", "$last", "$push", "$addToSet"):
+            raise NotImplementedError(f"Accumulator {operator}")
+        self.operator, self.expression = operator, expression
+        self.values = []
+
+    def add(self, document):
+        self.values.append(_evaluate(document, self.expression))
+
+    def result(self):
+        numbers = [value for value in self.values if _number(value) is not None]
+        present = [value for value in self.values if value is not None]
+        if self.operator == "$sum":
+            return sum(numbers)
+        if self.operator == "$avg":
+            return sum(numbers) / len(numbers) if numbers else None
+        if self.operator == "$min":
+            return min(present, key=_sort_key) if present else None
+        if self.operator == "$max":
+            return max(present, key=_sort_key) if present else None
+        if self.operator == "$first":
+            return self.values[0] if self.values else None
+        if self.operator == "$last":
+            return self.values[-1] if self.values else None
+        if self.operator == "$push":
+            return present
+        return list(dict.fromkeys(value if not isinstance(value, list) else tuple(value)
+                                  for value in present))
+
+
+def _group(documents, body):
+    groups = {}
+    for document in documents:
+        key = _evaluate(document, body["_id"])
+        hashable = repr(key)
+        group = groups.get(hashable)
+        if group is None:
+            group = groups[hashable] = (key, {name: _Accumulator(*next(iter(spec.items())))
+                                              for name, spec in body.items() if name != "_id"})
+        for accumulator in group[1].values():
+            accumulator.add(document)
+    return [{"_id": key, **{name: accumulator.result() for name, accumulator in accumulators.items()}}
+            for key, accumulators in groups.values()]
+
+
+def _project(documents, body):
+    included = {key: value for key, value in body.items() if value not in (0, False)}
+    if not included or set(included) == {"_id"} and len(body) > 1:
+        excluded = [key for key, value in body.items() if value in (0, False)]
+        results = []
+        for document in documents:
+            document = copy.deepcopy(document)
+            for path in excluded:
+                *parents, leaf = path.split(".")
+                target = document
+                for part in parents:
+                    target = target.get(part) if isinstance(target, dict) else None
+                if isinstance(target, dict):
+                    target.pop(leaf, None)
+            results.append(document)
+        return results
+    results = []
+    for document in documents:
+        projected = {}
+        if body.get("_id", 1) not in (0, False) and "_id" in document:
+            projected["_id"] = document["_id"]
+        for path, value in included.items():
+            if path == "_id" and value in (1, True):
+                continue
+            computed = _get(document, path) if value in (1, True) else _evaluate(document, value)
+            if computed is not _MISSING:
+                _set(projected, path, computed)
+        results.append(projected)
+    return results
+
+
+def _unwind(documents, body):
+    if isinstance(body, str):
+        body = {"path": body}
+    path = body["path"][1:]
+    keep_empty = body.get("preserveNullAndEmptyArrays", False)
+    results = []
+    for document in documents:
+        value = _get(document, path)
+        if isinstance(value, list) and value:
+            for item in value:
+                unwound = copy.copy(document)
+                _set(unwound, path, item)
+                results.append(unwound)
+        elif isinstance(value, list) or value is _MISSING or value is None:
+            if keep_empty:
+                results.append(document)
+        else:
+            results.append(document)
+    return results
+
+
+def run_pipeline(documents, pipeline):
+    """Runs an aggregation pipeline on a list of documents."""
+    for stage in pipeline:
+        (name, body), = stage.items()
+        if name == "$match":
+            documents = [document for document in documents if _matches(document, body)]
+        elif name == "$project":
+            documents = _project(documents, body)
+        elif name in ("$addFields", "$set"):
+            extended = []
+            for document in documents:
+                document = copy.copy(document)
+                for path, expression in body.items():
+                    _set(document, path, _evaluate(document, expression))
+                extended.append(document)
+            documents = extended
+        elif name == "$unset":
+            documents = _project(documents, {path: 0 for path in ([body] if isinstance(body, str) else body)})
+        elif name == "$unwind":
+            documents = _unwind(documents, body)
+        elif name == "$group":
+            documents = _group(documents, body)
+        elif name == "$sort":
+            for path, direction in reversed(list(body.items())):
+                documents = sorted(documents, key=lambda document: _sort_key(_get(document, path)),
+                                   reverse=direction == -1)
+        elif name == "$skip":
+            documents = documents[body:]
+        elif name == "$limit":
+            documents = documents[:body]
+        elif name == "$count":
+            documents = [{body: len(documents)}] if documents else []
+        elif name == "$sortByCount":
+            documents = run_pipeline(documents, [{"$group": {"_id": body, "count": {"$sum": 1}}},
+                                                 {"$sort": {"count": -1}}])
+        elif name == "$sample":
+            documents = documents[:body["size"]]
+        else:
+            raise NotImplementedError(f"Stage {name}")
+    return documents
+
+
+class _Cursor:
+    def __init__(self, documents):
+        self._documents = iter(documents)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._documents)
+
+    def close(self):
+        pass
+
+
+class _AsyncCursor(_Cursor):
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._documents)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def close(self):
+        pass
+
+
+class _Database:
+    def __init__(self, collection):
+        self._collection = collection
+
+    def _explain(self, spec):
+        self._collection.round_trips += 1
+        return {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}}
+
+    def command(self, name, spec, **kwargs):
+        time.sleep(self._collection.latency)
+        return self._explain(spec)
+
+
+class _AsyncDatabase(_Database):
+    async def command(self, name, spec, **kwargs):
+        await asyncio.sleep(self._collection.latency)
+        return self._explain(spec)
+
+
+class MemoryCollection:
+    """
+    Sync collection stand-in running pipelines on documents held in memory.
+    Documents are deep-copied on the way out, like a decoded cursor.
+    """
+    name = "movies"
+
+    def __init__(self, documents: Optional[list] = None, latency: float = 0.0):
+        self.documents = documents if documents is not None else list(mflix_documents(2000))
+        self.latency = latency
+        self.round_trips = 0
+        self.database = _Database(self)
+
+    def _run(self, pipeline):
+        self.round_trips += 1
+        return copy.deepcopy(run_pipeline(self.documents, pipeline))
+
+    def aggregate(self, pipeline, **kwargs):
+        time.sleep(self.latency)
+        return _Cursor(self._run(pipeline))
+
+    def estimated_document_count(self):
+        return len(self.documents)
+
+
+class AsyncMemoryCollection(MemoryCollection):
+    """Async variant of `MemoryCollection`, mirroring `pymongo.AsyncCollection`."""
+
+    def __init__(self, documents: Optional[list] = None, latency: float = 0.0):
+        super().__init__(documents, latency)
+        self.database = _AsyncDatabase(self)
+
+    async def aggregate(self, pipeline, **kwargs):
+        await asyncio.sleep(self.latency)
+        return _AsyncCursor(self._run(pipeline))
+
+    async def estimated_document_count(self):
+        return len(self.documents)
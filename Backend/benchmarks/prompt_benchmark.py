@@ -0,0 +1,100 @@
+"""
+Prompt tokens of the pipeline generation, visualization plan and rephrasing
+prompts with the whole schema and every example, and with the prompt builder.
+
+Every QnA and Visualization question of the replay corpus
+(`benchmarks.replay_corpus`) is rendered into each prompt both ways; a question
+that is itself one of the prompt's examples is left out of the example bank
+while it is rendered, so it cannot pick itself. Reported per prompt:
+
+- tokens: mean prompt tokens per call, without chat history.
+- prefix: mean tokens before the first part that depends on the question, which
+  provider-side prompt caching can reuse across questions.
+- coverage: the share of questions whose recorded pipeline only uses schema
+  fields the prompt describes; the builder must not drop a field the answer needs.
+
+Usage (from the Backend directory):
+    python -m benchmarks.prompt_benchmark
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import statistics
+
+from langchain_core.messages import get_buffer_string
+
+from agents.prompt_builder import PromptBuilder, parse_examples, schema_blocks
+from agents.tokens import count_tokens
+from benchmarks.replay_corpus import default_corpus, load_corpus
+from prompts.mongoDB_movies_Prompt import (
+    examples, get_movies_collection_prompt, movies_collection_schema, schema_field_keywords)
+from prompts.visualizationPrompt import create_query_generation_prompt, create_visualization_plan_prompt
+
+_field_path = re.compile(r'"\$?([A-Za-z_]\w*)(?:\.[\w.]+)?"')
+
+
+def _render(prompt_name, question, context):
+    if prompt_name == "pipeline":
+        return get_buffer_string(get_movies_collection_prompt().format_messages(
+            user_question=question, chat_history=[], **context))
+    if prompt_name == "plan":
+        return get_buffer_string(create_visualization_plan_prompt().format_messages(
+            user_query=question, chat_history=[], **context))
+    return create_query_generation_prompt().format(
+        user_query=question, collection_schema=context["movies_collection_schema"])
+
+
+def _prefix_tokens(first, second):
+    common = 0
+    for left, right in zip(first, second):
+        if left != right:
+            break
+        common += 1
+    return count_tokens(first[:common])
+
+
+def _covered(entry, text, fields):
+    pipeline = entry.get("pipeline") or entry["plan"]["pipeline"]
+    used = set(_field_path.findall(json.dumps(pipeline))) & fields
+    return all(f"**{name}**" in text for name in used)
+
+
+def main(args):
+    logging.disable(logging.INFO)
+    corpus = default_corpus() + (load_corpus(args.corpus) if args.corpus else [])
+    corpus = [entry for entry in corpus if entry["route"] in ("QnA", "Visualization")]
+    bank = parse_examples(examples)
+    fields = set(schema_blocks(movies_collection_schema))
+    full = {"movies_collection_schema": movies_collection_schema, "examples": examples}
+    core_fields = os.getenv("PROMPT_CORE_FIELDS", "_id,title,year,genres,imdb").split(",")
+
+    print(f"{len(corpus)} questions, {len(bank)} examples in the bank, k={args.k}")
+    print(f"{'prompt':<10}{'mode':<9}{'tokens':>8}{'prefix':>8}{'coverage':>10}")
+    for prompt_name in ("pipeline", "plan", "rephrase"):
+        for mode in ("full", "builder"):
+            tokens, texts, covered = [], [], 0
+            for entry in corpus:
+                if mode == "full":
+                    context = full
+                else:
+                    builder = PromptBuilder(movies_collection_schema,
+                                            [example for example in bank if example.question != entry["question"]],
+                                            k=args.k, core_fields=core_fields, keywords=schema_field_keywords)
+                    context = builder.context(entry["question"])
+                text = _render(prompt_name, entry["question"], context)
+                tokens.append(count_tokens(text))
+                texts.append(text)
+                covered += _covered(entry, text, fields)
+            prefix = statistics.mean(_prefix_tokens(first, second) for first, second in zip(texts, texts[1:]))
+            print(f"{prompt_name:<10}{mode:<9}{statistics.mean(tokens):>8.0f}{prefix:>8.0f}"
+                  f"{covered / len(corpus):>10.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--k", type=int, default=3, help="Examples per prompt")
+    parser.add_argument("--corpus", help="A JSON lines file of further corpus entries")
+    main(parser.parse_args())
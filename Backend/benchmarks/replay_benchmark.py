@@ -0,0 +1,156 @@
+"""
+Replays a corpus of QnA, Visualization and NoContext questions through the
+graph, offline.
+
+The chat models answer from recorded responses (`benchmarks.replay_corpus`)
+after `--llm-latency` seconds, and MongoDB is an in-memory mflix-shaped
+collection (`benchmarks.mflix`) that runs the recorded pipelines for real, so
+the parsing, validation, aggregation, result budget and chart stages do their
+usual work. Every answer is checked, then:
+
+- memory: each question runs on its own under tracemalloc, reporting the peak
+  allocation per request by route.
+- load: closed-loop clients replay the corpus at each `--concurrency` level,
+  reporting throughput and p50/p95/p99 latency, overall and by route.
+
+The pipeline, plan and result caches and request coalescing are disabled unless
+`--warm` is given, so every request pays for the whole graph. `--json` writes
+the numbers for comparing runs.
+
+Usage (from the Backend directory):
+    python -m benchmarks.replay_benchmark --llm-latency 0.05 --concurrency 1 8 32
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import math
+import os
+import statistics
+import time
+import tracemalloc
+import warnings
+from collections import defaultdict
+
+from benchmarks.mflix import AsyncMemoryCollection, MemoryCollection, mflix_documents
+from benchmarks.stubs import StubLLMManager
+
+
+def install_replay(responder, llm_latency=0.0, mongo_latency=0.0, documents=None) -> StubLLMManager:
+    """
+    Points the shared LLM manager at stub models answering with `responder` and
+    the MongoDB collections at in-memory ones, like `benchmarks.stubs.install_stubs`.
+    """
+    from agents import clients
+    import agents.mongodb_retriever as mongodb_retriever
+
+    llm_manager = StubLLMManager(latency=llm_latency, responder=responder)
+    clients.llm_manager.override(llm_manager)
+    mongodb_retriever.collection.override(MemoryCollection(documents, mongo_latency))
+    mongodb_retriever.async_collection.override(AsyncMemoryCollection(documents, mongo_latency))
+    return llm_manager
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(math.ceil(len(ordered) * fraction) - 1, 0)]
+
+
+def _summary(latencies):
+    return {"requests": len(latencies), "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95), "p99": percentile(latencies, 0.99)}
+
+
+def _check(entry, response):
+    if entry["route"] == "Visualization" and not response.chart_id:
+        raise RuntimeError(f"No chart was generated for: {entry['question']}")
+    if entry["route"] != "Visualization" and not response.answer:
+        raise RuntimeError(f"No answer was generated for: {entry['question']}")
+
+
+async def _memory_pass(workflow_manager, corpus):
+    peaks = defaultdict(list)
+    for entry in corpus:
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        response = await workflow_manager.ainvoke(entry["question"])
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        tracemalloc.stop()
+        _check(entry, response)
+        peaks[entry["route"]].append(peak / 1024)
+    return {route: {"mean_kib": statistics.mean(values), "max_kib": max(values)}
+            for route, values in peaks.items()}
+
+
+async def _load_level(workflow_manager, corpus, clients, requests_per_client):
+    latencies = defaultdict(list)
+    start = time.perf_counter()
+
+    async def client(index):
+        for request in range(requests_per_client):
+            entry = corpus[(index * requests_per_client + request) % len(corpus)]
+            issued = time.perf_counter()
+            _check(entry, await workflow_manager.ainvoke(entry["question"]))
+            latencies[entry["route"]].append(time.perf_counter() - issued)
+
+    await asyncio.gather(*(client(index) for index in range(clients)))
+    elapsed = time.perf_counter() - start
+    every = [latency for values in latencies.values() for latency in values]
+    return {"clients": clients, "throughput": len(every) / elapsed, **_summary(every),
+            "routes": {route: _summary(values) for route, values in latencies.items()}}
+
+
+async def main(args):
+    logging.disable(logging.INFO)
+    warnings.simplefilter("ignore")
+    if not args.warm:
+        os.environ["PIPELINE_CACHE_ENABLED"] = "false"
+        os.environ["RESULT_CACHE_BACKEND"] = "none"
+        os.environ["SINGLE_FLIGHT_ENABLED"] = "false"
+    from benchmarks.replay_corpus import ReplayResponder, default_corpus, load_corpus
+    corpus = default_corpus() + (load_corpus(args.corpus) if args.corpus else [])
+    documents = list(mflix_documents(args.documents))
+    llm_manager = install_replay(ReplayResponder(corpus), args.llm_latency, args.mongo_latency, documents)
+    from workflowManager import WorkflowManager
+    workflow_manager = WorkflowManager(llm_manager=llm_manager)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        memory = await _memory_pass(workflow_manager, corpus)
+        levels = [await _load_level(workflow_manager, corpus, clients,
+                                    max(args.requests_per_client, math.ceil(len(corpus) / clients)))
+                  for clients in args.concurrency]
+
+    routes = defaultdict(int)
+    for entry in corpus:
+        routes[entry["route"]] += 1
+    print(f"{len(corpus)} questions ({', '.join(f'{count} {route}' for route, count in routes.items())}), "
+          f"{args.documents} movies, LLM latency {args.llm_latency}s, Mongo latency {args.mongo_latency}s")
+    print(f"{'clients':>8}{'req/s':>9}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}")
+    for level in levels:
+        print(f"{level['clients']:>8}{level['throughput']:>9.1f}{level['p50']:>9.3f}"
+              f"{level['p95']:>9.3f}{level['p99']:>9.3f}")
+    print(f"\n{'route':<15}{'clients':>8}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}{'mean KiB':>10}{'max KiB':>9}")
+    for route in memory:
+        for level in levels:
+            latency = level["routes"][route]
+            print(f"{route:<15}{level['clients']:>8}{latency['p50']:>9.3f}{latency['p95']:>9.3f}"
+                  f"{latency['p99']:>9.3f}{memory[route]['mean_kib']:>10.0f}{memory[route]['max_kib']:>9.0f}")
+    if args.json:
+        with open(args.json, "w") as report:
+            json.dump({"arguments": vars(args), "memory": memory, "levels": levels}, report, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--mongo-latency", type=float, default=0.005)
+    parser.add_argument("--documents", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests-per-client", type=int, default=2)
+    parser.add_argument("--corpus", help="A JSON lines file of further corpus entries")
+    parser.add_argument("--warm", action="store_true", help="Keep the caches and coalescing on")
+    parser.add_argument("--json", help="Write the results to this file")
+    asyncio.run(main(parser.parse_args()))
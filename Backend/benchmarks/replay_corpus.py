@@ -0,0 +1,170 @@
+"""
+Questions and recorded model responses for replaying the graph offline.
+
+Each entry has the 'question', its 'route' and, depending on the route, the
+'pipeline' the pipeline generation prompt answers with or the visualization
+'plan'. The QnA entries include the examples of the pipeline generation prompt.
+`load_corpus` reads further entries from a JSON lines file with the same keys.
+`ReplayResponder` answers the graph's prompts from the entries, so the chat
+models are deterministic and the pipelines and charts are real.
+"""
+import json
+import re
+from typing import List, Optional
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+
+from agents.prompt_builder import parse_examples
+from benchmarks.stubs import STUB_PLOT_CODE, _message_text
+from prompts.mongoDB_movies_Prompt import examples
+
+
+def prompt_examples() -> list:
+    """The question and pipeline pairs of the pipeline generation prompt's examples."""
+    return [{"question": example.question, "route": "QnA", "pipeline": json.loads(example.output)}
+            for example in parse_examples(examples)]
+
+
+QNA = [
+    {"question": "Show me all the movies directed by Christopher Nolan",
+     "pipeline": [{"$match": {"directors": "Christopher Nolan"}},
+                  {"$project": {"_id": 0, "title": 1, "year": 1, "imdb.rating": 1}}]},
+    {"question": "Get me the movies released in 2000 with rating greater than 8",
+     "pipeline": [{"$match": {"year": 2000, "imdb.rating": {"$gt": 8}}},
+                  {"$project": {"_id": 0, "title": 1, "imdb.rating": 1}}]},
+    {"question": "What are the top 10 highest rated horror movies?",
+     "pipeline": [{"$match": {"genres": "Horror", "imdb.rating": {"$exists": True}}},
+                  {"$sort": {"imdb.rating": -1}}, {"$limit": 10},
+                  {"$project": {"_id": 0, "title": 1, "year": 1, "imdb.rating": 1}}]},
+    {"question": "How many movies were released in 1999?",
+     "pipeline": [{"$match": {"year": 1999}}, {"$count": "count"}]},
+    {"question": "Which movies did Tom Hanks act in?",
+     "pipeline": [{"$match": {"cast": "Tom Hanks"}},
+                  {"$project": {"_id": 0, "title": 1, "year": 1}}, {"$sort": {"year": 1}}]},
+    {"question": "Which genre has the most movies?",
+     "pipeline": [{"$unwind": "$genres"}, {"$group": {"_id": "$genres", "count": {"$sum": 1}}},
+                  {"$sort": {"count": -1}}, {"$limit": 1}]},
+    {"question": "List French movies from the 1960s",
+     "pipeline": [{"$match": {"countries": "France", "year": {"$gte": 1960, "$lt": 1970}}},
+                  {"$project": {"_id": 0, "title": 1, "year": 1}}]},
+    {"question": "What is the average runtime of movies for each age rating?",
+     "pipeline": [{"$group": {"_id": "$rated", "averageRuntime": {"$avg": "$runtime"}}},
+                  {"$sort": {"averageRuntime": -1}}]},
+]
+
+VISUALIZATION = [
+    {"question": "Plot the number of movies per genre",
+     "plan": {"rephrased_question": "Count the movies of each genre for a bar chart.",
+              "pipeline": [{"$unwind": "$genres"},
+                           {"$group": {"_id": "$genres", "count": {"$sum": 1}}},
+                           {"$project": {"_id": 0, "genre": "$_id", "count": 1}},
+                           {"$sort": {"count": -1}}],
+              "chart": {"type": "bar", "x": "genre", "y": "count", "title": "Movies per genre"}}},
+    {"question": "Show a line chart of the average IMDb rating per year",
+     "plan": {"rephrased_question": "Average the IMDb rating of the movies of each year.",
+              "pipeline": [{"$match": {"imdb.rating": {"$exists": True}}},
+                           {"$group": {"_id": "$year", "averageRating": {"$avg": "$imdb.rating"}}},
+                           {"$project": {"_id": 0, "year": "$_id", "averageRating": 1}},
+                           {"$sort": {"year": 1}}],
+              "chart": {"type": "line", "x": "year", "y": "averageRating",
+                        "title": "Average IMDb rating per year"}}},
+    {"question": "Create a pie chart of movies per country",
+     "plan": {"rephrased_question": "Count the movies of each country for a pie chart.",
+              "pipeline": [{"$unwind": "$countries"},
+                           {"$group": {"_id": "$countries", "count": {"$sum": 1}}},
+                           {"$project": {"_id": 0, "country": "$_id", "count": 1}}],
+              "chart": {"type": "pie", "x": "country", "y": "count", "title": "Movies per country"}}},
+    {"question": "Draw a histogram of movie runtimes",
+     "plan": {"rephrased_question": "Retrieve the runtime of every movie for a histogram.",
+              "pipeline": [{"$match": {"runtime": {"$exists": True}}},
+                           {"$project": {"_id": 0, "runtime": 1}}],
+              "chart": {"type": "histogram", "x": "runtime", "title": "Runtimes"}}},
+    {"question": "Scatter plot of IMDb rating versus runtime",
+     "plan": {"rephrased_question": "Retrieve the runtime and IMDb rating of rated movies.",
+              "pipeline": [{"$match": {"imdb.rating": {"$exists": True}}},
+                           {"$project": {"_id": 0, "runtime": 1, "rating": "$imdb.rating"}},
+                           {"$limit": 500}],
+              "chart": {"type": "scatter", "x": "runtime", "y": "rating",
+                        "title": "IMDb rating versus runtime"}}},
+    {"question": "Graph the number of awards won per decade",
+     "plan": {"rephrased_question": "Sum the awards won by the movies of each decade.",
+              "pipeline": [{"$group": {"_id": {"$multiply": [{"$floor": {"$divide": ["$year", 10]}}, 10]},
+                                       "wins": {"$sum": "$awards.wins"}}},
+                           {"$project": {"_id": 0, "decade": "$_id", "wins": 1}},
+                           {"$sort": {"decade": 1}}],
+              "chart": {"type": "line", "x": "decade", "y": "wins", "title": "Awards won per decade"}}},
+]
+
+NO_CONTEXT = ["Hello", "What is the weather like today?", "Tell me a joke",
+              "Write me a poem about the sea"]
+
+
+def default_corpus() -> list:
+    """The built-in corpus: the prompt's examples and the entries above."""
+    return (prompt_examples()
+            + [{**entry, "route": "QnA"} for entry in QNA]
+            + [{**entry, "route": "Visualization"} for entry in VISUALIZATION]
+            + [{"question": question, "route": "NoContext"} for question in NO_CONTEXT])
+
+
+def load_corpus(path: str) -> list:
+    """Reads corpus entries from a JSON lines file."""
+    with open(path) as corpus_file:
+        return [json.loads(line) for line in corpus_file if line.strip()]
+
+
+def _normalize(text: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+
+class ReplayResponder:
+    """
+    Answers the graph's prompts with the corpus entry of the question in the
+    last human message. The prompt is recognised from a distinctive phrase in
+    its system message, as in `benchmarks.stubs.scripted_responder`.
+    """
+
+    def __init__(self, corpus: list):
+        self.corpus = corpus
+        # Longest first, so a question containing another matches itself.
+        self._entries = sorted(((_normalize(entry["question"]), entry) for entry in corpus),
+                               key=lambda item: -len(item[0]))
+
+    def entry(self, text: str) -> Optional[dict]:
+        normalized = f" {_normalize(text)} "
+        for question, entry in self._entries:
+            if f" {question} " in normalized:
+                return entry
+        return None
+
+    def __call__(self, messages: List[BaseMessage]) -> AIMessage:
+        prompt_text = " ".join(_message_text(message) for message in messages)
+        human = [message for message in messages if isinstance(message, HumanMessage)]
+        question = _message_text(human[-1]) if human else ""
+        entry = self.entry(question) or {}
+
+        if "batch of incoming questions" in prompt_text:
+            lines = []
+            for line in question.splitlines():
+                number, _, text = line.partition(". ")
+                lines.append(f"{number}: {(self.entry(text) or {}).get('route', 'NoContext')}")
+            return AIMessage(content="\n".join(lines))
+        if "complete visualization plan" in prompt_text:
+            return AIMessage(content=json.dumps(entry.get("plan") or {}))
+        if "AI router agent" in prompt_text:
+            return AIMessage(content=entry.get("route", "NoContext"))
+        if "selects appropriate tools" in prompt_text:
+            results = [message for message in messages if isinstance(message, ToolMessage)]
+            if results:
+                return AIMessage(content=f"## Movies\n\n{_message_text(results[-1])[:500]}")
+            return AIMessage(content="", tool_calls=[{
+                "name": "GetMovies", "args": {"query": entry.get("question", question)},
+                "id": "call_replay"}])
+        if "mongodb aggregation pipeline" in prompt_text:
+            return AIMessage(content=json.dumps(entry.get("pipeline") or []))
+        if "expert Python programmer" in prompt_text:
+            return AIMessage(content=STUB_PLOT_CODE)
+        if "user's intent" in prompt_text:
+            plan = entry.get("plan") or {}
+            return AIMessage(content=plan.get("rephrased_question", question))
+        return AIMessage(content="NoContext")
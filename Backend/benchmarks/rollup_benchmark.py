@@ -0,0 +1,173 @@
+"""
+Latency and correctness of answering common analytics pipelines from the rollups
+instead of aggregating the collection.
+
+The rollups (`agents.rollups`) are built from an in-memory mflix-shaped
+collection (`benchmarks.mflix`). Every pipeline of the replay corpus and a few
+further common shapes are answered both ways, with the paging stages the result
+budget adds, and the answers compared. Then `--changes` documents are updated,
+deleted or inserted, the rollups follow each change incrementally through a
+ledger of contributions as `Rollups.apply_document` does, and the answers are
+compared again against the changed collection.
+
+Reported per pipeline: whether the rollups answer it, the time on the collection
+and on the rollups, and how many documents or groups each read.
+
+Usage (from the Backend directory):
+    python -m benchmarks.rollup_benchmark --documents 20000 --changes 500
+"""
+import argparse
+import copy
+import logging
+import math
+import random
+import statistics
+import time
+
+from bson import ObjectId
+
+from agents.rollups import (
+    DEFAULT_DIMENSIONS, DEFAULT_MEASURES, RollupSpec, RollupStore, contribution, deltas, parse_dimensions)
+from benchmarks.mflix import COUNTRIES, GENRES, mflix_documents, run_pipeline
+from benchmarks.replay_corpus import default_corpus
+
+EXTRA_PIPELINES = [
+    [{"$unwind": "$countries"}, {"$sortByCount": "$countries"}, {"$limit": 5}],
+    [{"$unwind": "$genres"}, {"$group": {"_id": "$genres", "wins": {"$sum": "$awards.wins"},
+                                         "rating": {"$avg": "$imdb.rating"}}},
+     {"$project": {"_id": 0, "genre": "$_id", "wins": 1, "rating": {"$round": ["$rating", 2]}}},
+     {"$sort": {"wins": -1}}],
+    [{"$match": {"imdb.rating": {"$exists": True}}}, {"$unwind": "$genres"},
+     {"$group": {"_id": "$genres", "rated": {"$sum": 1}}}, {"$sort": {"rated": -1}}],
+    [{"$group": {"_id": "$awards.wins", "movies": {"$sum": 1}}}, {"$sort": {"_id": 1}},
+     {"$project": {"_id": 0, "wins": "$_id", "movies": 1}}],
+    [{"$group": {"_id": "$imdb.rating", "count": {"$sum": 1}}}, {"$match": {"count": {"$gte": 30}}},
+     {"$count": "ratings"}],
+    [{"$group": {"_id": "$year", "runtime": {"$avg": "$runtime"}}}, {"$sort": {"runtime": -1}}, {"$limit": 3}],
+]
+
+
+def _page(pipeline):
+    # As `ResultBudget.base_pipeline` and `page_pipeline` extend a pipeline.
+    return pipeline + [{"$project": {"plot_embedding": 0}},
+                       {"$limit": 101}]
+
+
+def _normalized(value):
+    if isinstance(value, float):
+        return round(value, 6)
+    if isinstance(value, dict):
+        return {key: _normalized(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_normalized(item) for item in value]
+    return value
+
+
+def _same(pipeline, left, right):
+    left, right = _normalized(left), _normalized(right)
+    if not any("$sort" in stage or "$sortByCount" in stage for stage in pipeline):
+        left, right = sorted(map(repr, left)), sorted(map(repr, right))
+    return left == right
+
+
+def _timed(function, repeats):
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        durations.append(time.perf_counter() - start)
+    return result, statistics.median(durations)
+
+
+def _compare(pipelines, documents, store, repeats):
+    rows = []
+    for name, pipeline in pipelines:
+        paged = _page(pipeline)
+        expected, base_seconds = _timed(lambda: run_pipeline(documents, paged), repeats)
+        answer, rollup_seconds = _timed(lambda: store.answer(paged), repeats)
+        if answer is not None and not _same(pipeline, expected, answer):
+            raise RuntimeError(f"The rollups answered {name} differently:\n{expected[:3]}\n{answer[:3]}")
+        rows.append((name, answer is not None, base_seconds, rollup_seconds))
+    return rows
+
+
+def _change(documents, rng):
+    """Updates, deletes or inserts a random document; returns its id and new version."""
+    roll = rng.random()
+    if roll < 0.1:
+        document = documents.pop(rng.randrange(len(documents)))
+        return document["_id"], None
+    if roll < 0.2:
+        document = copy.deepcopy(rng.choice(documents))
+        document["_id"] = ObjectId()
+        documents.append(document)
+        return document["_id"], document
+    document = rng.choice(documents)
+    field = rng.choice(["genres", "countries", "year", "imdb.rating", "awards.wins", "runtime"])
+    if field == "genres":
+        document["genres"] = rng.sample(GENRES, rng.randint(0, 3))
+    elif field == "countries":
+        document["countries"] = rng.sample(COUNTRIES, rng.randint(1, 2))
+    elif field == "year":
+        document["year"] = rng.randint(1920, 2016)
+    elif field == "imdb.rating":
+        if rng.random() < 0.2:
+            document["imdb"].pop("rating", None)
+        else:
+            document["imdb"]["rating"] = round(rng.uniform(1, 10), 1)
+    elif field == "awards.wins":
+        document["awards"]["wins"] = rng.randint(0, 20)
+    else:
+        document["runtime"] = rng.randint(60, 200)
+    return document["_id"], document
+
+
+def main(args):
+    logging.disable(logging.INFO)
+    spec = RollupSpec(parse_dimensions(DEFAULT_DIMENSIONS), DEFAULT_MEASURES.split(","))
+    documents = list(mflix_documents(args.documents))
+    pipelines = [(entry["question"][:48], entry.get("pipeline") or entry["plan"]["pipeline"])
+                 for entry in default_corpus() if entry["route"] != "NoContext"]
+    pipelines += [(f"extra shape {index}", pipeline) for index, pipeline in enumerate(EXTRA_PIPELINES, 1)]
+
+    store = RollupStore(spec)
+    start = time.perf_counter()
+    store.build(documents)
+    build_seconds = time.perf_counter() - start
+    ledger = {document["_id"]: contribution(document, spec) for document in documents}
+    groups = store.stats()["groups"]
+    rows = _compare(pipelines, documents, store, args.repeats)
+
+    rng = random.Random(args.seed)
+    change_seconds = []
+    for _ in range(args.changes):
+        document_id, document = _change(documents, rng)
+        start = time.perf_counter()
+        new = None if document is None else contribution(document, spec)
+        store.apply(deltas(ledger.pop(document_id, None), new))
+        if new is not None:
+            ledger[document_id] = new
+        change_seconds.append(time.perf_counter() - start)
+    _compare(pipelines, documents, store, 1)
+
+    answered = [row for row in rows if row[1]]
+    print(f"{args.documents} movies, {groups} rollup groups built in {build_seconds:.2f}s; "
+          f"{len(answered)} of {len(rows)} pipelines answered from the rollups")
+    print(f"{'pipeline':<50}{'rollup':>7}{'base ms':>9}{'rollup ms':>11}{'speedup':>9}")
+    for name, routed, base_seconds, rollup_seconds in rows:
+        speedup = f"{base_seconds / rollup_seconds:>8.0f}x" if routed else f"{'-':>9}"
+        print(f"{name:<50}{'yes' if routed else 'no':>7}{base_seconds * 1000:>9.1f}"
+              f"{rollup_seconds * 1000 if routed else math.nan:>11.2f}{speedup}")
+    print(f"\n{args.changes} changes applied incrementally, {statistics.mean(change_seconds) * 1e6:.0f}us each; "
+          f"every answer still matches the changed collection")
+    print(f"documents read per answered pipeline: {args.documents} on the collection, at most {groups} groups")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=20000)
+    parser.add_argument("--changes", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=7)
+    main(parser.parse_args())
@@ -0,0 +1,84 @@
+"""
+Latency of routing with the router model, speculative execution and the local
+route classifier.
+
+Runs chart and question answering requests through the graph with stub chat
+models that sleep for `--llm-latency` seconds per call, in four modes:
+
+- router: every question waits for the router model before its branch starts.
+- speculative: the visualization node starts while the router model runs and is
+  cancelled when the question is routed elsewhere (ROUTER_SPECULATIVE).
+- local: questions the local classifier is sure about skip the router model
+  (ROUTER_LOCAL_CLASSIFIER_ENABLED).
+- local + speculative: both.
+
+Each mode uses its own years in the questions, so no mode reuses another's cached
+pipelines and plans.
+
+Usage (from the Backend directory):
+    python -m benchmarks.routing_benchmark --llm-latency 0.5 --requests 10
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import logging
+import os
+import statistics
+import time
+import warnings
+
+from benchmarks.stubs import install_stubs
+
+MODES = (
+    ("router", "false", "false"),
+    ("speculative", "false", "true"),
+    ("local", "true", "false"),
+    ("local + speculative", "true", "true"),
+)
+
+
+async def _run(workflow_manager, llm_manager, questions):
+    calls, latencies = [], []
+    for question in questions:
+        before = llm_manager.llm.calls + llm_manager.slm.calls
+        start = time.perf_counter()
+        await workflow_manager.ainvoke(question)
+        latencies.append(time.perf_counter() - start)
+        calls.append(llm_manager.llm.calls + llm_manager.slm.calls - before)
+    return statistics.median(latencies), statistics.mean(calls)
+
+
+async def main(args):
+    logging.disable(logging.INFO)
+    warnings.simplefilter("ignore")
+    llm_manager = install_stubs(args.llm_latency, args.mongo_latency)
+    from workflowManager import WorkflowManager
+
+    rows = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for index, (mode, local, speculative) in enumerate(MODES):
+            os.environ["ROUTER_LOCAL_CLASSIFIER_ENABLED"] = local
+            os.environ["ROUTER_SPECULATIVE"] = speculative
+            workflow_manager = WorkflowManager(llm_manager=llm_manager)
+            years = [1900 + index * args.requests + offset for offset in range(args.requests)]
+            charts = [f"Plot the number of movies per genre released in {year}" for year in years]
+            answers = [f"List the movies released in {year}" for year in years]
+            chart_p50, chart_calls = await _run(workflow_manager, llm_manager, charts)
+            answer_p50, answer_calls = await _run(workflow_manager, llm_manager, answers)
+            rows.append((mode, chart_p50, chart_calls, answer_p50, answer_calls))
+
+    print(f"Median latency and LLM calls per request with {args.llm_latency * 1000:.0f}ms "
+          f"per LLM call ({args.requests} requests per branch and mode)")
+    print(f"{'mode':<22}{'chart s':>9}{'calls':>7}{'answer s':>10}{'calls':>7}")
+    for mode, chart_p50, chart_calls, answer_p50, answer_calls in rows:
+        print(f"{mode:<22}{chart_p50:>9.3f}{chart_calls:>7.1f}{answer_p50:>10.3f}{answer_calls:>7.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--mongo-latency", type=float, default=0.02)
+    parser.add_argument("--requests", type=int, default=10)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,82 @@
+"""
+Cold start benchmark of the API process.
+
+Starts fresh interpreters and measures how long importing `agents.main` takes,
+which is when uvicorn can start serving, and how long the managers then take to
+build on first use. It also reports the network connections opened and the heavy
+plotting and data frame modules loaded by that point; both should be none.
+
+Usage (from the Backend directory):
+    python -m benchmarks.startup_benchmark --runs 5
+    python -m benchmarks.startup_benchmark --max-import-seconds 3
+The second form exits with status 1 when the median import time exceeds the
+budget, or when start up opens a network connection.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from benchmarks.stubs import BACKEND_DIR
+
+HEAVY_MODULES = ("matplotlib", "pandas", "plotly")
+
+_PROBE = """
+import json, logging, socket, sys, time, warnings
+logging.disable(logging.INFO)
+warnings.simplefilter("ignore")
+connections = []
+original_connect = socket.socket.connect
+def connect(self, address):
+    connections.append(str(address))
+    return original_connect(self, address)
+socket.socket.connect = connect
+
+start = time.perf_counter()
+import agents.main
+imported = time.perf_counter()
+heavy = sorted(name for name in %r if name in sys.modules)
+agents.main.workflow_manager()
+built = time.perf_counter()
+print(json.dumps({"import": imported - start, "build": built - imported,
+                  "connections": connections, "heavy_modules": heavy}))
+""" % (HEAVY_MODULES,)
+
+
+def _probe():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.join(BACKEND_DIR, "agents"), BACKEND_DIR, env.get("PYTHONPATH", "")])
+    env.setdefault("OPENAI_API_KEY", "stub")
+    env.setdefault("MONGODB_DATABASE_NAME", "sample_mflix")
+    output = subprocess.run([sys.executable, "-c", _PROBE], cwd=BACKEND_DIR, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(args):
+    runs = [_probe() for _ in range(args.runs)]
+    import_seconds = statistics.median(run["import"] for run in runs)
+    build_seconds = statistics.median(run["build"] for run in runs)
+    connections = sorted({address for run in runs for address in run["connections"]})
+    heavy_modules = sorted({name for run in runs for name in run["heavy_modules"]})
+
+    print(f"Cold start over {args.runs} runs (median)")
+    print(f"{'import agents.main':<28}{import_seconds:>8.3f}s")
+    print(f"{'first manager build':<28}{build_seconds:>8.3f}s")
+    print(f"{'network connections':<28}{len(connections):>8}  {', '.join(connections)}")
+    print(f"{'heavy modules at import':<28}{len(heavy_modules):>8}  {', '.join(heavy_modules)}")
+
+    if args.max_import_seconds is not None:
+        if import_seconds > args.max_import_seconds or connections:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-seconds", type=float, default=None)
+    main(parser.parse_args())
@@ -0,0 +1,295 @@
+"""
+Offline stand-ins for the chat models and the MongoDB collection.
+
+The benchmarks use these so the graph can be driven end to end without
+calling OpenAI or MongoDB Atlas. Latency is injected with `time.sleep` for the
+sync code paths and `asyncio.sleep` for the async ones, which is what makes the
+difference between a blocking and a non-blocking handler visible.
+"""
+import asyncio
+import copy
+import os
+import sys
+import time
+import zlib
+from typing import Any, Callable, List, Optional
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (BACKEND_DIR, os.path.join(BACKEND_DIR, "agents")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+os.environ.setdefault("OPENAI_API_KEY", "stub")
+os.environ.setdefault("MONGODB_DATABASE_NAME", "sample_mflix")
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+VISUALIZATION_KEYWORDS = ("chart", "plot", "graph", "visuali", "histogram")
+
+SAMPLE_DOCUMENTS = [
+    {"_id": "Drama", "genre": "Drama", "count": 12385, "averageRating": 6.8},
+    {"_id": "Comedy", "genre": "Comedy", "count": 6532, "averageRating": 6.4},
+    {"_id": "Romance", "genre": "Romance", "count": 3318, "averageRating": 6.7},
+    {"_id": "Crime", "genre": "Crime", "count": 2457, "averageRating": 6.7},
+    {"_id": "Thriller", "genre": "Thriller", "count": 2454, "averageRating": 6.2},
+]
+
+STUB_PLOT_CODE = """```python
+import plotly.graph_objects as go
+
+def generate_plot(data):
+    labels = [str(record.get('genre')) for record in data]
+    values = [record.get('count', 0) for record in data]
+    fig = go.Figure(go.Bar(x=labels, y=values))
+    fig.update_layout(template='plotly_dark')
+    return fig
+
+fig = generate_plot(data)
+```"""
+
+STUB_VISUALIZATION_PLAN = """{
+    "rephrased_question": "Retrieve the number of movies per genre to visualize a bar chart.",
+    "pipeline": [ { "$unwind": "$genres" },
+                  { "$group": { "_id": "$genres", "count": { "$sum": 1 } } },
+                  { "$project": { "_id": 0, "genre": "$_id", "count": 1 } },
+                  { "$sort": { "count": -1 } }, { "$limit": 20 } ],
+    "chart": { "type": "bar", "x": "genre", "y": "count", "title": "Movies per genre" }
+}"""
+
+
+def _message_text(message: BaseMessage) -> str:
+    content = message.content
+    if isinstance(content, str):
+        return content
+    return " ".join(
+        part.get("text", "") if isinstance(part, dict) else str(part)
+        for part in content)
+
+
+def _last_question(messages: List[BaseMessage]) -> str:
+    for message in reversed(messages):
+        if isinstance(message, HumanMessage):
+            return _message_text(message)
+    return _message_text(messages[-1]) if messages else ""
+
+
+def is_visualization_question(question: str) -> bool:
+    lowered = question.lower()
+    return any(keyword in lowered for keyword in VISUALIZATION_KEYWORDS)
+
+
+def scripted_responder(messages: List[BaseMessage]) -> AIMessage:
+    """
+    Answers the prompts used by the graph with fixed, well-formed responses.
+    The prompt is recognised from a distinctive phrase in its system message.
+    """
+    prompt_text = " ".join(_message_text(message) for message in messages)
+    question = _last_question(messages)
+
+    if "complete visualization plan" in prompt_text:
+        return AIMessage(content=STUB_VISUALIZATION_PLAN)
+    if "batch of incoming questions" in prompt_text:
+        lines = []
+        for line in question.splitlines():
+            number, _, text = line.partition(". ")
+            route = "Visualization" if is_visualization_question(text) else "QnA"
+            lines.append(f"{number}: {route}")
+        return AIMessage(content="\n".join(lines))
+    if "AI router agent" in prompt_text:
+        route = "Visualization" if is_visualization_question(question) else "QnA"
+        return AIMessage(content=route)
+    if "selects appropriate tools" in prompt_text:
+        if any(isinstance(message, ToolMessage) for message in messages):
+            return AIMessage(content="## Movies\n\nHere are the movies you asked for.")
+        return AIMessage(
+            content="",
+            tool_calls=[{"name": "GetMovies", "args": {"query": question}, "id": "call_stub"}])
+    if "mongodb aggregation pipeline" in prompt_text:
+        return AIMessage(content=(
+            '[ { "$unwind": "$genres" }, '
+            '{ "$group": { "_id": "$genres", "count": { "$sum": 1 } } }, '
+            '{ "$sort": { "count": -1 } }, { "$limit": 20 } ]'))
+    if "expert Python programmer" in prompt_text:
+        return AIMessage(content=STUB_PLOT_CODE)
+    if "user's intent" in prompt_text:
+        return AIMessage(content="Retrieve the number of movies per genre to visualize a bar chart.")
+    return AIMessage(content="NoContext")
+
+
+class StubChatModel(BaseChatModel):
+    """
+    Chat model that sleeps for `latency` seconds and answers via `responder`.
+    `latency` may also be a function drawing the seconds of each call, which
+    raises to make the call fail.
+    """
+
+    latency: Any = 0.0
+    responder: Callable[[List[BaseMessage]], Any] = scripted_responder
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub-chat"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _respond(self, messages: List[BaseMessage]) -> ChatResult:
+        self.calls += 1
+        response = self.responder(messages)
+        if isinstance(response, str):
+            response = AIMessage(content=response)
+        return ChatResult(generations=[ChatGeneration(message=response)])
+
+    def _delay(self) -> float:
+        return self.latency() if callable(self.latency) else self.latency
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self._delay())
+        return self._respond(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self._delay())
+        return self._respond(messages)
+
+
+class StubEmbeddings(Embeddings):
+    """Deterministic hashed bag-of-words embeddings."""
+
+    def __init__(self, dimensions: int = 256):
+        self.dimensions = dimensions
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimensions
+        for token in text.lower().split():
+            vector[zlib.crc32(token.encode()) % self.dimensions] += 1.0
+        return vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+class StubLLMManager:
+    """Drop-in replacement for `LLMManager` holding stub models."""
+
+    def __init__(self, latency: float = 0.0, responder=scripted_responder):
+        self.llm = StubChatModel(latency=latency, responder=responder)
+        self.slm = StubChatModel(latency=latency, responder=responder)
+        self.embeddings = StubEmbeddings()
+
+
+def _apply_paging(documents, pipeline):
+    """Applies the trailing $skip, $limit and $count stages the result budget adds."""
+    documents = copy.deepcopy(documents)
+    for stage in pipeline:
+        if "$skip" in stage:
+            documents = documents[stage["$skip"]:]
+        elif "$limit" in stage:
+            documents = documents[:stage["$limit"]]
+        elif "$count" in stage:
+            documents = [{stage["$count"]: len(documents)}]
+    return documents
+
+
+class _Cursor:
+    def __init__(self, documents):
+        self._documents = iter(documents)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._documents)
+
+    def close(self):
+        pass
+
+
+class _AsyncCursor(_Cursor):
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._documents)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def close(self):
+        pass
+
+
+class _StubDatabase:
+    """Answers the query guard's explain commands with a collection scan plan."""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def _explain(self):
+        self._collection.round_trips += 1
+        return {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}}
+
+    def command(self, name, spec, **kwargs):
+        time.sleep(self._collection.latency)
+        return self._explain()
+
+
+class _AsyncStubDatabase(_StubDatabase):
+    async def command(self, name, spec, **kwargs):
+        await asyncio.sleep(self._collection.latency)
+        return self._explain()
+
+
+class StubCollection:
+    """Sync collection stand-in returning a fixed document list from `aggregate`."""
+    name = "movies"
+
+    def __init__(self, documents: Optional[list] = None, latency: float = 0.0):
+        self.documents = documents if documents is not None else SAMPLE_DOCUMENTS
+        self.latency = latency
+        self.round_trips = 0
+        self.database = _StubDatabase(self)
+
+    def estimated_document_count(self):
+        return len(self.documents)
+
+    def aggregate(self, pipeline, **kwargs):
+        time.sleep(self.latency)
+        self.round_trips += 1
+        return _Cursor(_apply_paging(self.documents, pipeline))
+
+
+class AsyncStubCollection(StubCollection):
+    """Async collection stand-in mirroring `pymongo.AsyncCollection.aggregate`."""
+
+    def __init__(self, documents: Optional[list] = None, latency: float = 0.0):
+        super().__init__(documents, latency)
+        self.database = _AsyncStubDatabase(self)
+
+    async def estimated_document_count(self):
+        return len(self.documents)
+
+    async def aggregate(self, pipeline, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.round_trips += 1
+        return _AsyncCursor(_apply_paging(self.documents, pipeline))
+
+
+def install_stubs(llm_latency: float = 0.0, mongo_latency: float = 0.0,
+                  documents: Optional[list] = None) -> StubLLMManager:
+    """
+    Points the shared LLM manager and the MongoDB collections at stubs and
+    returns the stub `LLMManager` to build a `WorkflowManager` with. Must run
+    before the first request, since chains and caches are built on first use.
+    """
+    from agents import clients
+    import agents.mongodb_retriever as mongodb_retriever
+
+    llm_manager = StubLLMManager(latency=llm_latency)
+    clients.llm_manager.override(llm_manager)
+    mongodb_retriever.collection.override(StubCollection(documents, mongo_latency))
+    mongodb_retriever.async_collection.override(AsyncStubCollection(documents, mongo_latency))
+    return llm_manager
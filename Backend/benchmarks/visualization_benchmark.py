@@ -0,0 +1,73 @@
+"""
+LLM calls and latency of the visualization branch.
+
+Runs chart questions through the graph with stub chat models that sleep for
+`--llm-latency` seconds per call, once with the legacy branch (rephrase, pipeline
+generation and code generation each call the LLM) and once with the single
+planning step. The planned branch is run a second time with the same questions
+to show the cost of a cached plan.
+
+Usage (from the Backend directory):
+    python -m benchmarks.visualization_benchmark --llm-latency 0.5 --requests 10
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import logging
+import math
+import os
+import statistics
+import time
+import warnings
+
+from benchmarks.stubs import install_stubs
+
+
+async def _run(workflow_manager, llm_manager, questions):
+    calls, latencies = [], []
+    for question in questions:
+        before = llm_manager.llm.calls + llm_manager.slm.calls
+        start = time.perf_counter()
+        response = await workflow_manager.ainvoke(question)
+        latencies.append(time.perf_counter() - start)
+        calls.append(llm_manager.llm.calls + llm_manager.slm.calls - before)
+        if not response.chart_id:
+            raise RuntimeError(f"No chart was generated for: {question}")
+    latencies.sort()
+    p95 = latencies[math.ceil(len(latencies) * 0.95) - 1]
+    return statistics.mean(calls), statistics.median(latencies), p95
+
+
+async def main(args):
+    logging.disable(logging.INFO)
+    warnings.simplefilter("ignore")
+    llm_manager = install_stubs(args.llm_latency, args.mongo_latency)
+    from workflowManager import WorkflowManager
+
+    # Distinct years keep the questions from sharing cached pipelines and plans.
+    questions = [f"Plot the number of movies per genre released in {1950 + index}"
+                 for index in range(args.requests)]
+    rows = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for mode in ("legacy", "single"):
+            os.environ["VISUALIZATION_PLANNER"] = mode
+            workflow_manager = WorkflowManager(llm_manager=llm_manager)
+            rows.append((mode, *await _run(workflow_manager, llm_manager, questions)))
+        rows.append(("single, cached plan",
+                     *await _run(workflow_manager, llm_manager, questions)))
+
+    print(f"Visualization requests with {args.llm_latency * 1000:.0f}ms per LLM call "
+          f"({args.requests} requests per mode, router call included)")
+    print(f"{'mode':<22}{'LLM calls':>10}{'p50 s':>9}{'p95 s':>9}")
+    for mode, calls, p50, p95 in rows:
+        print(f"{mode:<22}{calls:>10.1f}{p50:>9.3f}{p95:>9.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--mongo-latency", type=float, default=0.02)
+    parser.add_argument("--requests", type=int, default=10)
+    asyncio.run(main(parser.parse_args()))
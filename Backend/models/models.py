@@ -1,15 +1,35 @@
-from typing import Optional
+from typing import List, Optional
 from pydantic import BaseModel, Field
 
 
 class Query(BaseModel):
     query: str = Field(..., example="Query for NLP")
+    session_id: Optional[str] = Field(
+        None, example="Conversation identifier returned by a previous response")
 
 
 class QueryResponse(BaseModel):
     answer: str = Field(..., example="Final answer for the user query")
     chart: str = Field(...,
                        example="Chart generated from the user query in json format")
+    figure: Optional[dict] = Field(
+        None, example="Plotly figure of the chart, with numeric arrays as typed arrays")
+    chart_id: Optional[str] = Field(
+        None, example="Content hash of the chart, for reading it from /charts/{chart_id}")
+    session_id: Optional[str] = Field(
+        None, example="Conversation identifier to send with follow-up queries")
+    result_id: Optional[str] = Field(
+        None, example="Identifier for reading further pages of a truncated result")
+    total_results: Optional[int] = Field(
+        None, example="Number of documents the query matched")
+
+
+class ResultPage(BaseModel):
+    documents: List[dict] = Field(..., example=[{"title": "Inception", "year": 2010}])
+    offset: int = Field(..., example=100)
+    total: int = Field(..., example=3124)
+    next_offset: Optional[int] = Field(
+        None, example="Offset of the following page, missing on the last page")
 
 class HelpResponse(BaseModel):
     help_text: str = Field(..., example="Detailed help text for the user")
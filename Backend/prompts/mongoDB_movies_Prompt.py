@@ -64,15 +64,26 @@ movies_collection_schema = """
             - **num_mflix_comments** (Number): Number of comments on the movie.  
     """
 
+# Words questions use for a field that its schema description lacks, so the
+# prompt builder keeps the field for them.
+schema_field_keywords = {
+    "cast": "actor actress act acted acting star starring feature featuring",
+    "directors": "direct directed director filmmaker",
+    "countries": "country nation american british french german italian indian japanese korean spanish foreign",
+    "languages": "language speak spoken english french spanish hindi dubbed",
+    "released": "date month day recent newest oldest",
+    "lastupdated": "latest recent updated newest",
+    "runtime": "long longest short shortest length minutes hours",
+    "awards": "award win won winning oscar nominated",
+    "imdb": "rated best worst top popular score",
+    "tomatoes": "rotten tomato critic critics viewer audience fresh meter review",
+    "rated": "pg kids children family mature",
+    "plot": "story about summary",
+    "num_mflix_comments": "comment commented",
+}
+
 movies_mongodb_prompt = """You are an intelligent AI assistant who is expert in transforming natural language questions into mongodb aggregation pipeline queries.
       Your task is to accurately generate MongoDB aggregation pipeline using the provided schema.
-    **Schema Description**:
-       The mentioned mongodb collection talks about various movies and their details.
-       The schema for this document represents the structure of the data, describing various properties related to the movies, ratings, plot/story, cast/actors and genres.
-    {movies_collection_schema}
-    
-    **Examples**:
-    {examples}
     **Important Instructions**:
     - All dates must be in ISODate bson type and don't use '$date' in queries.
     - **You must return the query as to use in aggregation pipeline nothing else.No additional explanations or text.**
@@ -82,11 +93,24 @@ movies_mongodb_prompt = """You are an intelligent AI assistant who is expert in
     - If the provided context is insufficient or no requested data, ask clarifying questions to gather more information.
     """
 
+# Kept apart from the instructions and sent after the chat history: the schema
+# fields and examples are chosen per question, and whatever comes before them
+# stays a stable prefix the provider can cache.
+movies_mongodb_context_prompt = """**Schema Description**:
+       The mentioned mongodb collection talks about various movies and their details.
+       The schema for this document represents the structure of the data, describing various properties related to the movies, ratings, plot/story, cast/actors and genres.
+    {movies_collection_schema}
+
+    **Examples**:
+    {examples}
+    """
+
 def get_movies_collection_prompt():
     prompt = ChatPromptTemplate.from_messages(
         [
           SystemMessagePromptTemplate.from_template(movies_mongodb_prompt),
           MessagesPlaceholder(variable_name="chat_history"),
+          SystemMessagePromptTemplate.from_template(movies_mongodb_context_prompt),
           HumanMessagePromptTemplate.from_template("{user_question}")
         ])
     return prompt
@@ -113,5 +137,6 @@ def get_text2nosql_prompt():
             ("placeholder", "{agent_scratchpad}"),
         ]
     )
-    prompt = prompt.partial(present_date=datetime.now().strftime("%Y-%m-%d"))
+    # Resolved on every format call, so a prompt built once stays current.
+    prompt = prompt.partial(present_date=lambda: datetime.now().strftime("%Y-%m-%d"))
     return prompt
@@ -37,3 +37,69 @@ def get_router_prompt():
         ]
     ).partial(options=str(options), members=", ".join(members))
     return prompt
+
+
+system_batch_router_prompt = (
+    """You are an AI router agent responsible for classifying a batch of incoming questions. Based on your classification, each question will be routed to the appropriate team.
+       There are four possible classifications:
+        - QnA: For questions about fetching data related to movies, actors/casts, budgets, genres, directors, imdb and tomatoe ratings etc
+        - Visualization: For questions related to data visualization, like creating or analyzing graphs, charts, and tables (not images).
+        - Help: For questions related to requesting for help and guidance
+        - NoContext: For questions that do not fit into any of the above categories.
+
+        The questions are numbered. Classify each question on its own and answer with one line per
+        question, in the same order, formatted as `<number>: <classification>`, for example `1: QnA`.
+        Do not include any other text.
+
+    """
+)
+
+
+def get_batch_router_prompt():
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", system_batch_router_prompt),
+            ("human", "{questions}"),
+        ]
+    )
+    return prompt
+
+
+# Labelled questions for the local route classifier, which answers obvious
+# cases without calling the router model.
+router_examples = [
+    ("Show me the top 10 movies by IMDb rating", "QnA"),
+    ("List the movies directed by Christopher Nolan", "QnA"),
+    ("Which movies did Tom Hanks act in?", "QnA"),
+    ("What is the plot of The Godfather?", "QnA"),
+    ("How many movies were released in 1999?", "QnA"),
+    ("Find comedies with a rating above 8", "QnA"),
+    ("Who directed Titanic?", "QnA"),
+    ("What are the highest rated horror movies?", "QnA"),
+    ("Give me the cast of Inception", "QnA"),
+    ("Which movies won the most awards?", "QnA"),
+    ("List French movies from the 1960s", "QnA"),
+    ("What is the runtime of Avatar?", "QnA"),
+    ("Find movies with Meryl Streep and a tomatoes rating above 4", "QnA"),
+    ("Which genre has the most movies?", "QnA"),
+    ("Recommend some animated family movies", "QnA"),
+    ("Tell me about the movie Casablanca", "QnA"),
+    ("Plot the number of movies per genre", "Visualization"),
+    ("Plot the average IMDb rating by year", "Visualization"),
+    ("Show a bar chart of movies per country", "Visualization"),
+    ("Create a pie chart of genres", "Visualization"),
+    ("Draw a histogram of runtimes", "Visualization"),
+    ("Visualize the trend of movie releases over the years", "Visualization"),
+    ("Show a line chart of average ratings per decade", "Visualization"),
+    ("Scatter plot of IMDb rating versus runtime", "Visualization"),
+    ("Graph the number of awards won per year", "Visualization"),
+    ("Show the distribution of IMDb ratings as a chart", "Visualization"),
+    ("Compare the number of dramas and comedies in a chart", "Visualization"),
+    ("Hello", "NoContext"),
+    ("What is the weather like today?", "NoContext"),
+    ("Write me a poem about the sea", "NoContext"),
+    ("What is the capital of France?", "NoContext"),
+    ("Tell me a joke", "NoContext"),
+    ("How do I cook pasta?", "NoContext"),
+    ("What time is it?", "NoContext"),
+]
@@ -1,8 +1,11 @@
-from langchain.prompts import PromptTemplate
+from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate, MessagesPlaceholder, PromptTemplate, SystemMessagePromptTemplate
 from agents.logger import setup_logger
 
 logger = setup_logger(__name__)
 
+# The parts that change per question (the schema fields chosen for it and the
+# query) come last, so the instructions and examples form a stable prefix the
+# provider can cache. The same holds for the prompts below.
 user_query_regenerate_prompt = """
         You are an expert in generating MongoDB queries based on the schema of a collection and the user's intent.
         Based on the original user query (which is related to visualizing data) and the schema provided,
@@ -12,12 +15,6 @@ user_query_regenerate_prompt = """
         **Schema Context**:
         - The collection schema represents various aspects of movies data, such as movie information, actors/casts, budgets, genres, directors, imdb ratings etc.
 
-        **Original User Query**:
-        "{user_query}"
-
-        **Collection Schema**:
-        {collection_schema}
-
         Your task is to:
         - Understand the original user query and identify what data is required for visualization.
         - Based on the user's request and the schema context, generate a relevant new query that can fetch the required data from the collection.
@@ -39,6 +36,12 @@ user_query_regenerate_prompt = """
         Note:
             1. Just return the generated query string as the final output.
             2. The generated query should be plain text, not MongoDB Query.
+
+        **Collection Schema**:
+        {collection_schema}
+
+        **Original User Query**:
+        "{user_query}"
         """
 
 
@@ -58,14 +61,7 @@ python_code_generation_prompt = """
         **Context**:
         - The data is retrieved from a MongoDB collection as JSON and passed as an argument to the function.
         - The metadata and a sample of the retrieved data are provided below. You **must only** refer to the data described in the metadata.
-
-        **Metadata of the retrieved data:**
-        - Columns: {column_names}
-        - Number of rows: {number_of_rows}
-        - Sample record: {sample_record}
-
-        **User query**:
-        "{user_query}"
+        - The same data is also available as a Pandas DataFrame named `frame`, with nested fields flattened to dotted column names (e.g. `imdb.rating`) and array fields such as `genres` kept as lists. Use `frame` instead of building a new DataFrame from `data`.
 
         **Your task**:
         - Generate Python code that defines a function `generate_plot(data)` which:
@@ -99,6 +95,14 @@ python_code_generation_prompt = """
             - There should not be any syntax errors in the generated code.
         - You must **strictly** follow the structure of the data provided in the metadata.
         - The input data is already filtered based on the user query, so you can directly use it for preprocessing and plotting.
+
+        **Metadata of the retrieved data:**
+        - Columns: {column_names}
+        - Number of rows: {number_of_rows}
+        - Sample record: {sample_record}
+
+        **User query**:
+        "{user_query}"
         """
 
 def create_code_generation_prompt():
@@ -108,3 +112,49 @@ def create_code_generation_prompt():
                          "sample_record", "collection_schema", "user_query"]
     )
     return code_generation_prompt_template
+
+
+visualization_plan_prompt = """You are an expert in visualizing MongoDB data. You turn a user's request for a chart into a complete visualization plan in a single step.
+    Your task is to:
+    - Understand what data the user wants to see and which chart shows it best. Always consider whether a time series or trend chart is asked for.
+    - Write a MongoDB aggregation pipeline that returns exactly the rows to plot, already grouped, sorted and limited. Give every output field a readable name with $project, and keep the grouping key out of '_id' (for example project it as 'genre' and set '_id' to 0).
+    - Describe the chart that plots these rows.
+
+    **Output format**:
+    Return only a JSON object, with no additional text, in this form:
+    {{
+        "rephrased_question": "<plain text description of the data to retrieve for the chart>",
+        "pipeline": [<aggregation pipeline stages>],
+        "chart": {{
+            "type": "<one of: bar, line, scatter, pie, histogram>",
+            "x": "<output field for the x axis, or the labels of a pie chart>",
+            "y": "<output field for the y axis, or the values of a pie chart; omit it for a histogram>",
+            "color": "<optional output field to group the series by>",
+            "title": "<chart title>"
+        }}
+    }}
+
+    **Important Instructions**:
+    - All dates must be in ISODate bson type and don't use '$date' in queries.
+    - The chart fields must be output fields of the pipeline.
+    - Limit the pipeline to at most 100 rows using the $limit stage.
+    """
+
+visualization_plan_context_prompt = """**Schema Description**:
+       The mongodb collection holds movies and their details: ratings, plot/story, cast/actors, genres, directors, release dates and awards.
+    {movies_collection_schema}
+
+    **Aggregation pipeline examples**:
+    {examples}
+    """
+
+
+def create_visualization_plan_prompt():
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            SystemMessagePromptTemplate.from_template(visualization_plan_prompt),
+            MessagesPlaceholder(variable_name="chat_history"),
+            SystemMessagePromptTemplate.from_template(visualization_plan_context_prompt),
+            HumanMessagePromptTemplate.from_template("{user_query}")
+        ])
+    return prompt
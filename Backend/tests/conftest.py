@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Mirrors PYTHONPATH in the Dockerfile, so the tests run from Backend with `python -m pytest`.
+_backend = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(_backend, "agents"), _backend]
@@ -0,0 +1,100 @@
+from datetime import datetime
+from agents.pipeline_validation import (
+    PipelineParseError, PipelineRejected, PipelineValidator, create_pipeline_validator,
+    parse_extended_json,
+)
+import pytest
+
+FIELDS = ["title", "year", "genres", "imdb.rating", "imdb.votes", "released", "awards.wins"]
+
+
+@pytest.fixture
+def validator():
+    return PipelineValidator(FIELDS, indexed_fields=["year"])
+
+
+def test_parses_relaxed_json():
+    value, repairs = parse_extended_json(
+        "```javascript\n[{$match: {'year': 2000, title: None, }}, {$limit: 5,},]\n```")
+    assert value == [{"$match": {"year": 2000, "title": None}}, {"$limit": 5}]
+    assert repairs == ["relaxed JSON syntax"]
+
+
+def test_parses_shell_constructors():
+    value, _ = parse_extended_json(
+        '[{"$match": {"released": {"$gte": ISODate("2000-01-01")}, '
+        '"imdb.votes": {"$gt": NumberInt(100)}, "year": NumberLong("1999")}}]')
+    query = value[0]["$match"]
+    assert query["released"]["$gte"] == datetime(2000, 1, 1)
+    assert query["imdb.votes"]["$gt"] == 100
+    assert query["year"] == 1999
+
+
+def test_wraps_stages_without_an_array():
+    value, repairs = parse_extended_json('Output: {"$match": {"year": 2000}}, {"$limit": 1}')
+    assert value == [{"$match": {"year": 2000}}, {"$limit": 1}]
+    assert "wrapped the stages in an array" in repairs
+
+
+def test_unreadable_text_fails_to_parse(validator):
+    with pytest.raises(PipelineParseError):
+        validator.parse("I cannot answer that")
+    assert validator.stats()["parse_failures"] == 1
+
+
+def test_repairs_misspelled_fields():
+    validator = create_pipeline_validator()
+    pipeline = validator.parse('[{"$group": {"_id": "$year", "rating": {"$avg": "$imdb_rating"}}}]')
+    assert pipeline == [{"$group": {"_id": "$year", "rating": {"$avg": "$imdb.rating"}}}]
+
+
+def test_rejects_unknown_fields(validator):
+    with pytest.raises(PipelineRejected, match="Unknown field 'budget'"):
+        validator.validate([{"$match": {"budget": {"$gt": 10}}}])
+
+
+def test_tracks_fields_across_stages(validator):
+    pipeline = [
+        {"$group": {"_id": "$year", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1}},
+    ]
+    assert validator.validate(pipeline).pipeline == pipeline
+    with pytest.raises(PipelineRejected):
+        validator.validate(pipeline + [{"$match": {"title": "Heat"}}])
+
+
+def test_moves_match_ahead_of_sort(validator):
+    result = validator.validate([{"$sort": {"year": 1}}, {"$match": {"year": 2000}}])
+    assert result.pipeline == [{"$match": {"year": 2000}}, {"$sort": {"year": 1}}]
+    assert "moved $match ahead of $sort" in result.repairs
+    assert result.warnings == []
+
+
+def test_rejects_disallowed_stages_and_operators(validator):
+    with pytest.raises(PipelineRejected, match=r"\$lookup"):
+        validator.validate([{"$lookup": {"from": "users", "as": "users"}}])
+    with pytest.raises(PipelineRejected, match=r"\$where"):
+        validator.validate([{"$match": {"$where": "sleep(1000)"}}])
+
+
+def test_checks_facet_sub_pipelines(validator):
+    with pytest.raises(PipelineRejected, match=r"\$lookup"):
+        validator.validate([{"$facet": {"users": [{"$lookup": {"from": "users", "as": "u"}}]}}])
+    with pytest.raises(PipelineRejected, match=r"\$where"):
+        validator.validate([{"$facet": {"slow": [{"$match": {"$where": "true"}}]}}])
+    with pytest.raises(PipelineRejected, match="Unknown field"):
+        validator.validate([{"$facet": {"top": [{"$sort": {"budget": -1}}]}}])
+
+
+def test_checks_fields_after_facet(validator):
+    pipeline = [
+        {"$facet": {"byYear": [{"$group": {"_id": "$year", "count": {"$sum": 1}}}],
+                    "total": [{"$count": "movies"}]}},
+        {"$unwind": "$byYear"},
+        {"$project": {"year": "$byYear._id", "count": "$byYear.count"}},
+    ]
+    assert validator.validate(pipeline).pipeline == pipeline
+    with pytest.raises(PipelineRejected, match="Unknown field"):
+        validator.validate(pipeline[:1] + [{"$match": {"byYear.budget": 1}}])
+    result = validator.validate([{"$facet": {"top": [{"$sort": {"imdb_rating": -1}}]}}])
+    assert result.pipeline == [{"$facet": {"top": [{"$sort": {"imdb.rating": -1}}]}}]
@@ -0,0 +1,153 @@
+"""
+The rollups must answer exactly what `$group` returns on the collection: here the
+in-memory aggregation of `benchmarks.mflix`, and a MongoDB server when
+`ROLLUPS_TEST_MONGODB_URI` names one (a throwaway database is created and dropped).
+"""
+from agents.rollups import (
+    DEFAULT_DIMENSIONS, DEFAULT_MEASURES, Rollups, RollupSpec, RollupStore, contribution, deltas,
+    parse_dimensions,
+)
+from benchmarks.mflix import mflix_documents, run_pipeline
+from bson import ObjectId
+import copy
+import os
+import random
+import pytest
+
+SPEC = RollupSpec(parse_dimensions(DEFAULT_DIMENSIONS), DEFAULT_MEASURES.split(","))
+
+PIPELINES = [
+    [{"$unwind": "$genres"}, {"$group": {"_id": "$genres", "count": {"$sum": 1}}}],
+    [{"$unwind": "$countries"}, {"$sortByCount": "$countries"}],
+    [{"$group": {"_id": "$year", "movies": {"$sum": 1}, "runtime": {"$avg": "$runtime"}}}],
+    [{"$unwind": "$genres"}, {"$group": {"_id": "$genres", "wins": {"$sum": "$awards.wins"},
+                                         "rating": {"$avg": "$imdb.rating"}}},
+     {"$project": {"_id": 0, "genre": "$_id", "wins": 1, "rating": 1}}],
+    [{"$match": {"imdb.rating": {"$exists": True}}}, {"$unwind": "$genres"},
+     {"$group": {"_id": "$genres", "rated": {"$sum": 1}}}],
+    [{"$group": {"_id": "$imdb.rating", "count": {"$sum": 1}}}, {"$match": {"count": {"$gte": 10}}}],
+]
+
+
+def _normalized(documents):
+    # Ties make the order of equal groups arbitrary, so the answers are compared as sets.
+    def normalize(value):
+        if isinstance(value, float):
+            return round(value, 6)
+        if isinstance(value, dict):
+            return {key: normalize(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [normalize(item) for item in value]
+        return value
+    return sorted(repr(normalize(document)) for document in documents)
+
+
+def _change(documents, rng):
+    """Updates, deletes or inserts a random document; returns its id and new version."""
+    roll = rng.random()
+    if roll < 0.1:
+        document = documents.pop(rng.randrange(len(documents)))
+        return document["_id"], None
+    if roll < 0.2:
+        document = copy.deepcopy(rng.choice(documents))
+        document["_id"] = ObjectId()
+        documents.append(document)
+        return document["_id"], document
+    document = rng.choice(documents)
+    document["genres"] = rng.sample(["Drama", "Comedy", "Crime", "Horror"], rng.randint(0, 2))
+    document["year"] = rng.randint(1990, 2015)
+    if rng.random() < 0.2:
+        document["imdb"].pop("rating", None)
+    else:
+        document["imdb"]["rating"] = round(rng.uniform(1, 10), 1)
+    return document["_id"], document
+
+
+def _assert_answers(answer, expected):
+    for pipeline in PIPELINES:
+        documents = answer(pipeline)
+        assert documents is not None, pipeline
+        assert _normalized(documents) == _normalized(expected(pipeline)), pipeline
+
+
+def test_store_matches_group():
+    documents = list(mflix_documents(1000))
+    store = RollupStore(SPEC)
+    store.build(documents)
+    _assert_answers(store.answer, lambda pipeline: run_pipeline(documents, pipeline))
+
+
+def test_store_follows_changes():
+    documents = list(mflix_documents(1000))
+    store = RollupStore(SPEC)
+    store.build(documents)
+    ledger = {document["_id"]: contribution(document, SPEC) for document in documents}
+    rng = random.Random(5)
+    for _ in range(300):
+        document_id, document = _change(documents, rng)
+        new = None if document is None else contribution(document, SPEC)
+        store.apply(deltas(ledger.pop(document_id, None), new))
+        if new is not None:
+            ledger[document_id] = new
+    _assert_answers(store.answer, lambda pipeline: run_pipeline(documents, pipeline))
+
+
+def test_store_declines_other_pipelines():
+    store = RollupStore(SPEC)
+    store.build(mflix_documents(100))
+    assert store.answer([{"$match": {"year": 2000}}, {"$group": {"_id": "$genres"}}]) is None
+    assert store.answer([{"$group": {"_id": "$title", "count": {"$sum": 1}}}]) is None
+
+
+@pytest.fixture
+def mongo_database():
+    uri = os.getenv("ROLLUPS_TEST_MONGODB_URI")
+    if not uri:
+        pytest.skip("ROLLUPS_TEST_MONGODB_URI is not set")
+    from pymongo import MongoClient
+    client = MongoClient(uri)
+    name = f"rollups_test_{ObjectId()}"
+    try:
+        yield client[name]
+    finally:
+        client.drop_database(name)
+        client.close()
+
+
+def _interrupted(*args, **kwargs):
+    raise RuntimeError("interrupted")
+
+
+def test_rollups_match_group_on_mongodb(mongo_database, monkeypatch):
+    documents = list(mflix_documents(1000))
+    collection = mongo_database["movies"]
+    collection.insert_many(copy.deepcopy(documents))
+    rollups = Rollups(lambda: collection, lambda: mongo_database, SPEC, mode="poll",
+                      change_timeout_seconds=0)
+    rollups.rebuild()
+    rollups.reload()
+    _assert_answers(rollups.answer, lambda pipeline: list(collection.aggregate(pipeline)))
+
+    rng = random.Random(11)
+    interrupted = []
+    for index in range(200):
+        document_id, document = _change(documents, rng)
+        if document is None:
+            collection.delete_one({"_id": document_id})
+        else:
+            collection.replace_one({"_id": document_id}, copy.deepcopy(document), upsert=True)
+        if index % 10 == 0:
+            # A crash between incrementing the groups and finishing the ledger entry.
+            monkeypatch.setattr(rollups, "_finish", _interrupted)
+            with pytest.raises(RuntimeError):
+                rollups.apply_document(document_id, copy.deepcopy(document))
+            monkeypatch.undo()
+            interrupted.append(document_id)
+        else:
+            rollups.apply_document(document_id, copy.deepcopy(document))
+    rollups.recover()
+    # The change source delivers the interrupted changes again.
+    for document_id in interrupted:
+        rollups.apply_document(document_id, collection.find_one({"_id": document_id}))
+    rollups.reload()
+    _assert_answers(rollups.answer, lambda pipeline: list(collection.aggregate(pipeline)))
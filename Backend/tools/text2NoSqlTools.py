@@ -2,10 +2,14 @@ from datetime import date
 from langchain.agents import Tool
 from langchain.tools import StructuredTool
 from pydantic import BaseModel, Field, model_validator
-from agents.mongodb_retriever import get_movies
+from agents.mongodb_retriever import aget_movies, get_movies
 from agents.logger import setup_logger
+from agents.pipeline_validation import PipelineParseError, PipelineRejected
+from agents.tool_output import create_tool_output_compactor
 
 logger = setup_logger(__name__)
+# The agent resends every tool response on each of its iterations; keep them small.
+tool_output_compactor = create_tool_output_compactor()
 
 def get_no_context_response(self):
     try:
@@ -16,6 +20,26 @@ def get_no_context_response(self):
         raise
 
 
+def _rejected_pipeline_response(error):
+    # Lets the agent rephrase the request instead of failing the whole run.
+    return (f"The generated query was not run: {error}. Rephrase the request using "
+            "only fields of the movies collection.")
+
+
+def get_movies_for_agent(query):
+    try:
+        return tool_output_compactor.compact(get_movies(query))
+    except (PipelineParseError, PipelineRejected) as e:
+        return _rejected_pipeline_response(e)
+
+
+async def aget_movies_for_agent(query):
+    try:
+        return tool_output_compactor.compact(await aget_movies(query))
+    except (PipelineParseError, PipelineRejected) as e:
+        return _rejected_pipeline_response(e)
+
+
 class TimeStamp(BaseModel):
     fromDate: date = Field()
     toDate: date = Field()
@@ -28,13 +52,15 @@ class TimeStampInStrings(BaseModel):
 text2NoSqlTools = [
     Tool(
         name="GetMovies",
-        func=get_movies,
+        func=get_movies_for_agent,
+        coroutine=aget_movies_for_agent,
         description="""
         Gets information about the movies, ratings, plot or story, cast or actors, and genres based on the user input.
         Args:
             query (str): The user input to send. Accepts user input directly without modification.
         Returns:
-            list: List of movies with the requested information.
+            str: A table of the movies with the requested information, preceded by the
+            number of matching movies and, for larger results, statistics of each column.
         """
     ),
     # Fallback
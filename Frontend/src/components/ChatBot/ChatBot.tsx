@@ -1,19 +1,19 @@
-import axios from "axios";
 import { useRef, useState } from "react";
 import ChatBot, { Button, Flow, Settings, Styles } from "react-chatbotify";
-import ReactMarkdown from "react-markdown";
-import remarkGfm from "remark-gfm";
 import Chatbot from "../../assets/images/minion.png";
 import User from "../../assets/images/User.svg";
 import "./ChatBot.css";
-import Visualization from "./Visualization";
-import { AgentApiResponse } from "../../interfaces/agentApiResponse";
+import StreamedReply from "./StreamedReply";
+import { AnswerStream } from "./answerStream";
+import { AgentStreamEvent } from "../../interfaces/agentStreamEvent";
 
 const ChatBotWrapper = () => {
   const chatBotWrapperWindowRef = useRef<HTMLDivElement>(null);
-  const [chatbotResponse, setchatbotResponse] = useState<any>(null);
-  const [chartPayload, setChartPayload] = useState<{} | null>(null);
-  const [chartDesign, setChartDesign] = useState<{} | null>(null);
+  // Identifies this conversation so the backend keeps its history separate.
+  const sessionIdRef = useRef<string>(crypto.randomUUID());
+  const [answerStream, setAnswerStream] = useState<AnswerStream>(
+    () => new AnswerStream()
+  );
   const options: string[] = [
     "Get me the movies released in 2000 with rating greater than 8",
     "Show me all the movies directed by Christopher Nolan",
@@ -21,73 +21,79 @@ const ChatBotWrapper = () => {
     "Show me the details of the movie Titanic by James Cameron",
   ];
 
-  async function fetchResponse(
-    query: string
-  ): Promise<string | AgentApiResponse> {
-    return new Promise((resolve) => {
-      axios
-        .post(
-          `${import.meta.env.VITE_CHAT_API_URL}/query`,
-          { query: query, localTimeStamp: new Date().toISOString() },
-          {
-            headers: {
-              "Content-Type": "application/json",
-              "Cache-Control": "no-cache",
-            },
+  // Reads the server-sent events of /query/stream as they arrive. axios cannot
+  // expose a streamed response body in the browser, so this uses fetch.
+  async function streamResponse(
+    query: string,
+    onEvent: (event: AgentStreamEvent) => void
+  ): Promise<void> {
+    const response = await fetch(
+      `${import.meta.env.VITE_CHAT_API_URL}/query/stream`,
+      {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+          "Cache-Control": "no-cache",
+        },
+        body: JSON.stringify({
+          query: query,
+          session_id: sessionIdRef.current,
+          localTimeStamp: new Date().toISOString(),
+        }),
+      }
+    );
+    if (!response.ok || !response.body) {
+      throw new Error(`Request failed with status ${response.status}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    for (;;) {
+      const { done, value } = await reader.read();
+      if (done) {
+        break;
+      }
+      buffer += decoder.decode(value, { stream: true });
+      const frames = buffer.split("\n\n");
+      buffer = frames.pop() || "";
+      for (const frame of frames) {
+        let event = "message";
+        let data = "";
+        for (const line of frame.split("\n")) {
+          if (line.startsWith("event:")) {
+            event = line.slice(6).trim();
+          } else if (line.startsWith("data:")) {
+            data += line.slice(5).trim();
           }
-        )
-        .then((response) => {
-          resolve(response.data);
-        })
-        .catch(() => {
-          resolve("Error encountered. Please retry");
-        });
-    });
+        }
+        if (data) {
+          onEvent({ event, data: JSON.parse(data) });
+        }
+      }
+    }
   }
 
   async function fetchResponseFromAgent(params: any) {
     if (params.userInput === "end") {
+      sessionIdRef.current = crypto.randomUUID();
       await params.goToPath("end");
       setTimeout(() => params.openChat(false), 1000);
       return;
     }
 
+    // Show the reply bubble right away; it renders each event as it arrives.
+    const stream = new AnswerStream();
+    setAnswerStream(stream);
+    await params.goToPath("reply");
     try {
-      const response = (await fetchResponse(
-        params.userInput
-      )) as AgentApiResponse;
-      if (response?.chart) {
-        try {
-          const chartData = JSON.parse(response.chart);
-          setChartPayload(chartData?.data[0] || null);
-          setChartDesign({
-            ...chartData?.layout,
-            autosize: true,
-            responsive: true,
-          });
-        } catch (error) {
-          console.error("Invalid chart data format:", error);
-          setChartPayload(null);
-          setChartDesign(null);
-        }
-        setchatbotResponse(response.answer || "");
-      } else {
-        setchatbotResponse(
-          response.answer ||
-            "Unable to answer your query. Could you try again with more information?"
-        );
-        setChartPayload(null);
-      }
-
-      await params.goToPath("reply");
+      await streamResponse(params.userInput, (event) => stream.apply(event));
     } catch (error) {
       console.error("API call failed:", error);
-      setchatbotResponse(
-        "I couldn't process your request. Could you provide more details and try again?"
-      );
+      stream.fail();
     }
   }
-  
+
   const flow: Flow = {
     start: {
       message: "Hi, How can I assist you today?",
@@ -104,35 +110,7 @@ const ChatBotWrapper = () => {
       chatDisabled: false,
     },
     reply: {
-      component: (
-        <div className="rcb-bot-message rcb-bot-message-entry">
-          {chartPayload && chartDesign ? (
-            <>
-              <div className="customMarkDown">
-                <ReactMarkdown
-                  remarkPlugins={[remarkGfm]}
-                  rehypePlugins={[remarkGfm]}
-                >
-                  {chatbotResponse}
-                </ReactMarkdown>
-              </div>
-              <Visualization
-                data={[chartPayload]}
-                layout={chartDesign}
-              />
-            </>
-          ) : (
-            <div className="customMarkDown">
-              <ReactMarkdown
-                remarkPlugins={[remarkGfm]}
-                rehypePlugins={[remarkGfm]}
-              >
-                {chatbotResponse}
-              </ReactMarkdown>
-            </div>
-          )}
-        </div>
-      ),
+      component: <StreamedReply stream={answerStream} />,
       path: "loop",
       options: [],
     },
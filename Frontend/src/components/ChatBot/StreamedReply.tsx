@@ -0,0 +1,28 @@
+import { useSyncExternalStore } from "react";
+import ReactMarkdown from "react-markdown";
+import remarkGfm from "remark-gfm";
+import "./ChatBot.css";
+import Visualization from "./Visualization";
+import { AnswerStream } from "./answerStream";
+
+const StreamedReply = ({ stream }: { stream: AnswerStream }) => {
+  const { answer, status, chartPayload, chartDesign } = useSyncExternalStore(
+    stream.subscribe,
+    stream.getSnapshot
+  );
+
+  return (
+    <div className="rcb-bot-message rcb-bot-message-entry">
+      <div className="customMarkDown">
+        <ReactMarkdown remarkPlugins={[remarkGfm]} rehypePlugins={[remarkGfm]}>
+          {answer || status}
+        </ReactMarkdown>
+      </div>
+      {chartPayload && chartDesign && (
+        <Visualization data={chartPayload} layout={chartDesign} />
+      )}
+    </div>
+  );
+};
+
+export default StreamedReply;
@@ -0,0 +1,121 @@
+import { AgentApiResponse } from "../../interfaces/agentApiResponse";
+import { AgentStreamEvent } from "../../interfaces/agentStreamEvent";
+
+type ChartFields = Pick<AgentApiResponse, "chart" | "figure" | "chart_id">;
+
+export interface AnswerSnapshot {
+  answer: string;
+  status: string;
+  chartPayload: {}[] | null;
+  chartDesign: {} | null;
+}
+
+const FALLBACK_ANSWER =
+  "Unable to answer your query. Could you try again with more information?";
+
+/**
+ * Holds the state of one streamed reply and notifies subscribers whenever a
+ * server-sent event from /query/stream updates it.
+ */
+export class AnswerStream {
+  private snapshot: AnswerSnapshot = {
+    answer: "",
+    status: "Thinking...",
+    chartPayload: null,
+    chartDesign: null,
+  };
+  private listeners = new Set<() => void>();
+  private chartId: string | null = null;
+
+  subscribe = (listener: () => void) => {
+    this.listeners.add(listener);
+    return () => {
+      this.listeners.delete(listener);
+    };
+  };
+
+  getSnapshot = () => this.snapshot;
+
+  apply({ event, data }: AgentStreamEvent) {
+    switch (event) {
+      case "route":
+        this.update({ status: `Routing to ${data.question_type}...` });
+        break;
+      case "pipeline":
+        this.update({ status: "Querying the movies collection..." });
+        break;
+      case "documents":
+        this.update({
+          status: `Retrieved ${data.count} records, generating the chart...`,
+        });
+        break;
+      case "token":
+        this.update({ answer: this.snapshot.answer + data.content, status: "" });
+        break;
+      case "answer":
+        this.update({ answer: data.answer || "" });
+        break;
+      case "chart":
+        this.setChart(data);
+        break;
+      case "done":
+        if (
+          !this.snapshot.chartPayload &&
+          !(data.chart_id && data.chart_id === this.chartId)
+        ) {
+          this.setChart(data);
+        }
+        this.update({
+          answer:
+            data.answer ||
+            this.snapshot.answer ||
+            (this.snapshot.chartPayload || data.chart_id ? "" : FALLBACK_ANSWER),
+          status: "",
+        });
+        break;
+      case "error":
+        this.fail();
+        break;
+    }
+  }
+
+  fail() {
+    this.update({
+      answer:
+        "I couldn't process your request. Could you provide more details and try again?",
+      status: "",
+    });
+  }
+
+  // The chart arrives as a figure object, as a content hash to read from
+  // /charts (cached by the browser with its ETag), or as a JSON string.
+  private async setChart({ chart, figure, chart_id }: ChartFields) {
+    this.chartId = chart_id || null;
+    try {
+      if (!figure && !chart && chart_id) {
+        const response = await fetch(
+          `${import.meta.env.VITE_CHAT_API_URL}/charts/${chart_id}`
+        );
+        if (!response.ok) {
+          throw new Error(`Request failed with status ${response.status}`);
+        }
+        figure = await response.json();
+      }
+      const chartData = figure || (chart ? JSON.parse(chart) : null);
+      if (!chartData) {
+        return;
+      }
+      this.update({
+        chartPayload: chartData?.data?.length ? chartData.data : null,
+        chartDesign: { ...chartData?.layout, autosize: true, responsive: true },
+      });
+    } catch (error) {
+      console.error("Invalid chart data format:", error);
+    }
+  }
+
+  private update(changes: Partial<AnswerSnapshot>) {
+    this.snapshot = { ...this.snapshot, ...changes };
+    this.listeners.forEach((listener) => listener());
+  }
+}
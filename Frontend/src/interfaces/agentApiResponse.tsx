@@ -1,4 +1,7 @@
 export interface AgentApiResponse {
   chart: string;
+  figure?: { data?: {}[]; layout?: {} } | null;
+  chart_id?: string | null;
   answer: string;
+  session_id?: string;
 }
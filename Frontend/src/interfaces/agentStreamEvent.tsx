@@ -0,0 +1,4 @@
+export interface AgentStreamEvent {
+  event: string;
+  data: any;
+}